@@ -0,0 +1,20 @@
+#
+# An ASGI module for deploying the viewer on the web (e.g. by
+# `uvicorn git_branch_viewer_asgi:application`).
+#
+# Copyright: (c) 2014 by Petr Zemek <s3rvac@gmail.com> and contributors
+# License: BSD, see LICENSE for more details
+#
+
+from viewer.web import app
+from viewer.web.asgi import application # noqa
+from viewer.web.views import get_indexer
+from viewer.web.views import get_repo
+
+# Verify the repository when the application starts rather than on the first
+# request.
+get_repo()
+
+# Start obtaining data about branches before the first request comes.
+if app.config['BACKGROUND_INDEXER']:
+    get_indexer()
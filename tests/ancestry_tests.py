@@ -0,0 +1,240 @@
+"""
+    tests.ancestry
+    ~~~~~~~~~~~~~~
+
+    Tests for the viewer.ancestry module and its usage in viewer.git.
+
+    :copyright: © 2014 by Petr Zemek <s3rvac@gmail.com> and contributors
+    :license: BSD, see LICENSE for more details
+"""
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from tests.commitgraph_tests import commit
+from tests.commitgraph_tests import generate_history
+from tests.commitgraph_tests import rev_parse
+from tests.objects_tests import run_git
+from viewer.ancestry import AncestryIndex
+from viewer.ancestry import AncestryIndexError
+from viewer.git import Branch
+from viewer.git import Repo
+from viewer.git import deadline
+from viewer.git import results_cache
+
+
+HASH1 = 'c8f6cf0b0fa9c0e3b4a2f1e06e5f4b9b2b6b0c11'
+HASH2 = '0f1e2d3c4b5a69788796a5b4c3d2e1f0a1b2c3d4'
+HASH3 = 'a' * 40
+
+
+class AncestryIndexTests(unittest.TestCase):
+    """Tests for the AncestryIndex class."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, 'subdir', 'index')
+
+    def test_tip_returns_correct_value(self):
+        index = AncestryIndex(HASH1, [HASH1])
+        self.assertEqual(index.tip, HASH1)
+
+    def test_contains_returns_true_for_hashes_in_index(self):
+        index = AncestryIndex(HASH1, [HASH1, HASH2])
+        self.assertIn(HASH1, index)
+        self.assertIn(HASH2, index)
+
+    def test_contains_returns_false_for_hashes_not_in_index(self):
+        index = AncestryIndex(HASH1, [HASH1])
+        self.assertNotIn(HASH2, index)
+
+    def test_contains_returns_false_for_invalid_hash(self):
+        index = AncestryIndex(HASH1, [HASH1])
+        self.assertNotIn('xyz', index)
+
+    def test_extended_returns_new_index_with_all_hashes(self):
+        index = AncestryIndex(HASH1, [HASH1])
+        extended_index = index.extended(HASH2, [HASH2])
+        self.assertEqual(extended_index.tip, HASH2)
+        self.assertEqual(len(extended_index), 2)
+        self.assertEqual(len(index), 1)
+
+    def test_saved_index_can_be_loaded(self):
+        AncestryIndex(HASH2, [HASH1, HASH2, HASH3]).save(self.path)
+        index = AncestryIndex.load(self.path)
+        self.assertEqual(index.tip, HASH2)
+        self.assertEqual(len(index), 3)
+        self.assertIn(HASH3, index)
+
+    def test_save_replaces_existing_index(self):
+        AncestryIndex(HASH1, [HASH1]).save(self.path)
+        AncestryIndex(HASH2, [HASH2]).save(self.path)
+        self.assertEqual(AncestryIndex.load(self.path).tip, HASH2)
+        self.assertEqual(os.listdir(os.path.dirname(self.path)), ['index'])
+
+    def test_load_raises_exception_for_nonexisting_file(self):
+        with self.assertRaises(FileNotFoundError):
+            AncestryIndex.load(self.path)
+
+    def test_load_raises_exception_for_corrupted_file(self):
+        AncestryIndex(HASH1, [HASH1, HASH2]).save(self.path)
+        with open(self.path, 'r+b') as f:
+            f.seek(40)
+            f.write(b'\0')
+        with self.assertRaises(AncestryIndexError):
+            AncestryIndex.load(self.path)
+
+    def test_load_raises_exception_for_truncated_file(self):
+        AncestryIndex(HASH1, [HASH1, HASH2]).save(self.path)
+        with open(self.path, 'r+b') as f:
+            f.truncate(50)
+        with self.assertRaises(AncestryIndexError):
+            AncestryIndex.load(self.path)
+
+
+@unittest.skipUnless(shutil.which('git'), 'requires git')
+class RepoAncestryIndexTests(unittest.TestCase):
+    """Tests of the usage of ancestry indexes in Repo."""
+
+    def setUp(self):
+        self.repo_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.repo_path)
+        generate_history(self.repo_path)
+        results_cache.clear()
+        self.repo = Repo(self.repo_path, master_ancestry_index=True)
+
+    def get_branch(self, name, repo=None):
+        return Branch(repo or self.repo, 'origin', name, commit=mock.Mock(
+            hash=rev_parse(self.repo_path, name)))
+
+    def get_all_hashes(self, rev):
+        return run_git(self.repo_path, 'rev-list', rev).decode().split()
+
+    def test_index_contains_all_commits_in_branch(self):
+        index = self.repo.get_ancestry_index(self.get_branch('master'))
+        self.assertEqual(index.tip, rev_parse(self.repo_path, 'master'))
+        self.assertEqual(len(index), len(self.get_all_hashes('master')))
+
+    def test_index_is_none_when_repo_does_not_keep_indexes(self):
+        repo = Repo(self.repo_path)
+        self.assertIsNone(repo.get_ancestry_index(self.get_branch('master')))
+
+    def test_index_is_updated_incrementally_when_branch_moves_forward(self):
+        self.repo.get_ancestry_index(self.get_branch('master'))
+        old_tip = rev_parse(self.repo_path, 'master')
+        new_tip = commit(self.repo_path, 'new')
+        with mock.patch.object(self.repo, 'stream_git_cmd',
+                               wraps=self.repo.stream_git_cmd) as stream_cmd:
+            index = self.repo.get_ancestry_index(self.get_branch('master'))
+        stream_cmd.assert_called_once_with(
+            ['rev-list', new_tip, '--not', old_tip])
+        self.assertIn(new_tip, index)
+        self.assertEqual(len(index), len(self.get_all_hashes('master')))
+
+    def test_index_is_rebuilt_when_branch_is_rewritten(self):
+        self.repo.get_ancestry_index(self.get_branch('master'))
+        old_tip = rev_parse(self.repo_path, 'master')
+        run_git(self.repo_path, 'reset', '--quiet', '--hard', 'master~2')
+        new_tip = commit(self.repo_path, 'rewritten')
+        index = self.repo.get_ancestry_index(self.get_branch('master'))
+        self.assertIn(new_tip, index)
+        self.assertNotIn(old_tip, index)
+        self.assertEqual(len(index), len(self.get_all_hashes('master')))
+
+    def test_index_is_built_in_background_without_deadline_of_request(self):
+        master = self.get_branch('master')
+        # The deadline has already passed, so no Git command could be run
+        # with it.
+        with deadline(time.monotonic() - 1):
+            self.assertIsNone(self.repo.get_ancestry_index(master))
+            self.repo._ancestry_updates[master.full_name].join(5)
+            index = self.repo.get_ancestry_index(master)
+        self.assertEqual(index.tip, rev_parse(self.repo_path, 'master'))
+        self.assertEqual(len(index), len(self.get_all_hashes('master')))
+
+    def test_results_with_deadline_are_same_while_index_is_being_built(self):
+        master = self.get_branch('master')
+        branches = [self.get_branch(name)
+                    for name in ('feature0', 'feature1', 'feature3')]
+        expected_counts = Repo(self.repo_path).get_unmerged_commit_counts(
+            master, branches)
+        results_cache.clear()
+        with mock.patch.object(self.repo,
+                               '_update_ancestry_index_in_background'):
+            with deadline(time.monotonic() + 60):
+                counts = self.repo.get_unmerged_commit_counts(master, branches)
+        self.assertEqual(counts, expected_counts)
+
+    def test_index_is_loaded_from_disk_by_new_repo(self):
+        self.repo.get_ancestry_index(self.get_branch('master'))
+        repo = Repo(self.repo_path, master_ancestry_index=True)
+        with mock.patch.object(repo, 'stream_git_cmd') as stream_cmd:
+            index = repo.get_ancestry_index(self.get_branch('master', repo))
+        self.assertFalse(stream_cmd.called)
+        self.assertEqual(len(index), len(self.get_all_hashes('master')))
+
+    def test_index_is_kept_in_memory_when_it_cannot_be_saved(self):
+        with mock.patch('viewer.git.AncestryIndex.save',
+                        side_effect=PermissionError):
+            index = self.repo.get_ancestry_index(self.get_branch('master'))
+        self.assertIs(
+            self.repo.get_ancestry_index(self.get_branch('master')), index)
+
+    def test_results_are_same_as_without_index(self):
+        master = self.get_branch('master')
+        branches = [self.get_branch(name)
+                    for name in ('feature0', 'feature1', 'feature3')]
+        repo = Repo(self.repo_path)
+
+        def get_results(repo):
+            results_cache.clear()
+            return (
+                repo.get_unmerged_commit_counts(master, branches),
+                [repo.has_unmerged_commits(master, b) for b in branches],
+                [repo.get_num_of_unmerged_commits(master, b) for b in branches],
+                [repo.get_unmerged_commits(master, b) for b in branches]
+            )
+
+        self.assertEqual(get_results(self.repo), get_results(repo))
+
+    def test_results_with_commit_graph_are_same_as_without_index(self):
+        run_git(self.repo_path, 'commit-graph', 'write', '--reachable')
+        self.test_results_are_same_as_without_index()
+
+    def test_unmerged_commit_counts_are_counted_by_single_walk(self):
+        master = self.get_branch('master')
+        branches = [self.get_branch(name)
+                    for name in ('feature0', 'feature1', 'feature3')]
+        self.repo.get_ancestry_index(master)
+        with mock.patch.object(self.repo, 'stream_git_cmd',
+                               wraps=self.repo.stream_git_cmd) as stream_cmd:
+            counts = self.repo.get_unmerged_commit_counts(master, branches)
+        self.assertEqual(stream_cmd.call_count, 1)
+        self.assertEqual(counts['origin/feature0'].ahead, 0)
+
+    def test_unmerged_commit_counts_are_counted_by_commit_graph(self):
+        run_git(self.repo_path, 'commit-graph', 'write', '--reachable')
+        master = self.get_branch('master')
+        branches = [self.get_branch(name)
+                    for name in ('feature0', 'feature1', 'feature3')]
+        self.repo.get_ancestry_index(master)
+        with mock.patch.object(self.repo, 'stream_git_cmd') as stream_cmd, \
+                mock.patch.object(self.repo, 'run_git_cmd') as run_git_cmd:
+            self.repo.get_unmerged_commit_counts(master, branches)
+        self.assertFalse(stream_cmd.called)
+        self.assertFalse(run_git_cmd.called)
+
+    def test_has_unmerged_commits_runs_no_command_once_index_is_built(self):
+        master = self.get_branch('master')
+        self.repo.get_ancestry_index(master)
+        with mock.patch.object(self.repo, 'run_git_cmd') as run_git_cmd:
+            self.assertFalse(self.repo.has_unmerged_commits(
+                master, self.get_branch('feature0')))
+            self.assertTrue(self.repo.has_unmerged_commits(
+                master, self.get_branch('feature3')))
+        self.assertFalse(run_git_cmd.called)
@@ -0,0 +1,257 @@
+"""
+    tests.commitgraph
+    ~~~~~~~~~~~~~~~~~
+
+    Tests for the viewer.commitgraph module.
+
+    The tests generate Git repositories with commit-graph files and compare
+    the results of walks over the graph with the results obtained from Git.
+
+    :copyright: © 2014 by Petr Zemek <s3rvac@gmail.com> and contributors
+    :license: BSD, see LICENSE for more details
+"""
+
+import itertools
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+from unittest import mock
+
+from tests.objects_tests import run_git
+from viewer.commitgraph import CommitGraphError
+from viewer.commitgraph import CommitGraphReader
+from viewer.commitgraph import load_commit_graph
+from viewer.git import Branch
+from viewer.git import Repo
+from viewer.git import results_cache
+
+
+def commit(repo_path, message):
+    """Creates an empty commit with the given message and returns its hash."""
+    run_git(repo_path, 'commit', '--quiet', '--allow-empty',
+            '--message={}'.format(message))
+    return rev_parse(repo_path, 'HEAD')
+
+
+def rev_parse(repo_path, rev):
+    """Returns the hash of the given revision."""
+    return run_git(repo_path, 'rev-parse', rev).decode().strip()
+
+
+def generate_history(repo_path):
+    """Generates a history with diverged branches, merges, and an octopus
+    merge, and returns hashes of all commits.
+    """
+    run_git(repo_path, 'init', '--quiet')
+    for i in range(20):
+        commit(repo_path, 'master {}'.format(i))
+    run_git(repo_path, 'branch', '-M', 'master')
+    for i in range(3):
+        run_git(repo_path, 'checkout', '--quiet', '-b', 'feature{}'.format(i),
+                'master~{}'.format(i * 5 + 2))
+        for j in range(i + 3):
+            commit(repo_path, 'feature {} {}'.format(i, j))
+    run_git(repo_path, 'checkout', '--quiet', 'master')
+    run_git(repo_path, 'merge', '--quiet', '--no-ff', '--message=merge',
+            'feature0')
+    commit(repo_path, 'after merge')
+    run_git(repo_path, 'merge', '--quiet', '--no-ff', '--message=octopus',
+            'feature1', 'feature2')
+    run_git(repo_path, 'checkout', '--quiet', '-b', 'feature3', 'master~3')
+    for i in range(4):
+        commit(repo_path, 'feature 3 {}'.format(i))
+    run_git(repo_path, 'checkout', '--quiet', 'master')
+    return run_git(repo_path, 'rev-list', '--all').decode().split()
+
+
+def write_split_commit_graph(repo_path):
+    """Writes a commit-graph chain with more layers."""
+    run_git(repo_path, 'commit-graph', 'write', '--reachable', '--split')
+    commit(repo_path, 'master after split')
+    run_git(repo_path, 'checkout', '--quiet', '-b', 'feature4', 'master~4')
+    commit(repo_path, 'feature 4')
+    run_git(repo_path, 'checkout', '--quiet', 'master')
+    run_git(repo_path, 'commit-graph', 'write', '--reachable',
+            '--split=no-merge')
+
+
+@unittest.skipUnless(shutil.which('git'), 'requires git')
+class CommitGraphDifferentialTests(unittest.TestCase):
+    """Differential tests comparing walks over commit graphs with Git."""
+
+    def setUp(self):
+        self.repo_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.repo_path)
+        generate_history(self.repo_path)
+        self.objects_dir = os.path.join(self.repo_path, '.git', 'objects')
+
+    def get_all_hashes(self):
+        return run_git(self.repo_path, 'rev-list', '--all').decode().split()
+
+    def get_all_hashes_in(self, rev):
+        return run_git(self.repo_path, 'rev-list', rev).decode().split()
+
+    def is_ancestor_by_git(self, ancestor, descendant):
+        try:
+            run_git(self.repo_path, 'merge-base', '--is-ancestor',
+                    ancestor, descendant)
+        except subprocess.CalledProcessError:
+            return False
+        return True
+
+    def count_unmerged_by_git(self, master, other):
+        return int(run_git(
+            self.repo_path, 'rev-list', '--count', '{}..{}'.format(master, other)
+        ))
+
+    def assert_walks_are_same_as_by_git(self):
+        graph = load_commit_graph(self.objects_dir)
+        hashes = self.get_all_hashes()
+        self.assertEqual(len(graph), len(hashes))
+        # Use only some pairs to keep the number of Git calls reasonable.
+        for a, b in itertools.islice(itertools.product(hashes, repeat=2),
+                                     0, None, 7):
+            self.assertEqual(
+                graph.is_ancestor(a, b),
+                self.is_ancestor_by_git(a, b),
+                (a, b)
+            )
+            self.assertEqual(
+                graph.count_unmerged(a, b),
+                self.count_unmerged_by_git(a, b),
+                (a, b)
+            )
+
+    def test_count_reachable_stops_at_excluded_commits(self):
+        run_git(self.repo_path, 'commit-graph', 'write', '--reachable')
+        graph = load_commit_graph(self.objects_dir)
+        master = rev_parse(self.repo_path, 'master')
+        in_master = set(self.get_all_hashes_in(master))
+        for hash in self.get_all_hashes():
+            self.assertEqual(
+                graph.count_reachable(hash, in_master.__contains__),
+                self.count_unmerged_by_git(master, hash),
+                hash
+            )
+
+    def test_walks_over_single_commit_graph_are_same_as_by_git(self):
+        run_git(self.repo_path, 'commit-graph', 'write', '--reachable')
+        self.assert_walks_are_same_as_by_git()
+
+    def test_walks_over_split_commit_graph_are_same_as_by_git(self):
+        write_split_commit_graph(self.repo_path)
+        graph = load_commit_graph(self.objects_dir)
+        self.assertEqual(len(graph.layers), 2)
+        self.assert_walks_are_same_as_by_git()
+
+    def test_single_commit_graph_is_preferred_to_chain_like_in_git(self):
+        run_git(self.repo_path, 'commit-graph', 'write', '--reachable')
+        single_graph_path = os.path.join(
+            self.objects_dir, 'info', 'commit-graph'
+        )
+        with open(single_graph_path, 'rb') as f:
+            single_graph = f.read()
+        os.remove(single_graph_path)
+        write_split_commit_graph(self.repo_path)
+        with open(single_graph_path, 'wb') as f:
+            f.write(single_graph)
+
+        graph = load_commit_graph(self.objects_dir)
+
+        self.assertEqual(len(graph.layers), 1)
+        self.assertNotIn(rev_parse(self.repo_path, 'feature4'), graph)
+
+    def test_load_commit_graph_returns_none_when_there_is_no_graph(self):
+        self.assertIsNone(load_commit_graph(self.objects_dir))
+
+    def test_commit_not_in_graph_results_in_none(self):
+        run_git(self.repo_path, 'commit-graph', 'write', '--reachable')
+        master = rev_parse(self.repo_path, 'master')
+        new = commit(self.repo_path, 'not in graph')
+        graph = load_commit_graph(self.objects_dir)
+        self.assertNotIn(new, graph)
+        self.assertIsNone(graph.is_ancestor(master, new))
+        self.assertIsNone(graph.count_unmerged(master, new))
+        self.assertIsNone(graph.count_reachable(new, lambda hash: False))
+
+    def test_exception_is_raised_for_file_in_unsupported_format(self):
+        info_dir = os.path.join(self.objects_dir, 'info')
+        os.makedirs(info_dir, exist_ok=True)
+        with open(os.path.join(info_dir, 'commit-graph'), 'wb') as f:
+            f.write(b'XXXX\x01\x01\x00\x00')
+        with self.assertRaises(CommitGraphError):
+            load_commit_graph(self.objects_dir)
+
+    def test_reader_reloads_graph_when_it_is_rewritten(self):
+        reader = CommitGraphReader(self.objects_dir)
+        self.assertIsNone(reader.get_graph())
+        run_git(self.repo_path, 'commit-graph', 'write', '--reachable')
+        graph = reader.get_graph()
+        self.assertIsNotNone(graph)
+        self.assertIs(reader.get_graph(), graph)
+        new = commit(self.repo_path, 'new')
+        run_git(self.repo_path, 'commit-graph', 'write', '--reachable')
+        self.assertIn(new, reader.get_graph())
+
+    def test_reader_returns_none_for_file_in_unsupported_format(self):
+        info_dir = os.path.join(self.objects_dir, 'info')
+        os.makedirs(info_dir, exist_ok=True)
+        with open(os.path.join(info_dir, 'commit-graph'), 'wb') as f:
+            f.write(b'garbage')
+        self.assertIsNone(CommitGraphReader(self.objects_dir).get_graph())
+
+
+@unittest.skipUnless(shutil.which('git'), 'requires git')
+class RepoCommitGraphTests(unittest.TestCase):
+    """Tests of the usage of commit graphs in Repo."""
+
+    def setUp(self):
+        self.repo_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.repo_path)
+        generate_history(self.repo_path)
+        results_cache.clear()
+        self.repo = Repo(self.repo_path)
+        self.master = Branch(self.repo, 'origin', 'master', commit=mock.Mock(
+            hash=rev_parse(self.repo_path, 'master')))
+        self.branches = [
+            Branch(self.repo, 'origin', name, commit=mock.Mock(
+                hash=rev_parse(self.repo_path, name)))
+            for name in ('feature0', 'feature1', 'feature3')
+        ]
+
+    def get_counts(self):
+        return self.repo.get_unmerged_commit_counts(
+            self.master, self.branches, include_behind=True
+        )
+
+    def test_counts_with_and_without_commit_graph_are_same(self):
+        counts_by_git = self.get_counts()
+        results_cache.clear()
+        run_git(self.repo_path, 'commit-graph', 'write', '--reachable')
+        with mock.patch.object(self.repo, 'run_git_cmd') as run_git_cmd, \
+                mock.patch.object(self.repo, 'stream_git_cmd') as stream_cmd:
+            counts_from_graph = self.get_counts()
+            has_unmerged_commits = [
+                self.repo.has_unmerged_commits(self.master, branch)
+                for branch in self.branches
+            ]
+        self.assertEqual(counts_from_graph, counts_by_git)
+        self.assertEqual(has_unmerged_commits, [False, False, True])
+        self.assertFalse(run_git_cmd.called)
+        self.assertFalse(stream_cmd.called)
+
+    def test_commit_graph_is_not_used_in_shallow_repositories(self):
+        run_git(self.repo_path, 'commit-graph', 'write', '--reachable')
+        open(os.path.join(self.repo_path, '.git', 'shallow'), 'w').close()
+        with mock.patch('viewer.git.CommitGraphReader.get_graph') as get_graph:
+            self.repo.has_unmerged_commits(self.master, self.branches[0])
+        self.assertFalse(get_graph.called)
+
+    def test_commit_graph_is_not_used_with_replaced_objects(self):
+        run_git(self.repo_path, 'commit-graph', 'write', '--reachable')
+        run_git(self.repo_path, 'replace', 'feature0', 'master')
+        with mock.patch('viewer.git.CommitGraphReader.get_graph') as get_graph:
+            self.repo.has_unmerged_commits(self.master, self.branches[0])
+        self.assertFalse(get_graph.called)
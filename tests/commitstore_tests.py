@@ -0,0 +1,245 @@
+"""
+    tests.commitstore
+    ~~~~~~~~~~~~~~~~~
+
+    Tests for the viewer.commitstore module and its usage in viewer.git.
+
+    :copyright: © 2014 by Petr Zemek <s3rvac@gmail.com> and contributors
+    :license: BSD, see LICENSE for more details
+"""
+
+import asyncio
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+
+from tests.commitgraph_tests import generate_history
+from tests.commitgraph_tests import rev_parse
+from tests.objects_tests import run_git
+from viewer.commitstore import CommitStore
+from viewer.commitstore import CommitStoreError
+from viewer.git import AsyncRepo
+from viewer.git import Repo
+from viewer.git import results_cache
+
+
+HASH1 = 'c8f6cf0b0fa9c0e3b4a2f1e06e5f4b9b2b6b0c11'
+HASH2 = '0f1e2d3c4b5a69788796a5b4c3d2e1f0a1b2c3d4'
+HASH3 = 'a' * 40
+
+DATA1 = ('Petr Zemek', 's3rvac@gmail.com', 1420070400, 'Subject 1')
+DATA2 = ('Other Author', 'other@example.com', 1420156800, 'Subject 2')
+DATA3 = ('Third Author', 'third@example.com', 1420243200, 'Subject 3')
+
+
+class CommitStoreTests(unittest.TestCase):
+    """Tests for the CommitStore class."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, 'subdir', 'commits.sqlite3')
+        self.store = CommitStore(self.path)
+        self.addCleanup(self.store.close)
+
+    def test_get_returns_none_for_commit_not_in_store(self):
+        self.assertIsNone(self.store.get(HASH1))
+
+    def test_get_returns_stored_data(self):
+        self.store.put(HASH1, DATA1)
+        self.assertEqual(self.store.get(HASH1), DATA1)
+
+    def test_get_many_returns_only_stored_commits(self):
+        self.store.put_many({HASH1: DATA1, HASH2: DATA2})
+        self.assertEqual(
+            self.store.get_many([HASH1, HASH2, HASH3]),
+            {HASH1: DATA1, HASH2: DATA2}
+        )
+
+    def test_get_many_looks_up_more_hashes_than_fit_into_single_query(self):
+        hashes = ['{:040x}'.format(i)
+                  for i in range(CommitStore.MAX_HASHES_PER_QUERY + 10)]
+        self.store.put_many({hash: DATA1 for hash in hashes})
+        self.assertEqual(len(self.store.get_many(hashes)), len(hashes))
+
+    def test_put_does_not_change_stored_commit(self):
+        self.store.put(HASH1, DATA1)
+        self.store.put(HASH1, DATA2)
+        self.assertEqual(self.store.get(HASH1), DATA1)
+
+    def test_oldest_commits_are_removed_when_store_is_full(self):
+        store = CommitStore(self.path, max_entries=2)
+        self.addCleanup(store.close)
+        store.put(HASH1, DATA1)
+        store.put(HASH2, DATA2)
+        store.put(HASH3, DATA3)
+        self.assertEqual(store.get_many([HASH1, HASH2, HASH3]),
+                         {HASH2: DATA2, HASH3: DATA3})
+
+    def test_stored_commits_are_visible_to_other_store_with_same_path(self):
+        self.store.put(HASH1, DATA1)
+        store = CommitStore(self.path)
+        self.addCleanup(store.close)
+        self.assertEqual(store.get(HASH1), DATA1)
+
+    def test_store_is_reopened_in_forked_process(self):
+        self.store.put(HASH1, DATA1)
+        with mock.patch('sqlite3.connect', wraps=sqlite3.connect) as connect, \
+                mock.patch('os.getpid', return_value=os.getpid() + 1):
+            self.assertEqual(self.store.get(HASH1), DATA1)
+        connect.assert_called_once_with(mock.ANY, timeout=5,
+                                        check_same_thread=False)
+
+    def test_store_uses_wal_mode(self):
+        self.store.put(HASH1, DATA1)
+        self.assertTrue(os.path.exists(self.path + '-wal'))
+
+    def test_stats_returns_number_of_entries_hits_and_misses(self):
+        self.store.put(HASH1, DATA1)
+        self.store.get_many([HASH1, HASH2])
+        stats = self.store.stats()
+        self.assertEqual(stats['entries'], 1)
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+
+    def test_stats_do_not_contain_path_to_store(self):
+        self.assertNotIn(self.dir, repr(self.store.stats()))
+
+    def test_get_raises_exception_when_store_cannot_be_opened(self):
+        store = CommitStore(os.path.join(self.dir, 'subdir'))
+        os.makedirs(os.path.join(self.dir, 'subdir'), exist_ok=True)
+        with self.assertRaises(CommitStoreError):
+            store.get(HASH1)
+
+    def test_get_raises_exception_for_unsupported_version(self):
+        self.store.put(HASH1, DATA1)
+        self.store.close()
+        with mock.patch.object(CommitStore, 'VERSION', 2):
+            with self.assertRaises(CommitStoreError):
+                self.store.get(HASH1)
+
+    def test_repr_returns_correct_representation(self):
+        self.assertEqual(repr(self.store),
+                         'CommitStore({!r})'.format(self.path))
+
+
+class RepoCommitStoreTests(unittest.TestCase):
+    """Tests of the usage of the commit store in Repo."""
+
+    def setUp(self):
+        self.repo_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.repo_path)
+        generate_history(self.repo_path)
+        results_cache.clear()
+        self.addCleanup(results_cache.clear)
+        self.repo = self.create_repo()
+        self.hashes = [rev_parse(self.repo_path, name)
+                       for name in ('master', 'feature0', 'feature3')]
+        for name in ('master', 'feature0', 'feature3'):
+            run_git(self.repo_path, 'update-ref',
+                    'refs/remotes/origin/{}'.format(name), name)
+
+    def get_branches_and_unmerged_commits(self, repo):
+        branches = repo.load_branches('origin')
+        master = branches[[b.name for b in branches].index('master')]
+        return branches, [repo.get_unmerged_commits(master, branch)
+                          for branch in branches]
+
+    def create_repo(self):
+        repo = Repo(self.repo_path, commit_store_size=100)
+        self.addCleanup(repo.commit_store.close)
+        return repo
+
+    def test_commit_store_is_none_when_repo_does_not_keep_it(self):
+        self.assertIsNone(Repo(self.repo_path).commit_store)
+
+    def test_commit_store_is_in_git_directory(self):
+        self.assertEqual(
+            self.repo.commit_store.path,
+            os.path.join(self.repo.git_dir, 'branch-viewer', 'commits.sqlite3')
+        )
+
+    def test_commit_from_hash_is_put_into_store(self):
+        commit = self.repo.get_commit_from_hash(self.hashes[0])
+        self.assertEqual(
+            self.repo.commit_store.get(commit.hash),
+            (commit.author, commit.email, int(commit.date.timestamp()),
+             commit.subject)
+        )
+
+    def test_new_repo_reads_commits_from_store(self):
+        commits = self.repo.get_commits_from_hashes(self.hashes)
+        results_cache.clear()
+        repo = self.create_repo()
+        with mock.patch.object(repo, '_read_commit_object') as read_commit:
+            self.assertEqual(repo.get_commits_from_hashes(self.hashes),
+                             commits)
+        self.assertFalse(read_commit.called)
+
+    def test_commits_from_store_are_same_as_without_store(self):
+        self.repo.get_commits_from_hashes(self.hashes)
+        results_cache.clear()
+        stored_commits = self.create_repo().get_commits_from_hashes(self.hashes)
+        results_cache.clear()
+        self.assertEqual(
+            stored_commits,
+            Repo(self.repo_path).get_commits_from_hashes(self.hashes)
+        )
+
+    def test_get_commits_from_hashes_returns_commits_in_order_of_hashes(self):
+        hashes = [self.hashes[2], self.hashes[0], self.hashes[2]]
+        commits = self.repo.get_commits_from_hashes(hashes)
+        self.assertEqual([commit.hash for commit in commits], hashes)
+
+    def test_commits_are_read_from_repo_when_store_cannot_be_used(self):
+        with mock.patch.object(self.repo.commit_store, 'get_many',
+                               side_effect=CommitStoreError('locked')), \
+                mock.patch.object(self.repo.commit_store, 'put_many',
+                                  side_effect=CommitStoreError('read-only')):
+            commit = self.repo.get_commit_from_hash(self.hashes[0])
+        self.assertEqual(commit.hash, self.hashes[0])
+
+    def test_branches_and_unmerged_commits_are_same_as_without_store(self):
+        results = self.get_branches_and_unmerged_commits(self.repo)
+        results_cache.clear()
+        self.assertEqual(
+            self.get_branches_and_unmerged_commits(Repo(self.repo_path)),
+            results
+        )
+
+    def test_commits_of_branches_and_unmerged_commits_are_put_into_store(self):
+        branches, unmerged_commits = \
+            self.get_branches_and_unmerged_commits(self.repo)
+        for commit in ([branch.commit for branch in branches] +
+                       [c for commits in unmerged_commits for c in commits]):
+            self.assertIsNotNone(self.repo.commit_store.get(commit.hash))
+
+    def test_new_repo_reads_commits_of_branches_from_store(self):
+        results = self.get_branches_and_unmerged_commits(self.repo)
+        results_cache.clear()
+        repo = self.create_repo()
+        with mock.patch.object(repo, '_read_commit_object') as read_commit:
+            self.assertEqual(self.get_branches_and_unmerged_commits(repo),
+                             results)
+        self.assertFalse(read_commit.called)
+        self.assertGreater(repo.commit_store.stats()['hits'], 0)
+
+    def test_async_repo_obtains_same_commits_from_store(self):
+        branches, unmerged_commits = \
+            self.get_branches_and_unmerged_commits(self.repo)
+        results_cache.clear()
+        async_repo = AsyncRepo(self.create_repo())
+
+        async def get_results():
+            # The branches are feature0, feature3, and master.
+            branches = await async_repo.load_branches('origin')
+            return branches, await async_repo.get_unmerged_commits(
+                branches[2], branches[1])
+        async_branches, async_unmerged_commits = asyncio.run(get_results())
+        self.assertEqual(async_branches, branches)
+        self.assertEqual([b.commit for b in async_branches],
+                         [b.commit for b in branches])
+        self.assertEqual(async_unmerged_commits, unmerged_commits[1])
@@ -9,19 +9,41 @@
 """
 
 # Cannot use `from datetime import datetime` because of eval() in `repr` tests.
+import asyncio
 import datetime
+import io
+import operator
 import os
 import random
+import shutil
 import subprocess
+import tempfile
+import threading
+import time
 import unittest
 from unittest import mock
 
+from tests.commitgraph_tests import generate_history
+from tests.commitgraph_tests import rev_parse
+from tests.objects_tests import run_git
+from viewer.commitgraph import CommitGraph
+from viewer.git import AsyncRepo
 from viewer.git import Branch
+from viewer.git import CatFileBatch
+from viewer.git import CommitCounts
 from viewer.git import Commit
 from viewer.git import GitBinaryNotFoundError
 from viewer.git import GitCmdError
+from viewer.git import GitDeadlineExceededError
+from viewer.git import GitProcessLimitExceededError
 from viewer.git import Repo
+from viewer.git import RequestCache
+from viewer.git import results_cache
+from viewer.git import deadline
+from viewer.git import get_deadline
 from viewer.git import sort_branches
+from viewer.refs import RefReader
+from viewer.utils import ConcurrencyLimiter
 
 
 def get_curr_date():
@@ -266,6 +288,83 @@ class BranchCommitTests(unittest.TestCase):
         self.assertEqual(branch.commit, expected_commit)
         repo_mock.get_commit_for_branch.assert_called_once_with(branch)
 
+    def test_get_commit_returns_commit_passed_into_constructor(self):
+        repo_mock = get_git_repo_mock()
+        commit = get_new_commit()
+        branch = Branch(repo_mock, 'origin', 'featureX', commit)
+        self.assertEqual(branch.commit, commit)
+        self.assertFalse(repo_mock.get_commit_for_branch.called)
+
+
+class RequestCacheTests(unittest.TestCase):
+    """Tests for RequestCache."""
+
+    def setUp(self):
+        self.cache = RequestCache()
+
+    def test_computes_value_when_not_cached(self):
+        self.assertEqual(self.cache.get_or_compute('key', lambda: 1), 1)
+
+    def test_returns_cached_value_without_computing_it_again(self):
+        self.cache.get_or_compute('key', lambda: 1)
+        compute = mock.Mock(return_value=2)
+        self.assertEqual(self.cache.get_or_compute('key', compute), 1)
+        self.assertFalse(compute.called)
+
+    def test_values_with_different_keys_are_cached_separately(self):
+        self.cache.get_or_compute('key1', lambda: 1)
+        self.assertEqual(self.cache.get_or_compute('key2', lambda: 2), 2)
+        self.assertEqual(len(self.cache), 2)
+
+
+class BranchCachingTests(unittest.TestCase):
+    """Tests for memoization of values in branches with a cache."""
+
+    def setUp(self):
+        self.repo_mock = get_git_repo_mock()
+        self.cache = RequestCache()
+        self.branch = Branch(self.repo_mock, 'origin', 'featureX',
+                             cache=self.cache)
+        self.master_branch = Branch(self.repo_mock, 'origin', 'master')
+
+    def test_commit_is_obtained_only_once(self):
+        self.repo_mock.get_commit_for_branch.return_value = get_new_commit()
+        self.branch.commit
+        self.branch.age
+        self.assertEqual(self.repo_mock.get_commit_for_branch.call_count, 1)
+
+    def test_commit_is_shared_by_branches_with_same_cache(self):
+        self.repo_mock.get_commit_for_branch.return_value = get_new_commit()
+        self.branch.commit
+        Branch(self.repo_mock, 'origin', 'featureX', cache=self.cache).commit
+        self.assertEqual(self.repo_mock.get_commit_for_branch.call_count, 1)
+
+    def test_has_unmerged_commits_is_obtained_only_once(self):
+        self.repo_mock.has_unmerged_commits.return_value = True
+        self.branch.has_unmerged_commits(self.master_branch)
+        self.branch.has_unmerged_commits(self.master_branch)
+        self.assertEqual(self.repo_mock.has_unmerged_commits.call_count, 1)
+
+    def test_num_of_unmerged_commits_is_obtained_only_once(self):
+        self.repo_mock.get_num_of_unmerged_commits.return_value = 5
+        self.branch.num_of_unmerged_commits(self.master_branch)
+        self.branch.has_more_unmerged_commits_than(self.master_branch, 3)
+        self.assertEqual(
+            self.repo_mock.get_num_of_unmerged_commits.call_count, 1)
+
+    def test_unmerged_commits_are_cached_separately_for_each_limit(self):
+        self.repo_mock.get_unmerged_commits.return_value = []
+        self.branch.unmerged_commits(self.master_branch, 5)
+        self.branch.unmerged_commits(self.master_branch, 5)
+        self.branch.unmerged_commits(self.master_branch, 10)
+        self.assertEqual(self.repo_mock.get_unmerged_commits.call_count, 2)
+
+    def test_values_are_not_memoized_without_cache(self):
+        self.repo_mock.get_commit_for_branch.return_value = get_new_commit()
+        self.master_branch.commit
+        self.master_branch.commit
+        self.assertEqual(self.repo_mock.get_commit_for_branch.call_count, 2)
+
 
 class BranchFullNameTests(unittest.TestCase):
     """Tests for Branch.full_name."""
@@ -396,29 +495,40 @@ class RepoTests(unittest.TestCase):
     """A base class for all Repo tests."""
 
     def setUp(self):
-        # Patch os.chdir.
-        patcher = mock.patch('os.chdir')
+        # Patch os.path.isdir (the repositories used in tests do not exist).
+        patcher = mock.patch('os.path.isdir', return_value=True)
         self.addCleanup(patcher.stop)
-        self.mock_chdir = patcher.start()
+        self.mock_isdir = patcher.start()
 
         # Patch subprocess.check_output.
         patcher = mock.patch('subprocess.check_output')
         self.addCleanup(patcher.stop)
         self.mock_check_output = patcher.start()
+        self.mock_check_output.return_value = '.git\n'
+
+        # Do not reuse results from other tests.
+        results_cache.clear()
+        self.addCleanup(results_cache.clear)
 
 
 class RepoCreateTests(RepoTests):
     """Tests for Repo.__init__()."""
 
-    def test_create_repo_enters_the_repo_and_calls_git_status(self):
+    def test_create_repo_calls_git_rev_parse_in_the_repo(self):
         REPO_PATH = '/path/to/existing/repository'
         Repo(REPO_PATH)
-        self.mock_chdir.assert_any_call(REPO_PATH)
         self.mock_check_output.assert_called_once_with(
-            ['git', 'status'],
-            universal_newlines=True
+            ['git', 'rev-parse', '--git-dir'],
+            cwd=REPO_PATH,
+            universal_newlines=True,
+            timeout=None
         )
 
+    @mock.patch('os.chdir')
+    def test_create_repo_does_not_change_working_directory(self, mock_chdir):
+        Repo('/path/to/existing/repository')
+        self.assertFalse(mock_chdir.called)
+
     def test_path_is_accessible_after_creating_repo_from_existing_repository(self):
         REPO_PATH = '/path/to/existing/repository'
         repo = Repo(REPO_PATH)
@@ -433,26 +543,40 @@ class RepoCreateTests(RepoTests):
         repo = Repo(REL_REPO_PATH)
         self.assertEqual(repo.path, ABS_REPO_PATH)
 
+    def test_git_dir_is_accessible_after_creation(self):
+        REPO_PATH = '/path/to/existing/repository'
+        repo = Repo(REPO_PATH)
+        self.assertEqual(repo.git_dir, os.path.join(REPO_PATH, '.git'))
+
+    def test_absolute_git_dir_is_kept_after_creation(self):
+        self.mock_check_output.return_value = '/path/to/git/dir\n'
+        repo = Repo('/path/to/existing/repository')
+        self.assertEqual(repo.git_dir, '/path/to/git/dir')
+
     def test_path_cannot_be_changed_after_creation(self):
         repo = Repo('/path/to/existing/repository')
         with self.assertRaises(AttributeError):
             repo.path = '/some/other/path'
 
     def test_create_repo_from_nonexisting_location_raises_exception(self):
-        self.mock_chdir.side_effect = FileNotFoundError('No such file or directory')
+        self.mock_check_output.side_effect = FileNotFoundError(
+            'No such file or directory')
+        self.mock_isdir.return_value = False
         REPO_PATH = '/path/to/nonexisting/location'
         self.assertRaises(FileNotFoundError, Repo, REPO_PATH)
 
     def test_create_repo_from_location_with_no_repository_raises_exception(self):
         self.mock_check_output.side_effect = subprocess.CalledProcessError(
-            128, "['git', 'status']",
+            128, "['git', 'rev-parse', '--git-dir']",
             b'fatal: Not a git repository (or any parent up to mount point)'
         )
         REPO_PATH = '/path/to/existing/location/with/no/repository'
         self.assertRaises(GitCmdError, Repo, REPO_PATH)
         self.mock_check_output.assert_called_once_with(
-            ['git', 'status'],
-            universal_newlines=True
+            ['git', 'rev-parse', '--git-dir'],
+            cwd=REPO_PATH,
+            universal_newlines=True,
+            timeout=None
         )
 
     def test_exception_is_raised_when_git_binary_is_not_found(self):
@@ -463,8 +587,10 @@ class RepoCreateTests(RepoTests):
         REPO_PATH = '/path/to/existing/location/with/norepository'
         self.assertRaises(GitBinaryNotFoundError, Repo, REPO_PATH)
         self.mock_check_output.assert_called_once_with(
-            ['git', 'status'],
-            universal_newlines=True
+            ['git', 'rev-parse', '--git-dir'],
+            cwd=REPO_PATH,
+            universal_newlines=True,
+            timeout=None
         )
 
 
@@ -478,7 +604,9 @@ class RepoNameTests(RepoTests):
         repo.name
         self.mock_check_output.assert_called_with(
             ['git', 'rev-parse', '--show-toplevel'],
-            universal_newlines=True
+            cwd=REPO_PATH,
+            universal_newlines=True,
+            timeout=None
         )
 
     def test_name_returns_correct_name(self):
@@ -489,6 +617,15 @@ class RepoNameTests(RepoTests):
         self.mock_check_output.return_value = '{}\n'.format(REPO_BASE_PATH)
         self.assertEqual(repo.name, REPO_NAME)
 
+    def test_name_is_obtained_only_once(self):
+        REPO_PATH = '/path/to/existing/repository'
+        repo = Repo(REPO_PATH)
+        self.mock_check_output.return_value = REPO_PATH
+        self.mock_check_output.reset_mock()
+        repo.name
+        repo.name
+        self.assertEqual(self.mock_check_output.call_count, 1)
+
 
 class RepoComparisonTests(RepoTests):
     """Tests for repository comparison."""
@@ -531,69 +668,394 @@ class RepoRunGitCmdTests(RepoWithRepoTests):
         self.mock_check_output.return_value = GIT_STATUS_OUTPUT
         self.assertEqual(self.repo.run_git_cmd(['status']), GIT_STATUS_OUTPUT)
 
+    def test_command_holds_place_in_git_processes_while_it_runs(self):
+        git_processes = ConcurrencyLimiter(limit=1)
+        self.mock_check_output.side_effect = \
+            lambda *args, **kwargs: git_processes.stats()['running']
+        with mock.patch('viewer.git.git_processes', git_processes):
+            self.assertEqual(self.repo.run_git_cmd(['status']), 1)
+        self.assertEqual(git_processes.stats()['running'], 0)
+
+    def test_exception_is_raised_when_limit_of_git_processes_is_exceeded(self):
+        git_processes = ConcurrencyLimiter(limit=0, max_waiting=0)
+        self.mock_check_output.reset_mock()
+        with mock.patch('viewer.git.git_processes', git_processes):
+            with self.assertRaises(GitProcessLimitExceededError):
+                self.repo.run_git_cmd(['status'])
+        self.assertFalse(self.mock_check_output.called)
+
+    def test_command_is_run_with_timeout_until_deadline(self):
+        with deadline(time.monotonic() + 60):
+            self.repo.run_git_cmd(['status'])
+        timeout = self.mock_check_output.call_args[1]['timeout']
+        self.assertTrue(0 < timeout <= 60)
+
+    def test_exception_is_raised_when_command_does_not_end_before_deadline(self):
+        self.mock_check_output.side_effect = subprocess.TimeoutExpired(
+            ['git', 'status'], 1)
+        with deadline(time.monotonic() + 60):
+            with self.assertRaises(GitDeadlineExceededError):
+                self.repo.run_git_cmd(['status'])
+
+    def test_command_is_not_run_when_deadline_has_passed(self):
+        self.mock_check_output.reset_mock()
+        with deadline(time.monotonic() - 1):
+            with self.assertRaises(GitDeadlineExceededError):
+                self.repo.run_git_cmd(['status'])
+        self.assertFalse(self.mock_check_output.called)
+
+
+class RepoMapBranchesTests(RepoTests):
+    """Tests for Repo.map_branches()."""
+
+    def setUp(self):
+        super().setUp()
+        self.branches = [
+            Branch(get_git_repo_mock(), 'origin', 'branch{}'.format(i))
+            for i in range(5)
+        ]
+
+    def test_pool_size_is_accessible_after_creation(self):
+        repo = Repo('/path/to/existing/repository', pool_size=4)
+        self.assertEqual(repo.pool_size, 4)
+
+    def test_returns_results_in_order_of_branches_without_pool(self):
+        repo = Repo('/path/to/existing/repository')
+        self.assertEqual(
+            repo.map_branches(operator.attrgetter('name'), self.branches),
+            [branch.name for branch in self.branches]
+        )
+
+    def test_returns_results_in_order_of_branches_with_pool(self):
+        repo = Repo('/path/to/existing/repository', pool_size=3)
+        self.assertEqual(
+            repo.map_branches(operator.attrgetter('name'), self.branches),
+            [branch.name for branch in self.branches]
+        )
+
+    def test_calls_func_from_multiple_threads_with_pool(self):
+        repo = Repo('/path/to/existing/repository', pool_size=2)
+        barrier = threading.Barrier(2, timeout=5)
+        # Both calls can pass the barrier only when they run concurrently.
+        repo.map_branches(lambda branch: barrier.wait(), self.branches[:2])
+
+    def test_exception_raised_by_func_is_reraised(self):
+        repo = Repo('/path/to/existing/repository', pool_size=2)
+
+        def func(branch):
+            raise GitCmdError('error')
+        with self.assertRaises(GitCmdError):
+            repo.map_branches(func, self.branches)
+
+
+class DeadlineTests(RepoTests):
+    """Tests for the deadline of Git commands."""
+
+    def test_there_is_no_deadline_by_default(self):
+        self.assertIsNone(get_deadline())
+
+    def test_deadline_is_set_only_in_block(self):
+        with deadline(100):
+            self.assertEqual(get_deadline(), 100)
+        self.assertIsNone(get_deadline())
+
+    def test_deadline_applies_to_calls_made_from_pool(self):
+        repo = Repo('/path/to/existing/repository', pool_size=2)
+        with deadline(100):
+            self.assertEqual(
+                repo.map_branches(lambda branch: get_deadline(), [1, 2]),
+                [100, 100]
+            )
+            self.assertEqual(
+                list(repo.imap_branches(lambda branch: get_deadline(), [1, 2])),
+                [100, 100]
+            )
+
+
+class RepoImapBranchesTests(RepoTests):
+    """Tests for Repo.imap_branches()."""
+
+    def setUp(self):
+        super().setUp()
+        self.branches = [
+            Branch(get_git_repo_mock(), 'origin', 'branch{}'.format(i))
+            for i in range(5)
+        ]
+
+    def test_yields_results_in_order_of_branches_without_pool(self):
+        repo = Repo('/path/to/existing/repository')
+        self.assertEqual(
+            list(repo.imap_branches(operator.attrgetter('name'),
+                                    self.branches)),
+            [branch.name for branch in self.branches]
+        )
+
+    def test_yields_results_in_order_of_branches_with_pool(self):
+        repo = Repo('/path/to/existing/repository', pool_size=3)
+        self.assertEqual(
+            list(repo.imap_branches(operator.attrgetter('name'),
+                                    self.branches)),
+            [branch.name for branch in self.branches]
+        )
+
+    def test_calls_func_lazily_without_pool(self):
+        repo = Repo('/path/to/existing/repository')
+        func = mock.Mock()
+        results = repo.imap_branches(func, self.branches)
+        self.assertFalse(func.called)
+        next(results)
+        func.assert_called_once_with(self.branches[0])
+
+    def test_first_result_is_yielded_before_other_calls_end(self):
+        repo = Repo('/path/to/existing/repository', pool_size=2)
+        first_result_taken = threading.Event()
+
+        def func(branch):
+            if branch is not self.branches[0]:
+                first_result_taken.wait(5)
+            return branch.name
+        results = repo.imap_branches(func, self.branches[:2])
+        self.assertEqual(next(results), self.branches[0].name)
+        first_result_taken.set()
+        self.assertEqual(next(results), self.branches[1].name)
+
+    def test_exception_raised_by_func_is_reraised(self):
+        repo = Repo('/path/to/existing/repository', pool_size=2)
+
+        def func(branch):
+            raise GitCmdError('error')
+        with self.assertRaises(GitCmdError):
+            list(repo.imap_branches(func, self.branches))
+
 
 class RepoGetBranchesOnRemoteTests(RepoWithRepoTests):
     """Tests for Repo.get_branches_on_remote()."""
 
-    def test_calls_proper_command_to_get_branches_on_given_remote(self):
-        remote = 'origin'
-        self.repo.get_branches_on_remote(remote)
-        self.mock_check_output.assert_called_with(
-            ['git', 'branch', '--remote', '--no-color'],
-            universal_newlines=True
-        )
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(RefReader, 'get_remote_branch_tips')
+        self.addCleanup(patcher.stop)
+        self.mock_get_remote_branch_tips = patcher.start()
+
+    def test_reads_branches_on_given_remote_without_running_git(self):
+        self.mock_check_output.reset_mock()
+        self.mock_get_remote_branch_tips.return_value = {}
+        self.repo.get_branches_on_remote('origin')
+        self.mock_get_remote_branch_tips.assert_called_once_with('origin')
+        self.assertFalse(self.mock_check_output.called)
 
     def test_returns_empty_list_when_there_are_no_branches(self):
-        self.mock_check_output.return_value = ''
+        self.mock_get_remote_branch_tips.return_value = {}
         self.assertEqual(self.repo.get_branches_on_remote('origin'), [])
 
-    def test_returns_single_branch_when_there_is_single_branch(self):
-        remote = 'origin'
-        name = 'master'
-        self.mock_check_output.return_value = '  {}/{}\n'.format(
-            remote, name
-        )
-        expected_branches = [
-            Branch(self.repo, remote, name)
-        ]
+    def test_returns_branches_sorted_by_name(self):
+        self.mock_get_remote_branch_tips.return_value = {
+            'master': get_rand_hash(),
+            'featureX': get_rand_hash()
+        }
+        self.assertEqual(self.repo.get_branches_on_remote('origin'), [
+            Branch(self.repo, 'origin', 'featureX'),
+            Branch(self.repo, 'origin', 'master')
+        ])
+
+
+class RepoWithReftableTests(unittest.TestCase):
+    """Tests for Repo with references in the reftable format (with a real
+    repository).
+    """
+
+    def setUp(self):
+        self.repo_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.repo_path)
+        generate_history(self.repo_path)
+        for name in ('master', 'feature3'):
+            run_git(self.repo_path, 'update-ref',
+                    'refs/remotes/origin/{}'.format(name), name)
+        # References are listed by Git when there is a list of reftables, so
+        # the references of the repository are listed by Git even though they
+        # are in files.
+        os.mkdir(os.path.join(self.repo_path, '.git', 'reftable'))
+        open(os.path.join(self.repo_path, '.git', 'reftable', 'tables.list'),
+             'w').close()
+        self.repo = Repo(self.repo_path)
+
+    def test_get_branches_on_remote_returns_branches_listed_by_git(self):
+        self.assertEqual(self.repo.get_branches_on_remote('origin'), [
+            Branch(self.repo, 'origin', 'feature3'),
+            Branch(self.repo, 'origin', 'master')
+        ])
+
+    def test_refs_resolve_branch_listed_by_git(self):
         self.assertEqual(
-            self.repo.get_branches_on_remote(remote),
-            expected_branches
+            self.repo.refs.resolve('refs/remotes/origin/feature3'),
+            rev_parse(self.repo_path, 'feature3')
         )
 
-    def test_returns_two_branches_when_there_are_two_branches(self):
-        remote = 'origin'
-        name1 = 'master'
-        name2 = 'featureX'
-        self.mock_check_output.return_value = """
-            {0}/{1}
-            {0}/{2}
-            """.format(remote, name1, name2)
-        expected_branches = [
-            Branch(self.repo, remote, name1),
-            Branch(self.repo, remote, name2)
-        ]
+    def test_fingerprint_changes_when_branch_listed_by_git_changes(self):
+        fingerprint = self.repo.get_fingerprint('origin')
+        run_git(self.repo_path, 'update-ref', 'refs/remotes/origin/feature3',
+                'master')
+        self.assertNotEqual(self.repo.get_fingerprint('origin'), fingerprint)
+
+
+def get_cat_file_process_mock(output):
+    """Returns a Mock object for a `git cat-file --batch` process producing the
+    given output (`bytes`).
+    """
+    process = mock.MagicMock()
+    process.stdin = io.BytesIO()
+    process.stdout = io.BytesIO(output)
+    process.poll.return_value = None
+    return process
+
+
+def get_raw_commit_object(author, email, date, subject):
+    """Returns a raw commit object (`bytes`) with the given data."""
+    return (
+        'tree 4b825dc642cb6eb9a060e54bf8d69288fbee4904\n'
+        'author {0} <{1}> {2} +0100\n'
+        'committer {0} <{1}> {2} +0100\n'
+        '\n'
+        '{3}\n'
+        '\n'
+        'Commit body.\n'
+    ).format(author, email, int(date.timestamp()), subject).encode()
+
+
+def get_cat_file_output(hash, content, type='commit'):
+    """Returns `git cat-file --batch` output (`bytes`) for the given object."""
+    return '{} {} {}\n'.format(hash, type, len(content)).encode() + content + b'\n'
+
+
+class CatFileBatchTests(unittest.TestCase):
+    """Tests for CatFileBatch."""
+
+    def setUp(self):
+        patcher = mock.patch('subprocess.Popen')
+        self.addCleanup(patcher.stop)
+        self.mock_popen = patcher.start()
+
+        self.reader = CatFileBatch('/path/to/existing/repository')
+        self.hash = '4b34858294e9f4eee1cdd9af58911154b99472e3'
+
+    def test_path_is_accessible_after_creation(self):
+        self.assertEqual(self.reader.path, '/path/to/existing/repository')
+
+    def test_process_is_started_in_repository(self):
+        self.mock_popen.return_value = get_cat_file_process_mock(
+            get_cat_file_output(self.hash, b'content'))
+        self.reader.read_object(self.hash)
+        self.mock_popen.assert_called_once_with(
+            ['git', 'cat-file', '--batch'],
+            cwd='/path/to/existing/repository',
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL
+        )
+
+    def test_object_name_is_written_to_process(self):
+        process = get_cat_file_process_mock(
+            get_cat_file_output(self.hash, b'content'))
+        self.mock_popen.return_value = process
+        self.reader.read_object('origin/master')
+        self.assertEqual(process.stdin.getvalue(), b'origin/master\n')
+
+    def test_returns_hash_type_and_content(self):
+        self.mock_popen.return_value = get_cat_file_process_mock(
+            get_cat_file_output(self.hash, b'content'))
         self.assertEqual(
-            self.repo.get_branches_on_remote(remote),
-            expected_branches
+            self.reader.read_object(self.hash),
+            (self.hash, 'commit', b'content')
+        )
+
+    def test_process_is_reused_for_more_objects(self):
+        self.mock_popen.return_value = get_cat_file_process_mock(
+            get_cat_file_output(self.hash, b'content1') +
+            get_cat_file_output(self.hash, b'content2'))
+        self.reader.read_object(self.hash)
+        self.assertEqual(self.reader.read_object(self.hash)[2], b'content2')
+        self.assertEqual(self.mock_popen.call_count, 1)
+
+    def test_process_is_restarted_when_it_has_terminated(self):
+        dead_process = get_cat_file_process_mock(b'')
+        live_process = get_cat_file_process_mock(
+            get_cat_file_output(self.hash, b'content'))
+        self.mock_popen.side_effect = [dead_process, live_process]
+        self.assertEqual(self.reader.read_object(self.hash)[2], b'content')
+        self.assertEqual(self.mock_popen.call_count, 2)
+
+    def test_exception_is_raised_when_object_is_missing(self):
+        self.mock_popen.return_value = get_cat_file_process_mock(
+            b'origin/nonexisting missing\n')
+        with self.assertRaises(GitCmdError):
+            self.reader.read_object('origin/nonexisting')
+
+    def test_exception_is_raised_when_git_binary_is_not_found(self):
+        self.mock_popen.side_effect = FileNotFoundError(
+            "[Errno 2] No such file or directory: 'git'"
+        )
+        with self.assertRaises(GitBinaryNotFoundError):
+            self.reader.read_object(self.hash)
+
+
+class RepoLoadBranchesTests(RepoWithRepoTests):
+    """Tests for Repo.load_branches()."""
+
+    def get_for_each_ref_line(self, refname, commit, symref=''):
+        return '\0'.join([
+            refname,
+            symref,
+            commit.hash,
+            commit.author,
+            '<{}>'.format(commit.email),
+            '{} +0100'.format(int(commit.date.timestamp())),
+            commit.subject
+        ]) + '\n'
+
+    def test_calls_proper_command_to_get_branches_on_given_remote(self):
+        self.mock_check_output.return_value = ''
+        self.repo.load_branches('origin')
+        self.mock_check_output.assert_called_with(
+            ['git', 'for-each-ref',
+                '--format=%(refname)%00%(symref)%00%(objectname)%00'
+                '%(authorname)%00%(authoremail)%00%(authordate:raw)%00'
+                '%(contents:subject)',
+                'refs/remotes/origin/'],
+            cwd=self.repo.path,
+            universal_newlines=True,
+            timeout=None
+        )
+
+    def test_returns_empty_list_when_there_are_no_branches(self):
+        self.mock_check_output.return_value = ''
+        self.assertEqual(self.repo.load_branches('origin'), [])
+
+    def test_returns_branches_with_their_commits(self):
+        commit1 = get_new_commit()
+        commit2 = get_new_commit(subject='Other commit message')
+        self.mock_check_output.return_value = (
+            self.get_for_each_ref_line('refs/remotes/origin/master', commit1) +
+            self.get_for_each_ref_line('refs/remotes/origin/feature/x', commit2)
         )
+        branches = self.repo.load_branches('origin')
+        self.assertEqual(branches, [
+            Branch(self.repo, 'origin', 'master'),
+            Branch(self.repo, 'origin', 'feature/x')
+        ])
+        self.assertEqual(branches[0].commit, commit1)
+        self.assertEqual(branches[1].commit, commit2)
 
     def test_ignores_remote_head(self):
-        self.mock_check_output.return_value = 'origin/HEAD -> origin/master\n'
-        self.assertEqual(self.repo.get_branches_on_remote('origin'), [])
+        self.mock_check_output.return_value = self.get_for_each_ref_line(
+            'refs/remotes/origin/HEAD', get_new_commit(),
+            symref='refs/remotes/origin/master'
+        )
+        self.assertEqual(self.repo.load_branches('origin'), [])
 
 
 class RepoGetCommitTests(RepoWithRepoTests):
     """A base class for all Repo.get_commit_*() tests."""
 
-    def mock_check_output_side_effect(self, *args, **kwargs):
-        if 'show' in args[0]:
-            return '{}\n{}\n{}\n{}\n{}\n\ndiff'.format(
-                self.hash, self.author, self.email,
-                int(self.date.timestamp()), self.subject
-            )
-        return ''
-
     def setUp(self):
         super().setUp()
         self.hash = '4b34858294e9f4eee1cdd9af58911154b99472e3'
@@ -601,26 +1063,70 @@ class RepoGetCommitTests(RepoWithRepoTests):
         self.email = 's3rvac@gmail.com'
         self.date = get_curr_date()
         self.subject = 'Commit message'
-        self.mock_check_output.side_effect = self.mock_check_output_side_effect
+
+        # Do not reuse readers from other tests.
+        patcher = mock.patch.dict('viewer.git._cat_file_batches', clear=True)
+        self.addCleanup(patcher.stop)
+        patcher.start()
+
+        patcher = mock.patch('subprocess.Popen')
+        self.addCleanup(patcher.stop)
+        self.mock_popen = patcher.start()
+        self.process = get_cat_file_process_mock(get_cat_file_output(
+            self.hash,
+            get_raw_commit_object(
+                self.author, self.email, self.date, self.subject)
+        ))
+        self.mock_popen.return_value = self.process
 
 
 class RepoGetCommitFromHashTests(RepoGetCommitTests):
     """Tests for Repo.get_commit_from_hash()."""
 
-    def test_calls_proper_subprocess_command(self):
+    def test_requests_proper_object(self):
         hash = '8a9abf8ad351dc9c7e2a5ba9f3b4d41c038ea605'
         self.repo.get_commit_from_hash(hash)
-        self.mock_check_output.assert_called_with(
-            ['git', 'show', '--quiet', '--format=format:%H%n%an%n%ae%n%at%n%s%n', hash],
-            universal_newlines=True
+        self.assertEqual(
+            self.process.stdin.getvalue(),
+            '{}^{{commit}}\n'.format(hash).encode()
         )
 
     def test_returns_correct_commit(self):
         self.assertEqual(
-            self.repo.get_commit_from_hash(hash),
+            self.repo.get_commit_from_hash(self.hash),
             Commit(self.hash, self.author, self.email, self.date, self.subject)
         )
 
+    def test_subject_is_first_paragraph_of_message_joined_by_spaces(self):
+        self.subject = 'First line\nsecond line'
+        self.process.stdout = io.BytesIO(get_cat_file_output(
+            self.hash,
+            get_raw_commit_object(
+                self.author, self.email, self.date, self.subject)
+        ))
+        commit = self.repo.get_commit_from_hash(self.hash)
+        self.assertEqual(commit.subject, 'First line second line')
+
+    def test_commits_are_read_by_single_process(self):
+        self.process.stdout = io.BytesIO(self.process.stdout.getvalue() * 2)
+        self.repo.get_commit_from_hash(self.hash)
+        self.repo.get_commit_from_hash(self.hash)
+        self.assertEqual(self.mock_popen.call_count, 1)
+
+    def test_commits_are_read_by_new_process_in_forked_process(self):
+        self.process.stdout = io.BytesIO(self.process.stdout.getvalue() * 2)
+        # Abbreviated hashes are not cached, so both commits are read.
+        self.repo.get_commit_from_hash(self.hash[:7])
+        with mock.patch('os.getpid', return_value=os.getpid() + 1):
+            self.repo.get_commit_from_hash(self.hash[:7])
+        self.assertEqual(self.mock_popen.call_count, 2)
+
+    def test_exception_is_raised_when_object_is_not_commit(self):
+        self.process.stdout = io.BytesIO(
+            get_cat_file_output(self.hash, b'content', type='blob'))
+        with self.assertRaises(GitCmdError):
+            self.repo.get_commit_from_hash(self.hash)
+
 
 class RepoGetCommitForBranchTests(RepoGetCommitTests):
     """Tests for Repo.get_commit_for_branch()."""
@@ -629,12 +1135,19 @@ class RepoGetCommitForBranchTests(RepoGetCommitTests):
         super().setUp()
         self.branch = Branch(self.repo, 'origin', 'master')
 
-    def test_calls_proper_subprocess_command(self):
+    def test_requests_hash_of_branch_when_branch_can_be_resolved(self):
+        with mock.patch.object(RefReader, 'resolve', return_value=self.hash):
+            self.repo.get_commit_for_branch(self.branch)
+        self.assertEqual(
+            self.process.stdin.getvalue(),
+            '{}^{{commit}}\n'.format(self.hash).encode()
+        )
+
+    def test_requests_proper_object(self):
         self.repo.get_commit_for_branch(self.branch)
-        self.mock_check_output.assert_called_with(
-            ['git', 'show', '--quiet', '--format=format:%H%n%an%n%ae%n%at%n%s%n',
-                self.branch.full_name],
-            universal_newlines=True
+        self.assertEqual(
+            self.process.stdin.getvalue(),
+            '{}^{{commit}}\n'.format(self.branch.full_name).encode()
         )
 
     def test_returns_correct_commit(self):
@@ -649,78 +1162,271 @@ class RepoUnmergedCommitsTests(RepoWithRepoTests):
 
     def setUp(self):
         super().setUp()
-        self.master_branch = Branch(self.repo, 'origin', 'master')
-        self.other_branch = Branch(self.repo, 'origin', 'other')
+        self.master_branch = Branch(self.repo, 'origin', 'master',
+                                    get_new_commit())
+        self.other_branch = Branch(self.repo, 'origin', 'other',
+                                   get_new_commit())
+
+
+def get_git_process_mock(output, returncode=0):
+    """Returns a Mock object for a Git process producing the given output
+    (`str`).
+    """
+    process = mock.MagicMock()
+    process.stdout = io.StringIO(output)
+    process.poll.return_value = returncode
+    process.wait.return_value = returncode
+    process.returncode = returncode
+    return process
+
+
+def get_log_record(commit):
+    """Returns a record for the given commit, as produced by `git log` in
+    Repo.get_unmerged_commits().
+    """
+    return '{}\0{}\0{}\0{}\0{}\x1e\n'.format(
+        commit.hash, commit.author, commit.email,
+        int(commit.date.timestamp()), commit.subject
+    )
+
+
+class RepoStreamGitCmdTests(RepoWithRepoTests):
+    """Tests for Repo.stream_git_cmd()."""
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch('subprocess.Popen')
+        self.addCleanup(patcher.stop)
+        self.mock_popen = patcher.start()
+
+    def test_runs_git_in_repository(self):
+        self.mock_popen.return_value = get_git_process_mock('')
+        list(self.repo.stream_git_cmd(['log']))
+        self.mock_popen.assert_called_once_with(
+            ['git', 'log'],
+            cwd=self.repo.path,
+            stdout=subprocess.PIPE,
+            universal_newlines=True
+        )
+
+    def test_yields_output_in_chunks(self):
+        self.mock_popen.return_value = get_git_process_mock('abcde')
+        self.assertEqual(
+            list(self.repo.stream_git_cmd(['log'], chunk_size=2)),
+            ['ab', 'cd', 'e']
+        )
+
+    def test_exception_is_raised_when_command_fails(self):
+        self.mock_popen.return_value = get_git_process_mock('', returncode=128)
+        with self.assertRaises(GitCmdError):
+            list(self.repo.stream_git_cmd(['log']))
+
+    def test_exception_is_raised_when_git_binary_is_not_found(self):
+        self.mock_popen.side_effect = FileNotFoundError(
+            "[Errno 2] No such file or directory: 'git'"
+        )
+        with self.assertRaises(GitBinaryNotFoundError):
+            list(self.repo.stream_git_cmd(['log']))
+
+    def test_process_is_killed_when_generator_is_closed_early(self):
+        process = get_git_process_mock('abcde')
+        process.poll.return_value = None
+        self.mock_popen.return_value = process
+        chunks = self.repo.stream_git_cmd(['log'], chunk_size=2)
+        next(chunks)
+        chunks.close()
+        process.kill.assert_called_once_with()
+
+    def test_process_is_killed_when_it_does_not_end_before_deadline(self):
+        process = get_git_process_mock('')
+        killed = threading.Event()
+        process.kill.side_effect = killed.set
+        process.stdout = mock.Mock()
+        process.stdout.read.side_effect = lambda size: killed.wait(5) and ''
+        process.wait.return_value = process.returncode = -9
+        self.mock_popen.return_value = process
+        with deadline(time.monotonic() + 0.01):
+            with self.assertRaises(GitDeadlineExceededError):
+                list(self.repo.stream_git_cmd(['log']))
+        self.assertTrue(killed.is_set())
+
+    def test_command_is_not_started_when_deadline_has_passed(self):
+        with deadline(time.monotonic() - 1):
+            with self.assertRaises(GitDeadlineExceededError):
+                list(self.repo.stream_git_cmd(['log']))
+        self.assertFalse(self.mock_popen.called)
+
+    def test_place_in_git_processes_is_released_when_generator_ends(self):
+        self.mock_popen.return_value = get_git_process_mock('abcde')
+        git_processes = ConcurrencyLimiter(limit=1)
+        with mock.patch('viewer.git.git_processes', git_processes):
+            chunks = self.repo.stream_git_cmd(['log'], chunk_size=2)
+            next(chunks)
+            self.assertEqual(git_processes.stats()['running'], 1)
+            list(chunks)
+        self.assertEqual(git_processes.stats()['running'], 0)
 
 
 class RepoGetUnmergedCommitsTests(RepoUnmergedCommitsTests):
     """Tests for Repo.get_unmerged_commits()."""
 
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch('subprocess.Popen')
+        self.addCleanup(patcher.stop)
+        self.mock_popen = patcher.start()
+        self.mock_popen.return_value = get_git_process_mock('')
+
     def test_calls_proper_subprocess_command_when_no_limit_is_given(self):
         self.repo.get_unmerged_commits(self.master_branch, self.other_branch)
-        self.mock_check_output.assert_called_with(
-            ['git', 'log', '--format=format:%H', '{}..{}'.format(
-                self.master_branch.full_name, self.other_branch.full_name)],
-            universal_newlines=True
-        )
+        self.assertEqual(self.mock_popen.call_args[0][0], [
+            'git', 'log', '--format=tformat:%H%x00%an%x00%ae%x00%at%x00%s%x1e',
+            '{}..{}'.format(
+                self.master_branch.commit.hash, self.other_branch.commit.hash)
+        ])
 
     def test_calls_proper_subprocess_command_when_limit_is_given(self):
         self.repo.get_unmerged_commits(self.master_branch, self.other_branch,
                                        limit=5)
-        self.mock_check_output.assert_called_with(
-            ['git', 'log', '-5', '--format=format:%H', '{}..{}'.format(
-                self.master_branch.full_name, self.other_branch.full_name)],
-            universal_newlines=True
-        )
+        self.assertEqual(self.mock_popen.call_args[0][0], [
+            'git', 'log', '-5',
+            '--format=tformat:%H%x00%an%x00%ae%x00%at%x00%s%x1e',
+            '{}..{}'.format(
+                self.master_branch.commit.hash, self.other_branch.commit.hash)
+        ])
 
     def test_no_unmerged_commits(self):
-        self.mock_check_output.return_value = '\n'
         unmerged_commits = self.repo.get_unmerged_commits(
             self.master_branch, self.other_branch)
         expected_unmerged_commits = []
         self.assertEqual(unmerged_commits, expected_unmerged_commits)
 
-    def test_calls_get_commit_from_hash_for_every_hash_in_output(self):
-        commits = [get_new_commit(), get_new_commit()]
-        self.mock_check_output.return_value = '\n'.join(
-            commit.hash for commit in commits)
-
-        def mock_get_commit_from_hash_side_effect(hash):
-            for commit in commits:
-                if commit.hash == hash:
-                    return commit
-        self.repo.get_commit_from_hash = mock.MagicMock(
-            spec=Repo.get_commit_from_hash,
-            side_effect=mock_get_commit_from_hash_side_effect)
+    def test_returns_commits_from_output(self):
+        commits = [get_new_commit(), get_new_commit(subject='Other subject')]
+        self.mock_popen.return_value = get_git_process_mock(
+            ''.join(get_log_record(commit) for commit in commits))
         unmerged_commits = self.repo.get_unmerged_commits(
             self.master_branch, self.other_branch)
         self.assertEqual(unmerged_commits, commits)
 
+    def test_returns_commits_from_output_split_into_chunks(self):
+        commits = [get_new_commit(), get_new_commit(subject='Other subject')]
+        chunks = iter([get_log_record(commit) for commit in commits])
+        commits_iter = self.repo._iter_commits_from_log_records(
+            chunk[i:i + 7] for chunk in chunks for i in range(0, len(chunk), 7)
+        )
+        self.assertEqual(list(commits_iter), commits)
+
+    def test_does_not_get_commits_one_by_one(self):
+        self.mock_popen.return_value = get_git_process_mock(
+            get_log_record(get_new_commit()))
+        self.repo.get_commit_from_hash = mock.MagicMock(
+            spec=Repo.get_commit_from_hash)
+        self.repo.get_unmerged_commits(self.master_branch, self.other_branch)
+        self.assertFalse(self.repo.get_commit_from_hash.called)
+
 
 class RepoGetNumOfUnmergedCommitsTests(RepoUnmergedCommitsTests):
     """Tests for Repo.get_num_of_unmerged_commits()."""
 
     def test_calls_proper_subprocess_command(self):
-        self.repo.has_unmerged_commits(self.master_branch, self.other_branch)
+        self.mock_check_output.return_value = '0\n'
+        self.repo.get_num_of_unmerged_commits(
+            self.master_branch, self.other_branch)
         self.mock_check_output.assert_called_with(
-            ['git', 'log', '-1', '--format=format:%h', '{}..{}'.format(
-                self.master_branch.full_name, self.other_branch.full_name)],
-            universal_newlines=True
+            ['git', 'rev-list', '--count', '{}..{}'.format(
+                self.master_branch.commit.hash, self.other_branch.commit.hash)],
+            cwd=self.repo.path,
+            universal_newlines=True,
+            timeout=None
         )
 
     def test_there_are_no_unmerged_commits(self):
-        self.mock_check_output.return_value = '\n'
+        self.mock_check_output.return_value = '0\n'
         num_of_unmerged_commits = self.repo.get_num_of_unmerged_commits(
             self.master_branch, self.other_branch)
         self.assertEqual(num_of_unmerged_commits, 0)
 
     def test_there_are_unmerged_commits(self):
-        self.mock_check_output.return_value = '327c90a\n548a89e\n'
+        self.mock_check_output.return_value = '2\n'
         num_of_unmerged_commits = self.repo.get_num_of_unmerged_commits(
             self.master_branch, self.other_branch)
         self.assertEqual(num_of_unmerged_commits, 2)
 
 
+class RepoGetUnmergedCommitCountsTests(RepoUnmergedCommitsTests):
+    """Tests for Repo.get_unmerged_commit_counts()."""
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch('subprocess.Popen')
+        self.addCleanup(patcher.stop)
+        self.mock_popen = patcher.start()
+
+        # The history looks as follows (m is the master branch):
+        #
+        #   m -- a -- b (branch1)
+        #         \
+        #          c -- d (branch2)
+        #
+        self.a, self.b, self.c, self.d, self.m = (
+            get_rand_hash() for _ in range(5)
+        )
+        self.mock_popen.return_value = get_git_process_mock(
+            '{0.b} {0.a}\n{0.d} {0.c}\n{0.c} {0.a}\n{0.a} {0.m}\n'.format(self)
+        )
+        self.branch1 = Branch(self.repo, 'origin', 'branch1',
+                              get_new_commit(hash=self.b))
+        self.branch2 = Branch(self.repo, 'origin', 'branch2',
+                              get_new_commit(hash=self.d))
+        self.merged_branch = Branch(self.repo, 'origin', 'merged',
+                                    get_new_commit(hash=self.m))
+
+    def test_returns_empty_dict_without_running_git_when_no_branches(self):
+        self.assertEqual(
+            self.repo.get_unmerged_commit_counts(self.master_branch, []),
+            {}
+        )
+        self.assertFalse(self.mock_popen.called)
+
+    def test_calls_single_proper_subprocess_command(self):
+        self.repo.get_unmerged_commit_counts(
+            self.master_branch, [self.branch1, self.branch2])
+        self.mock_popen.assert_called_once_with(
+            ['git', 'rev-list', '--parents', self.b, self.d,
+                '--not', self.master_branch.commit.hash],
+            cwd=self.repo.path,
+            stdout=subprocess.PIPE,
+            universal_newlines=True
+        )
+
+    def test_returns_ahead_counts_for_all_branches(self):
+        self.mock_check_output.reset_mock()
+        counts = self.repo.get_unmerged_commit_counts(
+            self.master_branch,
+            [self.branch1, self.branch2, self.merged_branch]
+        )
+        self.assertEqual(counts, {
+            self.branch1.full_name: CommitCounts(2, None),
+            self.branch2.full_name: CommitCounts(3, None),
+            self.merged_branch.full_name: CommitCounts(0, None)
+        })
+        self.assertFalse(self.mock_check_output.called)
+
+    def test_returns_behind_counts_when_requested(self):
+        self.mock_check_output.return_value = '4\n'
+        counts = self.repo.get_unmerged_commit_counts(
+            self.master_branch, [self.branch1], include_behind=True)
+        self.assertEqual(counts[self.branch1.full_name], CommitCounts(2, 4))
+        self.mock_check_output.assert_called_with(
+            ['git', 'rev-list', '--count', '{}..{}'.format(
+                self.b, self.master_branch.commit.hash)],
+            cwd=self.repo.path,
+            universal_newlines=True,
+            timeout=None
+        )
+
+
 class RepoHasUnmergedCommitsTests(RepoUnmergedCommitsTests):
     """Tests for Repo.has_unmerged_commits()."""
 
@@ -728,8 +1434,10 @@ class RepoHasUnmergedCommitsTests(RepoUnmergedCommitsTests):
         self.repo.has_unmerged_commits(self.master_branch, self.other_branch)
         self.mock_check_output.assert_called_with(
             ['git', 'log', '-1', '--format=format:%h', '{}..{}'.format(
-                self.master_branch.full_name, self.other_branch.full_name)],
-            universal_newlines=True
+                self.master_branch.commit.hash, self.other_branch.commit.hash)],
+            cwd=self.repo.path,
+            universal_newlines=True,
+            timeout=None
         )
 
     def test_there_are_no_unmerged_commits(self):
@@ -745,6 +1453,87 @@ class RepoHasUnmergedCommitsTests(RepoUnmergedCommitsTests):
         )
 
 
+class RepoResultsCacheTests(RepoUnmergedCommitsTests):
+    """Tests for caching of results in results_cache."""
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch('subprocess.Popen')
+        self.addCleanup(patcher.stop)
+        self.mock_popen = patcher.start()
+        self.mock_popen.side_effect = lambda *args, **kwargs: \
+            get_git_process_mock('')
+
+    def test_unmerged_commits_are_obtained_only_once_for_same_commits(self):
+        self.repo.get_unmerged_commits(self.master_branch, self.other_branch)
+        self.repo.get_unmerged_commits(
+            Branch(self.repo, 'origin', 'master', self.master_branch.commit),
+            Branch(self.repo, 'origin', 'renamed', self.other_branch.commit)
+        )
+        self.assertEqual(self.mock_popen.call_count, 1)
+
+    def test_unmerged_commits_are_obtained_again_when_master_changes(self):
+        self.repo.get_unmerged_commits(self.master_branch, self.other_branch)
+        self.repo.get_unmerged_commits(
+            Branch(self.repo, 'origin', 'master', get_new_commit()),
+            self.other_branch
+        )
+        self.assertEqual(self.mock_popen.call_count, 2)
+
+    def test_unmerged_commits_are_cached_separately_for_each_limit(self):
+        self.repo.get_unmerged_commits(self.master_branch, self.other_branch, 1)
+        self.repo.get_unmerged_commits(self.master_branch, self.other_branch, 2)
+        self.assertEqual(self.mock_popen.call_count, 2)
+
+    def test_num_of_unmerged_commits_is_obtained_only_once(self):
+        self.mock_check_output.return_value = '2\n'
+        self.repo.get_num_of_unmerged_commits(
+            self.master_branch, self.other_branch)
+        self.mock_check_output.reset_mock()
+        self.assertEqual(
+            self.repo.get_num_of_unmerged_commits(
+                self.master_branch, self.other_branch),
+            2
+        )
+        self.assertFalse(self.mock_check_output.called)
+
+    def test_has_unmerged_commits_uses_cached_num_of_unmerged_commits(self):
+        self.mock_check_output.return_value = '2\n'
+        self.repo.get_num_of_unmerged_commits(
+            self.master_branch, self.other_branch)
+        self.mock_check_output.reset_mock()
+        self.assertTrue(
+            self.repo.has_unmerged_commits(
+                self.master_branch, self.other_branch)
+        )
+        self.assertFalse(self.mock_check_output.called)
+
+    def test_unmerged_commit_counts_are_walked_only_for_changed_branches(self):
+        self.repo.get_unmerged_commit_counts(
+            self.master_branch, [self.other_branch])
+        new_branch = Branch(self.repo, 'origin', 'new', get_new_commit())
+        self.repo.get_unmerged_commit_counts(
+            self.master_branch, [self.other_branch, new_branch])
+        self.assertEqual(self.mock_popen.call_count, 2)
+        self.assertEqual(
+            self.mock_popen.call_args[0][0],
+            ['git', 'rev-list', '--parents', new_branch.commit.hash,
+                '--not', self.master_branch.commit.hash]
+        )
+
+    def test_unmerged_commit_counts_are_not_walked_when_all_are_cached(self):
+        branches = [self.other_branch]
+        self.repo.get_unmerged_commit_counts(self.master_branch, branches)
+        self.repo.get_unmerged_commit_counts(self.master_branch, branches)
+        self.assertEqual(self.mock_popen.call_count, 1)
+
+    def test_commit_from_hash_is_obtained_only_once(self):
+        commit = get_new_commit()
+        results_cache.put(('commit', commit.hash), commit)
+        self.assertEqual(self.repo.get_commit_from_hash(commit.hash), commit)
+        self.assertFalse(self.mock_popen.called)
+
+
 @mock.patch('os.path.getmtime')
 class RepoGetDateOfLastUpdateTests(RepoWithRepoTests):
     """Tests for Repo.get_date_of_last_update()."""
@@ -752,9 +1541,180 @@ class RepoGetDateOfLastUpdateTests(RepoWithRepoTests):
     def test_calls_getmtime_with_proper_argument(self, getmtime_mock):
         self.repo.get_date_of_last_update()
         getmtime_mock.assert_called_with(
-            os.path.join(self.repo.path, '.git', 'FETCH_HEAD'))
+            os.path.join(self.repo.git_dir, 'FETCH_HEAD'))
 
     def test_returns_correct_date(self, getmtime_mock):
         expected_date = get_curr_date()
         getmtime_mock.return_value = expected_date.timestamp()
         self.assertEqual(self.repo.get_date_of_last_update(), expected_date)
+
+
+class AsyncRepoTests(unittest.TestCase):
+    """Tests for the AsyncRepo class (with a real repository)."""
+
+    def setUp(self):
+        self.repo_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.repo_path)
+        generate_history(self.repo_path)
+        for name in ('master', 'feature0', 'feature3'):
+            run_git(self.repo_path, 'update-ref',
+                    'refs/remotes/origin/{}'.format(name), name)
+        results_cache.clear()
+        self.addCleanup(results_cache.clear)
+        self.repo = Repo(self.repo_path)
+        self.async_repo = AsyncRepo(self.repo)
+
+    def load_branches(self):
+        return {
+            branch.name: branch
+            for branch in asyncio.run(self.async_repo.load_branches('origin'))
+        }
+
+    def test_repo_returns_wrapped_repo(self):
+        self.assertIs(self.async_repo.repo, self.repo)
+
+    def test_run_git_cmd_returns_output(self):
+        output = asyncio.run(self.async_repo.run_git_cmd(['rev-parse', 'master']))
+        self.assertEqual(output.strip(), rev_parse(self.repo_path, 'master'))
+
+    def test_run_git_cmd_raises_exception_when_command_fails(self):
+        with self.assertRaises(GitCmdError):
+            asyncio.run(self.async_repo.run_git_cmd(['rev-parse', 'nonexisting']))
+
+    def test_run_git_cmd_raises_exception_when_deadline_has_passed(self):
+        async def run_git_cmd():
+            with deadline(time.monotonic() - 1):
+                await self.async_repo.run_git_cmd(['rev-parse', 'master'])
+        with self.assertRaises(GitDeadlineExceededError):
+            asyncio.run(run_git_cmd())
+
+    def test_run_git_cmd_kills_command_that_does_not_end_before_deadline(self):
+        process = mock.Mock(returncode=None, wait=mock.AsyncMock())
+
+        async def communicate():
+            await asyncio.sleep(10)
+        process.communicate = communicate
+
+        async def run_git_cmd():
+            with deadline(time.monotonic() + 0.01):
+                await self.async_repo.run_git_cmd(['status'])
+        with mock.patch('asyncio.create_subprocess_exec',
+                        mock.AsyncMock(return_value=process)):
+            with self.assertRaises(GitDeadlineExceededError):
+                asyncio.run(run_git_cmd())
+        process.kill.assert_called_once_with()
+
+    def test_run_git_cmd_runs_at_most_limit_of_git_processes_concurrently(
+            self):
+        git_processes = ConcurrencyLimiter(limit=2)
+        running = []
+        max_running = []
+
+        async def create_subprocess_exec(*args, **kwargs):
+            running.append(args)
+            max_running.append(len(running))
+            await asyncio.sleep(0.01)
+            running.pop()
+            return mock.Mock(
+                returncode=0,
+                communicate=mock.AsyncMock(return_value=(b'output', b''))
+            )
+
+        async def run_git_cmds():
+            return await asyncio.gather(*(
+                self.async_repo.run_git_cmd(['status']) for _ in range(5)
+            ))
+        with mock.patch('asyncio.create_subprocess_exec',
+                        create_subprocess_exec), \
+                mock.patch('viewer.git.git_processes', git_processes):
+            outputs = asyncio.run(run_git_cmds())
+        self.assertEqual(outputs, ['output'] * 5)
+        self.assertEqual(max(max_running), 2)
+        self.assertEqual(git_processes.stats()['running'], 0)
+        self.assertGreater(git_processes.stats()['waits'], 0)
+
+    def test_run_git_cmd_raises_exception_when_limit_of_git_processes_is_exceeded(
+            self):
+        git_processes = ConcurrencyLimiter(limit=0, max_waiting=0)
+        with mock.patch('viewer.git.git_processes', git_processes):
+            with self.assertRaises(GitProcessLimitExceededError):
+                asyncio.run(self.async_repo.run_git_cmd(['status']))
+
+    def test_run_git_cmd_releases_place_taken_after_deadline(self):
+        git_processes = ConcurrencyLimiter(limit=1)
+        git_processes.acquire()
+        threading.Timer(0.2, git_processes.release).start()
+
+        async def run_git_cmd():
+            with deadline(time.monotonic() + 0.1):
+                await self.async_repo.run_git_cmd(['status'])
+        # The waiting thread takes the place after the deadline.
+        with mock.patch('viewer.git.git_processes', git_processes), \
+                mock.patch('viewer.git._acquire_git_process_slot',
+                           git_processes.acquire):
+            with self.assertRaises(GitDeadlineExceededError):
+                asyncio.run(run_git_cmd())
+        for _ in range(500):
+            if git_processes.stats()['running'] == 0:
+                break
+            time.sleep(0.01)
+        self.assertEqual(git_processes.stats()['running'], 0)
+
+    def test_load_branches_returns_same_branches_as_repo(self):
+        branches = self.load_branches()
+        self.assertEqual(sorted(branches), ['feature0', 'feature3', 'master'])
+        self.assertEqual(
+            branches['feature3'].commit,
+            self.repo.get_commit_for_branch(branches['feature3'])
+        )
+
+    def test_get_unmerged_commit_counts_returns_counts_for_all_branches(self):
+        branches = self.load_branches()
+        counts = asyncio.run(self.async_repo.get_unmerged_commit_counts(
+            branches['master'],
+            [branches['feature0'], branches['feature3']]
+        ))
+        self.assertEqual(counts, {
+            'origin/feature0': CommitCounts(0, None),
+            'origin/feature3': CommitCounts(4, None)
+        })
+
+    def test_get_unmerged_commit_counts_counts_in_process_in_thread(self):
+        run_git(self.repo_path, 'commit-graph', 'write', '--reachable')
+        branches = self.load_branches()
+        threads = []
+        count_unmerged = CommitGraph.count_unmerged
+
+        def count_unmerged_in_thread(graph, *args):
+            threads.append(threading.current_thread())
+            return count_unmerged(graph, *args)
+
+        with mock.patch.object(CommitGraph, 'count_unmerged',
+                               count_unmerged_in_thread):
+            counts = asyncio.run(self.async_repo.get_unmerged_commit_counts(
+                branches['master'],
+                [branches['feature3']]
+            ))
+        self.assertEqual(counts['origin/feature3'], CommitCounts(4, None))
+        self.assertEqual(len(threads), 1)
+        self.assertIsNot(threads[0], threading.current_thread())
+
+    def test_get_unmerged_commits_returns_same_commits_as_repo(self):
+        branches = self.load_branches()
+        commits = asyncio.run(self.async_repo.get_unmerged_commits(
+            branches['master'],
+            branches['feature3'],
+            limit=2
+        ))
+        self.assertEqual(len(commits), 2)
+        results_cache.clear()
+        self.assertEqual(
+            commits,
+            self.repo.get_unmerged_commits(
+                branches['master'], branches['feature3'], limit=2
+            )
+        )
+
+    def test_repr_returns_correct_representation(self):
+        self.assertEqual(repr(self.async_repo),
+                         'AsyncRepo({!r})'.format(self.repo))
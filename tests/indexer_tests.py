@@ -0,0 +1,99 @@
+"""
+    tests.indexer
+    ~~~~~~~~~~~~~
+
+    Tests for the viewer.indexer module.
+
+    :copyright: © 2014 by Petr Zemek <s3rvac@gmail.com> and contributors
+    :license: BSD, see LICENSE for more details
+"""
+
+import threading
+import unittest
+from unittest import mock
+
+from viewer.indexer import Indexer
+
+
+class IndexerTests(unittest.TestCase):
+    """Tests for the Indexer class."""
+
+    def setUp(self):
+        self.fingerprint = 'fingerprint1'
+        self.take_snapshot = mock.Mock(
+            side_effect=lambda: mock.Mock(fingerprint=self.fingerprint)
+        )
+        self.indexer = Indexer(
+            self.take_snapshot,
+            lambda: self.fingerprint,
+            interval=0.01
+        )
+        self.addCleanup(self.indexer.stop)
+
+    def test_get_snapshot_takes_snapshot_when_there_is_none(self):
+        snapshot = self.indexer.get_snapshot()
+        self.assertEqual(snapshot.fingerprint, 'fingerprint1')
+        self.assertEqual(self.take_snapshot.call_count, 1)
+
+    def test_get_snapshot_returns_same_snapshot_when_nothing_changed(self):
+        snapshot = self.indexer.get_snapshot()
+        self.indexer.refresh()
+        self.assertIs(self.indexer.get_snapshot(), snapshot)
+        self.assertEqual(self.take_snapshot.call_count, 1)
+
+    def test_refresh_takes_new_snapshot_when_fingerprint_changes(self):
+        self.indexer.get_snapshot()
+        self.fingerprint = 'fingerprint2'
+        self.indexer.refresh()
+        self.assertEqual(self.indexer.get_snapshot().fingerprint,
+                         'fingerprint2')
+
+    def test_refresh_takes_new_snapshot_when_snapshot_is_not_complete(self):
+        self.take_snapshot.side_effect = lambda: mock.Mock(
+            fingerprint=self.fingerprint, is_complete=False)
+        snapshot = self.indexer.get_snapshot()
+        self.assertIsNot(self.indexer.refresh(), snapshot)
+        self.assertEqual(self.take_snapshot.call_count, 2)
+
+    def test_refresh_takes_new_snapshot_when_forced(self):
+        snapshot = self.indexer.get_snapshot()
+        self.assertIsNot(self.indexer.refresh(force=True), snapshot)
+
+    def test_background_thread_takes_new_snapshot_when_fingerprint_changes(self):
+        taken = threading.Event()
+        self.take_snapshot.side_effect = lambda: (
+            taken.set(), mock.Mock(fingerprint=self.fingerprint))[1]
+        self.indexer.start()
+        self.assertTrue(taken.wait(5))
+        taken.clear()
+        self.fingerprint = 'fingerprint2'
+        self.assertTrue(taken.wait(5))
+        self.assertTrue(self.indexer.is_running)
+
+    def test_stop_stops_background_thread(self):
+        self.indexer.start()
+        self.indexer.stop(timeout=5)
+        self.assertFalse(self.indexer.is_running)
+
+    def test_error_in_background_thread_keeps_previous_snapshot(self):
+        snapshot = self.indexer.get_snapshot()
+        failed = threading.Event()
+
+        def fail():
+            failed.set()
+            raise RuntimeError('error')
+        self.take_snapshot.side_effect = fail
+        self.fingerprint = 'fingerprint2'
+        with mock.patch('viewer.indexer.logger'):
+            self.indexer.start()
+            self.assertTrue(failed.wait(5))
+            self.indexer.stop(timeout=5)
+        self.assertIs(self.indexer.get_snapshot(), snapshot)
+        self.assertIn('RuntimeError', self.indexer.stats()['last_error'])
+
+    def test_stats_returns_number_of_snapshots(self):
+        self.indexer.get_snapshot()
+        stats = self.indexer.stats()
+        self.assertEqual(stats['snapshots'], 1)
+        self.assertFalse(stats['running'])
+        self.assertIsNone(stats['last_error'])
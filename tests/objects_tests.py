@@ -0,0 +1,269 @@
+"""
+    tests.objects
+    ~~~~~~~~~~~~~
+
+    Unit tests for the viewer.objects module.
+
+    Apart from tests of individual functions, the module contains differential
+    tests that generate Git repositories and compare the objects read by
+    ObjectReader with the objects read by Git itself.
+
+    :copyright: © 2014 by Petr Zemek <s3rvac@gmail.com> and contributors
+    :license: BSD, see LICENSE for more details
+"""
+
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+import zlib
+from unittest import mock
+
+from viewer.git import Repo
+from viewer.git import results_cache
+from viewer.objects import ObjectNotFoundError
+from viewer.objects import ObjectReader
+from viewer.objects import ObjectReaderError
+from viewer.objects import apply_delta
+
+
+class ApplyDeltaTests(unittest.TestCase):
+    """Tests for apply_delta()."""
+
+    def test_copy_instruction_copies_part_of_base(self):
+        base = b'0123456789'
+        # Sizes (10, 4), copy 4 bytes from offset 3.
+        delta = bytes([10, 4, 0x80 | 0x01 | 0x10, 3, 4])
+        self.assertEqual(apply_delta(base, delta), b'3456')
+
+    def test_insert_instruction_inserts_data_from_delta(self):
+        base = b'0123456789'
+        # Sizes (10, 3), insert 3 bytes.
+        delta = bytes([10, 3, 3]) + b'abc'
+        self.assertEqual(apply_delta(base, delta), b'abc')
+
+    def test_copy_and_insert_instructions_can_be_combined(self):
+        base = b'0123456789'
+        delta = bytes([10, 6, 0x80 | 0x10, 3, 3]) + b'abc'
+        self.assertEqual(apply_delta(base, delta), b'012abc')
+
+    def test_exception_is_raised_when_base_size_does_not_match(self):
+        with self.assertRaises(ObjectReaderError):
+            apply_delta(b'0123', bytes([10, 3, 3]) + b'abc')
+
+    def test_exception_is_raised_when_result_size_does_not_match(self):
+        with self.assertRaises(ObjectReaderError):
+            apply_delta(b'0123456789', bytes([10, 5, 3]) + b'abc')
+
+
+def run_git(repo_path, *args, input=None):
+    """Runs Git with the given arguments in the given repository and returns
+    its output (`bytes`).
+    """
+    env = dict(
+        os.environ,
+        GIT_AUTHOR_NAME='Petr Zemek',
+        GIT_AUTHOR_EMAIL='s3rvac@gmail.com',
+        GIT_COMMITTER_NAME='Petr Zemek',
+        GIT_COMMITTER_EMAIL='s3rvac@gmail.com',
+        GIT_CONFIG_NOSYSTEM='1',
+        HOME=repo_path
+    )
+    return subprocess.check_output(
+        ['git'] + list(args),
+        cwd=repo_path,
+        env=env,
+        input=input,
+        stderr=subprocess.DEVNULL
+    )
+
+
+def generate_repo(repo_path, num_of_commits=40, tag='v1.0'):
+    """Generates a repository with commits whose files and messages are
+    similar to each other, so they end up as deltas when packed.
+    """
+    run_git(repo_path, 'init', '--quiet')
+    lines = ['Line number {} of a file that slowly changes.\n'.format(i)
+             for i in range(500)]
+    for i in range(num_of_commits):
+        lines[(i * 37) % len(lines)] = 'Changed in commit {}.\n'.format(i)
+        with open(os.path.join(repo_path, 'file.txt'), 'w') as f:
+            f.writelines(lines)
+        run_git(repo_path, 'add', 'file.txt')
+        message = 'Commit number {}\n\n{}'.format(
+            i, 'A long body that is the same in all commits. ' * 20)
+        if i % 10 == 0:
+            # A subject spanning more lines and non-ASCII characters.
+            message = 'Multi-line\nsubject ěščřž {}\n\nBody.'.format(i)
+        run_git(repo_path, 'commit', '--quiet', '--file=-',
+                input=message.encode())
+    run_git(repo_path, 'tag', '--annotate', '--message=Tag', tag)
+
+
+def get_all_objects(repo_path):
+    """Returns a list of tuples ``(hash, type)`` for all objects in the given
+    repository.
+    """
+    output = run_git(
+        repo_path, 'cat-file', '--batch-all-objects', '--batch-check'
+    ).decode()
+    return [tuple(line.split()[:2]) for line in output.splitlines()]
+
+
+@unittest.skipUnless(shutil.which('git'), 'requires git')
+class ObjectReaderDifferentialTests(unittest.TestCase):
+    """Differential tests comparing ObjectReader with Git."""
+
+    def setUp(self):
+        self.repo_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.repo_path)
+        generate_repo(self.repo_path)
+        self.objects_dir = os.path.join(self.repo_path, '.git', 'objects')
+
+    def assert_all_objects_are_read_as_by_git(self):
+        reader = ObjectReader(self.objects_dir)
+        self.addCleanup(reader.close)
+        objects = get_all_objects(self.repo_path)
+        self.assertTrue(objects)
+        for hash, type in objects:
+            content = run_git(self.repo_path, 'cat-file', type, hash)
+            self.assertEqual(reader.read_object(hash), (type, content), hash)
+
+    def assert_commits_are_same_as_from_git_show(self):
+        results_cache.clear()
+        repo = Repo(self.repo_path, read_objects_in_process=True)
+        hashes = run_git(self.repo_path, 'rev-list', '--all').split()
+        for hash in hashes:
+            hash = hash.decode()
+            output = run_git(
+                self.repo_path, 'show', '--quiet',
+                '--format=format:%H%n%an%n%ae%n%at%n%s', hash
+            ).decode()
+            commit = repo.get_commit_from_hash(hash)
+            self.assertEqual(
+                '\n'.join([
+                    commit.hash, commit.author, commit.email,
+                    str(int(commit.date.timestamp())), commit.subject
+                ]),
+                output
+            )
+
+    def test_loose_objects_are_read_as_by_git(self):
+        self.assert_all_objects_are_read_as_by_git()
+
+    def test_objects_in_pack_with_offset_deltas_are_read_as_by_git(self):
+        run_git(self.repo_path, 'repack', '-a', '-d', '-f', '--depth=50',
+                '--window=50', '--quiet')
+        self.assert_all_objects_are_read_as_by_git()
+
+    def test_objects_in_pack_with_ref_deltas_are_read_as_by_git(self):
+        run_git(self.repo_path, 'config', 'repack.useDeltaBaseOffset', 'false')
+        run_git(self.repo_path, 'repack', '-a', '-d', '-f', '--depth=50',
+                '--window=50', '--quiet')
+        self.assert_all_objects_are_read_as_by_git()
+
+    def test_objects_in_more_packs_and_loose_objects_are_read_as_by_git(self):
+        run_git(self.repo_path, 'repack', '-a', '-d', '--quiet')
+        generate_repo(self.repo_path, num_of_commits=5, tag='v2.0')
+        run_git(self.repo_path, 'repack', '-d', '--quiet')
+        generate_repo(self.repo_path, num_of_commits=3, tag='v3.0')
+        self.assert_all_objects_are_read_as_by_git()
+
+    def test_new_pack_is_found_after_repacking(self):
+        reader = ObjectReader(self.objects_dir)
+        self.addCleanup(reader.close)
+        hash, type = get_all_objects(self.repo_path)[0]
+        reader.read_object(hash)
+        run_git(self.repo_path, 'repack', '-a', '-d', '--quiet')
+        run_git(self.repo_path, 'prune-packed')
+        reader = ObjectReader(self.objects_dir, cache_size=0)
+        self.assertEqual(reader.read_object(hash)[0], type)
+
+    def test_commits_are_same_as_from_git_show_for_loose_objects(self):
+        self.assert_commits_are_same_as_from_git_show()
+
+    def test_commits_are_same_as_from_git_show_for_packed_objects(self):
+        run_git(self.repo_path, 'repack', '-a', '-d', '-f', '--quiet')
+        self.assert_commits_are_same_as_from_git_show()
+
+    def test_exception_is_raised_for_nonexisting_object(self):
+        reader = ObjectReader(self.objects_dir)
+        self.addCleanup(reader.close)
+        with self.assertRaises(ObjectNotFoundError):
+            reader.read_object('0' * 40)
+
+    def test_exception_is_raised_for_corrupted_pack_entry(self):
+        run_git(self.repo_path, 'repack', '-a', '-d', '--quiet')
+        hash, _ = get_all_objects(self.repo_path)[0]
+        reader = ObjectReader(self.objects_dir)
+        self.addCleanup(reader.close)
+        with mock.patch('zlib.decompressobj') as decompressobj:
+            decompressobj.return_value.eof = False
+            decompressobj.return_value.decompress.side_effect = zlib.error
+            with self.assertRaises(ObjectReaderError):
+                reader.read_object(hash)
+
+    def test_exception_is_raised_when_pack_is_closed_while_being_read(self):
+        run_git(self.repo_path, 'repack', '-a', '-d', '--quiet')
+        hash, _ = get_all_objects(self.repo_path)[0]
+        reader = ObjectReader(self.objects_dir)
+        packs = reader._get_packs(refresh=False)
+        reader.close()
+        with mock.patch.object(reader, '_get_packs', return_value=packs):
+            with self.assertRaises(ObjectReaderError):
+                reader.read_object(hash)
+
+    def test_removed_pack_is_not_closed_when_packs_are_refreshed(self):
+        run_git(self.repo_path, 'repack', '-a', '-d', '--quiet')
+        hash, type = get_all_objects(self.repo_path)[0]
+        reader = ObjectReader(self.objects_dir, cache_size=0)
+        self.addCleanup(reader.close)
+        packs = reader._get_packs(refresh=False)
+        run_git(self.repo_path, 'repack', '-a', '-d', '-f', '--depth=5',
+                '--quiet')
+        reader._get_packs(refresh=True)
+        with mock.patch.object(reader, '_get_packs', return_value=packs):
+            self.assertEqual(reader.read_object(hash)[0], type)
+
+    def test_exception_is_raised_for_invalid_hash(self):
+        reader = ObjectReader(self.objects_dir)
+        with self.assertRaises(ObjectReaderError):
+            reader.read_object('xyz')
+
+
+@unittest.skipUnless(shutil.which('git'), 'requires git')
+class RepoObjectReaderFallbackTests(unittest.TestCase):
+    """Tests that Repo falls back to Git for objects that cannot be read
+    in-process.
+    """
+
+    def setUp(self):
+        self.repo_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.repo_path)
+        generate_repo(self.repo_path, num_of_commits=2)
+        results_cache.clear()
+
+    def test_commit_is_read_by_git_when_reader_cannot_read_it(self):
+        hash = run_git(self.repo_path, 'rev-parse', 'HEAD').decode().strip()
+        repo = Repo(self.repo_path, read_objects_in_process=True)
+        with mock.patch.object(ObjectReader, 'read_object',
+                               side_effect=ObjectReaderError('error')):
+            commit = repo.get_commit_from_hash(hash)
+        self.assertEqual(commit.hash, hash)
+
+    def test_commit_is_read_by_git_when_pack_is_corrupted(self):
+        run_git(self.repo_path, 'repack', '-a', '-d', '--quiet')
+        hash = run_git(self.repo_path, 'rev-parse', 'HEAD').decode().strip()
+        repo = Repo(self.repo_path, read_objects_in_process=True)
+        with mock.patch('viewer.objects.Pack.read_entry',
+                        side_effect=zlib.error('invalid stored block')):
+            commit = repo.get_commit_from_hash(hash)
+        self.assertEqual(commit.hash, hash)
+
+    def test_tag_is_peeled_by_git(self):
+        tag_hash = run_git(self.repo_path, 'rev-parse', 'v1.0').decode().strip()
+        commit_hash = run_git(
+            self.repo_path, 'rev-parse', 'v1.0^{commit}').decode().strip()
+        repo = Repo(self.repo_path, read_objects_in_process=True)
+        self.assertEqual(repo.get_commit_from_hash(tag_hash).hash, commit_hash)
@@ -0,0 +1,301 @@
+"""
+    tests.refs
+    ~~~~~~~~~~
+
+    Unit tests for the viewer.refs module.
+
+    :copyright: © 2014 by Petr Zemek <s3rvac@gmail.com> and contributors
+    :license: BSD, see LICENSE for more details
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from viewer.refs import RefReader
+from viewer.refs import is_valid_ref_name
+from viewer.refs import uses_reftable
+
+
+HASH1 = '4b34858294e9f4eee1cdd9af58911154b99472e3'
+HASH2 = '8a9abf8ad351dc9c7e2a5ba9f3b4d41c038ea605'
+HASH3 = '207891db5bddbfb0c7210aca8c76ac6a9c5f9859'
+
+
+class IsValidRefNameTests(unittest.TestCase):
+    """Tests for is_valid_ref_name()."""
+
+    def test_returns_true_for_valid_names(self):
+        self.assertTrue(is_valid_ref_name('refs/remotes/origin/master'))
+        self.assertTrue(is_valid_ref_name('refs/remotes/origin/feature/x-1.2'))
+
+    def test_returns_false_for_names_with_dot_dot(self):
+        self.assertFalse(is_valid_ref_name('refs/remotes/origin/../../HEAD'))
+        self.assertFalse(is_valid_ref_name('refs/remotes/origin/a..b'))
+
+    def test_returns_false_for_names_not_under_refs(self):
+        self.assertFalse(is_valid_ref_name('HEAD'))
+        self.assertFalse(is_valid_ref_name('config'))
+
+    def test_returns_false_for_names_violating_other_rules(self):
+        for name in ('refs/remotes/origin/', 'refs/remotes//master',
+                     'refs/remotes/origin/.hidden', 'refs/remotes/origin/x.',
+                     'refs/remotes/origin/x.lock', 'refs/remotes/origin/a b',
+                     'refs/remotes/origin/a~1', 'refs/remotes/origin/a^',
+                     'refs/remotes/origin/a:b', 'refs/remotes/origin/a?',
+                     'refs/remotes/origin/a*', 'refs/remotes/origin/a[',
+                     'refs/remotes/origin/a\\b', 'refs/remotes/origin/a@{1}',
+                     'refs/remotes/origin/a\x7f'):
+            self.assertFalse(is_valid_ref_name(name), name)
+
+
+class RefReaderTests(unittest.TestCase):
+    """A base class for all RefReader tests."""
+
+    def setUp(self):
+        self.git_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.git_dir)
+        self.reader = RefReader(self.git_dir)
+
+    def write_file(self, name, content, git_dir=None):
+        path = os.path.join(git_dir or self.git_dir, *name.split('/'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def write_loose_ref(self, name, value):
+        return self.write_file(name, value + '\n')
+
+    def write_packed_refs(self, refs):
+        self.write_file('packed-refs', '# pack-refs with: sorted\n' + ''.join(
+            '{} {}\n'.format(hash, name) for name, hash in refs
+        ))
+
+
+class RefReaderReadRefsTests(RefReaderTests):
+    """Tests for RefReader.read_refs() and RefReader.read_packed_refs()."""
+
+    def test_returns_empty_dict_when_there_are_no_refs(self):
+        self.assertEqual(self.reader.read_refs('refs/remotes/origin/'), {})
+
+    def test_returns_loose_refs(self):
+        self.write_loose_ref('refs/remotes/origin/master', HASH1)
+        self.write_loose_ref('refs/remotes/origin/feature/x', HASH2)
+        self.assertEqual(self.reader.read_refs('refs/remotes/origin/'), {
+            'refs/remotes/origin/master': HASH1,
+            'refs/remotes/origin/feature/x': HASH2
+        })
+
+    def test_returns_packed_refs(self):
+        self.write_packed_refs([
+            ('refs/remotes/origin/master', HASH1),
+            ('refs/tags/v1.0', HASH2)
+        ])
+        self.assertEqual(self.reader.read_refs('refs/remotes/origin/'), {
+            'refs/remotes/origin/master': HASH1
+        })
+
+    def test_peeled_lines_in_packed_refs_are_skipped(self):
+        self.write_file('packed-refs', '{} refs/tags/v1.0\n^{}\n'.format(
+            HASH1, HASH2))
+        self.assertEqual(self.reader.read_packed_refs(), {
+            'refs/tags/v1.0': HASH1
+        })
+
+    def test_loose_ref_takes_precedence_over_packed_ref(self):
+        self.write_packed_refs([('refs/remotes/origin/master', HASH1)])
+        self.write_loose_ref('refs/remotes/origin/master', HASH2)
+        self.assertEqual(self.reader.read_refs('refs/remotes/origin/'), {
+            'refs/remotes/origin/master': HASH2
+        })
+
+    def test_refs_with_other_prefix_are_not_returned(self):
+        self.write_loose_ref('refs/remotes/origin/master', HASH1)
+        self.write_loose_ref('refs/remotes/other/master', HASH2)
+        self.assertEqual(
+            list(self.reader.read_refs('refs/remotes/origin/')),
+            ['refs/remotes/origin/master']
+        )
+
+    def test_lock_files_are_skipped(self):
+        self.write_loose_ref('refs/remotes/origin/master.lock', HASH1)
+        self.assertEqual(self.reader.read_refs('refs/remotes/origin/'), {})
+
+    def test_packed_refs_are_parsed_again_when_file_changes(self):
+        self.write_packed_refs([('refs/remotes/origin/master', HASH1)])
+        self.reader.read_packed_refs()
+        self.write_packed_refs([
+            ('refs/remotes/origin/master', HASH2),
+            ('refs/remotes/origin/other', HASH3)
+        ])
+        self.assertEqual(
+            self.reader.read_packed_refs()['refs/remotes/origin/master'],
+            HASH2
+        )
+
+    def test_packed_refs_are_not_parsed_again_when_file_does_not_change(self):
+        self.write_packed_refs([('refs/remotes/origin/master', HASH1)])
+        refs = self.reader.read_packed_refs()
+        self.assertIs(self.reader.read_packed_refs(), refs)
+
+    def test_refs_are_read_from_common_dir_of_linked_working_tree(self):
+        common_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, common_dir)
+        self.write_file('refs/remotes/origin/master', HASH1, common_dir)
+        self.write_file('commondir', common_dir + '\n')
+        reader = RefReader(self.git_dir)
+        self.assertEqual(reader.read_refs('refs/remotes/origin/'), {
+            'refs/remotes/origin/master': HASH1
+        })
+
+
+class RefReaderResolveTests(RefReaderTests):
+    """Tests for RefReader.resolve()."""
+
+    def test_returns_none_when_there_is_no_such_ref(self):
+        self.assertIsNone(self.reader.resolve('refs/remotes/origin/master'))
+
+    def test_returns_hash_of_loose_ref(self):
+        self.write_loose_ref('refs/remotes/origin/master', HASH1)
+        self.assertEqual(
+            self.reader.resolve('refs/remotes/origin/master'), HASH1)
+
+    def test_returns_hash_of_packed_ref(self):
+        self.write_packed_refs([('refs/remotes/origin/master', HASH1)])
+        self.assertEqual(
+            self.reader.resolve('refs/remotes/origin/master'), HASH1)
+
+    def test_follows_symbolic_refs(self):
+        self.write_loose_ref('refs/remotes/origin/HEAD',
+                             'ref: refs/remotes/origin/master')
+        self.write_packed_refs([('refs/remotes/origin/master', HASH1)])
+        self.assertEqual(self.reader.resolve('refs/remotes/origin/HEAD'), HASH1)
+
+    def test_returns_none_for_invalid_name(self):
+        self.write_file('config', HASH1 + '\n')
+        self.assertIsNone(self.reader.resolve('refs/../config'))
+
+    def test_returns_none_for_loose_ref_with_invalid_contents(self):
+        self.write_loose_ref('refs/remotes/origin/master', '[core]')
+        self.assertIsNone(self.reader.resolve('refs/remotes/origin/master'))
+
+    def test_returns_none_for_symbolic_ref_outside_of_refs(self):
+        self.write_file('HEAD', HASH1 + '\n')
+        self.write_loose_ref('refs/remotes/origin/HEAD', 'ref: HEAD')
+        self.assertIsNone(self.reader.resolve('refs/remotes/origin/HEAD'))
+
+    def test_returns_none_for_cycle_of_symbolic_refs(self):
+        self.write_loose_ref('refs/heads/a', 'ref: refs/heads/b')
+        self.write_loose_ref('refs/heads/b', 'ref: refs/heads/a')
+        self.assertIsNone(self.reader.resolve('refs/heads/a'))
+
+
+class RefReaderGetRemoteBranchTipsTests(RefReaderTests):
+    """Tests for RefReader.get_remote_branch_tips()."""
+
+    def test_returns_names_and_hashes_of_branches(self):
+        self.write_loose_ref('refs/remotes/origin/feature/x', HASH1)
+        self.write_packed_refs([('refs/remotes/origin/master', HASH2)])
+        self.assertEqual(self.reader.get_remote_branch_tips('origin'), {
+            'feature/x': HASH1,
+            'master': HASH2
+        })
+
+    def test_symbolic_refs_are_skipped(self):
+        self.write_loose_ref('refs/remotes/origin/HEAD',
+                             'ref: refs/remotes/origin/master')
+        self.write_loose_ref('refs/remotes/origin/master', HASH1)
+        self.assertEqual(self.reader.get_remote_branch_tips('origin'), {
+            'master': HASH1
+        })
+
+
+class RefReaderFingerprintTests(RefReaderTests):
+    """Tests for RefReader.fingerprint()."""
+
+    def test_fingerprint_does_not_change_when_refs_do_not_change(self):
+        self.write_loose_ref('refs/remotes/origin/master', HASH1)
+        self.assertEqual(self.reader.fingerprint(), self.reader.fingerprint())
+
+    def test_fingerprint_changes_when_ref_changes(self):
+        self.write_loose_ref('refs/remotes/origin/master', HASH1)
+        fingerprint = self.reader.fingerprint()
+        self.write_loose_ref('refs/remotes/origin/master', HASH2)
+        self.assertNotEqual(self.reader.fingerprint(), fingerprint)
+
+    def test_fingerprint_changes_when_ref_is_added(self):
+        self.write_loose_ref('refs/remotes/origin/master', HASH1)
+        fingerprint = self.reader.fingerprint()
+        self.write_loose_ref('refs/remotes/origin/other', HASH1)
+        self.assertNotEqual(self.reader.fingerprint(), fingerprint)
+
+    def test_fingerprint_does_not_change_when_refs_are_packed(self):
+        self.write_loose_ref('refs/remotes/origin/master', HASH1)
+        fingerprint = self.reader.fingerprint()
+        os.remove(os.path.join(
+            self.git_dir, 'refs', 'remotes', 'origin', 'master'))
+        self.write_packed_refs([('refs/remotes/origin/master', HASH1)])
+        self.assertEqual(self.reader.fingerprint(), fingerprint)
+
+
+class UsesReftableTests(RefReaderTests):
+    """Tests for uses_reftable()."""
+
+    def test_returns_false_for_refs_in_files(self):
+        self.write_file('config', '[core]\n\tbare = false\n')
+        self.assertFalse(uses_reftable(self.git_dir))
+
+    def test_returns_true_when_there_is_list_of_reftables(self):
+        self.write_file('reftable/tables.list', '')
+        self.assertTrue(uses_reftable(self.git_dir))
+
+    def test_returns_true_when_ref_storage_is_reftable_in_config(self):
+        self.write_file(
+            'config',
+            '[core]\n\trepositoryformatversion = 1\n'
+            '[extensions]\n\trefStorage = reftable\n'
+        )
+        self.assertTrue(uses_reftable(self.git_dir))
+
+
+class RefReaderWithReftableTests(RefReaderTests):
+    """Tests for RefReader with references in the reftable format."""
+
+    def setUp(self):
+        super().setUp()
+        self.write_file('reftable/tables.list', '')
+        self.refs = {
+            'refs/remotes/origin/HEAD': 'ref: refs/remotes/origin/master',
+            'refs/remotes/origin/master': HASH1,
+            'refs/remotes/origin/feature': HASH2
+        }
+
+        def list_refs(prefix):
+            return {name: value for name, value in self.refs.items()
+                    if name.startswith(prefix)}
+        self.reader = RefReader(self.git_dir, list_refs=list_refs)
+
+    def test_read_refs_returns_listed_refs(self):
+        self.assertEqual(self.reader.read_refs('refs/remotes/origin/'),
+                         self.refs)
+
+    def test_resolve_follows_listed_symbolic_refs(self):
+        self.assertEqual(self.reader.resolve('refs/remotes/origin/HEAD'),
+                         HASH1)
+
+    def test_get_remote_branch_tips_returns_listed_branches(self):
+        self.assertEqual(self.reader.get_remote_branch_tips('origin'), {
+            'master': HASH1,
+            'feature': HASH2
+        })
+
+    def test_fingerprint_changes_when_listed_ref_changes(self):
+        fingerprint = self.reader.fingerprint()
+        self.refs['refs/remotes/origin/feature'] = HASH3
+        self.assertNotEqual(self.reader.fingerprint(), fingerprint)
+
+    def test_no_refs_are_read_without_function_listing_them(self):
+        self.write_loose_ref('refs/remotes/origin/master', HASH1)
+        self.assertEqual(RefReader(self.git_dir).read_refs('refs/'), {})
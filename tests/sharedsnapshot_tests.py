@@ -0,0 +1,261 @@
+"""
+    tests.sharedsnapshot
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Tests for the viewer.sharedsnapshot module.
+
+    :copyright: © 2014 by Petr Zemek <s3rvac@gmail.com> and contributors
+    :license: BSD, see LICENSE for more details
+"""
+
+import datetime
+import json
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+import zlib
+from unittest import mock
+
+from tests.git_tests import get_new_commit
+from viewer.git import CommitCounts
+from viewer.sharedsnapshot import SharedSnapshot
+from viewer.sharedsnapshot import SharedSnapshotError
+from viewer.sharedsnapshot import dump_snapshot
+from viewer.sharedsnapshot import is_supported
+from viewer.sharedsnapshot import load_snapshot
+from viewer.snapshot import BranchSnapshot
+from viewer.snapshot import Snapshot
+
+
+def get_snapshot(fingerprint='fingerprint1', with_pending_branch=True):
+    """Returns a snapshot with the given fingerprint.
+
+    When `with_pending_branch` is `True`, the snapshot is not complete.
+    """
+    commit1 = get_new_commit()
+    commit2 = get_new_commit()
+    pending_branches = []
+    if with_pending_branch:
+        pending_branches.append(BranchSnapshot('origin', 'pending', commit2))
+    return Snapshot(
+        repo_name='repo',
+        remote='origin',
+        last_update_date=datetime.datetime(2014, 12, 24, 10, 20, 30),
+        master_branch=BranchSnapshot('origin', 'master'),
+        shown_branches=[
+            BranchSnapshot('origin', 'branch1', commit1, [commit1, commit2]),
+            BranchSnapshot('origin', 'branch2', commit2),
+            *pending_branches
+        ],
+        ignored_branches=[BranchSnapshot('origin', 'ignored')],
+        unmerged_commit_counts={
+            'origin/branch1': CommitCounts(2, None),
+            'origin/branch2': CommitCounts(0, 3)
+        },
+        fingerprint=fingerprint,
+        num_of_shown_branches=10
+    )
+
+
+def get_snapshot_data(snapshot):
+    """Returns all data in the given snapshot (snapshots cannot be compared
+    directly).
+    """
+    return (
+        snapshot.repo_name,
+        snapshot.remote,
+        snapshot.last_update_date,
+        snapshot.master_branch,
+        snapshot.shown_branches,
+        [branch.commit for branch in snapshot.shown_branches],
+        snapshot.ignored_branches,
+        snapshot.unmerged_commit_counts,
+        snapshot.fingerprint,
+        snapshot.date,
+        snapshot.num_of_shown_branches
+    )
+
+
+def try_to_become_leader_in_child_process(shared_snapshot):
+    """Returns the result of trying to become the leader in a forked
+    process.
+    """
+    context = multiprocessing.get_context('fork')
+    queue = context.Queue()
+    process = context.Process(
+        target=lambda: queue.put(
+            (shared_snapshot.is_leader, shared_snapshot.try_to_become_leader())
+        )
+    )
+    process.start()
+    result = queue.get(timeout=10)
+    process.join(10)
+    return result
+
+
+class DumpAndLoadSnapshotTests(unittest.TestCase):
+    """Tests for dump_snapshot() and load_snapshot()."""
+
+    def test_loaded_snapshot_contains_same_data_as_dumped_one(self):
+        snapshot = get_snapshot()
+        generation, loaded_snapshot = load_snapshot(dump_snapshot(snapshot, 7))
+        self.assertEqual(generation, 7)
+        self.assertEqual(get_snapshot_data(loaded_snapshot),
+                         get_snapshot_data(snapshot))
+
+    def test_commits_in_more_branches_are_dumped_only_once(self):
+        data = dump_snapshot(get_snapshot(), 1)
+        payload = json.loads(zlib.decompress(data[20:-20]).decode())
+        self.assertEqual(len(payload['commits']), 2)
+
+    def test_load_raises_exception_for_invalid_data(self):
+        with self.assertRaises(SharedSnapshotError):
+            load_snapshot(b'invalid data')
+
+    def test_load_raises_exception_for_corrupted_data(self):
+        data = bytearray(dump_snapshot(get_snapshot(), 1))
+        data[30] ^= 0xff
+        with self.assertRaises(SharedSnapshotError):
+            load_snapshot(bytes(data))
+
+    def test_load_raises_exception_for_unsupported_version(self):
+        with mock.patch('viewer.sharedsnapshot.VERSION', 2):
+            data = dump_snapshot(get_snapshot(), 1)
+        with self.assertRaises(SharedSnapshotError):
+            load_snapshot(data)
+
+
+class IsSupportedTests(unittest.TestCase):
+    """Tests for the is_supported() function."""
+
+    def test_returns_true_when_fcntl_is_available(self):
+        self.assertTrue(is_supported())
+
+    def test_returns_false_when_fcntl_cannot_be_imported(self):
+        # Reloading the module in this process would replace its classes, so
+        # it is imported in a new process.
+        output = subprocess.check_output([
+            sys.executable, '-c',
+            'import sys; sys.modules["fcntl"] = None; '
+            'import viewer.web; '
+            'from viewer.sharedsnapshot import is_supported; '
+            'print(is_supported())'
+        ], cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        self.assertEqual(output.strip(), b'False')
+
+
+class SharedSnapshotTests(unittest.TestCase):
+    """Tests for the SharedSnapshot class."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.leader = self.create_shared_snapshot()
+        self.assertTrue(self.leader.try_to_become_leader())
+        self.follower = self.create_shared_snapshot()
+
+    def create_shared_snapshot(self):
+        shared_snapshot = SharedSnapshot(os.path.join(self.dir, 'subdir'))
+        self.addCleanup(shared_snapshot.close)
+        return shared_snapshot
+
+    def test_get_snapshot_returns_none_when_nothing_is_published(self):
+        self.assertIsNone(self.follower.get_snapshot())
+
+    def test_published_snapshot_is_loaded_by_other_instance(self):
+        snapshot = get_snapshot()
+        self.leader.publish(snapshot)
+        self.assertEqual(get_snapshot_data(self.follower.get_snapshot()),
+                         get_snapshot_data(snapshot))
+        self.assertEqual(self.follower.stats()['generation'], 1)
+
+    def test_snapshot_is_loaded_only_when_generation_changes(self):
+        self.leader.publish(get_snapshot('fingerprint1'))
+        snapshot = self.follower.get_snapshot()
+        self.assertIs(self.follower.get_snapshot(), snapshot)
+        self.leader.publish(get_snapshot('fingerprint2'))
+        self.assertEqual(self.follower.get_snapshot().fingerprint,
+                         'fingerprint2')
+        self.assertEqual(self.follower.stats()['loads'], 2)
+
+    def test_only_two_latest_snapshots_are_kept(self):
+        for i in range(4):
+            self.leader.publish(get_snapshot())
+        self.assertEqual(
+            sorted(name for name in os.listdir(self.leader.dir)
+                   if name.endswith('.bin')),
+            ['snapshot-3.bin', 'snapshot-4.bin']
+        )
+
+    def test_previous_snapshot_is_kept_when_new_one_cannot_be_loaded(self):
+        self.leader.publish(get_snapshot('fingerprint1'))
+        self.follower.get_snapshot()
+        self.leader.publish(get_snapshot('fingerprint2'))
+        with open(os.path.join(self.leader.dir, 'snapshot-2.bin'), 'wb') as f:
+            f.write(b'corrupted')
+        self.assertEqual(self.follower.get_snapshot().fingerprint,
+                         'fingerprint1')
+
+    def test_other_process_cannot_become_leader(self):
+        self.assertEqual(try_to_become_leader_in_child_process(self.leader),
+                         (False, False))
+
+    def test_other_process_becomes_leader_when_leader_ends(self):
+        self.leader.close()
+        self.assertEqual(try_to_become_leader_in_child_process(self.follower),
+                         (False, True))
+
+    def test_publish_raises_exception_when_process_is_not_leader(self):
+        self.leader.close()
+        with self.assertRaises(SharedSnapshotError):
+            self.leader.publish(get_snapshot())
+
+    def test_leader_takes_and_publishes_snapshot_when_fingerprint_changes(self):
+        take_snapshot = mock.Mock(
+            side_effect=lambda: get_snapshot(with_pending_branch=False)
+        )
+        self.leader.get_or_take_snapshot(take_snapshot, lambda: 'fingerprint1')
+        self.leader.get_or_take_snapshot(take_snapshot, lambda: 'fingerprint1')
+        self.assertEqual(take_snapshot.call_count, 1)
+        self.assertEqual(self.follower.get_snapshot().fingerprint,
+                         'fingerprint1')
+
+    def test_leader_takes_new_snapshot_when_published_one_is_not_complete(
+            self):
+        self.leader.publish(get_snapshot('fingerprint1'))
+        take_snapshot = mock.Mock(
+            side_effect=lambda: get_snapshot(with_pending_branch=False)
+        )
+        snapshot = self.leader.get_or_take_snapshot(
+            take_snapshot, lambda: 'fingerprint1'
+        )
+        self.assertTrue(snapshot.is_complete)
+        self.assertTrue(self.follower.get_snapshot().is_complete)
+
+    def test_follower_returns_published_snapshot_without_taking_new_one(self):
+        self.leader.publish(get_snapshot('fingerprint1'))
+        take_snapshot = mock.Mock()
+        with mock.patch('fcntl.lockf', side_effect=BlockingIOError):
+            snapshot = self.follower.get_or_take_snapshot(
+                take_snapshot, lambda: 'fingerprint2'
+            )
+        self.assertEqual(snapshot.fingerprint, 'fingerprint1')
+        self.assertFalse(take_snapshot.called)
+
+    def test_follower_takes_snapshot_when_nothing_is_published(self):
+        with mock.patch('fcntl.lockf', side_effect=BlockingIOError):
+            snapshot = self.follower.get_or_take_snapshot(
+                get_snapshot, lambda: 'fingerprint1'
+            )
+        self.assertEqual(snapshot.fingerprint, 'fingerprint1')
+        self.assertIsNone(self.follower.stats()['generation'])
+
+    def test_repr_returns_correct_representation(self):
+        self.assertEqual(
+            repr(self.leader),
+            "SharedSnapshot({!r}, 'snapshot')".format(self.leader.dir)
+        )
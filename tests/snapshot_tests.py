@@ -0,0 +1,556 @@
+"""
+    tests.snapshot
+    ~~~~~~~~~~~~~~
+
+    Tests for the viewer.snapshot module.
+
+    :copyright: © 2014 by Petr Zemek <s3rvac@gmail.com> and contributors
+    :license: BSD, see LICENSE for more details
+"""
+
+import asyncio
+import datetime
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from tests.commitgraph_tests import generate_history
+from tests.commitgraph_tests import rev_parse
+from tests.git_tests import get_git_repo_mock
+from tests.git_tests import get_new_commit
+from tests.objects_tests import run_git
+from viewer.git import AsyncRepo
+from viewer.git import Branch
+from viewer.git import CommitCounts
+from viewer.git import GitCmdError
+from viewer.git import GitDeadlineExceededError
+from viewer.git import Repo
+from viewer.git import deadline
+from viewer.git import get_deadline
+from viewer.git import git_processes
+from viewer.git import results_cache
+from viewer.git import set_deadline
+from viewer.snapshot import BranchSnapshot
+from viewer.snapshot import Snapshot
+from viewer.snapshot import StreamedSnapshot
+from viewer.snapshot import take_snapshot
+from viewer.snapshot import take_snapshot_async
+
+
+class BranchSnapshotTests(unittest.TestCase):
+    """Tests for the BranchSnapshot class."""
+
+    def test_data_passed_into_constructor_are_accessible_after_creation(self):
+        commit = get_new_commit()
+        branch = BranchSnapshot('origin', 'feature', commit)
+        self.assertEqual(branch.remote, 'origin')
+        self.assertEqual(branch.name, 'feature')
+        self.assertEqual(branch.full_name, 'origin/feature')
+        self.assertEqual(branch.commit, commit)
+
+    def test_age_is_age_of_commit(self):
+        commit = get_new_commit(date=datetime.datetime(2000, 1, 1))
+        branch = BranchSnapshot('origin', 'feature', commit)
+        self.assertEqual(branch.age.days, commit.age.days)
+
+    def test_unmerged_commits_returns_all_commits_when_there_is_no_limit(self):
+        commits = [get_new_commit(), get_new_commit()]
+        branch = BranchSnapshot('origin', 'feature', get_new_commit(), commits)
+        self.assertEqual(branch.unmerged_commits(mock.Mock()), commits)
+
+    def test_unmerged_commits_respects_limit(self):
+        commits = [get_new_commit(), get_new_commit()]
+        branch = BranchSnapshot('origin', 'feature', get_new_commit(), commits)
+        self.assertEqual(branch.unmerged_commits(mock.Mock(), 1), commits[:1])
+
+    def test_two_snapshots_with_same_data_are_equal(self):
+        commit = get_new_commit()
+        self.assertEqual(
+            BranchSnapshot('origin', 'feature', commit),
+            BranchSnapshot('origin', 'feature', commit)
+        )
+
+    def test_two_snapshots_with_different_commits_are_not_equal(self):
+        self.assertNotEqual(
+            BranchSnapshot('origin', 'feature', get_new_commit()),
+            BranchSnapshot('origin', 'feature', get_new_commit())
+        )
+
+
+class SnapshotTests(unittest.TestCase):
+    """Tests for the Snapshot class."""
+
+    def get_snapshot(self, **kwargs):
+        data = {
+            'repo_name': 'repo',
+            'remote': 'origin',
+            'last_update_date': datetime.datetime.now(),
+            'master_branch': BranchSnapshot('origin', 'master'),
+            'shown_branches': [],
+            'ignored_branches': [],
+            'unmerged_commit_counts': {},
+        }
+        data.update(kwargs)
+        return Snapshot(**data)
+
+    def test_date_is_current_date_by_default(self):
+        snapshot = self.get_snapshot()
+        self.assertLess(snapshot.age.total_seconds(), 60)
+
+    def test_age_is_computed_from_date(self):
+        snapshot = self.get_snapshot(
+            date=datetime.datetime.now() - datetime.timedelta(days=2))
+        self.assertEqual(snapshot.age.days, 2)
+
+    def test_snapshot_cannot_be_changed_by_changing_returned_lists(self):
+        branch = BranchSnapshot('origin', 'feature', get_new_commit())
+        snapshot = self.get_snapshot(
+            shown_branches=[branch],
+            unmerged_commit_counts={branch.full_name: CommitCounts(0, None)}
+        )
+        snapshot.shown_branches.clear()
+        snapshot.unmerged_commit_counts.clear()
+        self.assertEqual(snapshot.shown_branches, [branch])
+        self.assertEqual(len(snapshot.unmerged_commit_counts), 1)
+
+    def test_num_of_shown_branches_is_number_of_shown_branches_by_default(self):
+        snapshot = self.get_snapshot(
+            shown_branches=[BranchSnapshot('origin', 'feature')])
+        self.assertEqual(snapshot.num_of_shown_branches, 1)
+
+    def test_slice_shown_branches_returns_snapshot_with_sliced_branches(self):
+        branches = [BranchSnapshot('origin', name) for name in 'abc']
+        snapshot = self.get_snapshot(
+            shown_branches=branches,
+            unmerged_commit_counts={
+                branch.full_name: CommitCounts(0, None) for branch in branches
+            }
+        )
+        sliced_snapshot = snapshot.slice_shown_branches(slice(1, 2))
+        self.assertEqual(sliced_snapshot.shown_branches, branches[1:2])
+        self.assertEqual(list(sliced_snapshot.unmerged_commit_counts),
+                         ['origin/b'])
+        self.assertEqual(sliced_snapshot.num_of_shown_branches, 3)
+        self.assertEqual(sliced_snapshot.date, snapshot.date)
+
+
+class TakeSnapshotTests(unittest.TestCase):
+    """Tests for take_snapshot()."""
+
+    def setUp(self):
+        self.repo_mock = get_git_repo_mock()
+        self.repo_mock.get_unmerged_commit_counts.side_effect = \
+            lambda master_branch, branches: {
+                branch.full_name: CommitCounts(
+                    1 if branch.name == 'unmerged' else 0, None)
+                for branch in branches
+            }
+        self.repo_mock.map_branches.side_effect = \
+            lambda func, branches: [func(branch) for branch in branches]
+        self.unmerged_commit = get_new_commit()
+        self.repo_mock.get_unmerged_commits.return_value = [
+            self.unmerged_commit]
+        self.repo_mock.load_branches.side_effect = lambda remote, cache: [
+            Branch(self.repo_mock, remote, name, get_new_commit(), cache)
+            for name in ('master', 'merged', 'unmerged', 'ignored')
+        ]
+
+    def take_snapshot(self, **kwargs):
+        args = {
+            'remote': 'origin',
+            'master_branch_name': 'master',
+            'is_ignored': lambda name: name in ('master', 'ignored'),
+            'sort_branches_by': 'name',
+            'unmerged_commits_limit': 5
+        }
+        args.update(kwargs)
+        return take_snapshot(self.repo_mock, **args)
+
+    def test_shown_and_ignored_branches_are_in_snapshot(self):
+        snapshot = self.take_snapshot()
+        self.assertEqual(
+            [branch.name for branch in snapshot.shown_branches],
+            ['merged', 'unmerged']
+        )
+        self.assertEqual(
+            [branch.name for branch in snapshot.ignored_branches],
+            ['master', 'ignored']
+        )
+
+    def test_master_branch_is_in_snapshot(self):
+        snapshot = self.take_snapshot()
+        self.assertEqual(snapshot.master_branch.full_name, 'origin/master')
+
+    def test_unmerged_commits_are_obtained_only_for_unmerged_branches(self):
+        snapshot = self.take_snapshot()
+        self.repo_mock.get_unmerged_commits.assert_called_once_with(
+            mock.ANY, mock.ANY, 5)
+        merged, unmerged = snapshot.shown_branches
+        self.assertEqual(merged.unmerged_commits(), [])
+        self.assertEqual(unmerged.unmerged_commits(), [self.unmerged_commit])
+
+    def test_snapshot_contains_data_from_repository(self):
+        snapshot = self.take_snapshot()
+        self.assertEqual(snapshot.repo_name, self.repo_mock.name)
+        self.assertEqual(
+            snapshot.last_update_date,
+            self.repo_mock.get_date_of_last_update.return_value
+        )
+        self.assertEqual(
+            snapshot.fingerprint,
+            self.repo_mock.get_fingerprint.return_value
+        )
+        self.repo_mock.get_fingerprint.assert_called_once_with('origin')
+
+    def test_only_shown_branches_in_slice_are_in_snapshot(self):
+        snapshot = self.take_snapshot(branches_slice=slice(1, 2))
+        self.assertEqual(
+            [branch.name for branch in snapshot.shown_branches], ['unmerged'])
+        self.assertEqual(snapshot.num_of_shown_branches, 2)
+        self.repo_mock.get_unmerged_commit_counts.assert_called_once_with(
+            mock.ANY, [mock.ANY])
+
+    def test_snapshot_is_complete_when_all_data_are_obtained(self):
+        self.assertTrue(self.take_snapshot().is_complete)
+
+    def test_branch_whose_data_are_not_obtained_before_deadline_is_pending(self):
+        get_counts = self.repo_mock.get_unmerged_commit_counts.side_effect
+
+        def get_unmerged_commit_counts(master_branch, branches):
+            if any(branch.name == 'unmerged' for branch in branches):
+                raise GitDeadlineExceededError('deadline exceeded')
+            return get_counts(master_branch, branches)
+        self.repo_mock.get_unmerged_commit_counts.side_effect = \
+            get_unmerged_commit_counts
+        with deadline(time.monotonic() + 60):
+            snapshot = self.take_snapshot()
+        self.assertFalse(snapshot.is_complete)
+        self.assertEqual(list(snapshot.unmerged_commit_counts),
+                         ['origin/merged'])
+        merged, unmerged = snapshot.shown_branches
+        self.assertEqual(unmerged.name, 'unmerged')
+        self.assertEqual(unmerged.unmerged_commits(), [])
+
+    def test_name_is_obtained_before_data_about_branches_run_out_of_deadline(
+            self):
+        def get_name():
+            # Like a Git command, the name cannot be obtained after the
+            # deadline.
+            if get_deadline() < time.monotonic():
+                raise GitDeadlineExceededError('deadline exceeded')
+            return 'repo'
+        type(self.repo_mock).name = mock.PropertyMock(side_effect=get_name)
+
+        def get_unmerged_commit_counts(master_branch, branches):
+            set_deadline(time.monotonic() - 1)
+            raise GitDeadlineExceededError('deadline exceeded')
+        self.repo_mock.get_unmerged_commit_counts.side_effect = \
+            get_unmerged_commit_counts
+        with deadline(time.monotonic() + 60):
+            snapshot = self.take_snapshot()
+        self.assertEqual(snapshot.repo_name, 'repo')
+        self.assertFalse(snapshot.is_complete)
+        self.assertEqual(snapshot.unmerged_commit_counts, {})
+
+    def test_master_branch_that_is_not_loaded_is_obtained_from_repository(self):
+        snapshot = self.take_snapshot(master_branch_name='develop')
+        self.assertEqual(snapshot.master_branch.name, 'develop')
+
+
+@unittest.skipUnless(shutil.which('git'), 'requires git')
+class TakeSnapshotOfRealRepoTests(unittest.TestCase):
+    """Tests for take_snapshot() and Repo.get_fingerprint() with a real
+    repository.
+    """
+
+    def setUp(self):
+        self.repo_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.repo_path)
+        generate_history(self.repo_path)
+        for name in ('master', 'feature0', 'feature3'):
+            self.update_remote_branch(name, name)
+        open(os.path.join(self.repo_path, '.git', 'FETCH_HEAD'), 'w').close()
+        results_cache.clear()
+        self.repo = Repo(self.repo_path)
+
+    def update_remote_branch(self, name, rev):
+        run_git(self.repo_path, 'update-ref',
+                'refs/remotes/origin/{}'.format(name), rev)
+
+    def take_snapshot(self):
+        return take_snapshot(
+            self.repo,
+            remote='origin',
+            master_branch_name='master',
+            is_ignored=lambda name: name == 'master',
+            sort_branches_by='name',
+            unmerged_commits_limit=2
+        )
+
+    def test_snapshot_contains_branches_on_remote(self):
+        snapshot = self.take_snapshot()
+        feature0, feature3 = snapshot.shown_branches
+        self.assertEqual(feature0.commit.hash,
+                         rev_parse(self.repo_path, 'feature0'))
+        self.assertEqual(snapshot.unmerged_commit_counts, {
+            'origin/feature0': CommitCounts(0, None),
+            'origin/feature3': CommitCounts(4, None)
+        })
+        self.assertEqual(len(feature3.unmerged_commits()), 2)
+        self.assertEqual(snapshot.fingerprint,
+                         self.repo.get_fingerprint('origin'))
+
+    def test_fingerprint_changes_when_branch_on_remote_changes(self):
+        fingerprint = self.repo.get_fingerprint('origin')
+        self.update_remote_branch('feature0', 'feature1')
+        self.assertNotEqual(self.repo.get_fingerprint('origin'), fingerprint)
+
+    def test_fingerprint_changes_when_repository_is_updated(self):
+        fingerprint = self.repo.get_fingerprint('origin')
+        fetch_head = os.path.join(self.repo_path, '.git', 'FETCH_HEAD')
+        os.utime(fetch_head, (time.time() + 10, time.time() + 10))
+        self.assertNotEqual(self.repo.get_fingerprint('origin'), fingerprint)
+
+    def test_fingerprint_does_not_change_when_other_remote_changes(self):
+        fingerprint = self.repo.get_fingerprint('origin')
+        run_git(self.repo_path, 'update-ref', 'refs/remotes/other/x', 'master')
+        self.assertEqual(self.repo.get_fingerprint('origin'), fingerprint)
+
+
+class TakeSnapshotAsyncTests(TakeSnapshotOfRealRepoTests):
+    """Tests for take_snapshot_async()."""
+
+    def take_snapshot(self, branches_slice=None, max_concurrent_branches=None):
+        return asyncio.run(asyncio.wait_for(take_snapshot_async(
+            AsyncRepo(self.repo),
+            remote='origin',
+            master_branch_name='master',
+            is_ignored=lambda name: name == 'master',
+            sort_branches_by='name',
+            unmerged_commits_limit=2,
+            branches_slice=branches_slice,
+            max_concurrent_branches=max_concurrent_branches
+        ), 30))
+
+    def test_snapshot_contains_only_branches_in_slice(self):
+        snapshot = self.take_snapshot(slice(1, 2))
+        self.assertEqual([branch.name for branch in snapshot.shown_branches],
+                         ['feature3'])
+        self.assertEqual(snapshot.num_of_shown_branches, 2)
+        self.assertEqual(snapshot.unmerged_commit_counts, {
+            'origin/feature3': CommitCounts(4, None)
+        })
+
+    def test_branches_whose_data_are_not_obtained_before_deadline_are_pending(self):
+        async_repo = AsyncRepo(self.repo)
+        branches = asyncio.run(async_repo.load_branches('origin'))
+        # The name of the repository is obtained only once.
+        self.repo.name
+
+        async def take_snapshot():
+            with mock.patch.object(async_repo, 'load_branches',
+                                   mock.AsyncMock(return_value=branches)):
+                with deadline(time.monotonic() - 1):
+                    return await take_snapshot_async(
+                        async_repo,
+                        remote='origin',
+                        master_branch_name='master',
+                        is_ignored=lambda name: name == 'master',
+                        sort_branches_by='name',
+                        unmerged_commits_limit=2
+                    )
+        snapshot = asyncio.run(take_snapshot())
+        self.assertEqual(len(snapshot.shown_branches), 2)
+        self.assertEqual(snapshot.unmerged_commit_counts, {})
+        self.assertFalse(snapshot.is_complete)
+
+    def test_snapshot_is_taken_when_name_is_not_resolved_before_deadline(self):
+        async_repo = AsyncRepo(Repo(self.repo_path))
+
+        async def get_unmerged_commit_counts(master_branch, branches):
+            await asyncio.sleep(1)
+            raise GitDeadlineExceededError('deadline exceeded')
+
+        async def take_snapshot():
+            with mock.patch.object(async_repo, 'get_unmerged_commit_counts',
+                                   get_unmerged_commit_counts):
+                with deadline(time.monotonic() + 0.5):
+                    return await take_snapshot_async(
+                        async_repo,
+                        remote='origin',
+                        master_branch_name='master',
+                        is_ignored=lambda name: name == 'master',
+                        sort_branches_by='name',
+                        unmerged_commits_limit=2
+                    )
+        snapshot = asyncio.run(take_snapshot())
+        self.assertEqual(snapshot.repo_name, os.path.basename(self.repo_path))
+        self.assertEqual(len(snapshot.shown_branches), 2)
+        self.assertFalse(snapshot.is_complete)
+
+    def test_branches_over_limits_of_git_processes_are_not_rejected(self):
+        for name in ('feature1', 'feature2'):
+            self.update_remote_branch(name, name)
+        self.addCleanup(setattr, git_processes, 'limit', git_processes.limit)
+        self.addCleanup(setattr, git_processes, 'max_waiting',
+                        git_processes.max_waiting)
+        git_processes.limit = 2
+        git_processes.max_waiting = 1
+        run_git_process = AsyncRepo._run_git_process
+
+        async def run_slow_git_process(self, args):
+            # Commands for all branches would run at the same time.
+            await asyncio.sleep(0.1)
+            return await run_git_process(self, args)
+        with mock.patch.object(AsyncRepo, '_run_git_process',
+                               run_slow_git_process):
+            snapshot = self.take_snapshot(
+                max_concurrent_branches=git_processes.limit
+            )
+        self.assertEqual(len(snapshot.shown_branches), 4)
+        self.assertTrue(snapshot.is_complete)
+
+    def test_data_read_from_repository_are_obtained_outside_event_loop(self):
+        threads = []
+
+        def record_thread(func):
+            def wrapper(*args, **kwargs):
+                threads.append(threading.current_thread())
+                return func(*args, **kwargs)
+            return wrapper
+        with mock.patch.object(self.repo, 'get_fingerprint',
+                               record_thread(self.repo.get_fingerprint)), \
+                mock.patch.object(
+                    self.repo, 'get_date_of_last_update',
+                    record_thread(self.repo.get_date_of_last_update)):
+            self.take_snapshot()
+        self.assertEqual(len(threads), 2)
+        self.assertNotIn(threading.current_thread(), threads)
+
+    def test_snapshot_is_taken_when_max_concurrent_branches_is_zero(self):
+        snapshot = self.take_snapshot(max_concurrent_branches=0)
+        self.assertEqual(len(snapshot.shown_branches), 2)
+        self.assertTrue(snapshot.is_complete)
+
+    def test_other_branches_are_cancelled_when_data_about_branch_fail(self):
+        async_repo = AsyncRepo(self.repo)
+        cancelled = []
+
+        async def get_unmerged_commit_counts(master_branch, branches):
+            if branches[0].name == 'feature0':
+                raise GitCmdError('failure')
+            try:
+                await asyncio.sleep(60)
+            except asyncio.CancelledError:
+                cancelled.append(branches[0].name)
+                raise
+
+        async def take_snapshot():
+            with mock.patch.object(async_repo, 'get_unmerged_commit_counts',
+                                   get_unmerged_commit_counts):
+                with self.assertRaises(GitCmdError):
+                    await take_snapshot_async(
+                        async_repo,
+                        remote='origin',
+                        master_branch_name='master',
+                        is_ignored=lambda name: name == 'master',
+                        sort_branches_by='name',
+                        unmerged_commits_limit=2
+                    )
+            # The other branch has been cancelled before the failure is
+            # reported, not when the event loop is closed.
+            self.assertEqual(cancelled, ['feature3'])
+        asyncio.run(take_snapshot())
+
+
+class StreamedSnapshotTests(unittest.TestCase):
+    """Tests for the StreamedSnapshot class."""
+
+    def setUp(self):
+        self.repo_mock = get_git_repo_mock()
+        self.repo_mock.get_unmerged_commit_counts.side_effect = \
+            lambda master_branch, branches: {
+                branch.full_name: CommitCounts(
+                    1 if branch.name == 'unmerged' else 0, None)
+                for branch in branches
+            }
+        self.repo_mock.imap_branches.side_effect = \
+            lambda func, branches: (func(branch) for branch in branches)
+        self.unmerged_commit = get_new_commit()
+        self.repo_mock.get_unmerged_commits.return_value = [
+            self.unmerged_commit]
+        self.repo_mock.load_branches.side_effect = lambda remote, cache: [
+            Branch(self.repo_mock, remote, name, get_new_commit(), cache)
+            for name in ('master', 'unmerged', 'merged', 'ignored')
+        ]
+        self.snapshot = StreamedSnapshot(
+            self.repo_mock,
+            remote='origin',
+            master_branch_name='master',
+            is_ignored=lambda name: name in ('master', 'ignored'),
+            sort_branches_by='name',
+            unmerged_commits_limit=5
+        )
+
+    def test_creation_runs_no_git_command(self):
+        self.assertFalse(self.repo_mock.method_calls)
+
+    def test_checking_for_shown_branches_does_not_obtain_their_data(self):
+        self.assertTrue(self.snapshot.shown_branches)
+        self.assertEqual(len(self.snapshot.shown_branches), 2)
+        self.assertFalse(self.repo_mock.get_unmerged_commit_counts.called)
+
+    def test_fingerprint_is_obtained_when_branches_are_listed(self):
+        self.repo_mock.get_fingerprint.return_value = 'fingerprint1'
+        self.snapshot.num_of_shown_branches
+        self.repo_mock.get_fingerprint.return_value = 'fingerprint2'
+        self.assertEqual(self.snapshot.fingerprint, 'fingerprint1')
+        self.repo_mock.get_fingerprint.assert_called_once_with('origin')
+
+    def test_branches_are_listed_only_once(self):
+        list(self.snapshot.shown_branches)
+        self.snapshot.ignored_branches
+        self.assertEqual(self.repo_mock.load_branches.call_count, 1)
+
+    def test_shown_branches_yields_branches_with_their_data(self):
+        merged, unmerged = self.snapshot.shown_branches
+        self.assertEqual(merged.name, 'merged')
+        self.assertEqual(merged.unmerged_commits(), [])
+        self.assertEqual(unmerged.unmerged_commits(), [self.unmerged_commit])
+
+    def test_data_about_branch_are_obtained_just_before_it_is_yielded(self):
+        branches = iter(self.snapshot.shown_branches)
+        next(branches)
+        self.assertEqual(self.snapshot.unmerged_commit_counts, {
+            'origin/merged': CommitCounts(0, None)
+        })
+        next(branches)
+        self.assertEqual(len(self.snapshot.unmerged_commit_counts), 2)
+
+    def test_branch_whose_data_are_not_obtained_in_time_is_pending(self):
+        self.repo_mock.get_unmerged_commit_counts.side_effect = \
+            GitDeadlineExceededError('deadline exceeded')
+        branches = list(self.snapshot.shown_branches)
+        self.assertEqual(len(branches), 2)
+        self.assertEqual(self.snapshot.unmerged_commit_counts, {})
+        self.assertFalse(self.snapshot.is_complete)
+
+    def test_ignored_branches_are_in_snapshot(self):
+        self.assertEqual(
+            [branch.name for branch in self.snapshot.ignored_branches],
+            ['master', 'ignored']
+        )
+
+    def test_repository_data_are_in_snapshot(self):
+        self.assertEqual(self.snapshot.repo_name, self.repo_mock.name)
+        self.assertEqual(self.snapshot.remote, 'origin')
+        self.assertEqual(self.snapshot.master_branch.full_name,
+                         'origin/master')
+        self.assertEqual(
+            self.snapshot.last_update_date,
+            self.repo_mock.get_date_of_last_update.return_value
+        )
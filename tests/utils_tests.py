@@ -9,10 +9,17 @@
 """
 
 import os
+import threading
+import time
 import unittest
 from unittest import mock
 
+from viewer.utils import ConcurrencyLimitExceededError
+from viewer.utils import ConcurrencyLimiter
+from viewer.utils import LRUCache
+from viewer.utils import SingleFlight
 from viewer.utils import chdir
+from viewer.utils import iter_nonempty_lines
 from viewer.utils import nonempty_lines
 
 
@@ -60,3 +67,277 @@ class NonemptyLinesTests(unittest.TestCase):
         text = '\ntest1\n\n\ntest2\n\n'
         expected_lines = ['test1', 'test2']
         self.check(text, expected_lines)
+
+
+class IterNonemptyLinesTests(unittest.TestCase):
+    """Tests for iter_nonempty_lines()."""
+
+    def check(self, chunks, expected_lines):
+        self.assertEqual(list(iter_nonempty_lines(chunks)), expected_lines)
+
+    def test_nothing_is_yielded_for_no_chunks(self):
+        self.check([], [])
+
+    def test_line_is_yielded_for_single_chunk_without_newline(self):
+        self.check(['test'], ['test'])
+
+    def test_lines_split_between_chunks_are_joined(self):
+        self.check(['te', 'st1\nte', 'st2\n'], ['test1', 'test2'])
+
+    def test_empty_lines_are_skipped(self):
+        self.check(['\ntest1\n\n', '\ntest2\n\n'], ['test1', 'test2'])
+
+
+class LRUCacheTests(unittest.TestCase):
+    """Tests for LRUCache."""
+
+    def test_get_returns_default_when_item_is_not_cached(self):
+        cache = LRUCache(maxsize=2)
+        self.assertEqual(cache.get('key', 'default'), 'default')
+
+    def test_get_returns_item_that_was_put_into_cache(self):
+        cache = LRUCache(maxsize=2)
+        cache.put('key', 'value')
+        self.assertEqual(cache.get('key'), 'value')
+
+    def test_least_recently_used_item_is_evicted_when_cache_is_full(self):
+        cache = LRUCache(maxsize=2)
+        cache.put('key1', 1)
+        cache.put('key2', 2)
+        cache.get('key1')
+        cache.put('key3', 3)
+        self.assertEqual(cache.get('key1'), 1)
+        self.assertIsNone(cache.get('key2'))
+        self.assertEqual(cache.get('key3'), 3)
+
+    def test_nothing_is_cached_when_maxsize_is_zero(self):
+        cache = LRUCache(maxsize=0)
+        cache.put('key', 'value')
+        self.assertEqual(len(cache), 0)
+
+    def test_decreasing_maxsize_evicts_items(self):
+        cache = LRUCache(maxsize=2)
+        cache.put('key1', 1)
+        cache.put('key2', 2)
+        cache.maxsize = 1
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.get('key2'), 2)
+
+    def test_get_or_compute_computes_value_only_once(self):
+        cache = LRUCache(maxsize=2)
+        compute = mock.Mock(return_value='value')
+        cache.get_or_compute('key', compute)
+        self.assertEqual(cache.get_or_compute('key', compute), 'value')
+        compute.assert_called_once_with()
+
+    def test_hits_and_misses_are_counted(self):
+        cache = LRUCache(maxsize=2)
+        cache.put('key', 'value')
+        cache.get('key')
+        cache.get('key')
+        cache.get('other_key')
+        self.assertEqual(cache.hits, 2)
+        self.assertEqual(cache.misses, 1)
+
+    def test_stats_returns_size_maxsize_hits_and_misses(self):
+        cache = LRUCache(maxsize=2)
+        cache.put('key', 'value')
+        cache.get('key')
+        self.assertEqual(
+            cache.stats(),
+            {'size': 1, 'maxsize': 2, 'hits': 1, 'misses': 0}
+        )
+
+    def test_clear_removes_items_and_resets_counters(self):
+        cache = LRUCache(maxsize=2)
+        cache.put('key', 'value')
+        cache.get('key')
+        cache.clear()
+        self.assertEqual(
+            cache.stats(),
+            {'size': 0, 'maxsize': 2, 'hits': 0, 'misses': 0}
+        )
+
+
+class SingleFlightTests(unittest.TestCase):
+    """Tests for the SingleFlight class."""
+
+    def setUp(self):
+        self.single_flight = SingleFlight()
+
+    def run_concurrently_with_computation(self, key, value='value',
+                                          **kwargs):
+        # Starts a computation of the given value (or of the given exception)
+        # for the key 'key' in another thread, calls do() for the given key
+        # while the computation is in progress, and returns its result.
+        started = threading.Event()
+        finish = threading.Event()
+
+        def compute():
+            started.set()
+            finish.wait(5)
+            if isinstance(value, Exception):
+                raise value
+            return value
+
+        def do():
+            try:
+                self.single_flight.do('key', compute)
+            except Exception:
+                pass
+        thread = threading.Thread(target=do)
+        thread.start()
+        self.addCleanup(thread.join, 5)
+        self.assertTrue(started.wait(5))
+        # The computation is finished by a timer, so the call below is made
+        # while the computation is still in progress.
+        threading.Timer(0.1, finish.set).start()
+        return self.single_flight.do(key, lambda: 'other value', **kwargs)
+
+    def test_do_returns_computed_value(self):
+        self.assertEqual(self.single_flight.do('key', lambda: 'value'),
+                         'value')
+
+    def test_concurrent_call_with_same_key_gets_result_of_computation(self):
+        self.assertEqual(self.run_concurrently_with_computation('key'),
+                         'value')
+        self.assertEqual(self.single_flight.coalesced, 1)
+        self.assertEqual(self.single_flight.computations, 1)
+
+    def test_concurrent_call_with_other_key_computes_its_value(self):
+        self.assertEqual(self.run_concurrently_with_computation('other key'),
+                         'other value')
+        self.assertEqual(self.single_flight.coalesced, 0)
+
+    def test_concurrent_call_computes_value_when_its_deadline_passes(self):
+        self.assertEqual(
+            self.run_concurrently_with_computation(
+                'key', deadline=time.monotonic() - 1),
+            'other value'
+        )
+        self.assertEqual(self.single_flight.computations, 2)
+
+    def test_concurrent_call_computes_value_when_result_is_not_shareable(self):
+        self.assertEqual(
+            self.run_concurrently_with_computation(
+                'key', value='incomplete value',
+                is_shareable=lambda value: value != 'incomplete value'),
+            'other value'
+        )
+
+    def test_concurrent_call_gets_exception_of_computation(self):
+        with self.assertRaises(RuntimeError):
+            self.run_concurrently_with_computation(
+                'key', value=RuntimeError('error'))
+
+    def test_concurrent_call_computes_value_when_exception_is_not_shared(self):
+        self.assertEqual(
+            self.run_concurrently_with_computation(
+                'key', value=RuntimeError('error'),
+                unshared_exceptions=(RuntimeError,)),
+            'other value'
+        )
+
+    def test_value_is_computed_again_after_computation_ends(self):
+        compute = mock.Mock(return_value='value')
+        self.single_flight.do('key', compute)
+        self.single_flight.do('key', compute)
+        self.assertEqual(compute.call_count, 2)
+
+    def test_exception_raised_by_computation_is_propagated(self):
+        def compute():
+            raise RuntimeError('error')
+        with self.assertRaises(RuntimeError):
+            self.single_flight.do('key', compute)
+        self.assertEqual(self.single_flight.stats()['in_progress'], 0)
+
+    def test_stats_returns_computations_coalesced_calls_and_in_progress(self):
+        self.single_flight.do('key', lambda: 'value')
+        self.assertEqual(
+            self.single_flight.stats(),
+            {'computations': 1, 'coalesced': 0, 'in_progress': 0}
+        )
+
+
+class ConcurrencyLimiterTests(unittest.TestCase):
+    """Tests for the ConcurrencyLimiter class."""
+
+    def acquire_in_thread(self, limiter):
+        # Starts a thread that acquires a place and returns an event that is
+        # set once the place has been acquired.
+        acquired = threading.Event()
+
+        def acquire():
+            limiter.acquire()
+            acquired.set()
+        thread = threading.Thread(target=acquire)
+        thread.start()
+        self.addCleanup(thread.join, 5)
+        return acquired
+
+    def wait_for_waiting_callers(self, limiter, num_of_callers):
+        for _ in range(500):
+            if limiter.stats()['waiting'] == num_of_callers:
+                return
+            time.sleep(0.01)
+        self.fail('callers are not waiting')
+
+    def test_number_of_callers_is_not_limited_by_default(self):
+        limiter = ConcurrencyLimiter()
+        for _ in range(100):
+            limiter.acquire()
+        self.assertEqual(limiter.stats()['running'], 100)
+
+    def test_caller_over_limit_waits_until_place_is_released(self):
+        limiter = ConcurrencyLimiter(limit=1)
+        limiter.acquire()
+        acquired = self.acquire_in_thread(limiter)
+        self.wait_for_waiting_callers(limiter, 1)
+        self.assertFalse(acquired.is_set())
+        limiter.release()
+        self.assertTrue(acquired.wait(5))
+        self.assertEqual(limiter.stats()['waits'], 1)
+
+    def test_increasing_limit_lets_waiting_caller_in(self):
+        limiter = ConcurrencyLimiter(limit=1)
+        limiter.acquire()
+        acquired = self.acquire_in_thread(limiter)
+        self.wait_for_waiting_callers(limiter, 1)
+        limiter.limit = 2
+        self.assertTrue(acquired.wait(5))
+
+    def test_error_is_raised_when_too_many_callers_are_waiting(self):
+        limiter = ConcurrencyLimiter(limit=1, max_waiting=1)
+        limiter.acquire()
+        self.acquire_in_thread(limiter)
+        self.wait_for_waiting_callers(limiter, 1)
+        with self.assertRaises(ConcurrencyLimitExceededError):
+            limiter.acquire()
+        self.assertEqual(limiter.stats()['rejected'], 1)
+        limiter.release()
+
+    def test_try_acquire_takes_place_only_when_limit_allows_it(self):
+        limiter = ConcurrencyLimiter(limit=1, max_waiting=0)
+        self.assertTrue(limiter.try_acquire())
+        self.assertFalse(limiter.try_acquire())
+        self.assertEqual(limiter.stats()['running'], 1)
+        self.assertEqual(limiter.stats()['rejected'], 0)
+
+    def test_slot_releases_place_at_end_of_block(self):
+        limiter = ConcurrencyLimiter(limit=1)
+        with limiter.slot():
+            self.assertEqual(limiter.stats()['running'], 1)
+        self.assertEqual(limiter.stats()['running'], 0)
+
+    def test_stats_returns_limits_and_counters(self):
+        limiter = ConcurrencyLimiter(limit=2, max_waiting=3)
+        self.assertEqual(limiter.stats(), {
+            'limit': 2,
+            'max_waiting': 3,
+            'running': 0,
+            'waiting': 0,
+            'rejected': 0,
+            'waits': 0,
+            'total_wait_time': 0.0,
+            'max_wait_time': 0.0
+        })
@@ -8,12 +8,20 @@
     :license: BSD, see LICENSE for more details
 """
 
+import asyncio
+import datetime
+import os
 import re
+import shutil
+import tempfile
+import threading
 import unittest
 from unittest import mock
 
 import viewer
 import viewer.web
+import viewer.sharedsnapshot
+import viewer.web.asgi
 
 from tests.git_tests import get_new_commit
 
@@ -24,12 +32,33 @@ class WebTests(unittest.TestCase):
     def setUp(self):
         # Create a mocked repository.
         self.repo_mock = mock.MagicMock(spec=viewer.git.Repo)
+        self.repo_mock.commit_store = None
+        self.repo_mock.get_date_of_last_update.return_value = \
+            datetime.datetime.now()
+        self.repo_mock.get_unmerged_commit_counts.side_effect = \
+            lambda master_branch, branches: {
+                branch.full_name: viewer.git.CommitCounts(0, None)
+                for branch in branches
+            }
+        self.repo_mock.map_branches.side_effect = \
+            lambda func, branches: [func(branch) for branch in branches]
 
         # Patch repository creation.
         patcher = mock.patch('viewer.git.Repo', return_value=self.repo_mock)
         self.addCleanup(patcher.stop)
         self.repo_cls_mock = patcher.start()
 
+        # Do not reuse repositories from other tests.
+        patcher = mock.patch.dict('viewer.web.views._repos', clear=True)
+        self.addCleanup(patcher.stop)
+        patcher.start()
+
+        # Render pages on every request (tests of the page cache enable it).
+        patcher = mock.patch.dict(viewer.web.app.config, PAGE_CACHE_TTL=0)
+        self.addCleanup(patcher.stop)
+        patcher.start()
+        viewer.web.views.page_cache.clear()
+
         self.app = viewer.web.app.test_client()
 
 
@@ -44,7 +73,27 @@ class GeneralIndexPageTests(WebTests):
         REPO_PATH = '/path/to/repo'
         viewer.web.app.config['GIT_REPO_PATH'] = REPO_PATH
         self.app.get('/')
-        self.repo_cls_mock.assert_called_once_with(REPO_PATH)
+        self.repo_cls_mock.assert_called_once_with(
+            REPO_PATH, pool_size=1, read_objects_in_process=False,
+            master_ancestry_index=False, commit_store_size=None)
+
+    def test_repo_is_created_only_once_for_more_requests(self):
+        self.app.get('/')
+        self.app.get('/')
+        self.assertEqual(self.repo_cls_mock.call_count, 1)
+
+    def test_repo_is_created_again_when_path_in_config_changes(self):
+        viewer.web.app.config['GIT_REPO_PATH'] = '/path/to/repo1'
+        self.app.get('/')
+        viewer.web.app.config['GIT_REPO_PATH'] = '/path/to/repo2'
+        self.app.get('/')
+        self.assertEqual(self.repo_cls_mock.call_count, 2)
+
+    def test_repo_is_initialized_with_pool_size_from_config(self):
+        viewer.web.app.config['GIT_THREAD_POOL_SIZE'] = 4
+        self.app.get('/')
+        self.assertEqual(self.repo_cls_mock.call_args[1]['pool_size'], 4)
+        viewer.web.app.config['GIT_THREAD_POOL_SIZE'] = 1
 
 
 class BranchesOnIndexPageTests(WebTests):
@@ -63,16 +112,17 @@ class BranchesOnIndexPageTests(WebTests):
     def test_remote_from_config_is_used_when_getting_branches(self):
         viewer.web.app.config['GIT_REMOTE'] = self.REMOTE
         self.app.get('/')
-        self.repo_mock.get_branches_on_remote.assert_called_with(self.REMOTE)
+        self.repo_mock.load_branches.assert_called_with(
+            self.REMOTE, mock.ANY)
 
     def test_branches_are_shown(self):
-        self.repo_mock.get_branches_on_remote.return_value = self.BRANCHES
+        self.repo_mock.load_branches.return_value = self.BRANCHES
         rv = self.app.get('/')
         for branch in self.BRANCHES:
             self.assertIn(branch.name, rv.data.decode())
 
     def test_ignores_branch_by_name(self):
-        self.repo_mock.get_branches_on_remote.return_value = self.BRANCHES
+        self.repo_mock.load_branches.return_value = self.BRANCHES
         IGNORED_BRANCH_NAME = self.BRANCHES[1].name
         viewer.web.app.config['GIT_BRANCHES_TO_IGNORE'] = [IGNORED_BRANCH_NAME]
         rv = self.app.get('/')
@@ -83,7 +133,7 @@ class BranchesOnIndexPageTests(WebTests):
         self.assertRegex(rv.data.decode(), EXPECTED_RE)
 
     def test_ignores_branch_by_regular_expression(self):
-        self.repo_mock.get_branches_on_remote.return_value = self.BRANCHES
+        self.repo_mock.load_branches.return_value = self.BRANCHES
         viewer.web.app.config['GIT_BRANCHES_TO_IGNORE'] = ['.*1']
         rv = self.app.get('/')
         EXPECTED_RE = re.compile(
@@ -100,7 +150,7 @@ class CommitsOnIndexPageTests(WebTests):
         super().setUp()
         self.REMOTE = 'test_remote'
         self.BRANCH = viewer.git.Branch(self.repo_mock, self.REMOTE, 'test_branch')
-        self.repo_mock.get_branches_on_remote.return_value = [self.BRANCH]
+        self.repo_mock.load_branches.return_value = [self.BRANCH]
 
     def test_commit_for_branch_is_shown(self):
         COMMIT = get_new_commit()
@@ -112,6 +162,33 @@ class CommitsOnIndexPageTests(WebTests):
         self.assertIn(COMMIT.author, rv.data.decode())
         self.assertIn(COMMIT.email, rv.data.decode())
 
+    def test_unmerged_commits_of_branch_are_shown(self):
+        self.repo_mock.get_commit_for_branch.return_value = get_new_commit()
+        self.repo_mock.get_unmerged_commit_counts.side_effect = None
+        self.repo_mock.get_unmerged_commit_counts.return_value = {
+            self.BRANCH.full_name: viewer.git.CommitCounts(7, None)
+        }
+        UNMERGED_COMMIT = get_new_commit(subject='Unmerged commit')
+        self.repo_mock.get_unmerged_commits.return_value = [UNMERGED_COMMIT]
+        viewer.web.app.config['UNMERGED_COMMITS_LIMIT'] = 1
+        rv = self.app.get('/')
+        self.repo_mock.map_branches.assert_called_once_with(
+            mock.ANY, [self.BRANCH])
+        self.assertIn('showing the last 1', rv.data.decode())
+        self.assertIn('out of 7', rv.data.decode())
+        self.assertIn(UNMERGED_COMMIT.subject, rv.data.decode())
+
+    def test_commit_for_branch_is_obtained_only_once_per_request(self):
+        self.repo_mock.get_commit_for_branch.return_value = get_new_commit()
+        self.repo_mock.load_branches.side_effect = lambda remote, cache: [
+            viewer.git.Branch(self.repo_mock, remote, self.BRANCH.name,
+                              cache=cache)
+        ]
+        self.app.get('/')
+        self.assertEqual(self.repo_mock.get_commit_for_branch.call_count, 1)
+        self.app.get('/')
+        self.assertEqual(self.repo_mock.get_commit_for_branch.call_count, 2)
+
     def test_commit_hash_is_link_to_commit_details_taken_from_config(self):
         COMMIT = get_new_commit()
         self.repo_mock.get_commit_for_branch.return_value = COMMIT
@@ -134,3 +211,1054 @@ class CommitsOnIndexPageTests(WebTests):
         rv = self.app.get('/')
         NOT_EXPECTED_RE = r'{}</a>'.format(COMMIT.short_hash())
         self.assertNotRegex(rv.data.decode(), NOT_EXPECTED_RE)
+
+
+class MetricsPageTests(WebTests):
+    """Tests for the metrics page."""
+
+    def test_metrics_page_shows_results_cache_stats(self):
+        rv = self.app.get('/metrics')
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(
+            rv.get_json()['results_cache'],
+            viewer.git.results_cache.stats()
+        )
+
+    def test_results_cache_size_is_taken_from_config(self):
+        self.addCleanup(setattr, viewer.git.results_cache, 'maxsize',
+                        viewer.git.results_cache.maxsize)
+        viewer.web.app.config['GIT_RESULTS_CACHE_SIZE'] = 123
+        self.app.get('/metrics')
+        self.assertEqual(viewer.git.results_cache.maxsize, 123)
+
+    def test_results_cache_size_is_set_only_when_repo_is_created(self):
+        self.addCleanup(setattr, viewer.git.results_cache, 'maxsize',
+                        viewer.git.results_cache.maxsize)
+        self.app.get('/metrics')
+        viewer.git.results_cache.maxsize = 123
+        self.app.get('/metrics')
+        self.assertEqual(viewer.git.results_cache.maxsize, 123)
+
+    def test_metrics_page_shows_commit_store_stats_when_it_is_kept(self):
+        self.repo_mock.commit_store = mock.Mock()
+        self.repo_mock.commit_store.stats.return_value = {'entries': 1}
+        rv = self.app.get('/metrics')
+        self.assertEqual(rv.get_json()['commit_store'], {'entries': 1})
+
+
+class BackgroundIndexerTests(WebTests):
+    """Tests for showing branches from snapshots taken by the background
+    indexer.
+    """
+
+    def setUp(self):
+        super().setUp()
+        viewer.web.app.config['BACKGROUND_INDEXER'] = True
+        self.addCleanup(
+            viewer.web.app.config.__setitem__, 'BACKGROUND_INDEXER', False)
+
+        # Do not start background threads in tests.
+        patcher = mock.patch('viewer.web.views.Indexer.start')
+        self.addCleanup(patcher.stop)
+        patcher.start()
+        patcher = mock.patch.dict('viewer.web.views._indexers', clear=True)
+        self.addCleanup(patcher.stop)
+        patcher.start()
+
+        self.repo_mock.get_fingerprint.return_value = 'fingerprint1'
+        self.repo_mock.get_commit_for_branch.return_value = get_new_commit()
+        self.repo_mock.load_branches.return_value = [
+            viewer.git.Branch(self.repo_mock, 'origin', 'test_branch')
+        ]
+
+    def test_branches_from_snapshot_are_shown(self):
+        rv = self.app.get('/')
+        self.assertIn('test_branch', rv.data.decode())
+        self.assertIn('Data obtained', rv.data.decode())
+
+    def test_snapshot_is_reused_when_repository_does_not_change(self):
+        self.app.get('/')
+        self.app.get('/')
+        self.assertEqual(self.repo_mock.load_branches.call_count, 1)
+
+    def test_new_snapshot_is_taken_when_repository_changes(self):
+        self.app.get('/')
+        self.repo_mock.get_fingerprint.return_value = 'fingerprint2'
+        viewer.web.views.get_indexer().refresh()
+        self.assertEqual(self.repo_mock.load_branches.call_count, 2)
+
+    def test_page_version_is_from_snapshot_that_is_shown(self):
+        self.app.get('/')
+        # The repository has changed, but the indexer has not taken a new
+        # snapshot yet.
+        self.repo_mock.get_fingerprint.return_value = 'fingerprint2'
+        with viewer.web.app.test_request_context('/'):
+            viewer.web.views.setup_git_repo()
+            self.assertEqual(viewer.web.views.get_page_version()[0],
+                             'fingerprint1')
+
+    def test_indexer_is_started_only_once(self):
+        self.app.get('/')
+        self.app.get('/')
+        viewer.web.views.Indexer.start.assert_called_once_with()
+
+    def test_new_indexer_is_started_in_forked_process(self):
+        self.app.get('/')
+        indexer = viewer.web.views.get_indexer()
+        with mock.patch('os.getpid', return_value=os.getpid() + 1):
+            self.app.get('/')
+            self.assertIsNot(viewer.web.views.get_indexer(), indexer)
+        self.assertEqual(viewer.web.views.Indexer.start.call_count, 2)
+
+    def test_metrics_page_shows_indexer_stats(self):
+        self.app.get('/')
+        rv = self.app.get('/metrics')
+        self.assertEqual(rv.get_json()['indexer']['snapshots'], 1)
+
+    def test_snapshot_is_taken_without_deadline_of_request(self):
+        deadlines = []
+        get_counts = self.repo_mock.get_unmerged_commit_counts.side_effect
+
+        def get_unmerged_commit_counts(master_branch, branches):
+            deadlines.append(viewer.git.get_deadline())
+            return get_counts(master_branch, branches)
+        self.repo_mock.get_unmerged_commit_counts.side_effect = \
+            get_unmerged_commit_counts
+        with mock.patch.dict(viewer.web.app.config, REQUEST_DEADLINE=60):
+            rv = self.app.get('/')
+        self.assertEqual(deadlines, [None])
+        self.assertNotIn('Details pending', rv.data.decode())
+        self.assertTrue(viewer.web.views.get_indexer().get_snapshot().is_complete)
+
+    def test_snapshot_age_is_not_shown_without_indexer(self):
+        viewer.web.app.config['BACKGROUND_INDEXER'] = False
+        rv = self.app.get('/')
+        self.assertNotIn('Data obtained', rv.data.decode())
+
+
+class SharedSnapshotTests(BackgroundIndexerTests):
+    """Tests for sharing snapshots of the background indexer between
+    processes.
+    """
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.dict(viewer.web.app.config, SHARED_SNAPSHOT=True)
+        self.addCleanup(patcher.stop)
+        patcher.start()
+        patcher = mock.patch.dict('viewer.web.views._shared_snapshots',
+                                  clear=True)
+        self.addCleanup(patcher.stop)
+        patcher.start()
+
+        # Snapshots are published into the data directory of the repository.
+        self.data_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.data_dir)
+        self.repo_mock.data_dir = self.data_dir
+        self.repo_mock.name = 'repo'
+        self.repo_mock.get_date_of_last_update.return_value = \
+            datetime.datetime.now()
+
+    def test_snapshot_is_published_for_other_processes(self):
+        self.app.get('/')
+        shared_snapshot = viewer.sharedsnapshot.SharedSnapshot(
+            self.data_dir,
+            viewer.web.views.get_shared_snapshot().name
+        )
+        self.addCleanup(shared_snapshot.close)
+        self.assertEqual(
+            [branch.name for branch in
+             shared_snapshot.get_snapshot().shown_branches],
+            ['test_branch']
+        )
+
+    def test_shared_snapshot_depends_on_configuration(self):
+        shared_snapshot = viewer.web.views.get_shared_snapshot()
+        with mock.patch.dict(viewer.web.app.config,
+                             GIT_MASTER_BRANCH='other_master'):
+            self.assertNotEqual(viewer.web.views.get_shared_snapshot().name,
+                                shared_snapshot.name)
+
+    def test_metrics_page_shows_shared_snapshot_stats(self):
+        self.app.get('/')
+        rv = self.app.get('/metrics')
+        self.assertTrue(rv.get_json()['shared_snapshot']['leader'])
+        self.assertEqual(rv.get_json()['shared_snapshot']['generation'], 1)
+
+    def test_snapshot_is_not_shared_when_platform_does_not_support_it(self):
+        with mock.patch('viewer.sharedsnapshot.fcntl', None):
+            self.app.get('/')
+            rv = self.app.get('/metrics')
+        self.assertNotIn('shared_snapshot', rv.get_json())
+        self.assertEqual(os.listdir(self.data_dir), [])
+
+
+class PageCacheTests(WebTests):
+    """Tests for the cache of rendered index pages."""
+
+    def setUp(self):
+        super().setUp()
+        viewer.web.app.config['PAGE_CACHE_TTL'] = 60
+        self.repo_mock.get_fingerprint.return_value = 'fingerprint1'
+        self.repo_mock.get_commit_for_branch.return_value = get_new_commit()
+        self.repo_mock.load_branches.return_value = [
+            viewer.git.Branch(self.repo_mock, 'origin', 'test_branch')
+        ]
+
+    def test_page_is_rendered_only_once_when_nothing_changes(self):
+        rv1 = self.app.get('/')
+        with mock.patch('viewer.web.views.render_template') as render_mock:
+            rv2 = self.app.get('/')
+        self.assertEqual(rv1.data, rv2.data)
+        self.assertFalse(render_mock.called)
+        self.assertEqual(self.repo_mock.load_branches.call_count, 1)
+
+    def test_page_is_rendered_again_when_repository_changes(self):
+        self.app.get('/')
+        self.repo_mock.get_fingerprint.return_value = 'fingerprint2'
+        self.app.get('/')
+        self.assertEqual(self.repo_mock.load_branches.call_count, 2)
+
+    def test_page_is_cached_under_fingerprint_of_its_snapshot(self):
+        # The repository changes after the version of the page is obtained,
+        # but before the branches are loaded.
+        fingerprints = iter(['fingerprint1'])
+        self.repo_mock.get_fingerprint.side_effect = \
+            lambda remote: next(fingerprints, 'fingerprint2')
+        rv1 = self.app.get('/')
+        self.repo_mock.get_fingerprint.side_effect = None
+        self.repo_mock.get_fingerprint.return_value = 'fingerprint1'
+        self.app.get('/')
+        self.assertEqual(self.repo_mock.load_branches.call_count, 2)
+        self.repo_mock.get_fingerprint.return_value = 'fingerprint2'
+        rv2 = self.app.get('/', headers={'If-None-Match': rv1.headers['ETag']})
+        self.assertEqual(rv2.status_code, 304)
+        self.assertEqual(self.repo_mock.load_branches.call_count, 2)
+
+    def test_page_is_rendered_again_when_config_changes(self):
+        self.app.get('/')
+        with mock.patch.dict(viewer.web.app.config, COMMIT_SUBJECT_LIMIT=10):
+            self.app.get('/')
+        self.assertEqual(self.repo_mock.load_branches.call_count, 2)
+
+    def test_page_is_rendered_again_after_ttl(self):
+        with mock.patch('time.time', return_value=1000):
+            self.app.get('/')
+        with mock.patch('time.time', return_value=1070):
+            self.app.get('/')
+        self.assertEqual(self.repo_mock.load_branches.call_count, 2)
+
+    def test_metrics_page_shows_page_cache_stats(self):
+        self.app.get('/')
+        self.app.get('/')
+        rv = self.app.get('/metrics')
+        self.assertEqual(rv.get_json()['page_cache']['hits'], 1)
+
+
+class ConditionalRequestsTests(WebTests):
+    """Tests for conditional requests of the index page."""
+
+    def setUp(self):
+        super().setUp()
+        self.repo_mock.get_fingerprint.return_value = 'fingerprint1'
+        self.repo_mock.get_date_of_last_update.return_value = \
+            datetime.datetime.fromtimestamp(1500000000)
+        patcher = mock.patch('viewer.web.views._config_files_mtime', 0)
+        self.addCleanup(patcher.stop)
+        patcher.start()
+        self.repo_mock.get_commit_for_branch.return_value = get_new_commit()
+        self.repo_mock.load_branches.return_value = [
+            viewer.git.Branch(self.repo_mock, 'origin', 'test_branch')
+        ]
+
+    def test_response_contains_etag_and_last_modified(self):
+        rv = self.app.get('/')
+        self.assertTrue(rv.headers['ETag'].startswith('W/"'))
+        self.assertEqual(rv.headers['Last-Modified'],
+                         'Fri, 14 Jul 2017 02:40:00 GMT')
+
+    def test_returns_304_for_matching_etag_without_loading_branches(self):
+        etag = self.app.get('/').headers['ETag']
+        self.repo_mock.load_branches.reset_mock()
+        rv = self.app.get('/', headers={'If-None-Match': etag})
+        self.assertEqual(rv.status_code, 304)
+        self.assertEqual(rv.data, b'')
+        self.assertEqual(rv.headers['ETag'], etag)
+        self.assertFalse(self.repo_mock.load_branches.called)
+
+    def test_returns_200_when_etag_does_not_match(self):
+        etag = self.app.get('/').headers['ETag']
+        self.repo_mock.get_fingerprint.return_value = 'fingerprint2'
+        rv = self.app.get('/', headers={'If-None-Match': etag})
+        self.assertEqual(rv.status_code, 200)
+        self.assertNotEqual(rv.headers['ETag'], etag)
+
+    def test_returns_304_when_not_modified_since(self):
+        rv = self.app.get('/', headers={
+            'If-Modified-Since': 'Fri, 14 Jul 2017 02:40:00 GMT'})
+        self.assertEqual(rv.status_code, 304)
+        self.assertFalse(self.repo_mock.load_branches.called)
+
+    def test_returns_200_when_modified_since(self):
+        rv = self.app.get('/', headers={
+            'If-Modified-Since': 'Fri, 14 Jul 2017 02:39:59 GMT'})
+        self.assertEqual(rv.status_code, 200)
+
+    def test_returns_304_for_matching_etag_after_page_cache_ttl(self):
+        viewer.web.app.config['PAGE_CACHE_TTL'] = 60
+        with mock.patch('time.time', return_value=1000):
+            etag = self.app.get('/').headers['ETag']
+        with mock.patch('time.time', return_value=1061):
+            rv = self.app.get('/', headers={'If-None-Match': etag})
+        self.assertEqual(rv.status_code, 304)
+        self.assertEqual(rv.headers['ETag'], etag)
+
+    def test_if_none_match_takes_precedence_over_if_modified_since(self):
+        rv = self.app.get('/', headers={
+            'If-None-Match': 'W/"other"',
+            'If-Modified-Since': 'Fri, 14 Jul 2017 02:40:00 GMT'})
+        self.assertEqual(rv.status_code, 200)
+
+    def test_last_modified_is_date_of_configuration_when_it_is_newer(self):
+        with mock.patch('viewer.web.views._config_files_mtime', 1600000000):
+            rv = self.app.get('/')
+        self.assertEqual(rv.headers['Last-Modified'],
+                         'Sun, 13 Sep 2020 12:26:40 GMT')
+
+    def test_last_modified_is_date_of_snapshot_of_background_indexer(self):
+        with mock.patch.dict(viewer.web.app.config, BACKGROUND_INDEXER=True), \
+                mock.patch('viewer.web.views.Indexer.start'), \
+                mock.patch.dict('viewer.web.views._indexers', clear=True):
+            self.app.get('/')
+            # The repository has been updated, but the indexer has not taken
+            # a new snapshot yet.
+            self.repo_mock.get_date_of_last_update.return_value = \
+                datetime.datetime.fromtimestamp(1600000000)
+            rv = self.app.get('/')
+        self.assertEqual(rv.headers['Last-Modified'],
+                         'Fri, 14 Jul 2017 02:40:00 GMT')
+
+    def test_last_modified_is_not_sent_when_repository_was_never_updated(self):
+        self.repo_mock.get_date_of_last_update.side_effect = FileNotFoundError
+        with mock.patch('viewer.web.views.render_index_page',
+                        return_value='page'):
+            rv = self.app.get('/')
+        self.assertNotIn('Last-Modified', rv.headers)
+
+
+class StreamedIndexPageTests(WebTests):
+    """Tests for streaming of the index page."""
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.dict(viewer.web.app.config, STREAM_INDEX_PAGE=True)
+        self.addCleanup(patcher.stop)
+        patcher.start()
+        self.repo_mock.imap_branches.side_effect = \
+            lambda func, branches: (func(branch) for branch in branches)
+        self.repo_mock.get_fingerprint.return_value = 'fingerprint1'
+        self.repo_mock.get_commit_for_branch.return_value = get_new_commit()
+        self.repo_mock.load_branches.return_value = [
+            viewer.git.Branch(self.repo_mock, 'origin', 'test_branch1'),
+            viewer.git.Branch(self.repo_mock, 'origin', 'test_branch2')
+        ]
+
+    def test_streamed_page_is_same_as_rendered_page(self):
+        streamed_page = self.app.get('/').data
+        viewer.web.app.config['STREAM_INDEX_PAGE'] = False
+        self.assertEqual(self.app.get('/').data, streamed_page)
+
+    def test_beginning_of_page_is_sent_before_branch_data_are_obtained(self):
+        rv = self.app.get('/', buffered=False)
+        parts = rv.response
+        self.assertIn("Branches In", next(parts).decode())
+        self.assertFalse(self.repo_mock.get_unmerged_commit_counts.called)
+        rv.close()
+
+    def test_data_about_branches_are_obtained_one_by_one(self):
+        self.app.get('/').data
+        self.assertEqual(
+            self.repo_mock.get_unmerged_commit_counts.call_count, 2)
+
+    def test_streamed_page_is_stored_into_page_cache(self):
+        viewer.web.app.config['PAGE_CACHE_TTL'] = 60
+        streamed_page = self.app.get('/').data
+        self.repo_mock.load_branches.reset_mock()
+        self.assertEqual(self.app.get('/').data, streamed_page)
+        self.assertFalse(self.repo_mock.load_branches.called)
+
+
+class ApiBranchesTests(WebTests):
+    """Tests for the /api/branches endpoint."""
+
+    def setUp(self):
+        super().setUp()
+        self.branches = [
+            viewer.git.Branch(self.repo_mock, 'origin', name, get_new_commit())
+            for name in ('master', 'a', 'b', 'c', 'd', 'e')
+        ]
+        self.repo_mock.load_branches.return_value = self.branches
+        self.repo_mock.get_unmerged_commit_counts.side_effect = \
+            lambda master_branch, branches: {
+                branch.full_name: viewer.git.CommitCounts(
+                    1 if branch.name == 'b' else 0, None)
+                for branch in branches
+            }
+        self.unmerged_commit = get_new_commit()
+        self.repo_mock.get_unmerged_commits.return_value = [
+            self.unmerged_commit]
+        patcher = mock.patch.dict(
+            viewer.web.app.config,
+            GIT_REMOTE='origin',
+            GIT_MASTER_BRANCH='master',
+            GIT_BRANCHES_TO_IGNORE=['master'],
+            SORT_BRANCHES_BY='name',
+            API_PAGE_SIZE=2,
+            API_MAX_PAGE_SIZE=500
+        )
+        self.addCleanup(patcher.stop)
+        patcher.start()
+
+    def get_json(self, url):
+        rv = self.app.get(url)
+        self.assertEqual(rv.status_code, 200)
+        return rv.get_json()
+
+    def test_returns_first_page_of_shown_branches_by_default(self):
+        data = self.get_json('/api/branches')
+        self.assertEqual(
+            [branch['name'] for branch in data['branches']], ['a', 'b'])
+        self.assertEqual(data['total'], 5)
+        self.assertEqual(data['master_branch'], 'master')
+
+    def test_cursor_returns_next_page(self):
+        data = self.get_json('/api/branches')
+        data = self.get_json(
+            '/api/branches?cursor={}'.format(data['next_cursor']))
+        self.assertEqual(
+            [branch['name'] for branch in data['branches']], ['c', 'd'])
+        data = self.get_json(
+            '/api/branches?cursor={}'.format(data['next_cursor']))
+        self.assertEqual(
+            [branch['name'] for branch in data['branches']], ['e'])
+        self.assertIsNone(data['next_cursor'])
+
+    def test_limit_overrides_default_page_size(self):
+        data = self.get_json('/api/branches?limit=10')
+        self.assertEqual(len(data['branches']), 5)
+        self.assertIsNone(data['next_cursor'])
+
+    def test_branches_are_sorted_by_configured_attribute(self):
+        viewer.web.app.config['SORT_BRANCHES_BY'] = 'name'
+        self.branches.reverse()
+        data = self.get_json('/api/branches')
+        self.assertEqual(
+            [branch['name'] for branch in data['branches']], ['a', 'b'])
+
+    def test_returns_all_fields_by_default(self):
+        data = self.get_json('/api/branches')
+        unmerged = data['branches'][1]
+        self.assertEqual(unmerged['commit']['hash'],
+                         self.branches[2].commit.hash)
+        self.assertEqual(unmerged['ahead'], 1)
+        self.assertEqual(
+            [commit['hash'] for commit in unmerged['unmerged_commits']],
+            [self.unmerged_commit.hash]
+        )
+        self.assertIn('age', unmerged)
+
+    def test_data_about_unmerged_commits_are_obtained_only_for_page(self):
+        self.get_json('/api/branches')
+        self.repo_mock.get_unmerged_commit_counts.assert_called_once_with(
+            mock.ANY, self.branches[1:3])
+        self.assertEqual(self.repo_mock.get_unmerged_commits.call_count, 1)
+
+    def test_fields_selects_returned_fields(self):
+        data = self.get_json('/api/branches?fields=name,age')
+        self.assertEqual(set(data['branches'][0]), {'name', 'age'})
+
+    def test_unmerged_commits_are_not_counted_when_not_requested(self):
+        self.get_json('/api/branches?fields=name,commit')
+        self.assertFalse(self.repo_mock.get_unmerged_commit_counts.called)
+
+    def test_unknown_field_results_in_bad_request(self):
+        rv = self.app.get('/api/branches?fields=name,xxx')
+        self.assertEqual(rv.status_code, 400)
+        self.assertIn('xxx', rv.get_json()['error'])
+
+    def test_invalid_limit_results_in_bad_request(self):
+        for limit in ('0', '-1', 'abc', '1.5', ''):
+            rv = self.app.get('/api/branches?limit={}'.format(limit))
+            self.assertEqual(rv.status_code, 400, limit)
+
+    def test_limit_is_lowered_to_max_page_size(self):
+        viewer.web.app.config['API_MAX_PAGE_SIZE'] = 3
+        data = self.get_json('/api/branches?limit=100000')
+        self.assertEqual(len(data['branches']), 3)
+        self.repo_mock.get_unmerged_commit_counts.assert_called_once_with(
+            mock.ANY, self.branches[1:4])
+
+    def test_cursor_stays_valid_when_its_branch_is_removed(self):
+        data = self.get_json('/api/branches')
+        del self.branches[2]
+        data = self.get_json(
+            '/api/branches?cursor={}'.format(data['next_cursor']))
+        self.assertEqual(
+            [branch['name'] for branch in data['branches']], ['c', 'd'])
+
+    def test_cursor_does_not_repeat_branches_when_branch_moves(self):
+        viewer.web.app.config['SORT_BRANCHES_BY'] = 'age'
+        self.branches[:] = [
+            viewer.git.Branch(
+                self.repo_mock, 'origin', branch.name,
+                get_new_commit(date=datetime.datetime(2014, 12, 24 - i))
+            )
+            for i, branch in enumerate(self.branches)
+        ]
+        data = self.get_json('/api/branches')
+        self.assertEqual(
+            [branch['name'] for branch in data['branches']], ['a', 'b'])
+        # The last branch from the first page is pushed, so it moves to the
+        # top.
+        self.branches[2] = viewer.git.Branch(
+            self.repo_mock, 'origin', 'b',
+            get_new_commit(date=datetime.datetime(2015, 1, 1))
+        )
+        data = self.get_json(
+            '/api/branches?cursor={}'.format(data['next_cursor']))
+        self.assertEqual(
+            [branch['name'] for branch in data['branches']], ['c', 'd'])
+
+    def test_branches_with_same_sort_value_are_paginated_by_names(self):
+        viewer.web.app.config['SORT_BRANCHES_BY'] = 'remote'
+        self.branches.reverse()
+        data = self.get_json('/api/branches')
+        data = self.get_json(
+            '/api/branches?cursor={}'.format(data['next_cursor']))
+        self.assertEqual(
+            [branch['name'] for branch in data['branches']], ['c', 'd'])
+
+    def test_cursor_of_other_sorting_results_in_bad_request(self):
+        data = self.get_json('/api/branches')
+        viewer.web.app.config['SORT_BRANCHES_BY'] = 'age'
+        rv = self.app.get(
+            '/api/branches?cursor={}'.format(data['next_cursor']))
+        self.assertEqual(rv.status_code, 400)
+
+    def test_malformed_cursor_results_in_bad_request(self):
+        rv = self.app.get('/api/branches?cursor=%%%')
+        self.assertEqual(rv.status_code, 400)
+
+
+class LazyBranchDetailsTests(WebTests):
+    """Tests for lazy loading of details about branches."""
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.dict(
+            viewer.web.app.config,
+            LAZY_BRANCH_DETAILS=True,
+            GIT_REMOTE='origin',
+            GIT_MASTER_BRANCH='master',
+            GIT_BRANCHES_TO_IGNORE=['master'],
+            UNMERGED_COMMITS_LIMIT=5
+        )
+        self.addCleanup(patcher.stop)
+        patcher.start()
+        self.repo_mock.refs = mock.Mock()
+        self.repo_mock.refs.get_remote_branch_tips.return_value = {
+            'master': 'a' * 40,
+            'feature/test': 'b' * 40
+        }
+        self.repo_mock.get_commit_for_branch.return_value = get_new_commit()
+        self.repo_mock.load_branches.return_value = [
+            viewer.git.Branch(self.repo_mock, 'origin', name, get_new_commit())
+            for name in ('master', 'feature/test')
+        ]
+
+    def test_index_page_shows_branches_without_obtaining_their_details(self):
+        rv = self.app.get('/')
+        self.assertIn('feature/test', rv.data.decode())
+        self.assertIn('/branch/feature/test', rv.data.decode())
+        self.assertFalse(self.repo_mock.get_unmerged_commit_counts.called)
+        self.assertFalse(self.repo_mock.get_unmerged_commits.called)
+
+    def test_index_page_includes_script_loading_details(self):
+        rv = self.app.get('/')
+        self.assertIn('branch-details.js', rv.data.decode())
+
+    def test_branch_details_shows_unmerged_commits(self):
+        commit = get_new_commit(subject='Unmerged commit')
+        self.repo_mock.get_unmerged_commit_counts.side_effect = \
+            lambda master_branch, branches: {
+                branch.full_name: viewer.git.CommitCounts(1, None)
+                for branch in branches
+            }
+        self.repo_mock.get_unmerged_commits.return_value = [commit]
+        rv = self.app.get('/branch/feature/test')
+        self.assertEqual(rv.status_code, 200)
+        self.assertIn('Unmerged commits (1)', rv.data.decode())
+        self.assertIn('Unmerged commit', rv.data.decode())
+        self.repo_mock.refs.get_remote_branch_tips.assert_called_once_with(
+            'origin')
+        master_branch, branch, limit = \
+            self.repo_mock.get_unmerged_commits.call_args[0]
+        self.assertEqual(master_branch.name, 'master')
+        self.assertEqual(branch.name, 'feature/test')
+        self.assertEqual(limit, 5)
+
+    def test_branch_details_shows_that_branch_has_no_unmerged_commits(self):
+        rv = self.app.get('/branch/feature/test')
+        self.assertIn('No unmerged commits', rv.data.decode())
+        self.assertFalse(self.repo_mock.get_unmerged_commits.called)
+
+    def test_branch_details_of_nonexisting_branch_results_in_not_found(self):
+        rv = self.app.get('/branch/xxx')
+        self.assertEqual(rv.status_code, 404)
+        self.assertFalse(self.repo_mock.get_unmerged_commit_counts.called)
+
+    def test_branch_details_of_path_outside_of_refs_results_in_not_found(self):
+        for url in ('/branch/../../../HEAD', '/branch/..%2F..%2F..%2Fconfig'):
+            rv = self.app.get(url)
+            self.assertEqual(rv.status_code, 404, url)
+        self.assertFalse(self.repo_mock.refs.get_remote_branch_tips.called)
+        self.assertFalse(self.repo_mock.get_unmerged_commit_counts.called)
+
+
+class PaginatedIndexPageTests(WebTests):
+    """Tests for pagination of the index page."""
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.dict(
+            viewer.web.app.config,
+            GIT_REMOTE='origin',
+            GIT_MASTER_BRANCH='master',
+            GIT_BRANCHES_TO_IGNORE=['master'],
+            SORT_BRANCHES_BY='name',
+            BRANCHES_PER_PAGE=2,
+            MAX_BRANCHES_PER_PAGE=500
+        )
+        self.addCleanup(patcher.stop)
+        patcher.start()
+        self.repo_mock.load_branches.return_value = [
+            viewer.git.Branch(self.repo_mock, 'origin', name, get_new_commit())
+            for name in ('master', 'branch_a', 'branch_b', 'branch_c')
+        ]
+
+    def get_page(self, url):
+        rv = self.app.get(url)
+        self.assertEqual(rv.status_code, 200)
+        return rv.data.decode()
+
+    def test_first_page_is_shown_by_default(self):
+        page = self.get_page('/')
+        self.assertIn('branch_a', page)
+        self.assertIn('branch_b', page)
+        self.assertNotIn('branch_c', page)
+        self.assertIn('Page 1 of 2 (3 branches)', page)
+
+    def test_data_are_obtained_only_for_branches_on_page(self):
+        self.get_page('/?page=2')
+        branches = self.repo_mock.get_unmerged_commit_counts.call_args[0][1]
+        self.assertEqual([branch.name for branch in branches], ['branch_c'])
+
+    def test_page_has_links_to_previous_and_next_pages(self):
+        page = self.get_page('/?page=2&per_page=1')
+        self.assertIn('page=1&amp;per_page=1', page)
+        self.assertIn('page=3&amp;per_page=1', page)
+
+    def test_per_page_overrides_configured_number_of_branches(self):
+        page = self.get_page('/?per_page=3')
+        self.assertIn('branch_c', page)
+        self.assertNotIn('Page 1 of', page)
+
+    def test_all_branches_are_shown_when_pagination_is_disabled(self):
+        viewer.web.app.config['BRANCHES_PER_PAGE'] = None
+        page = self.get_page('/')
+        self.assertIn('branch_c', page)
+        self.assertNotIn('Page 1 of', page)
+
+    def test_different_pages_have_different_etags(self):
+        self.assertNotEqual(
+            self.app.get('/?page=1').headers['ETag'],
+            self.app.get('/?page=2').headers['ETag']
+        )
+
+    def test_page_after_last_page_results_in_not_found(self):
+        rv = self.app.get('/?page=3')
+        self.assertEqual(rv.status_code, 404)
+
+    def test_invalid_page_results_in_bad_request(self):
+        for url in ('/?page=0', '/?page=abc', '/?per_page=0',
+                    '/?per_page=xyz', '/?page=-1', '/?per_page='):
+            rv = self.app.get(url)
+            self.assertEqual(rv.status_code, 400, url)
+
+    def test_per_page_is_lowered_to_max_branches_per_page(self):
+        viewer.web.app.config['MAX_BRANCHES_PER_PAGE'] = 1
+        page = self.get_page('/?per_page=100000')
+        self.assertIn('Page 1 of 3 (3 branches)', page)
+
+    def test_streamed_page_contains_only_branches_on_page(self):
+        viewer.web.app.config['STREAM_INDEX_PAGE'] = True
+        self.repo_mock.imap_branches.side_effect = \
+            lambda func, branches: (func(branch) for branch in branches)
+        page = self.get_page('/?page=2')
+        self.assertIn('branch_c', page)
+        self.assertNotIn('branch_a', page)
+        self.assertIn('Page 2 of 2', page)
+
+    def test_lazily_loaded_page_contains_only_branches_on_page(self):
+        viewer.web.app.config['LAZY_BRANCH_DETAILS'] = True
+        page = self.get_page('/?page=2')
+        self.assertIn('branch_c', page)
+        self.assertNotIn('branch_a', page)
+
+
+class SnapshotCoalescingTests(WebTests):
+    """Tests for coalescing of concurrent snapshots."""
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch('viewer.web.views.snapshot_flights',
+                             viewer.utils.SingleFlight())
+        self.addCleanup(patcher.stop)
+        self.snapshot_flights = patcher.start()
+
+    def test_concurrent_requests_share_single_snapshot(self):
+        started = threading.Event()
+        finish = threading.Event()
+        take_snapshot = viewer.web.views.take_snapshot
+
+        def take_snapshot_slowly(*args, **kwargs):
+            started.set()
+            finish.wait(5)
+            return take_snapshot(*args, **kwargs)
+        with mock.patch('viewer.web.views.take_snapshot',
+                        side_effect=take_snapshot_slowly) as take_snapshot_mock:
+            thread = threading.Thread(
+                target=viewer.web.app.test_client().get, args=('/',))
+            thread.start()
+            self.assertTrue(started.wait(5))
+            # The snapshot is finished by a timer, so the request below is
+            # made while the snapshot is still being taken.
+            threading.Timer(0.1, finish.set).start()
+            rv = self.app.get('/')
+            thread.join(5)
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(take_snapshot_mock.call_count, 1)
+        self.assertEqual(self.snapshot_flights.coalesced, 1)
+
+    def test_concurrent_request_takes_own_snapshot_when_shared_is_incomplete(
+            self):
+        started = threading.Event()
+        finish = threading.Event()
+        take_snapshot = viewer.web.views.take_snapshot
+
+        def take_snapshot_slowly(*args, **kwargs):
+            if not started.is_set():
+                started.set()
+                finish.wait(5)
+                # Data about some branches could not be obtained before the
+                # deadline of the first request.
+                return mock.Mock(is_complete=False)
+            return take_snapshot(*args, **kwargs)
+        with mock.patch('viewer.web.views.take_snapshot',
+                        side_effect=take_snapshot_slowly) as take_snapshot_mock:
+            thread = threading.Thread(
+                target=viewer.web.app.test_client().get, args=('/',))
+            thread.start()
+            self.assertTrue(started.wait(5))
+            threading.Timer(0.1, finish.set).start()
+            rv = self.app.get('/')
+            thread.join(5)
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(take_snapshot_mock.call_count, 2)
+
+    def test_concurrent_request_waits_only_until_its_deadline(self):
+        started = threading.Event()
+        finish = threading.Event()
+        self.addCleanup(finish.set)
+        take_snapshot = viewer.web.views.take_snapshot
+
+        def take_snapshot_slowly(*args, **kwargs):
+            if not started.is_set():
+                started.set()
+                finish.wait(5)
+            return take_snapshot(*args, **kwargs)
+        with mock.patch('viewer.web.views.take_snapshot',
+                        side_effect=take_snapshot_slowly) as take_snapshot_mock:
+            thread = threading.Thread(
+                target=viewer.web.app.test_client().get, args=('/',))
+            thread.start()
+            self.addCleanup(thread.join, 5)
+            self.assertTrue(started.wait(5))
+            with mock.patch.dict(viewer.web.app.config, REQUEST_DEADLINE=0.1):
+                rv = self.app.get('/')
+            self.assertFalse(finish.is_set())
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(take_snapshot_mock.call_count, 2)
+
+    def test_metrics_page_shows_number_of_coalesced_requests(self):
+        rv = self.app.get('/metrics')
+        self.assertEqual(rv.get_json()['snapshot_flights']['coalesced'], 0)
+
+
+class GitProcessLimitTests(WebTests):
+    """Tests for the limit of Git processes."""
+
+    def setUp(self):
+        super().setUp()
+        # Restore the limits for other tests.
+        self.addCleanup(setattr, viewer.git.git_processes, 'limit',
+                        viewer.git.git_processes.limit)
+        self.addCleanup(setattr, viewer.git.git_processes, 'max_waiting',
+                        viewer.git.git_processes.max_waiting)
+
+    def test_limits_of_git_processes_are_set_from_configuration(self):
+        with mock.patch.dict(viewer.web.app.config, GIT_MAX_PROCESSES=4,
+                             GIT_MAX_WAITING_PROCESSES=8):
+            self.app.get('/metrics')
+        self.assertEqual(viewer.git.git_processes.limit, 4)
+        self.assertEqual(viewer.git.git_processes.max_waiting, 8)
+
+    def test_limits_of_git_processes_are_set_only_when_repo_is_created(self):
+        self.app.get('/metrics')
+        with mock.patch.dict(viewer.web.app.config, GIT_MAX_PROCESSES=4):
+            self.app.get('/metrics')
+        self.assertNotEqual(viewer.git.git_processes.limit, 4)
+
+    def test_service_unavailable_is_returned_when_limit_is_exceeded(self):
+        self.repo_mock.load_branches.side_effect = \
+            viewer.git.GitProcessLimitExceededError('limit reached')
+        with mock.patch.dict(viewer.web.app.config, GIT_BUSY_RETRY_AFTER=7):
+            rv = self.app.get('/')
+        self.assertEqual(rv.status_code, 503)
+        self.assertEqual(rv.headers['Retry-After'], '7')
+
+    def test_metrics_page_shows_git_processes_stats(self):
+        rv = self.app.get('/metrics')
+        self.assertIn('waiting', rv.get_json()['git_processes'])
+
+
+class RequestDeadlineTests(WebTests):
+    """Tests for the deadline of requests."""
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.dict(
+            viewer.web.app.config,
+            REQUEST_DEADLINE=60,
+            PAGE_CACHE_TTL=60
+        )
+        self.addCleanup(patcher.stop)
+        patcher.start()
+        self.repo_mock.get_commit_for_branch.return_value = get_new_commit()
+        self.repo_mock.load_branches.return_value = [
+            viewer.git.Branch(self.repo_mock, 'origin', 'slow_branch'),
+            viewer.git.Branch(self.repo_mock, 'origin', 'fast_branch')
+        ]
+        get_counts = self.repo_mock.get_unmerged_commit_counts.side_effect
+
+        def get_unmerged_commit_counts(master_branch, branches):
+            self.deadlines.append(viewer.git.get_deadline())
+            if any(branch.name == 'slow_branch' for branch in branches):
+                raise viewer.git.GitDeadlineExceededError('deadline exceeded')
+            return get_counts(master_branch, branches)
+        self.deadlines = []
+        self.repo_mock.get_unmerged_commit_counts.side_effect = \
+            get_unmerged_commit_counts
+
+    def test_deadline_is_set_when_data_are_obtained(self):
+        self.app.get('/')
+        self.assertIsNotNone(self.deadlines[0])
+        self.assertIsNone(viewer.git.get_deadline())
+
+    def test_name_of_repo_is_obtained_without_deadline_when_repo_is_created(
+            self):
+        name_deadlines = []
+
+        def get_name():
+            name_deadlines.append(viewer.git.get_deadline())
+            return 'repo'
+        type(self.repo_mock).name = mock.PropertyMock(side_effect=get_name)
+        self.app.get('/')
+        self.assertIsNone(name_deadlines[0])
+
+    def test_branch_whose_data_are_not_obtained_in_time_is_pending(self):
+        rv = self.app.get('/')
+        self.assertEqual(rv.status_code, 200)
+        self.assertIn('Details pending', rv.data.decode())
+        self.assertIn('fast_branch', rv.data.decode())
+
+    def test_incomplete_page_is_not_cached(self):
+        rv = self.app.get('/')
+        self.assertNotIn('ETag', rv.headers)
+        self.assertIn('no-store', rv.headers['Cache-Control'])
+        self.assertEqual(len(viewer.web.views.page_cache), 0)
+
+    def test_streamed_page_is_obtained_with_deadline(self):
+        viewer.web.app.config['STREAM_INDEX_PAGE'] = True
+        self.repo_mock.imap_branches.side_effect = \
+            lambda func, branches: (func(branch) for branch in branches)
+        rv = self.app.get('/')
+        self.assertIn('Details pending', rv.data.decode())
+        self.assertIsNotNone(self.deadlines[0])
+        self.assertNotIn('ETag', rv.headers)
+        self.assertEqual(len(viewer.web.views.page_cache), 0)
+
+    def test_service_unavailable_is_returned_when_api_runs_out_of_time(self):
+        rv = self.app.get('/api/branches')
+        self.assertEqual(rv.status_code, 503)
+
+
+class AsgiTests(WebTests):
+    """Tests for the ASGI application."""
+
+    def setUp(self):
+        super().setUp()
+        self.BRANCHES = [
+            viewer.git.Branch(self.repo_mock, 'origin', 'test_branch1'),
+            viewer.git.Branch(self.repo_mock, 'origin', 'test_branch2')
+        ]
+        self.repo_mock.get_commit_for_branch.return_value = get_new_commit()
+        self.async_repo_mock = mock.Mock(spec=viewer.git.AsyncRepo)
+        self.async_repo_mock.repo = self.repo_mock
+        self.async_repo_mock.load_branches = mock.AsyncMock(
+            return_value=self.BRANCHES
+        )
+        self.async_repo_mock.get_unmerged_commit_counts = mock.AsyncMock(
+            side_effect=lambda master_branch, branches: {
+                branch.full_name: viewer.git.CommitCounts(0, None)
+                for branch in branches
+            }
+        )
+        patcher = mock.patch('viewer.web.asgi.get_async_repo',
+                             return_value=self.async_repo_mock)
+        self.addCleanup(patcher.stop)
+        patcher.start()
+
+    def request(self, path, headers=()):
+        """Makes a GET request to the ASGI application and returns a tuple
+        ``(status, headers, body)``.
+        """
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b''}
+
+        async def send(message):
+            messages.append(message)
+        scope = {
+            'type': 'http',
+            'method': 'GET',
+            'http_version': '1.1',
+            'path': path,
+            'query_string': b'',
+            'headers': [(name.lower().encode(), value.encode())
+                        for name, value in headers]
+        }
+        asyncio.run(viewer.web.asgi.application(scope, receive, send))
+        start, *bodies = messages
+        return (
+            start['status'],
+            {name.decode(): value.decode() for name, value in start['headers']},
+            b''.join(body['body'] for body in bodies).decode()
+        )
+
+    def test_index_page_shows_branches_obtained_by_async_repo(self):
+        status, _, body = self.request('/')
+        self.assertEqual(status, 200)
+        for branch in self.BRANCHES:
+            self.assertIn(branch.name, body)
+        self.assertFalse(self.repo_mock.load_branches.called)
+        self.assertFalse(self.repo_mock.get_unmerged_commit_counts.called)
+
+    def test_index_page_is_not_modified_when_client_has_current_version(self):
+        _, headers, _ = self.request('/')
+        status, _, body = self.request(
+            '/', headers=[('If-None-Match', headers['etag'])]
+        )
+        self.assertEqual(status, 304)
+        self.assertEqual(body, '')
+
+    def test_version_and_date_of_index_page_are_obtained_outside_event_loop(
+            self):
+        threads = []
+
+        def record_thread(func):
+            def wrapper(*args, **kwargs):
+                # Only calls for the current state of the repository may need
+                # a snapshot or Git (a rendered page is identified by its
+                # snapshot, which is already in memory).
+                if not any(isinstance(arg, viewer.snapshot.Snapshot)
+                           for arg in args):
+                    threads.append(threading.current_thread())
+                return func(*args, **kwargs)
+            return wrapper
+        with mock.patch('viewer.web.views.get_page_version',
+                        record_thread(viewer.web.views.get_page_version)), \
+                mock.patch('viewer.web.views.get_last_modified_date',
+                           record_thread(
+                               viewer.web.views.get_last_modified_date)):
+            status, _, _ = self.request('/')
+        self.assertEqual(status, 200)
+        self.assertEqual(len(threads), 2)
+        self.assertNotIn(threading.current_thread(), threads)
+
+    def test_branches_are_obtained_concurrently_up_to_git_process_limit(self):
+        self.addCleanup(setattr, viewer.git.git_processes, 'limit',
+                        viewer.git.git_processes.limit)
+        with mock.patch('viewer.snapshot.take_snapshot_async',
+                        wraps=viewer.snapshot.take_snapshot_async) as take, \
+                mock.patch.dict(viewer.web.app.config, GIT_MAX_PROCESSES=3):
+            self.request('/')
+        self.assertEqual(take.call_args[1]['max_concurrent_branches'], 3)
+
+    def test_number_of_concurrent_branches_can_be_set_in_config(self):
+        with mock.patch('viewer.snapshot.take_snapshot_async',
+                        wraps=viewer.snapshot.take_snapshot_async) as take, \
+                mock.patch.dict(viewer.web.app.config,
+                                ASGI_MAX_CONCURRENT_BRANCHES=8):
+            self.request('/')
+        self.assertEqual(take.call_args[1]['max_concurrent_branches'], 8)
+
+    def test_incomplete_index_page_is_not_cached(self):
+        self.async_repo_mock.get_unmerged_commit_counts.side_effect = \
+            viewer.git.GitDeadlineExceededError('deadline exceeded')
+        status, headers, body = self.request('/')
+        self.assertEqual(status, 200)
+        self.assertIn('Details pending', body)
+        self.assertIn('no-store', headers['cache-control'])
+
+    def test_error_handlers_of_wsgi_app_are_used_for_index_page(self):
+        self.async_repo_mock.load_branches.side_effect = \
+            viewer.git.GitProcessLimitExceededError('limit reached')
+        status, headers, _ = self.request('/')
+        self.assertEqual(status, 503)
+        self.assertIn('retry-after', headers)
+
+    def test_other_pages_are_served_by_wsgi_app(self):
+        status, headers, body = self.request('/metrics')
+        self.assertEqual(status, 200)
+        self.assertIn('results_cache', body)
+        self.assertEqual(headers['content-type'], 'application/json')
+
+    def test_lifespan_events_are_answered(self):
+        messages = iter([
+            {'type': 'lifespan.startup'},
+            {'type': 'lifespan.shutdown'}
+        ])
+        sent = []
+
+        async def receive():
+            return next(messages)
+
+        async def send(message):
+            sent.append(message['type'])
+        asyncio.run(viewer.web.asgi.application(
+            {'type': 'lifespan'}, receive, send
+        ))
+        self.assertEqual(sent, ['lifespan.startup.complete',
+                                'lifespan.shutdown.complete'])
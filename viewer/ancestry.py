@@ -0,0 +1,138 @@
+"""
+    viewer.ancestry
+    ~~~~~~~~~~~~~~~
+
+    Indexes of commits reachable from a commit (e.g. from the tip of the master
+    branch), which can be stored on disk.
+
+    :copyright: © 2014 by Petr Zemek <s3rvac@gmail.com> and contributors
+    :license: BSD, see LICENSE for more details
+"""
+
+import binascii
+import hashlib
+import os
+import struct
+import tempfile
+
+
+class AncestryIndexError(Exception):
+    """An exception that is raised when an index cannot be loaded."""
+    pass
+
+
+class AncestryIndex:
+    """An immutable set of hashes of all commits reachable from a commit (the
+    tip of the index).
+
+    Checking whether a commit is in the index takes constant time.
+    """
+
+    #: Signature at the beginning of files with indexes.
+    SIGNATURE = b'BVAI'
+
+    #: Version of the format of files with indexes.
+    VERSION = 1
+
+    def __init__(self, tip, hashes=()):
+        """Creates an index.
+
+        :param str tip: Hash of the commit from which all the commits are
+                        reachable.
+        :param iterable hashes: Hashes (`str`) of all commits reachable from
+                                `tip` (including `tip`).
+        """
+        self._tip = tip
+        self._hashes = frozenset(binascii.unhexlify(hash) for hash in hashes)
+
+    @property
+    def tip(self):
+        """Hash of the commit from which all the commits are reachable."""
+        return self._tip
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def __contains__(self, hash):
+        try:
+            return binascii.unhexlify(hash) in self._hashes
+        except (binascii.Error, ValueError):
+            return False
+
+    def extended(self, tip, hashes):
+        """Returns a new index for the given tip that contains all commits
+        from this index and the given ones.
+
+        The commits of this index have to be reachable from `tip`.
+        """
+        index = AncestryIndex(tip, hashes)
+        index._hashes |= self._hashes
+        return index
+
+    def save(self, path):
+        """Saves the index into a file in the given path.
+
+        The file is replaced atomically, so readers never see a partially
+        written index.
+        """
+        # The file is of the following form (all numbers are big-endian):
+        #
+        #   signature (4 bytes), version (4 bytes)
+        #   hash of the tip (20 bytes)
+        #   number of hashes N (4 bytes)
+        #   N x hash (20 bytes, sorted)
+        #   SHA-1 checksum of all the preceding data (20 bytes)
+        data = b''.join([
+            self.SIGNATURE,
+            struct.pack('>I', self.VERSION),
+            binascii.unhexlify(self._tip),
+            struct.pack('>I', len(self._hashes)),
+            b''.join(sorted(self._hashes))
+        ])
+        data += hashlib.sha1(data).digest()
+
+        dir = os.path.dirname(path)
+        os.makedirs(dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=dir, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    @classmethod
+    def load(cls, path):
+        """Loads an index from the file in the given path.
+
+        :raises FileNotFoundError: If there is no such file.
+        :raises AncestryIndexError: If the file is not a valid index.
+        """
+        with open(path, 'rb') as f:
+            data = f.read()
+        if len(data) < 52 or data[:4] != cls.SIGNATURE:
+            raise AncestryIndexError(
+                "invalid ancestry index: '{}'".format(path)
+            )
+        version, = struct.unpack('>I', data[4:8])
+        if version != cls.VERSION:
+            raise AncestryIndexError(
+                "unsupported ancestry index version {}: '{}'".format(
+                    version, path
+                )
+            )
+        if hashlib.sha1(data[:-20]).digest() != data[-20:]:
+            raise AncestryIndexError(
+                "corrupted ancestry index: '{}'".format(path)
+            )
+        num_of_hashes, = struct.unpack('>I', data[28:32])
+        if len(data) != 32 + num_of_hashes * 20 + 20:
+            raise AncestryIndexError(
+                "corrupted ancestry index: '{}'".format(path)
+            )
+        index = cls(binascii.hexlify(data[8:28]).decode())
+        index._hashes = frozenset(
+            data[pos:pos + 20] for pos in range(32, len(data) - 20, 20)
+        )
+        return index
@@ -0,0 +1,477 @@
+"""
+    viewer.commitgraph
+    ~~~~~~~~~~~~~~~~~~
+
+    Reading of the commit-graph files written by Git (``git commit-graph
+    write``, ``gc.writeCommitGraph``, ``fetch.writeCommitGraph``) and walks
+    over the graph of commits that they describe.
+
+    :copyright: © 2014 by Petr Zemek <s3rvac@gmail.com> and contributors
+    :license: BSD, see LICENSE for more details
+"""
+
+import binascii
+import bisect
+import heapq
+import mmap
+import os
+import struct
+import threading
+
+
+class CommitGraphError(Exception):
+    """An exception that is raised when a commit-graph file cannot be read."""
+    pass
+
+
+# A parent position meaning that there is no such parent.
+_NO_PARENT = 0x70000000
+
+# When set in the position of the second parent, the other bits are an index
+# into the list of extra edges (parents of octopus merges).
+_EXTRA_EDGES_FLAG = 0x80000000
+
+# When set in an entry in the list of extra edges, the entry is the last one
+# for the commit.
+_LAST_EDGE_FLAG = 0x80000000
+
+# Flags used when walking the graph (see CommitGraph.count_unmerged()).
+_IN_MASTER = 1
+_IN_OTHER = 2
+
+
+class CommitGraphLayer:
+    """A single commit-graph file.
+
+    The file is mapped into memory, so opening it costs the same regardless of
+    its size.
+    """
+
+    #: Signature at the beginning of commit-graph files.
+    SIGNATURE = b'CGPH'
+
+    def __init__(self, path, base_position=0):
+        """Opens the commit-graph file in the given path.
+
+        :param int base_position: Number of commits in the layers below this
+                                  one (for split commit-graphs).
+
+        :raises CommitGraphError: If the file has an unsupported format.
+        """
+        self._path = path
+        self._base_position = base_position
+        with open(path, 'rb') as f:
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        # The file is of the following form (all numbers are big-endian):
+        #
+        #   signature (4 bytes), version (1 byte), hash version (1 byte),
+        #   number of chunks (1 byte), number of base layers (1 byte)
+        #   chunk table: (number of chunks + 1) x (ID (4 bytes), offset (8
+        #                bytes)); the last entry marks the end of the last
+        #                chunk
+        #   chunks
+        #
+        # We need the following chunks:
+        #
+        #   OIDF: fanout table (256 x 4 bytes, see PackIndex)
+        #   OIDL: N x hash (20 bytes, sorted)
+        #   CDAT: N x (tree hash (20 bytes), positions of the first and second
+        #         parent (2 x 4 bytes), generation number (upper 30 bits of 4
+        #         bytes) and commit date (34 bits))
+        #   EDGE: list of extra edges of octopus merges (4 bytes each;
+        #         optional)
+        if len(self._data) < 8 or self._data[:4] != self.SIGNATURE:
+            raise CommitGraphError(
+                "unsupported commit-graph format: '{}'".format(path)
+            )
+        version, hash_version, num_of_chunks = struct.unpack(
+            '>BBB', self._data[4:7]
+        )
+        if version != 1 or hash_version != 1:
+            raise CommitGraphError(
+                "unsupported commit-graph version {}: '{}'".format(
+                    version, path
+                )
+            )
+        chunks = self._read_chunk_table(num_of_chunks)
+        for chunk_id in (b'OIDF', b'OIDL', b'CDAT'):
+            if chunk_id not in chunks:
+                raise CommitGraphError(
+                    "missing chunk {} in commit-graph '{}'".format(
+                        chunk_id.decode(), path
+                    )
+                )
+        self._fanout = struct.unpack(
+            '>256I', self._data[chunks[b'OIDF']:chunks[b'OIDF'] + 256 * 4]
+        )
+        self._num_of_commits = self._fanout[255]
+        self._hashes_offset = chunks[b'OIDL']
+        self._commit_data_offset = chunks[b'CDAT']
+        self._extra_edges_offset = chunks.get(b'EDGE')
+
+    @property
+    def path(self):
+        """Path to the commit-graph file."""
+        return self._path
+
+    @property
+    def base_position(self):
+        """Position of the first commit in this layer."""
+        return self._base_position
+
+    def __len__(self):
+        return self._num_of_commits
+
+    def find_position(self, binary_hash):
+        """Returns the position of the commit with the given hash (20 `bytes`)
+        in the whole graph, or `None` if there is no such commit in this
+        layer.
+        """
+        first_byte = binary_hash[0]
+        low = self._fanout[first_byte - 1] if first_byte > 0 else 0
+        high = self._fanout[first_byte]
+        pos = bisect.bisect_left(_HashTable(self), binary_hash, low, high)
+        if pos == high or self.hash_at(pos) != binary_hash:
+            return None
+        return self._base_position + pos
+
+    def hash_at(self, pos):
+        """Returns the hash (20 `bytes`) at the given position in this layer.
+        """
+        start = self._hashes_offset + pos * 20
+        return self._data[start:start + 20]
+
+    def read_commit(self, pos):
+        """Returns a tuple ``(generation, parents)`` for the commit at the
+        given position in this layer, where `parents` is a list of positions
+        of parents in the whole graph.
+        """
+        start = self._commit_data_offset + pos * 36 + 20
+        parent1, parent2, generation_and_date = struct.unpack(
+            '>IIQ', self._data[start:start + 16]
+        )
+        generation = generation_and_date >> 34
+        parents = []
+        if parent1 != _NO_PARENT:
+            parents.append(parent1)
+        if parent2 & _EXTRA_EDGES_FLAG:
+            parents.extend(self._read_extra_edges(parent2 & ~_EXTRA_EDGES_FLAG))
+        elif parent2 != _NO_PARENT:
+            parents.append(parent2)
+        return generation, parents
+
+    def _read_chunk_table(self, num_of_chunks):
+        chunks = {}
+        for i in range(num_of_chunks):
+            start = 8 + i * 12
+            chunk_id, offset = struct.unpack(
+                '>4sQ', self._data[start:start + 12]
+            )
+            chunks[chunk_id] = offset
+        return chunks
+
+    def _read_extra_edges(self, index):
+        if self._extra_edges_offset is None:
+            raise CommitGraphError(
+                "missing chunk EDGE in commit-graph '{}'".format(self._path)
+            )
+        parents = []
+        while True:
+            start = self._extra_edges_offset + index * 4
+            edge, = struct.unpack('>I', self._data[start:start + 4])
+            parents.append(edge & ~_LAST_EDGE_FLAG)
+            if edge & _LAST_EDGE_FLAG:
+                return parents
+            index += 1
+
+
+class _HashTable:
+    """A sequence view of hashes in a commit-graph layer (for use with
+    :mod:`bisect`).
+    """
+
+    def __init__(self, layer):
+        self._layer = layer
+
+    def __len__(self):
+        return len(self._layer)
+
+    def __getitem__(self, pos):
+        return self._layer.hash_at(pos)
+
+
+class CommitGraph:
+    """A graph of commits described by one or more commit-graph layers.
+
+    Every commit in the graph has a generation number that is greater than
+    the generation numbers of all its parents, which allows walks over the
+    graph to stop before reaching the root commits. All ancestors of a commit
+    in the graph are in the graph as well.
+    """
+
+    def __init__(self, layers):
+        """Creates a graph from the given list of layers
+        (:class:`CommitGraphLayer`), ordered from the base one.
+        """
+        self._layers = layers
+        self._layer_starts = [layer.base_position for layer in layers]
+
+    @property
+    def layers(self):
+        """Layers of the graph, ordered from the base one."""
+        return self._layers
+
+    def __len__(self):
+        return sum(len(layer) for layer in self._layers)
+
+    def __contains__(self, hash):
+        return self._find_position(hash) is not None
+
+    def is_ancestor(self, ancestor_hash, descendant_hash):
+        """Checks if the commit with hash `ancestor_hash` is reachable from
+        the commit with hash `descendant_hash` (a commit is reachable from
+        itself).
+
+        :returns: `True` or `False`, or `None` when the answer cannot be
+                  obtained from the graph (e.g. when one of the commits is not
+                  in the graph).
+        """
+        ancestor = self._find_position(ancestor_hash)
+        descendant = self._find_position(descendant_hash)
+        if ancestor is None or descendant is None:
+            return None
+        if ancestor == descendant:
+            return True
+
+        min_generation, _ = self._read_commit(ancestor)
+        if min_generation == 0:
+            # The graph was written without generation numbers.
+            return None
+
+        # A depth-first walk from the descendant that does not enter commits
+        # whose generation number is lower than the one of the ancestor (they
+        # cannot reach it).
+        visited = {descendant}
+        to_visit = [descendant]
+        while to_visit:
+            generation, parents = self._read_commit(to_visit.pop())
+            if generation == 0:
+                return None
+            for parent in parents:
+                if parent == ancestor:
+                    return True
+                if parent in visited:
+                    continue
+                visited.add(parent)
+                parent_generation, _ = self._read_commit(parent)
+                if parent_generation >= min_generation:
+                    to_visit.append(parent)
+        return False
+
+    def count_unmerged(self, master_hash, other_hash):
+        """Returns the number of commits that are reachable from the commit
+        with hash `other_hash` but not from the commit with hash
+        `master_hash`.
+
+        :returns: The number of commits, or `None` when it cannot be obtained
+                  from the graph (e.g. when one of the commits is not in the
+                  graph).
+        """
+        master = self._find_position(master_hash)
+        other = self._find_position(other_hash)
+        if master is None or other is None:
+            return None
+        if master == other:
+            return 0
+
+        # Both commits are walked together, in the order of decreasing
+        # generation numbers, and every visited commit is marked by the
+        # commits from which it is reachable. Since all children of a commit
+        # have greater generation numbers, all of its marks are known when it
+        # is taken from the queue. The walk stops when there are no commits
+        # reachable only from `other` in the queue (their ancestors would be
+        # reachable from the master commit, too).
+        flags = {master: _IN_MASTER, other: _IN_OTHER}
+        queue = []
+        for pos in (master, other):
+            generation, _ = self._read_commit(pos)
+            if generation == 0:
+                return None
+            heapq.heappush(queue, (-generation, pos))
+        num_of_queued_only_in_other = 1
+        num_of_unmerged = 0
+        while num_of_queued_only_in_other > 0:
+            _, pos = heapq.heappop(queue)
+            pos_flags = flags[pos]
+            if pos_flags == _IN_OTHER:
+                num_of_queued_only_in_other -= 1
+                num_of_unmerged += 1
+            _, parents = self._read_commit(pos)
+            for parent in parents:
+                parent_flags = flags.get(parent)
+                if parent_flags is None:
+                    generation, _ = self._read_commit(parent)
+                    if generation == 0:
+                        return None
+                    flags[parent] = pos_flags
+                    heapq.heappush(queue, (-generation, parent))
+                    if pos_flags == _IN_OTHER:
+                        num_of_queued_only_in_other += 1
+                elif parent_flags | pos_flags != parent_flags:
+                    # The parent is still in the queue (it has a lower
+                    # generation number than the current commit).
+                    if parent_flags == _IN_OTHER:
+                        num_of_queued_only_in_other -= 1
+                    flags[parent] = parent_flags | pos_flags
+        return num_of_unmerged
+
+    def count_reachable(self, hash, is_excluded):
+        """Returns the number of commits that are reachable from the commit
+        with hash `hash` without passing through excluded commits.
+
+        :param callable is_excluded: A function that returns whether the
+                                     commit with the given hash is excluded.
+                                     Excluded commits are neither counted nor
+                                     walked through.
+
+        :returns: The number of commits, or `None` when the commit is not in
+                  the graph.
+        """
+        start = self._find_position(hash)
+        if start is None:
+            return None
+
+        visited = set()
+        to_visit = [start]
+        while to_visit:
+            pos = to_visit.pop()
+            if pos in visited or is_excluded(self._hash_at(pos)):
+                continue
+            visited.add(pos)
+            _, parents = self._read_commit(pos)
+            to_visit.extend(parents)
+        return len(visited)
+
+    def _find_position(self, hash):
+        try:
+            binary_hash = binascii.unhexlify(hash)
+        except (binascii.Error, ValueError):
+            return None
+        if len(binary_hash) != 20:
+            return None
+        # Newer layers are searched first as they contain the most recent
+        # commits.
+        for layer in reversed(self._layers):
+            pos = layer.find_position(binary_hash)
+            if pos is not None:
+                return pos
+        return None
+
+    def _read_commit(self, pos):
+        layer = self._get_layer(pos)
+        return layer.read_commit(pos - layer.base_position)
+
+    def _hash_at(self, pos):
+        layer = self._get_layer(pos)
+        binary_hash = layer.hash_at(pos - layer.base_position)
+        return binascii.hexlify(binary_hash).decode()
+
+    def _get_layer(self, pos):
+        return self._layers[bisect.bisect_right(self._layer_starts, pos) - 1]
+
+
+def load_commit_graph(objects_dir):
+    """Loads the commit graph from the given object database (usually
+    `.git/objects`).
+
+    Both a single ``info/commit-graph`` file and a chain of split commit-graph
+    files (``info/commit-graphs/``) are supported. Like in Git, the single
+    file is used when it exists and the chain is used only without it.
+
+    :returns: A :class:`CommitGraph`, or `None` if there is no commit-graph
+              file.
+
+    :raises CommitGraphError: If the files have an unsupported format.
+    """
+    info_dir = os.path.join(objects_dir, 'info')
+    try:
+        return CommitGraph(
+            [CommitGraphLayer(os.path.join(info_dir, 'commit-graph'))]
+        )
+    except FileNotFoundError:
+        pass
+
+    graphs_dir = os.path.join(info_dir, 'commit-graphs')
+    try:
+        with open(os.path.join(graphs_dir, 'commit-graph-chain')) as f:
+            chain = [line.strip() for line in f if line.strip()]
+    except FileNotFoundError:
+        return None
+
+    # The chain file lists hashes of the layers, starting from the base one.
+    layers = []
+    for hash in chain:
+        base_position = (layers[-1].base_position + len(layers[-1])
+                         if layers else 0)
+        layers.append(CommitGraphLayer(
+            os.path.join(graphs_dir, 'graph-{}.graph'.format(hash)),
+            base_position
+        ))
+    return CommitGraph(layers) if layers else None
+
+
+class CommitGraphReader:
+    """A reader of the commit graph of a repository that reloads the graph
+    whenever Git rewrites it.
+
+    Instances can be shared between threads.
+    """
+
+    def __init__(self, objects_dir):
+        """Creates a reader of the commit graph in the given object database
+        (usually `.git/objects`).
+        """
+        self._objects_dir = objects_dir
+        self._graph = None
+        self._graph_stat = None
+        self._lock = threading.Lock()
+
+    @property
+    def objects_dir(self):
+        """Path to the object database."""
+        return self._objects_dir
+
+    def get_graph(self):
+        """Returns the current :class:`CommitGraph`, or `None` if there is no
+        (usable) commit-graph file.
+        """
+        stat_key = self._get_stat_key()
+        with self._lock:
+            if stat_key != self._graph_stat:
+                try:
+                    self._graph = load_commit_graph(self._objects_dir)
+                except (OSError, ValueError, struct.error, CommitGraphError):
+                    # The files may have been rewritten in the meantime, or
+                    # they may be in an unsupported format. Git will be used
+                    # instead.
+                    self._graph = None
+                self._graph_stat = stat_key
+            return self._graph
+
+    def _get_stat_key(self):
+        # Git writes commit-graph files into temporary files that are then
+        # renamed, so a change of the graph is always visible in the stat of
+        # either the single file or the chain file.
+        stat_key = []
+        for path in (('info', 'commit-graph'),
+                     ('info', 'commit-graphs', 'commit-graph-chain')):
+            try:
+                stat = os.stat(os.path.join(self._objects_dir, *path))
+            except FileNotFoundError:
+                stat_key.append(None)
+            else:
+                stat_key.append(
+                    (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+                )
+        return tuple(stat_key)
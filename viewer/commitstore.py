@@ -0,0 +1,235 @@
+"""
+    viewer.commitstore
+    ~~~~~~~~~~~~~~~~~~
+
+    A persistent store of data about commits, which can be shared by all
+    processes that use the same repository.
+
+    :copyright: © 2014 by Petr Zemek <s3rvac@gmail.com> and contributors
+    :license: BSD, see LICENSE for more details
+"""
+
+import os
+import sqlite3
+import threading
+
+
+class CommitStoreError(Exception):
+    """An exception that is raised when the store cannot be read or
+    written.
+    """
+    pass
+
+
+class CommitStore:
+    """A store of data about commits, keyed by their hashes.
+
+    The store is an SQLite database in the WAL mode, so any number of
+    processes can read it while another process writes into it. Commits never
+    change, so the stored data never have to be invalidated. When there are
+    more than :attr:`max_entries` commits, the oldest stored ones are removed.
+
+    Data about a commit are a tuple ``(author, email, date_ts, subject)``,
+    where `date_ts` is the timestamp of the date the commit was authored.
+    Instances can be used from multiple threads.
+    """
+
+    #: Version of the format of the database.
+    VERSION = 1
+
+    #: Maximal number of hashes looked up by a single query.
+    MAX_HASHES_PER_QUERY = 500
+
+    def __init__(self, path, max_entries=100000):
+        """Creates a store in the file in the given path.
+
+        :param str path: A path to the database. The file (and its directory)
+                         is created when the store is first used.
+        :param int max_entries: Maximal number of stored commits.
+        """
+        self._path = path
+        self._max_entries = max_entries
+        self._connection = None
+        self._connection_pid = None
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    @property
+    def path(self):
+        """A path to the database."""
+        return self._path
+
+    @property
+    def max_entries(self):
+        """Maximal number of stored commits."""
+        return self._max_entries
+
+    def get(self, hash):
+        """Returns data about the commit with the given (full) hash, or `None`
+        when they are not in the store.
+
+        :raises CommitStoreError: If the store cannot be read.
+        """
+        return self.get_many([hash]).get(hash)
+
+    def get_many(self, hashes):
+        """Returns a dictionary mapping the given (full) hashes to data about
+        the commits that are in the store.
+
+        :raises CommitStoreError: If the store cannot be read.
+        """
+        hashes = list(hashes)
+        found = {}
+        with self._lock:
+            for i in range(0, len(hashes), self.MAX_HASHES_PER_QUERY):
+                chunk = hashes[i:i + self.MAX_HASHES_PER_QUERY]
+                rows = self._execute(
+                    'SELECT hash, author, email, date, subject FROM commits'
+                    ' WHERE hash IN ({})'.format(', '.join('?' * len(chunk))),
+                    chunk
+                ).fetchall()
+                for hash, *data in rows:
+                    found[hash] = tuple(data)
+            self._hits += len(found)
+            self._misses += len(set(hashes)) - len(found)
+        return found
+
+    def put_many(self, commits):
+        """Stores data about the given commits.
+
+        :param dict commits: A dictionary mapping (full) hashes to data about
+                             the commits.
+
+        Commits that are already in the store are left untouched. Then, the
+        oldest stored commits over :attr:`max_entries` are removed.
+
+        :raises CommitStoreError: If the store cannot be written.
+        """
+        if not commits:
+            return
+        with self._lock:
+            connection = self._get_connection()
+            try:
+                with connection:
+                    connection.executemany(
+                        'INSERT OR IGNORE INTO commits'
+                        ' (hash, author, email, date, subject)'
+                        ' VALUES (?, ?, ?, ?, ?)',
+                        [(hash, *data) for hash, data in commits.items()]
+                    )
+                    # Rows are only appended and the oldest ones are removed,
+                    # so their row IDs are consecutive and the newest
+                    # `max_entries` commits are those with the highest ones.
+                    connection.execute(
+                        'DELETE FROM commits WHERE rowid <='
+                        ' (SELECT MAX(rowid) FROM commits) - ?',
+                        (self._max_entries,)
+                    )
+            except sqlite3.Error as ex:
+                raise CommitStoreError(
+                    "cannot write commit store '{}': {}".format(self._path, ex)
+                ) from ex
+
+    def put(self, hash, data):
+        """Stores data about the commit with the given (full) hash.
+
+        :raises CommitStoreError: If the store cannot be written.
+        """
+        self.put_many({hash: data})
+
+    def stats(self):
+        """Returns a dictionary with statistics of lookups made by this
+        process and the number of stored commits.
+
+        The statistics are shown on the public /metrics page, so they do not
+        contain the path to the store.
+        """
+        with self._lock:
+            try:
+                entries, = self._execute(
+                    'SELECT COUNT(*) FROM commits'
+                ).fetchone()
+            except CommitStoreError:
+                entries = None
+            return {
+                'entries': entries,
+                'max_entries': self._max_entries,
+                'hits': self._hits,
+                'misses': self._misses
+            }
+
+    def close(self):
+        """Closes the database.
+
+        It is reopened when the store is used again.
+        """
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, self._path)
+
+    def _execute(self, sql, parameters=()):
+        try:
+            return self._get_connection().execute(sql, parameters)
+        except sqlite3.Error as ex:
+            raise CommitStoreError(
+                "cannot read commit store '{}': {}".format(self._path, ex)
+            ) from ex
+
+    def _get_connection(self):
+        # A connection must not be used in a child process of the process
+        # that opened it (e.g. when a web server forks its workers after
+        # loading the application), so the child opens its own one.
+        if (self._connection is None or
+                self._connection_pid != os.getpid()):
+            try:
+                self._connection = self._connect()
+                self._connection_pid = os.getpid()
+            except (OSError, sqlite3.Error) as ex:
+                raise CommitStoreError(
+                    "cannot open commit store '{}': {}".format(self._path, ex)
+                ) from ex
+        return self._connection
+
+    def _connect(self):
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        # The connection is used from multiple threads, but never
+        # concurrently (see self._lock). Writers from other processes are
+        # waited for at most `timeout` seconds.
+        connection = sqlite3.connect(
+            self._path,
+            timeout=5,
+            check_same_thread=False
+        )
+        try:
+            connection.execute('PRAGMA journal_mode=WAL')
+            # In the WAL mode, the database cannot be corrupted even without
+            # syncing after every transaction; at worst, the last stored
+            # commits are lost, which does not matter for a cache.
+            connection.execute('PRAGMA synchronous=NORMAL')
+            with connection:
+                connection.execute(
+                    'CREATE TABLE IF NOT EXISTS commits ('
+                    ' hash TEXT PRIMARY KEY,'
+                    ' author TEXT NOT NULL,'
+                    ' email TEXT NOT NULL,'
+                    ' date INTEGER NOT NULL,'
+                    ' subject TEXT NOT NULL)'
+                )
+                version, = connection.execute('PRAGMA user_version').fetchone()
+                if version == 0:
+                    connection.execute(
+                        'PRAGMA user_version={}'.format(self.VERSION)
+                    )
+                elif version != self.VERSION:
+                    raise sqlite3.DatabaseError(
+                        'unsupported version {}'.format(version)
+                    )
+        except BaseException:
+            connection.close()
+            raise
+        return connection
@@ -8,13 +8,33 @@
     :license: BSD, see LICENSE for more details
 """
 
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import contextvars
 import datetime
 import operator
 import os
 import re
 import subprocess
-
-from viewer.utils import chdir
+import threading
+import time
+import urllib.parse
+
+from viewer.ancestry import AncestryIndex
+from viewer.ancestry import AncestryIndexError
+from viewer.commitgraph import CommitGraphReader
+from viewer.commitstore import CommitStore
+from viewer.commitstore import CommitStoreError
+from viewer.objects import ObjectReader
+from viewer.objects import ObjectReaderError
+from viewer.refs import RefReader
+from viewer.refs import get_common_dir
+from viewer.utils import ConcurrencyLimitExceededError
+from viewer.utils import ConcurrencyLimiter
+from viewer.utils import LRUCache
+from viewer.utils import iter_nonempty_lines
 from viewer.utils import nonempty_lines
 
 
@@ -33,6 +53,21 @@ class GitBinaryNotFoundError(GitCmdError):
     pass
 
 
+class GitProcessLimitExceededError(BaseGitError):
+    """An exception that is raised when a Git command is not run because too
+    many Git commands are already running and waiting (see
+    :data:`git_processes`).
+    """
+    pass
+
+
+class GitDeadlineExceededError(BaseGitError):
+    """An exception that is raised when a Git command does not end before the
+    deadline (see :func:`set_deadline`).
+    """
+    pass
+
+
 class Commit:
     """A representation of a Git commit."""
 
@@ -160,21 +195,61 @@ class Commit:
             )
 
 
+class RequestCache:
+    """A cache of values obtained from a repository during a single request.
+
+    The cache is not invalidated in any way, so it should be dropped when the
+    request ends. It can be shared between threads.
+    """
+
+    def __init__(self):
+        """Creates an empty cache."""
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def get_or_compute(self, key, compute):
+        """Returns the value for the given key.
+
+        :param key: A hashable key of the value.
+        :param callable compute: A function without parameters that computes
+                                 the value when it is not in the cache.
+
+        When two threads ask for a missing value at the same time, both of them
+        may compute it.
+        """
+        with self._lock:
+            if key in self._values:
+                return self._values[key]
+        value = compute()
+        with self._lock:
+            return self._values.setdefault(key, value)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._values)
+
+
 class Branch:
     """A representation of a Git branch."""
 
-    def __init__(self, repo, remote, name):
+    def __init__(self, repo, remote, name, commit=None, cache=None):
         """Constructs a branch with the given data.
 
         :param Repo repo: Git repository in which this branch is.
         :param str remote: Name of the remote on which this branch is.
         :param str name: Name of the branch.
+        :param Commit commit: Commit representing the branch. If `None`, it is
+                              obtained from the repository when needed.
+        :param RequestCache cache: If not `None`, values obtained from the
+                                   repository are memoized in this cache.
 
         The data cannot be changed after the branch is created.
         """
         self._repo = repo
         self._remote = remote
         self._name = name
+        self._commit = commit
+        self._cache = cache
 
     @property
     def repo(self):
@@ -199,7 +274,12 @@ class Branch:
     @property
     def commit(self):
         """Commit representing the branch."""
-        return self._repo.get_commit_for_branch(self)
+        if self._commit is not None:
+            return self._commit
+        return self._get_cached(
+            'commit',
+            lambda: self.repo.get_commit_for_branch(self)
+        )
 
     @property
     def age(self):
@@ -214,11 +294,17 @@ class Branch:
 
         :param int limit: If not `None`, returns at most `limit` commits.
         """
-        return self.repo.get_unmerged_commits(master_branch, self, limit)
+        return self._get_cached(
+            ('unmerged_commits', master_branch.full_name, limit),
+            lambda: self.repo.get_unmerged_commits(master_branch, self, limit)
+        )
 
     def num_of_unmerged_commits(self, master_branch):
         """Returns the number of commits that are not in `master_branch`."""
-        return self.repo.get_num_of_unmerged_commits(master_branch, self)
+        return self._get_cached(
+            ('num_of_unmerged_commits', master_branch.full_name),
+            lambda: self.repo.get_num_of_unmerged_commits(master_branch, self)
+        )
 
     def has_unmerged_commits(self, master_branch):
         """Checks if there are commits in the branch that are not in
@@ -226,7 +312,10 @@ class Branch:
 
         :return `True` if there are such commits, `False` otherwise.
         """
-        return self.repo.has_unmerged_commits(master_branch, self)
+        return self._get_cached(
+            ('has_unmerged_commits', master_branch.full_name),
+            lambda: self.repo.has_unmerged_commits(master_branch, self)
+        )
 
     def has_more_unmerged_commits_than(self, master_branch, limit):
         """Checks if there are more than `limit` commits in the branch that are
@@ -250,6 +339,234 @@ class Branch:
             self.name
         )
 
+    def _get_cached(self, key, compute):
+        if self._cache is None:
+            return compute()
+        return self._cache.get_or_compute(
+            (self.repo.path, self.full_name, key),
+            compute
+        )
+
+
+class CatFileBatch:
+    """A long-running ``git cat-file --batch`` process reading objects from a
+    repository.
+
+    Objects are requested one by one over the standard input of the process,
+    so a single process serves any number of lookups. The process is started
+    lazily and restarted when it dies. Access to it is serialized, so an
+    instance can be shared between threads.
+    """
+
+    def __init__(self, path):
+        """Creates a reader of objects from the repository in the given `path`.
+
+        :param str path: An absolute path to the repository.
+        """
+        self._path = path
+        self._process = None
+        self._lock = threading.Lock()
+
+    @property
+    def path(self):
+        """Absolute path to the repository."""
+        return self._path
+
+    def read_object(self, obj):
+        """Returns a tuple ``(hash, type, content)`` for the given object.
+
+        :param str obj: Name of the object (e.g. a hash or a branch name).
+
+        The content is returned as :class:`bytes`.
+
+        :raises GitBinaryNotFoundError: If the Git binary is not found.
+        :raises GitCmdError: If there is no such object.
+        """
+        if '\n' in obj:
+            raise GitCmdError("invalid object name: '{}'".format(obj))
+
+        with self._lock:
+            try:
+                return self._read_object(obj)
+            except (OSError, EOFError):
+                # The process has died (e.g. it was killed from the outside).
+                # Start a new one and try once more.
+                self._stop()
+                return self._read_object(obj)
+
+    def close(self):
+        """Stops the process (if running)."""
+        with self._lock:
+            self._stop()
+
+    def _read_object(self, obj):
+        if self._process is None or self._process.poll() is not None:
+            self._start()
+
+        self._process.stdin.write('{}\n'.format(obj).encode())
+        self._process.stdin.flush()
+
+        # The process answers with a header of the form
+        #
+        #   hash type size
+        #
+        # followed by the content of the object and a newline. When the object
+        # does not exist, the header is `obj missing` and nothing follows.
+        header = self._process.stdout.readline().decode()
+        if not header.endswith('\n'):
+            raise EOFError('git cat-file terminated unexpectedly')
+        parts = header.split()
+        if len(parts) != 3:
+            raise GitCmdError(header.strip())
+        hash, type, size = parts
+        content = self._read_exactly(int(size))
+        self._read_exactly(1)
+        return hash, type, content
+
+    def _read_exactly(self, size):
+        data = self._process.stdout.read(size)
+        if len(data) != size:
+            raise EOFError('git cat-file terminated unexpectedly')
+        return data
+
+    def _start(self):
+        self._stop()
+        try:
+            self._process = subprocess.Popen(
+                ['git', 'cat-file', '--batch'],
+                cwd=self.path,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL
+            )
+        # When a command is not found or cannot be executed,
+        # subprocess.Popen() raises OSError.
+        except OSError:
+            raise GitBinaryNotFoundError(
+                "'git' is not installed or cannot be executed"
+            )
+
+    def _stop(self):
+        if self._process is None:
+            return
+        process, self._process = self._process, None
+        try:
+            process.stdin.close()
+        except OSError:
+            pass
+        process.kill()
+        process.wait()
+        process.stdout.close()
+
+
+# A registry of object readers, one per repository path. Readers are kept for
+# the whole lifetime of the process so that repeatedly created Repo instances
+# for the same repository do not start new processes.
+_cat_file_batches = {}
+_cat_file_batches_lock = threading.Lock()
+_cat_file_batches_pid = None
+
+
+def _get_cat_file_batch(path):
+    global _cat_file_batches_pid
+    with _cat_file_batches_lock:
+        # Processes started before a fork (e.g. when a web server forks its
+        # workers after loading the application) are shared with the parent
+        # process, so the child starts its own ones.
+        if _cat_file_batches_pid != os.getpid():
+            _cat_file_batches.clear()
+            _cat_file_batches_pid = os.getpid()
+        if path not in _cat_file_batches:
+            _cat_file_batches[path] = CatFileBatch(path)
+        return _cat_file_batches[path]
+
+
+#: A process-wide cache of results obtained from repositories. Commits are
+#: keyed by their hashes and results about unmerged commits by hashes of the
+#: commits representing the involved branches. Commits never change, so the
+#: cached results never become stale and only the least recently used ones are
+#: evicted when the cache is full.
+results_cache = LRUCache(maxsize=10000)
+
+
+#: A process-wide limit of Git commands that run at the same time (in all
+#: repositories and threads). Nothing is limited by default. The long-running
+#: ``git cat-file --batch`` processes (see :class:`CatFileBatch`) are not
+#: counted.
+git_processes = ConcurrencyLimiter()
+
+
+# When Git commands have to end (see set_deadline()).
+_deadline = contextvars.ContextVar('deadline', default=None)
+
+
+def set_deadline(deadline):
+    """Sets the time (:func:`time.monotonic`) by which Git commands run by
+    :class:`Repo` in the current context have to end.
+
+    Commands that would run longer are killed and
+    :class:`GitDeadlineExceededError` is raised. When `deadline` is `None`,
+    commands can run for any time.
+
+    The deadline applies to the current thread (more precisely, to the
+    current :mod:`contextvars` context) and to calls made by
+    :meth:`Repo.map_branches` and :meth:`Repo.imap_branches` from it. Reading
+    of commits by the long-running ``git cat-file --batch`` processes and
+    walks that do not run Git are not limited.
+    """
+    _deadline.set(deadline)
+
+
+def get_deadline():
+    """Returns the time by which Git commands run in the current context have
+    to end, or `None` when there is no such time.
+    """
+    return _deadline.get()
+
+
+@contextlib.contextmanager
+def deadline(deadline):
+    """A context manager that sets the given deadline (see
+    :func:`set_deadline`) for the block.
+    """
+    token = _deadline.set(deadline)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def _acquire_git_process_slot():
+    # Waits for a place in git_processes for a Git command. The place has to
+    # be released by git_processes.release().
+    try:
+        acquired = git_processes.acquire(timeout=_get_remaining_time())
+    except ConcurrencyLimitExceededError as ex:
+        raise GitProcessLimitExceededError(str(ex)) from None
+    if not acquired:
+        raise GitDeadlineExceededError(
+            'no Git command could be run before the deadline'
+        )
+
+
+def _get_remaining_time():
+    # Returns the number of seconds until the deadline, or None when there is
+    # no deadline. Raises GitDeadlineExceededError when the deadline has
+    # passed.
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    remaining_time = deadline - time.monotonic()
+    if remaining_time <= 0:
+        raise GitDeadlineExceededError('deadline exceeded')
+    return remaining_time
+
+
+#: Numbers of commits that are in a branch but not in the master branch
+#: (`ahead`) and commits that are in the master branch but not in the branch
+#: (`behind`).
+CommitCounts = collections.namedtuple('CommitCounts', ['ahead', 'behind'])
+
 
 def sort_branches(branches, attr):
     """Sorts the given list of branches in place by the given attribute
@@ -268,34 +585,121 @@ class Repo:
     :raises GitBinaryNotFoundError: If the Git binary (i.e. ``git``) is not
                                     found.
     :raises GitCmdError: If there is an error when running a Git command.
+    :raises GitProcessLimitExceededError: If a Git command cannot be run
+                                          because of the limit of Git
+                                          commands (see :data:`git_processes`).
+    :raises GitDeadlineExceededError: If a Git command does not end before
+                                      the deadline (see
+                                      :func:`set_deadline`).
     """
 
-    def __init__(self, path):
+    def __init__(self, path, pool_size=1, read_objects_in_process=False,
+                 master_ancestry_index=False, commit_store_size=None):
         """Creates an interface to a Git repository in the given `path`.
 
         :param str path: A path to the repository.
+        :param int pool_size: Number of threads used by :meth:`map_branches`.
+                              When it is 1, branches are processed one by
+                              one in the calling thread.
+        :param bool read_objects_in_process: Read commits directly from the
+                                             object database (see
+                                             :class:`ObjectReader`). Commits
+                                             that cannot be read in this way
+                                             are read by Git.
+        :param bool master_ancestry_index: Keep indexes of commits reachable
+                                           from master branches (see
+                                           :meth:`get_ancestry_index`).
+        :param int commit_store_size: If not `None`, data about commits are
+                                      kept in a persistent store of this
+                                      size (see :attr:`commit_store`).
 
         If the path is relative, it is converted into an absolute path.
 
+        Git commands are run without changing the working directory of the
+        process, so the repository can be used from multiple threads. The
+        existence of the repository is verified only here, so an instance can
+        be reused for any number of requests.
+
         See the class description for a list of exceptions that this method may
         raise.
         """
         self._path = os.path.abspath(path)
-        self._verify_repository_existence()
+        self._pool_size = pool_size
+        self._name = None
+        self._git_dir = self._verify_repository_existence()
+        self._refs = RefReader(self._git_dir, list_refs=self._list_refs)
+        objects_dir = os.path.join(get_common_dir(self._git_dir), 'objects')
+        self._commit_graph = CommitGraphReader(objects_dir)
+        self._objects = None
+        if read_objects_in_process:
+            self._objects = ObjectReader(objects_dir)
+        self._data_dir = os.path.join(
+            get_common_dir(self._git_dir), 'branch-viewer'
+        )
+        self._ancestry_dir = self._data_dir if master_ancestry_index else None
+        self._ancestry_indexes = {}
+        self._ancestry_lock = threading.Lock()
+        self._ancestry_updates = {}
+        self._commit_store = None
+        if commit_store_size is not None:
+            self._commit_store = CommitStore(
+                os.path.join(self._data_dir, 'commits.sqlite3'),
+                max_entries=commit_store_size
+            )
 
     @property
     def path(self):
         """Absolute path to the repository."""
         return self._path
 
+    @property
+    def pool_size(self):
+        """Number of threads used by :meth:`map_branches`."""
+        return self._pool_size
+
+    @property
+    def git_dir(self):
+        """Absolute path to the directory with Git data (usually `.git`)."""
+        return self._git_dir
+
+    @property
+    def data_dir(self):
+        """Absolute path to the directory in which data kept by the viewer
+        are stored (the ``branch-viewer`` subdirectory of the Git directory).
+
+        The directory may not exist.
+        """
+        return self._data_dir
+
+    @property
+    def refs(self):
+        """Reader of references in the repository (:class:`RefReader`)."""
+        return self._refs
+
+    @property
+    def commit_store(self):
+        """Persistent store of data about commits
+        (:class:`viewer.commitstore.CommitStore`), or `None` when the
+        repository does not keep it.
+
+        The store is in the Git directory, so it is shared by all processes
+        that use the repository and it survives restarts.
+        """
+        return self._commit_store
+
     @property
     def name(self):
-        """Name of the repository (its top-level directory)."""
-        # `git rev-parse --show-toplevel` prints the path to the top-level
-        # directory of the repository.
-        return os.path.basename(
-            self.run_git_cmd(['rev-parse', '--show-toplevel']).strip()
-        )
+        """Name of the repository (its top-level directory).
+
+        The name is obtained only once.
+        """
+        if self._name is None:
+            # `git rev-parse --show-toplevel` prints the path to the top-level
+            # directory of the repository.
+            self._name = os.path.basename(
+                self.run_git_cmd(['rev-parse', '--show-toplevel']).strip()
+            )
+        return self._name
 
     def run_git_cmd(self, args):
         """Runs the Git command with the given arguments in the repository and
@@ -306,74 +710,417 @@ class Repo:
         See the class description for a list of exceptions that this method may
         raise.
         """
-        with chdir(self.path):
+        with self._git_process_slot():
             try:
                 return subprocess.check_output(
                     ['git'] + list(args),
-                    universal_newlines=True
+                    cwd=self.path,
+                    universal_newlines=True,
+                    timeout=_get_remaining_time()
                 )
-            # When a command is not found or cannot be executed,
-            # subprocess.check_output() raises OSError.
+            # When a command is not found or cannot be executed (or when the
+            # working directory does not exist), subprocess.check_output()
+            # raises OSError.
             except OSError:
-                raise GitBinaryNotFoundError(
-                    "'git' is not installed or cannot be executed"
-                )
+                self._raise_error_for_failed_start()
             except subprocess.CalledProcessError as ex:
                 raise GitCmdError(ex.output)
+            # The command has already been killed by check_output().
+            except subprocess.TimeoutExpired:
+                raise GitDeadlineExceededError(
+                    "'git {}' did not end before the deadline".format(
+                        ' '.join(args)
+                    )
+                ) from None
+
+    def stream_git_cmd(self, args, chunk_size=65536):
+        """Runs the Git command with the given arguments in the repository and
+        yields its output in chunks as it arrives.
 
-    def get_branches_on_remote(self, remote):
-        """Returns a list of all branches on the given remote."""
-        output = self.run_git_cmd(['branch', '--remote', '--no-color'])
-        return self._get_branches_from_branch_remote_output(output, remote)
+        :param seq args: A sequence of parameters passed to git.
+        :param int chunk_size: Maximal size of a yielded chunk.
+
+        When the returned generator is closed before the whole output is read,
+        the command is terminated.
+
+        See the class description for a list of exceptions that this method may
+        raise.
+        """
+        with self._git_process_slot():
+            # The remaining time is obtained before the command is started, so
+            # a deadline that has already passed does not leave the command
+            # running.
+            remaining_time = _get_remaining_time()
+            try:
+                process = subprocess.Popen(
+                    ['git'] + list(args),
+                    cwd=self.path,
+                    stdout=subprocess.PIPE,
+                    universal_newlines=True
+                )
+            # When a command is not found or cannot be executed (or when the
+            # working directory does not exist), subprocess.Popen() raises
+            # OSError.
+            except OSError:
+                self._raise_error_for_failed_start()
+
+            # Reading of the output cannot be interrupted, so the command is
+            # killed by a timer when the deadline passes.
+            timer = None
+            if remaining_time is not None:
+                timer = threading.Timer(remaining_time, process.kill)
+                timer.start()
+            try:
+                while True:
+                    chunk = process.stdout.read(chunk_size)
+                    if not chunk:
+                        break
+                    yield chunk
+                if process.wait() != 0:
+                    if timer is not None and timer.finished.is_set():
+                        raise GitDeadlineExceededError(
+                            "'git {}' did not end before the deadline".format(
+                                ' '.join(args)
+                            )
+                        )
+                    raise GitCmdError(
+                        "'git {}' failed with exit status {}".format(
+                            ' '.join(args), process.returncode
+                        )
+                    )
+            finally:
+                if timer is not None:
+                    timer.cancel()
+                if process.poll() is None:
+                    process.kill()
+                    process.wait()
+                process.stdout.close()
+
+    def map_branches(self, func, branches):
+        """Calls `func(branch)` for every branch in `branches` and returns a
+        list of the results (in the order of `branches`).
+
+        When :attr:`pool_size` is greater than 1, the calls are made
+        concurrently from a pool of :attr:`pool_size` threads. An exception
+        raised by any of the calls is re-raised.
+        """
+        if self.pool_size <= 1 or len(branches) <= 1:
+            return [func(branch) for branch in branches]
+
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=min(self.pool_size, len(branches))) as executor:
+            futures = [self._submit(executor, func, branch)
+                       for branch in branches]
+            return [future.result() for future in futures]
+
+    def imap_branches(self, func, branches):
+        """Like :meth:`map_branches`, but returns an iterator that yields the
+        results (in the order of `branches`) as soon as they are available.
+        """
+        if self.pool_size <= 1 or len(branches) <= 1:
+            for branch in branches:
+                yield func(branch)
+            return
+
+        executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(self.pool_size, len(branches))
+        )
+        futures = [self._submit(executor, func, branch)
+                   for branch in branches]
+        try:
+            for future in futures:
+                yield future.result()
+        finally:
+            # When the iteration is stopped early, do not wait for the
+            # results that are no longer needed.
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+    def get_branches_on_remote(self, remote, cache=None):
+        """Returns a list of all branches on the given remote (sorted by their
+        names).
+
+        :param str remote: Name of the remote.
+        :param RequestCache cache: If not `None`, the returned branches memoize
+                                   values obtained from the repository in this
+                                   cache.
+
+        The branches are read directly from the files with references, so no
+        Git command is run (unless the references are in the reftable format,
+        see :attr:`refs`).
+        """
+        return [
+            Branch(self, remote, name, cache=cache)
+            for name in sorted(self.refs.get_remote_branch_tips(remote))
+        ]
+
+    def load_branches(self, remote, cache=None):
+        """Returns a list of all branches on the given remote, including the
+        commits representing them.
+
+        :param str remote: Name of the remote.
+        :param RequestCache cache: If not `None`, the returned branches memoize
+                                   values obtained from the repository in this
+                                   cache.
+
+        Unlike :meth:`get_branches_on_remote`, the commits are obtained by a
+        single Git command, so accessing :attr:`Branch.commit` or
+        :attr:`Branch.age` of the returned branches does not run any other
+        commands. When the repository keeps :attr:`commit_store`, the commits
+        are obtained by :meth:`get_commits_from_hashes` for the branches read
+        from the files with references instead, so commits that are already
+        in the store are not read from the repository.
+        """
+        if self._commit_store is not None:
+            return self._load_branches_from_commit_store(remote, cache)
+        output = self.run_git_cmd(self._get_for_each_ref_cmd(remote))
+        return self._get_branches_from_for_each_ref_output(
+            output, remote, cache
+        )
 
     def get_commit_from_hash(self, hash):
-        """Returns the commit corresponding to the given hash."""
-        return self._get_commit_from_git_show_with_object(hash)
+        """Returns the commit corresponding to the given hash.
+
+        Commits for full hashes are cached in :data:`results_cache` and, when
+        the repository keeps it, in :attr:`commit_store`.
+        """
+        if not self._is_full_hash(hash):
+            return self._get_commit_from_cat_file_with_object(hash)
+        return self.get_commits_from_hashes([hash])[0]
+
+    def get_commits_from_hashes(self, hashes):
+        """Returns a list of commits corresponding to the given full hashes
+        (in the order of `hashes`).
+
+        Commits are looked up in :data:`results_cache` first, then in
+        :attr:`commit_store` (all at once), and only the remaining ones are
+        read from the repository (and put into the store).
+        """
+        hashes = [hash.lower() for hash in hashes]
+        commits = {}
+        for hash in hashes:
+            commit = results_cache.get(('commit', hash))
+            if commit is not None:
+                commits[hash] = commit
+        missing_hashes = [hash for hash in dict.fromkeys(hashes)
+                          if hash not in commits]
+        if missing_hashes and self._commit_store is not None:
+            for hash, data in self._get_stored_commits(missing_hashes).items():
+                commits[hash] = self._get_commit_from_fields(hash, *data)
+                results_cache.put(('commit', hash), commits[hash])
+            missing_hashes = [hash for hash in missing_hashes
+                              if hash not in commits]
+        for hash in missing_hashes:
+            commits[hash] = self._get_commit_from_object_database(hash)
+            results_cache.put(('commit', hash), commits[hash])
+        if missing_hashes and self._commit_store is not None:
+            self._store_commits([commits[hash] for hash in missing_hashes])
+        return [commits[hash] for hash in hashes]
 
     def get_commit_for_branch(self, branch):
         """Returns the commit for the given branch."""
-        return self._get_commit_from_git_show_with_object(
+        # When the branch can be resolved from the files with references, the
+        # commit can be taken from the results cache.
+        hash = self.refs.resolve(
+            'refs/remotes/{}/{}'.format(branch.remote, branch.name)
+        )
+        if hash is not None:
+            return self.get_commit_from_hash(hash)
+        return self._get_commit_from_cat_file_with_object(
             '{}/{}'.format(branch.remote, branch.name)
         )
 
+    def get_ancestry_index(self, branch):
+        """Returns an index of all commits reachable from the given branch
+        (:class:`AncestryIndex`), or `None` when the repository does not keep
+        such indexes.
+
+        The index is updated incrementally: when the branch has moved forward
+        since the last update, only the new commits are walked. Indexes are
+        stored in the Git directory, so they survive restarts.
+
+        Walking the history of a branch may take longer than the deadline of a
+        request (see :func:`set_deadline`), and an index whose walk is killed
+        would be walked again by every request. Therefore, when there is a
+        deadline and the index has to be built or updated, it is done in a
+        background thread without the deadline and `None` is returned until
+        it is done.
+        """
+        if self._ancestry_dir is None:
+            return None
+
+        tip = branch.commit.hash
+        path = os.path.join(
+            self._ancestry_dir,
+            'ancestry-' + urllib.parse.quote(branch.full_name, safe='')
+        )
+        with self._ancestry_lock:
+            index = self._ancestry_indexes.get(branch.full_name)
+            if index is None:
+                try:
+                    index = AncestryIndex.load(path)
+                except (OSError, AncestryIndexError):
+                    index = None
+            if index is not None:
+                self._ancestry_indexes[branch.full_name] = index
+            if index is not None and index.tip == tip:
+                return index
+            if get_deadline() is not None:
+                self._update_ancestry_index_in_background(
+                    branch.full_name, index, tip, path
+                )
+                return None
+            index = self._get_updated_ancestry_index(index, tip, path)
+            self._ancestry_indexes[branch.full_name] = index
+            return index
+
     def get_unmerged_commits(self, master_branch, other_branch, limit=None):
         """Returns a list of commits that are in `other_branch` but not in
         `master_branch`.
 
         :param int limit: If not `None`, returns at most `limit` commits.
+
+        The result is cached in :data:`results_cache` for the pair of commits
+        representing the branches. When the repository keeps
+        :attr:`commit_store`, only hashes of the commits are listed by Git and
+        the commits are obtained by :meth:`get_commits_from_hashes`.
         """
-        hashes = self._get_hashes_of_unmerged_commits(
-            master_branch,
-            other_branch,
-            limit
-        )
-        return list(map(self.get_commit_from_hash, hashes))
+        master_hash = master_branch.commit.hash
+        other_hash = other_branch.commit.hash
+        index = self.get_ancestry_index(master_branch)
+        if index is not None and other_hash in index:
+            return []
+        return list(results_cache.get_or_compute(
+            ('unmerged_commits', master_hash, other_hash, limit),
+            lambda: tuple(self._get_unmerged_commits_in_range(
+                master_hash, other_hash, limit
+            ))
+        ))
 
     def get_num_of_unmerged_commits(self, master_branch, other_branch):
         """Returns the number of commits that are in `other_branch` but not in
         `master_branch`.
+
+        The result is cached in :data:`results_cache` for the pair of commits
+        representing the branches.
         """
-        hashes = self._get_hashes_of_unmerged_commits(
-            master_branch,
-            other_branch
-        )
-        return len(hashes)
+        master_hash = master_branch.commit.hash
+        other_hash = other_branch.commit.hash
+        index = self.get_ancestry_index(master_branch)
+        if index is not None:
+            num_of_commits = self._count_unmerged_in_process(
+                master_hash, other_hash, index, self._get_commit_graph()
+            )
+            if num_of_commits is not None:
+                results_cache.put(
+                    ('num_of_commits_in_range', master_hash, other_hash),
+                    num_of_commits
+                )
+                return num_of_commits
+        return self._get_num_of_commits_in_range(master_hash, other_hash)
+
+    def get_unmerged_commit_counts(self, master_branch, branches,
+                                   include_behind=False):
+        """Returns the numbers of unmerged commits for all the given branches.
+
+        :param Branch master_branch: Branch into which the commits are merged.
+        :param list branches: Branches whose commits are counted.
+        :param bool include_behind: Also count commits that are in
+                                    `master_branch` but not in the branches.
+
+        :returns: A dictionary mapping the full name of every branch to
+                  :class:`CommitCounts`. When `include_behind` is `False`, the
+                  `behind` counts are `None`.
+
+        When the repository has a commit-graph file, the commits are counted
+        by walking the graph in-process. When the repository also keeps an
+        index of commits in `master_branch` (see :meth:`get_ancestry_index`),
+        branches in the index are not walked at all and the walk over the
+        graph stops at commits in the index. Otherwise, commits that are not in
+        `master_branch` are counted for all the branches during a single walk
+        over these commits, so nothing proportional to the size of the whole
+        history is kept in memory.
+        Counting commits in `master_branch` requires a command per branch.
+
+        The counts are cached in :data:`results_cache` for pairs of commits
+        representing the branches, so only branches whose commits (or the
+        commit of `master_branch`) changed since the last call are walked.
+        """
+        if not branches:
+            return {}
+
+        master_hash = master_branch.commit.hash
+        ahead_counts = {}
+        for branch in branches:
+            ahead_counts[branch.commit.hash] = results_cache.get(
+                ('num_of_commits_in_range', master_hash, branch.commit.hash)
+            )
+        index = self.get_ancestry_index(master_branch)
+        graph = self._get_commit_graph()
+        for hash, count in ahead_counts.items():
+            if count is not None:
+                continue
+            count = self._count_unmerged_in_process(
+                master_hash, hash, index, graph
+            )
+            if count is not None:
+                ahead_counts[hash] = count
+                results_cache.put(
+                    ('num_of_commits_in_range', master_hash, hash), count
+                )
+        uncounted_hashes = [hash for hash, count in ahead_counts.items()
+                            if count is None]
+        if uncounted_hashes:
+            parents = self._get_parents_of_unmerged_commits(
+                master_hash, uncounted_hashes
+            )
+            for hash in uncounted_hashes:
+                ahead_counts[hash] = self._get_num_of_reachable_commits(
+                    hash, parents
+                )
+                results_cache.put(
+                    ('num_of_commits_in_range', master_hash, hash),
+                    ahead_counts[hash]
+                )
+
+        counts = {}
+        for branch in branches:
+            behind = None
+            if include_behind:
+                behind = self._get_num_of_commits_in_range(
+                    branch.commit.hash, master_hash
+                )
+            counts[branch.full_name] = CommitCounts(
+                ahead_counts[branch.commit.hash], behind
+            )
+        return counts
 
     def has_unmerged_commits(self, master_branch, other_branch):
         """Checks if there are commits in `other_branch` that are not in
         `master_branch`.
 
         :return `True` if there are such commits, `False` otherwise.
+
+        The result is cached in :data:`results_cache` for the pair of commits
+        representing the branches.
         """
-        # The following command either generates a single line (= there is at
-        # least one unmerged commit), or nothing (no unmerged commits).
-        output = self.run_git_cmd([
-            'log',
-            '-1',
-            '--format=format:%h',
-            '{}..{}'.format(master_branch.full_name, other_branch.full_name)
-        ])
-        return bool(output.strip())
+        master_hash = master_branch.commit.hash
+        other_hash = other_branch.commit.hash
+        index = self.get_ancestry_index(master_branch)
+        if index is not None:
+            return other_hash not in index
+
+        num_of_commits = results_cache.get(
+            ('num_of_commits_in_range', master_hash, other_hash)
+        )
+        if num_of_commits is not None:
+            return num_of_commits > 0
+
+        return results_cache.get_or_compute(
+            ('has_unmerged_commits', master_hash, other_hash),
+            lambda: self._has_commits_in_range(master_hash, other_hash)
+        )
 
     def get_date_of_last_update(self):
         """Returns the date when the repository was last updated."""
@@ -382,7 +1129,27 @@ class Repo:
         # in http://stackoverflow.com/a/9229377), but I don't know of any
         # better way.
         return datetime.datetime.fromtimestamp(
-            os.path.getmtime(os.path.join(self.path, '.git', 'FETCH_HEAD'))
+            os.path.getmtime(os.path.join(self.git_dir, 'FETCH_HEAD'))
+        )
+
+    def get_fingerprint(self, remote):
+        """Returns a fingerprint (`str`) of the state of branches on the given
+        remote.
+
+        The fingerprint changes whenever a branch on the remote is added,
+        removed, or changed, and whenever the repository is updated (see
+        :meth:`get_date_of_last_update`). No Git command is run (unless the
+        references are in the reftable format, see :attr:`refs`).
+        """
+        try:
+            fetch_head_mtime = os.stat(
+                os.path.join(self.git_dir, 'FETCH_HEAD')
+            ).st_mtime_ns
+        except FileNotFoundError:
+            fetch_head_mtime = None
+        return '{}:{}'.format(
+            self.refs.fingerprint('refs/remotes/{}/'.format(remote)),
+            fetch_head_mtime
         )
 
     def __eq__(self, other):
@@ -396,74 +1163,651 @@ class Repo:
             self.__class__.__name__,
             self.path)
 
-    def _get_hashes_of_unmerged_commits(self, master_branch, other_branch,
-                                        limit=None):
-        # The following command generates output of the form
+    def _is_full_hash(self, hash):
+        return (len(hash) == Commit.VALID_HASH_LENGTH and
+                set(hash.lower()) <= Commit.VALID_HASH_CHARACTERS)
+
+    def _get_unmerged_commits_in_range(self, from_hash, to_hash, limit):
+        if self._commit_store is not None:
+            return self.get_commits_from_hashes(nonempty_lines(
+                self.run_git_cmd(
+                    self._get_unmerged_hashes_cmd(from_hash, to_hash, limit)
+                )
+            ))
+
+        # All the needed information about the commits is obtained by a single
+        # `git log`. Every commit is a record of the form
         #
-        #   327c90a7c0bb4a739c2a245aeffa5f569cbd67da
-        #   548a89e53ffe8fb532655156b700ea1ed1e410fb
-        #   ...
+        #   hash\0author\0email\0date (timestamp)\0subject\x1e
         #
-        # where the number of lines is limited by the given limit (if any).
+        # The commits are parsed while the output is still being generated.
+        return self._iter_commits_from_log_records(self.stream_git_cmd(
+            self._get_unmerged_commits_cmd(from_hash, to_hash, limit)
+        ))
+
+    def _get_unmerged_commits_cmd(self, from_hash, to_hash, limit):
         cmd = ['log']
         if limit is not None:
             cmd.append('-{}'.format(limit))
         cmd.extend([
-            '--format=format:%H', '{}..{}'.format(
-                master_branch.full_name,
-                other_branch.full_name
-            )
+            '--format=tformat:%H%x00%an%x00%ae%x00%at%x00%s%x1e',
+            '{}..{}'.format(from_hash, to_hash)
         ])
-        output = self.run_git_cmd(cmd)
-        return nonempty_lines(output)
+        return cmd
 
-    def _get_branches_from_branch_remote_output(self, output, remote):
-        # The `git branch --remote` output should be of the form
+    def _get_unmerged_hashes_cmd(self, from_hash, to_hash, limit):
+        # Lists hashes of the same commits as _get_unmerged_commits_cmd(), in
+        # the same order.
+        cmd = ['rev-list']
+        if limit is not None:
+            cmd.append('--max-count={}'.format(limit))
+        cmd.append('{}..{}'.format(from_hash, to_hash))
+        return cmd
+
+    def _get_num_of_commits_in_range(self, from_hash, to_hash):
+        return results_cache.get_or_compute(
+            ('num_of_commits_in_range', from_hash, to_hash),
+            lambda: self._count_commits_in_range(from_hash, to_hash)
+        )
+
+    def _count_commits_in_range(self, from_hash, to_hash):
+        graph = self._get_commit_graph()
+        if graph is not None:
+            num_of_commits = graph.count_unmerged(from_hash, to_hash)
+            if num_of_commits is not None:
+                return num_of_commits
+
+        # `git rev-list --count` prints just the number of commits, so no list
+        # of the commits is ever built.
+        return int(self.run_git_cmd([
+            'rev-list',
+            '--count',
+            '{}..{}'.format(from_hash, to_hash)
+        ]).strip() or 0)
+
+    def _has_commits_in_range(self, from_hash, to_hash):
+        graph = self._get_commit_graph()
+        if graph is not None:
+            is_merged = graph.is_ancestor(to_hash, from_hash)
+            if is_merged is not None:
+                return not is_merged
+
+        # The following command either generates a single line (= there is at
+        # least one commit in the range), or nothing (no commits).
+        return bool(self.run_git_cmd([
+            'log',
+            '-1',
+            '--format=format:%h',
+            '{}..{}'.format(from_hash, to_hash)
+        ]).strip())
+
+    def _get_commit_graph(self):
+        # Git ignores commit-graph files when the history may differ from the
+        # one they describe (grafts, shallow clones, replaced objects), and so
+        # do we.
+        common_dir = get_common_dir(self.git_dir)
+        if (os.path.exists(os.path.join(common_dir, 'info', 'grafts')) or
+                os.path.exists(os.path.join(self.git_dir, 'shallow')) or
+                self.refs.read_refs('refs/replace/')):
+            return None
+        return self._commit_graph.get_graph()
+
+    def _get_parents_of_unmerged_commits(self, master_hash, hashes):
+        # The following command lists all commits that are reachable from at
+        # least one of the given commits but not from the master branch. Every
+        # line is of the form
+        #
+        #   hash parent1_hash parent2_hash ...
+        #
+        # Parents that are not listed are in the master branch.
+        cmd = ['rev-list', '--parents']
+        cmd.extend(hashes)
+        cmd.extend(['--not', master_hash])
+        parents = {}
+        for line in iter_nonempty_lines(self.stream_git_cmd(cmd)):
+            hash, *parent_hashes = line.split()
+            parents[hash] = parent_hashes
+        return parents
+
+    def _update_ancestry_index_in_background(self, name, index, tip, path):
+        # Has to be called with self._ancestry_lock held. At most one update
+        # of an index runs at a time (threads do not survive a fork, so an
+        # update started before it is not alive in the child process).
+        thread = self._ancestry_updates.get(name)
+        if thread is not None and thread.is_alive():
+            return
+
+        def update():
+            try:
+                with deadline(None):
+                    updated_index = self._get_updated_ancestry_index(
+                        index, tip, path
+                    )
+            except BaseGitError:
+                # The index is updated again when it is needed next time.
+                return
+            with self._ancestry_lock:
+                self._ancestry_indexes[name] = updated_index
+        thread = threading.Thread(
+            target=update,
+            name='viewer-ancestry-index',
+            daemon=True
+        )
+        self._ancestry_updates[name] = thread
+        thread.start()
+
+    def _get_updated_ancestry_index(self, index, tip, path):
+        # Returns the index updated to the given tip and saved into the given
+        # path.
+        index = self._walk_for_ancestry_index(index, tip)
+        try:
+            index.save(path)
+        except OSError:
+            # The Git directory may not be writable. The index is still kept
+            # in memory.
+            pass
+        return index
+
+    def _walk_for_ancestry_index(self, index, tip):
+        if index is not None:
+            try:
+                is_fast_forward = not self._has_commits_in_range(
+                    tip, index.tip
+                )
+            except GitCmdError:
+                # The old tip no longer exists (e.g. after a forced push
+                # and garbage collection).
+                is_fast_forward = False
+            if is_fast_forward:
+                return index.extended(
+                    tip, self._iter_reachable_hashes(tip, index.tip)
+                )
+        return AncestryIndex(tip, self._iter_reachable_hashes(tip))
+
+    def _iter_reachable_hashes(self, hash, excluded_hash=None):
+        # Hashes of commits reachable from `hash`, excluding commits reachable
+        # from `excluded_hash`.
+        cmd = ['rev-list', hash]
+        if excluded_hash is not None:
+            cmd.extend(['--not', excluded_hash])
+        return iter_nonempty_lines(self.stream_git_cmd(cmd))
+
+    def _count_unmerged_in_process(self, master_hash, hash, index, graph):
+        # Returns the number of commits that are in the given commit but not
+        # in the master commit, or None when they cannot be counted without
+        # running Git. `index` is an ancestry index of the master commit and
+        # `graph` is a commit graph (either may be None). With both of them,
+        # the walk over the graph stops at commits in the index, so it never
+        # walks the history of the master branch.
+        if index is not None and hash in index:
+            return 0
+        if graph is None:
+            return None
+        if index is not None:
+            return graph.count_reachable(hash, index.__contains__)
+        return graph.count_unmerged(master_hash, hash)
+
+    def _get_num_of_reachable_commits(self, hash, parents):
+        # Walks the graph given by `parents` from the given commit. Commits
+        # that are not in the graph are not counted.
+        reachable = set()
+        to_visit = [hash]
+        while to_visit:
+            hash = to_visit.pop()
+            if hash in reachable or hash not in parents:
+                continue
+            reachable.add(hash)
+            to_visit.extend(parents[hash])
+        return len(reachable)
+
+    def _list_refs(self, prefix):
+        # Lists references for self.refs when they cannot be read from files
+        # (see viewer.refs.uses_reftable()). Values of symbolic references are
+        # of the form 'ref: target'.
+        output = self.run_git_cmd([
+            'for-each-ref',
+            '--format=%(refname)%00%(symref)%00%(objectname)',
+            prefix
+        ])
+        refs = {}
+        for line in nonempty_lines(output):
+            name, symref, hash = line.split('\0')
+            if name.startswith(prefix):
+                refs[name] = 'ref: {}'.format(symref) if symref else hash
+        return refs
+
+    def _get_for_each_ref_cmd(self, remote):
+        # Fields are separated by NUL characters, which cannot appear in any
+        # of them. The subject of a commit is always a single line, so every
+        # branch is on a separate line.
+        return [
+            'for-each-ref',
+            '--format=' + '%00'.join([
+                '%(refname)',
+                '%(symref)',
+                '%(objectname)',
+                '%(authorname)',
+                '%(authoremail)',
+                '%(authordate:raw)',
+                '%(contents:subject)'
+            ]),
+            'refs/remotes/{}/'.format(remote)
+        ]
+
+    def _get_branches_from_for_each_ref_output(self, output, remote, cache):
+        # The output of `git for-each-ref` (see load_branches()) is of the
+        # form
         #
-        #   remote/branch1_name
-        #   remote/branch2_name
+        #   refname\0symref\0hash\0author\0<email>\0timestamp timezone\0subject
         #   ...
         #
+        # Symbolic references (e.g. remote/HEAD) have a nonempty symref and
+        # are skipped.
+        prefix = 'refs/remotes/{}/'.format(remote)
         branches = []
-        for line in output.split('\n'):
-            m = re.match(r"""
-                    \s*                # Optional spaces at the beginning
-                    {}/(?P<name>[^ ]+) # remote/branch_name
-                    $
-                """.format(remote), line, re.VERBOSE)
-            if m:
-                branches.append(Branch(self, remote, m.group('name')))
+        for line in nonempty_lines(output):
+            refname, symref, hash, author, email, date, subject = \
+                line.split('\0')
+            if symref or not refname.startswith(prefix):
+                continue
+            commit = self._get_commit_from_fields(
+                hash, author, email.strip('<>'), date.split()[0], subject
+            )
+            branches.append(
+                Branch(self, remote, refname[len(prefix):], commit, cache)
+            )
         return branches
 
-    def _get_commit_from_git_show_with_object(self, obj):
-        # We use `git show` with a custom format to get just the needed
-        # information about the commit. The used format produces output of the
-        # following form:
+    def _load_branches_from_commit_store(self, remote, cache):
+        tips = self.refs.get_remote_branch_tips(remote)
+        names = sorted(tips)
+        commits = self.get_commits_from_hashes([tips[name] for name in names])
+        return [
+            Branch(self, remote, name, commit, cache)
+            for name, commit in zip(names, commits)
+        ]
+
+    def _iter_commits_from_log_records(self, chunks):
+        # Records are terminated by the \x1e (record separator) character,
+        # which is followed by a newline. A record may be split between
+        # chunks, so its beginning is buffered until the terminator arrives.
+        buffer = ''
+        for chunk in chunks:
+            buffer += chunk
+            *records, buffer = buffer.split('\x1e')
+            for record in records:
+                yield self._get_commit_from_fields(
+                    *record.lstrip('\n').split('\0')
+                )
+        if buffer.strip():
+            raise GitCmdError('unexpected output: {!r}'.format(buffer))
+
+    def _get_commit_from_fields(self, hash, author, email, date_ts, subject):
+        return Commit(
+            hash,
+            author,
+            email,
+            datetime.datetime.fromtimestamp(int(date_ts)),
+            subject
+        )
+
+    def _get_stored_commits(self, hashes):
+        try:
+            return self._commit_store.get_many(hashes)
+        except CommitStoreError:
+            # The store is only a cache, so commits are read from the
+            # repository when it cannot be read (e.g. it is locked for too
+            # long).
+            return {}
+
+    def _store_commits(self, commits):
+        try:
+            self._commit_store.put_many({
+                commit.hash: (
+                    commit.author,
+                    commit.email,
+                    int(commit.date.timestamp()),
+                    commit.subject
+                )
+                for commit in commits
+            })
+        except CommitStoreError:
+            # The Git directory may not be writable. The commits are still
+            # cached in memory.
+            pass
+
+    def _get_commit_from_object_database(self, hash):
+        return self._get_commit_from_commit_object(
+            *self._read_commit_object(hash)
+        )
+
+    def _get_commit_from_cat_file_with_object(self, obj):
+        return self._get_commit_from_commit_object(
+            *self._read_commit_object_with_cat_file(obj)
+        )
+
+    def _read_commit_object(self, hash):
+        # Returns a tuple (hash, content) for the commit with the given full
+        # hash.
+        if self._objects is not None:
+            try:
+                type, content = self._objects.read_object(hash)
+            except (ObjectReaderError, OSError):
+                # The commit cannot be read in-process (e.g. it is in an
+                # alternate object database), so let Git read it.
+                pass
+            else:
+                if type == 'commit':
+                    return hash, content
+        return self._read_commit_object_with_cat_file(hash)
+
+    def _read_commit_object_with_cat_file(self, obj):
+        # Objects are read by a long-running `git cat-file --batch` process,
+        # which is shared by all Repo instances for this repository. The
+        # '^{commit}' suffix peels the object (e.g. an annotated tag) into the
+        # commit it points to.
+        hash, type, content = _get_cat_file_batch(self.path).read_object(
+            '{}^{{commit}}'.format(obj)
+        )
+        if type != 'commit':
+            raise GitCmdError("'{}' is not a commit".format(obj))
+        return hash, content
+
+    def _get_commit_from_commit_object(self, hash, content):
+        # A raw commit object is of the following form:
         #
-        #   hash
-        #   author
-        #   email
-        #   date (timestamp)
-        #   subject
+        #   tree hash
+        #   parent hash
+        #   author name <email> timestamp timezone
+        #   committer name <email> timestamp timezone
+        #   (other headers, e.g. encoding or gpgsig)
         #
-        # The '--quiet' parameter prevents a diff from being displayed (we do
-        # not need it).
-        output = self.run_git_cmd(
-            ['show', '--quiet', '--format=format:%H%n%an%n%ae%n%at%n%s%n', obj]
-        )
+        #   message
+        #
+        # Values of multi-line headers (e.g. gpgsig) continue on lines starting
+        # with a space.
+        headers, _, message = content.partition(b'\n\n')
+        author_line = None
+        encoding = 'utf-8'
+        for line in headers.split(b'\n'):
+            if line.startswith(b'author '):
+                author_line = line[len(b'author '):].decode('utf-8', 'replace')
+            elif line.startswith(b'encoding '):
+                encoding = line[len(b'encoding '):].decode('ascii', 'replace')
         m = re.match(r"""
-                (?P<hash>[a-fA-F0-9]+)\n
-                (?P<author>.+)\n
-                (?P<email>.+)\n
-                (?P<date_ts>[0-9]+)\n
-                (?P<subject>.+)\n
-            """, output, re.VERBOSE | re.MULTILINE)
-        hash = m.group('hash')
+                (?P<author>.*?)\s*
+                <(?P<email>[^>]*)>\s*
+                (?P<date_ts>[0-9]+)
+            """, author_line or '', re.VERBOSE)
+        if m is None:
+            raise GitCmdError(
+                "commit '{}' has an invalid author line".format(hash)
+            )
         author = m.group('author')
         email = m.group('email')
         date = datetime.datetime.fromtimestamp(int(m.group('date_ts')))
-        subject = m.group('subject')
+        subject = self._get_subject_from_message(message, encoding)
         return Commit(hash, author, email, date, subject)
 
+    def _get_subject_from_message(self, message, encoding):
+        # Mimic `git show --format=%s`: the subject is the first paragraph of
+        # the message with its lines joined by spaces.
+        try:
+            message = message.decode(encoding, 'replace')
+        except LookupError:
+            message = message.decode('utf-8', 'replace')
+        lines = []
+        for line in message.lstrip('\n').split('\n'):
+            if not line.strip():
+                break
+            lines.append(line.strip())
+        return ' '.join(lines)
+
+    def _submit(self, executor, func, branch):
+        # The call is made in a copy of the current context, so the deadline
+        # of the calling thread applies to it.
+        return executor.submit(contextvars.copy_context().run, func, branch)
+
+    @contextlib.contextmanager
+    def _git_process_slot(self):
+        # Holds a place in git_processes while a Git command runs.
+        _acquire_git_process_slot()
+        try:
+            yield
+        finally:
+            git_processes.release()
+
+    def _raise_error_for_failed_start(self):
+        if not os.path.isdir(self.path):
+            raise FileNotFoundError(
+                "No such directory: '{}'".format(self.path)
+            )
+        raise GitBinaryNotFoundError(
+            "'git' is not installed or cannot be executed"
+        )
+
     def _verify_repository_existence(self):
-        self.run_git_cmd(['status'])
+        # `git rev-parse --git-dir` fails outside of a repository. Unlike
+        # `git status`, it neither refreshes the index nor scans the working
+        # tree, so it is cheap even for large repositories. It prints the
+        # (possibly relative) path to the directory with Git data.
+        git_dir = self.run_git_cmd(['rev-parse', '--git-dir']).strip()
+        return os.path.join(self.path, git_dir)
+
+
+class AsyncRepo:
+    """An :mod:`asyncio` interface to a Git repository.
+
+    Git commands are run by :func:`asyncio.create_subprocess_exec`, so
+    waiting for them blocks neither the event loop nor a thread. Everything
+    that does not need a Git command (references, commit-graph files,
+    :data:`results_cache`) is shared with the wrapped :class:`Repo`. The
+    commands are counted in :data:`git_processes` together with the commands
+    run by :class:`Repo`.
+
+    The methods in this class may raise the same exceptions as the methods in
+    :class:`Repo`.
+    """
+
+    def __init__(self, repo):
+        """Creates an interface to the given repository.
+
+        :param Repo repo: The repository.
+
+        The instance has to be used only from a single event loop.
+        """
+        self._repo = repo
+
+    @property
+    def repo(self):
+        """The wrapped repository (:class:`Repo`)."""
+        return self._repo
+
+    async def run_git_cmd(self, args):
+        """Runs the Git command with the given arguments in the repository and
+        returns the output.
+
+        :param seq args: A sequence of parameters passed to git.
+        """
+        remaining_time = _get_remaining_time()
+        try:
+            return await asyncio.wait_for(
+                self._run_git_cmd(args),
+                remaining_time
+            )
+        # wait_for() has already cancelled the command, which kills it.
+        except asyncio.TimeoutError:
+            raise GitDeadlineExceededError(
+                "'git {}' did not end before the deadline".format(
+                    ' '.join(args)
+                )
+            ) from None
+
+    async def load_branches(self, remote, cache=None):
+        """Returns a list of all branches on the given remote, including the
+        commits representing them.
+
+        See :meth:`Repo.load_branches` for more details.
+        """
+        if self._repo.commit_store is not None:
+            # The store is read in a thread.
+            return await asyncio.to_thread(
+                self._repo._load_branches_from_commit_store, remote, cache
+            )
+        output = await self.run_git_cmd(
+            self._repo._get_for_each_ref_cmd(remote)
+        )
+        return self._repo._get_branches_from_for_each_ref_output(
+            output, remote, cache
+        )
+
+    async def get_unmerged_commits(self, master_branch, other_branch,
+                                   limit=None):
+        """Returns a list of commits that are in `other_branch` but not in
+        `master_branch`.
+
+        See :meth:`Repo.get_unmerged_commits` for more details.
+        """
+        master_hash = master_branch.commit.hash
+        other_hash = other_branch.commit.hash
+        index = await self._get_ancestry_index(master_branch)
+        if index is not None and other_hash in index:
+            return []
+        key = ('unmerged_commits', master_hash, other_hash, limit)
+        commits = results_cache.get(key)
+        if commits is None and self._repo.commit_store is not None:
+            output = await self.run_git_cmd(
+                self._repo._get_unmerged_hashes_cmd(
+                    master_hash, other_hash, limit
+                )
+            )
+            # The store is read in a thread.
+            commits = tuple(await asyncio.to_thread(
+                self._repo.get_commits_from_hashes, nonempty_lines(output)
+            ))
+            results_cache.put(key, commits)
+        elif commits is None:
+            output = await self.run_git_cmd(
+                self._repo._get_unmerged_commits_cmd(
+                    master_hash, other_hash, limit
+                )
+            )
+            commits = tuple(self._repo._iter_commits_from_log_records([output]))
+            results_cache.put(key, commits)
+        return list(commits)
+
+    async def get_unmerged_commit_counts(self, master_branch, branches):
+        """Returns the numbers of unmerged commits for all the given branches.
+
+        :returns: A dictionary mapping the full name of every branch to
+                  :class:`CommitCounts` (the `behind` counts are `None`).
+
+        The counts are obtained in the same way as by
+        :meth:`Repo.get_unmerged_commit_counts`, except that commits that
+        cannot be counted in-process are counted by a command per branch and
+        the commands run concurrently.
+        """
+        master_hash = master_branch.commit.hash
+        index = await self._get_ancestry_index(master_branch)
+        graph = await asyncio.to_thread(self._repo._get_commit_graph)
+
+        async def count(hash):
+            # In-process counting walks the history, which may take long for
+            # branches far ahead of the master branch, so it is done in a
+            # thread to keep the event loop responsive.
+            key = ('num_of_commits_in_range', master_hash, hash)
+            num_of_commits = results_cache.get(key)
+            if num_of_commits is None:
+                num_of_commits = await asyncio.to_thread(
+                    self._repo._count_unmerged_in_process,
+                    master_hash, hash, index, graph
+                )
+            if num_of_commits is None:
+                num_of_commits = int((await self.run_git_cmd([
+                    'rev-list',
+                    '--count',
+                    '{}..{}'.format(master_hash, hash)
+                ])).strip() or 0)
+            results_cache.put(key, num_of_commits)
+            return num_of_commits
+
+        hashes = list({branch.commit.hash for branch in branches})
+        ahead_counts = dict(zip(
+            hashes,
+            await asyncio.gather(*(count(hash) for hash in hashes))
+        ))
+        return {
+            branch.full_name: CommitCounts(ahead_counts[branch.commit.hash], None)
+            for branch in branches
+        }
+
+    def __repr__(self):
+        return '{}({!r})'.format(
+            self.__class__.__name__,
+            self._repo)
+
+    async def _run_git_cmd(self, args):
+        await self._acquire_git_process_slot()
+        try:
+            return await self._run_git_process(args)
+        finally:
+            git_processes.release()
+
+    async def _acquire_git_process_slot(self):
+        if git_processes.try_acquire():
+            return
+        # Waiting for a place blocks, so it is done in a thread (in the
+        # current context, so the deadline applies to it). When the waiting
+        # is cancelled (e.g. because of the deadline), the thread may still
+        # take the place, so the place is released by the thread or by this
+        # coroutine, whichever ends later.
+        lock = threading.Lock()
+        acquired = False
+        cancelled = False
+
+        def acquire():
+            nonlocal acquired
+            _acquire_git_process_slot()
+            with lock:
+                if cancelled:
+                    git_processes.release()
+                acquired = True
+
+        try:
+            await asyncio.to_thread(acquire)
+        except asyncio.CancelledError:
+            with lock:
+                if acquired:
+                    git_processes.release()
+                cancelled = True
+            raise
+
+    async def _run_git_process(self, args):
+        try:
+            process = await asyncio.create_subprocess_exec(
+                'git', *args,
+                cwd=self._repo.path,
+                stdout=asyncio.subprocess.PIPE
+            )
+        # When a command is not found or cannot be executed (or when the
+        # working directory does not exist),
+        # asyncio.create_subprocess_exec() raises OSError.
+        except OSError:
+            self._repo._raise_error_for_failed_start()
+        try:
+            output, _ = await process.communicate()
+        finally:
+            # The waiting has been cancelled (e.g. because of the deadline).
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+        output = output.decode(errors='replace')
+        if process.returncode != 0:
+            raise GitCmdError(output)
+        return output
+
+    async def _get_ancestry_index(self, branch):
+        # Updating an index may run Git commands, so it is done in a thread.
+        if self._repo._ancestry_dir is None:
+            return None
+        return await asyncio.to_thread(self._repo.get_ancestry_index, branch)
@@ -0,0 +1,140 @@
+"""
+    viewer.indexer
+    ~~~~~~~~~~~~~~
+
+    Background refreshing of snapshots of repositories.
+
+    :copyright: © 2014 by Petr Zemek <s3rvac@gmail.com> and contributors
+    :license: BSD, see LICENSE for more details
+"""
+
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class Indexer:
+    """Keeps the latest snapshot of a repository (see :mod:`viewer.snapshot`).
+
+    A background thread periodically checks the fingerprint of the repository
+    and takes a new snapshot whenever the fingerprint changes. The new
+    snapshot replaces the old one atomically, so readers always get a
+    complete snapshot without waiting for Git.
+
+    Instances can be shared between threads.
+    """
+
+    def __init__(self, take_snapshot, get_fingerprint, interval=5):
+        """Creates an indexer.
+
+        :param callable take_snapshot: A function without parameters that
+                                       returns a new snapshot
+                                       (:class:`viewer.snapshot.Snapshot`).
+        :param callable get_fingerprint: A function without parameters that
+                                         returns the current fingerprint of
+                                         the repository. It has to be cheap as
+                                         it is called every `interval`
+                                         seconds.
+        :param float interval: How often (in seconds) the fingerprint is
+                               checked.
+
+        The background thread is not started until :meth:`start` is called.
+        """
+        self._take_snapshot = take_snapshot
+        self._get_fingerprint = get_fingerprint
+        self._interval = interval
+        self._snapshot = None
+        self._refresh_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._num_of_snapshots = 0
+        self._last_error = None
+
+    @property
+    def interval(self):
+        """How often (in seconds) the fingerprint is checked."""
+        return self._interval
+
+    @property
+    def is_running(self):
+        """Is the background thread running?"""
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """Starts the background thread (if it is not already running)."""
+        if self.is_running:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(
+            target=self._run,
+            name='viewer-indexer',
+            daemon=True
+        )
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Stops the background thread and waits until it ends (at most
+        `timeout` seconds).
+        """
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def get_snapshot(self):
+        """Returns the latest snapshot.
+
+        When there is no snapshot yet, it is taken in the calling thread.
+        """
+        snapshot = self._snapshot
+        if snapshot is None:
+            snapshot = self.refresh()
+        return snapshot
+
+    def refresh(self, force=False):
+        """Takes a new snapshot if the fingerprint of the repository has changed
+        since the latest snapshot was taken or if the latest snapshot is not
+        complete (or always when `force` is `True`), and returns the latest
+        snapshot.
+
+        Only one snapshot is taken at a time; concurrent callers wait for it.
+        """
+        with self._refresh_lock:
+            snapshot = self._snapshot
+            if (force or snapshot is None or not snapshot.is_complete or
+                    snapshot.fingerprint != self._get_fingerprint()):
+                snapshot = self._take_snapshot()
+                # The function may return the current snapshot (e.g. when
+                # the snapshot is shared and a new one has not been published
+                # yet).
+                if snapshot is not self._snapshot:
+                    self._snapshot = snapshot
+                    self._num_of_snapshots += 1
+            return snapshot
+
+    def stats(self):
+        """Returns a dictionary with statistics of the indexer."""
+        snapshot = self._snapshot
+        return {
+            'running': self.is_running,
+            'snapshots': self._num_of_snapshots,
+            'snapshot_age': (
+                snapshot.age.total_seconds() if snapshot is not None else None
+            ),
+            'last_error': (
+                repr(self._last_error) if self._last_error is not None else None
+            )
+        }
+
+    def _run(self):
+        while True:
+            try:
+                self.refresh()
+                self._last_error = None
+            except Exception as ex:
+                # Keep the previous snapshot and try again later.
+                self._last_error = ex
+                logger.exception('failed to refresh the snapshot')
+            if self._stop_event.wait(self._interval):
+                return
@@ -0,0 +1,453 @@
+"""
+    viewer.objects
+    ~~~~~~~~~~~~~~
+
+    Reading of Git objects directly from the object database (loose objects and
+    packfiles), without running Git.
+
+    :copyright: © 2014 by Petr Zemek <s3rvac@gmail.com> and contributors
+    :license: BSD, see LICENSE for more details
+"""
+
+import binascii
+import bisect
+import glob
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+from viewer.utils import LRUCache
+
+
+class ObjectReaderError(Exception):
+    """An exception that is raised when an object cannot be read in-process.
+
+    Callers are expected to fall back to reading the object by Git itself.
+    """
+    pass
+
+
+class ObjectNotFoundError(ObjectReaderError):
+    """An exception that is raised when an object is not found."""
+    pass
+
+
+# Types of objects, as stored in packfiles.
+_PACK_OBJECT_TYPES = {
+    1: 'commit',
+    2: 'tree',
+    3: 'blob',
+    4: 'tag'
+}
+_OFS_DELTA = 6
+_REF_DELTA = 7
+
+# Size of chunks of compressed data that are passed to zlib.
+_ZLIB_CHUNK_SIZE = 4096
+
+
+class PackIndex:
+    """An index of a packfile (a version 2 ``.idx`` file).
+
+    The index is mapped into memory, so opening it costs the same regardless
+    of its size.
+    """
+
+    #: Signature at the beginning of version 2 (and newer) indexes.
+    SIGNATURE = b'\377tOc'
+
+    def __init__(self, path):
+        """Opens the index in the given path.
+
+        :raises ObjectReaderError: If the index has an unsupported format.
+        """
+        self._path = path
+        with open(path, 'rb') as f:
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        # The index is of the following form (all numbers are big-endian):
+        #
+        #   signature (4 bytes), version (4 bytes)
+        #   fanout table: 256 x number of objects whose first byte of hash is
+        #                 lower or equal to the index in the table (4 bytes)
+        #   N x hash (20 bytes, sorted)
+        #   N x CRC32 (4 bytes)
+        #   N x offset (4 bytes; when the MSB is set, the other bits are an
+        #               index into the table of large offsets)
+        #   M x large offset (8 bytes)
+        #   trailer
+        if self._data[:4] != self.SIGNATURE:
+            raise ObjectReaderError(
+                "unsupported pack index format: '{}'".format(path)
+            )
+        version, = struct.unpack('>I', self._data[4:8])
+        if version != 2:
+            raise ObjectReaderError(
+                "unsupported pack index version {}: '{}'".format(version, path)
+            )
+        self._fanout = struct.unpack('>256I', self._data[8:8 + 256 * 4])
+        self._num_of_objects = self._fanout[255]
+        self._hashes_offset = 8 + 256 * 4
+        self._offsets_offset = (self._hashes_offset +
+                                self._num_of_objects * (20 + 4))
+        self._large_offsets_offset = (self._offsets_offset +
+                                      self._num_of_objects * 4)
+
+    @property
+    def path(self):
+        """Path to the index."""
+        return self._path
+
+    def __len__(self):
+        return self._num_of_objects
+
+    def find_offset(self, binary_hash):
+        """Returns the offset of the object with the given hash (20 `bytes`) in
+        the packfile, or `None` if there is no such object.
+        """
+        # The fanout table gives the range of positions of hashes starting with
+        # the same byte, which is then binary-searched.
+        first_byte = binary_hash[0]
+        low = self._fanout[first_byte - 1] if first_byte > 0 else 0
+        high = self._fanout[first_byte]
+        pos = bisect.bisect_left(_HashTable(self), binary_hash, low, high)
+        if pos == high or self.hash_at(pos) != binary_hash:
+            return None
+        return self._offset_at(pos)
+
+    def hash_at(self, pos):
+        """Returns the hash (20 `bytes`) at the given position in the index."""
+        start = self._hashes_offset + pos * 20
+        return self._data[start:start + 20]
+
+    def close(self):
+        """Unmaps the index from memory."""
+        self._data.close()
+
+    def _offset_at(self, pos):
+        start = self._offsets_offset + pos * 4
+        offset, = struct.unpack('>I', self._data[start:start + 4])
+        if not offset & 0x80000000:
+            return offset
+        start = self._large_offsets_offset + (offset & 0x7fffffff) * 8
+        offset, = struct.unpack('>Q', self._data[start:start + 8])
+        return offset
+
+
+class _HashTable:
+    """A sequence view of hashes in a pack index (for use with
+    :mod:`bisect`).
+    """
+
+    def __init__(self, index):
+        self._index = index
+
+    def __len__(self):
+        return len(self._index)
+
+    def __getitem__(self, pos):
+        return self._index.hash_at(pos)
+
+
+class Pack:
+    """A packfile together with its index."""
+
+    def __init__(self, index_path):
+        """Opens the pack whose index is in the given path.
+
+        :raises ObjectReaderError: If the pack has an unsupported format.
+        """
+        self._index = PackIndex(index_path)
+        pack_path = index_path[:-len('.idx')] + '.pack'
+        with open(pack_path, 'rb') as f:
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._data[:4] != b'PACK':
+            raise ObjectReaderError(
+                "unsupported pack format: '{}'".format(pack_path)
+            )
+
+    @property
+    def index(self):
+        """Index of the pack (:class:`PackIndex`)."""
+        return self._index
+
+    def find_offset(self, binary_hash):
+        """Returns the offset of the object with the given hash (20 `bytes`) in
+        the pack, or `None` if there is no such object.
+        """
+        return self._index.find_offset(binary_hash)
+
+    def read_entry(self, offset):
+        """Reads the entry at the given offset.
+
+        :returns: A tuple ``(type, base, data)``. For non-delta objects,
+                  `type` is the type of the object (e.g. ``'commit'``), `base`
+                  is `None`, and `data` is the content of the object. For
+                  deltas, `type` is :data:`_OFS_DELTA` or :data:`_REF_DELTA`,
+                  `base` is the offset or the binary hash of the base object,
+                  and `data` is the delta.
+        """
+        # Every entry starts with a header with the type and the size of the
+        # (uncompressed) data. The size is encoded in a variable number of
+        # bytes, where the MSB tells whether another byte follows.
+        byte = self._data[offset]
+        type = (byte >> 4) & 0x7
+        size = byte & 0x0f
+        shift = 4
+        pos = offset + 1
+        while byte & 0x80:
+            byte = self._data[pos]
+            size |= (byte & 0x7f) << shift
+            shift += 7
+            pos += 1
+
+        base = None
+        if type == _OFS_DELTA:
+            # The base is given by a negative offset relative to this entry,
+            # encoded in a variable number of bytes (with an addition of one
+            # to every byte except the last one).
+            byte = self._data[pos]
+            pos += 1
+            relative_offset = byte & 0x7f
+            while byte & 0x80:
+                byte = self._data[pos]
+                pos += 1
+                relative_offset = ((relative_offset + 1) << 7) | (byte & 0x7f)
+            base = offset - relative_offset
+        elif type == _REF_DELTA:
+            base = self._data[pos:pos + 20]
+            pos += 20
+        elif type not in _PACK_OBJECT_TYPES:
+            raise ObjectReaderError(
+                'unsupported object type {} at offset {}'.format(type, offset)
+            )
+        else:
+            type = _PACK_OBJECT_TYPES[type]
+
+        return type, base, self._decompress(pos, size)
+
+    def close(self):
+        """Unmaps the pack and its index from memory."""
+        self._data.close()
+        self._index.close()
+
+    def _decompress(self, pos, size):
+        decompressor = zlib.decompressobj()
+        chunks = []
+        while not decompressor.eof:
+            chunk = self._data[pos:pos + _ZLIB_CHUNK_SIZE]
+            if not chunk:
+                raise ObjectReaderError('truncated pack')
+            chunks.append(decompressor.decompress(chunk))
+            pos += _ZLIB_CHUNK_SIZE
+        data = b''.join(chunks)
+        if len(data) != size:
+            raise ObjectReaderError('corrupted pack entry')
+        return data
+
+
+def apply_delta(base, delta):
+    """Returns the object obtained by applying the given delta (`bytes`) to the
+    given base object (`bytes`).
+
+    :raises ObjectReaderError: If the delta is invalid.
+    """
+    def read_size(pos):
+        size = shift = 0
+        while True:
+            byte = delta[pos]
+            pos += 1
+            size |= (byte & 0x7f) << shift
+            shift += 7
+            if not byte & 0x80:
+                return size, pos
+
+    # The delta starts with sizes of the base and the result. Then, there are
+    # instructions that either copy a part of the base (MSB set) or insert
+    # data from the delta (MSB unset; the other bits are the length of the
+    # data).
+    base_size, pos = read_size(0)
+    if base_size != len(base):
+        raise ObjectReaderError('delta does not match its base')
+    result_size, pos = read_size(pos)
+    result = bytearray()
+    while pos < len(delta):
+        instruction = delta[pos]
+        pos += 1
+        if instruction & 0x80:
+            offset = size = 0
+            for i in range(4):
+                if instruction & (1 << i):
+                    offset |= delta[pos] << (8 * i)
+                    pos += 1
+            for i in range(3):
+                if instruction & (1 << (4 + i)):
+                    size |= delta[pos] << (8 * i)
+                    pos += 1
+            if size == 0:
+                size = 0x10000
+            result += base[offset:offset + size]
+        elif instruction:
+            result += delta[pos:pos + instruction]
+            pos += instruction
+        else:
+            raise ObjectReaderError('invalid delta instruction')
+    if len(result) != result_size:
+        raise ObjectReaderError('delta produced object of an invalid size')
+    return bytes(result)
+
+
+class ObjectReader:
+    """A reader of objects from the object database of a repository.
+
+    Both loose objects and objects in packfiles are supported, including
+    deltified objects. Objects that cannot be read (e.g. because they are in
+    an alternate object database or in an unsupported format) raise
+    :class:`ObjectReaderError`, so the caller can fall back to Git.
+
+    Instances can be shared between threads.
+    """
+
+    def __init__(self, objects_dir, cache_size=256):
+        """Creates a reader of objects in the given directory.
+
+        :param str objects_dir: Path to the object database (usually
+                                `.git/objects`).
+        :param int cache_size: Number of recently read objects that are kept
+                               in memory (they are often bases of deltas).
+        """
+        self._objects_dir = objects_dir
+        self._packs = {}
+        self._packs_dir_mtime = None
+        self._lock = threading.Lock()
+        self._cache = LRUCache(maxsize=cache_size)
+
+    @property
+    def objects_dir(self):
+        """Path to the object database."""
+        return self._objects_dir
+
+    def read_object(self, hash):
+        """Returns a tuple ``(type, content)`` for the object with the given
+        hash (`str`).
+
+        :raises ObjectNotFoundError: If there is no such object.
+        :raises ObjectReaderError: If the object cannot be read.
+        """
+        try:
+            binary_hash = binascii.unhexlify(hash)
+        except (binascii.Error, ValueError):
+            raise ObjectReaderError("invalid hash: '{}'".format(hash))
+        if len(binary_hash) != 20:
+            raise ObjectReaderError("unsupported hash: '{}'".format(hash))
+        return self._read_object(binary_hash)
+
+    def close(self):
+        """Closes all opened packs."""
+        with self._lock:
+            for pack in self._packs.values():
+                pack.close()
+            self._packs = {}
+            self._packs_dir_mtime = None
+
+    def _read_object(self, binary_hash):
+        cached = self._cache.get(binary_hash)
+        if cached is not None:
+            return cached
+
+        obj = self._read_loose_object(binary_hash)
+        if obj is None:
+            obj = self._read_packed_object(binary_hash)
+        self._cache.put(binary_hash, obj)
+        return obj
+
+    def _read_loose_object(self, binary_hash):
+        # A loose object is a zlib-compressed file of the form
+        #
+        #   type size\0content
+        #
+        # stored in objects/xx/yyy..., where xx are the first two characters
+        # of the hash.
+        hash = binascii.hexlify(binary_hash).decode()
+        path = os.path.join(self._objects_dir, hash[:2], hash[2:])
+        try:
+            with open(path, 'rb') as f:
+                data = zlib.decompress(f.read())
+        except FileNotFoundError:
+            return None
+        except zlib.error:
+            raise ObjectReaderError("corrupted loose object '{}'".format(hash))
+        header, _, content = data.partition(b'\0')
+        type, _, size = header.decode('ascii', 'replace').partition(' ')
+        if not size.isdigit() or int(size) != len(content):
+            raise ObjectReaderError("corrupted loose object '{}'".format(hash))
+        return type, content
+
+    def _read_packed_object(self, binary_hash):
+        for refresh in (False, True):
+            for pack in self._get_packs(refresh):
+                try:
+                    offset = pack.find_offset(binary_hash)
+                    if offset is not None:
+                        return self._read_packed_object_at(pack, offset)
+                except (zlib.error, ValueError, IndexError, struct.error) as ex:
+                    # The pack is corrupted, or it has been closed by
+                    # close() in another thread.
+                    raise ObjectReaderError(
+                        "cannot read pack '{}': {}".format(pack.index.path, ex)
+                    ) from ex
+        raise ObjectNotFoundError(
+            "object '{}' not found".format(
+                binascii.hexlify(binary_hash).decode()
+            )
+        )
+
+    def _read_packed_object_at(self, pack, offset):
+        # Deltas are resolved iteratively (delta chains can be long), from the
+        # deepest base up to the requested object.
+        deltas = []
+        while True:
+            type, base, data = pack.read_entry(offset)
+            if type == _OFS_DELTA:
+                deltas.append(data)
+                offset = base
+            elif type == _REF_DELTA:
+                deltas.append(data)
+                type, data = self._read_object(base)
+                break
+            else:
+                break
+        for delta in reversed(deltas):
+            data = apply_delta(data, delta)
+        return type, data
+
+    def _get_packs(self, refresh):
+        # The list of packs is refreshed when a pack is not found since the
+        # repository may have been repacked since the last refresh.
+        packs_dir = os.path.join(self._objects_dir, 'pack')
+        with self._lock:
+            if refresh or self._packs_dir_mtime is None:
+                try:
+                    mtime = os.stat(packs_dir).st_mtime_ns
+                except FileNotFoundError:
+                    mtime = 0
+                if mtime != self._packs_dir_mtime:
+                    self._refresh_packs(packs_dir)
+                    self._packs_dir_mtime = mtime
+            return list(self._packs.values())
+
+    def _refresh_packs(self, packs_dir):
+        # Removed packs are not closed because other threads may still be
+        # reading from them. They are unmapped once they are no longer used.
+        index_paths = set(glob.glob(os.path.join(packs_dir, 'pack-*.idx')))
+        for index_path in set(self._packs) - index_paths:
+            del self._packs[index_path]
+        for index_path in sorted(index_paths - set(self._packs)):
+            try:
+                self._packs[index_path] = Pack(index_path)
+            except (OSError, ValueError, ObjectReaderError):
+                # The pack may have been removed in the meantime, or it may be
+                # in an unsupported format. Its objects will be read by Git.
+                continue
@@ -0,0 +1,277 @@
+"""
+    viewer.refs
+    ~~~~~~~~~~~
+
+    Reading of Git references directly from files in the Git directory.
+
+    :copyright: © 2014 by Petr Zemek <s3rvac@gmail.com> and contributors
+    :license: BSD, see LICENSE for more details
+"""
+
+import hashlib
+import os
+import re
+import threading
+
+
+def get_common_dir(git_dir):
+    """Returns the path to the directory with data shared by all working trees
+    of the repository whose Git directory is `git_dir`.
+
+    In a linked working tree, references and objects are in a directory given
+    by the `commondir` file. Otherwise, it is `git_dir` itself.
+    """
+    try:
+        with open(os.path.join(git_dir, 'commondir')) as f:
+            return os.path.normpath(os.path.join(git_dir, f.read().strip()))
+    except FileNotFoundError:
+        return git_dir
+
+
+def uses_reftable(git_dir):
+    """Checks if references of the repository whose Git directory is
+    `git_dir` are stored in the reftable format.
+
+    Such references are not stored in files that could be read by
+    :class:`RefReader`. The format is used when there is a list of reftables
+    (``reftable/tables.list``) or when ``extensions.refStorage`` is
+    ``reftable`` in the configuration of the repository.
+    """
+    common_dir = get_common_dir(git_dir)
+    if os.path.isfile(os.path.join(common_dir, 'reftable', 'tables.list')):
+        return True
+    try:
+        with open(os.path.join(common_dir, 'config'),
+                  encoding='utf-8', errors='replace') as f:
+            section = None
+            for line in f:
+                line = line.split('#')[0].split(';')[0].strip()
+                if line.startswith('['):
+                    section = line.strip('[]').strip().lower()
+                elif section == 'extensions' and '=' in line:
+                    name, value = line.split('=', 1)
+                    if (name.strip().lower() == 'refstorage' and
+                            value.strip() == 'reftable'):
+                        return True
+    except FileNotFoundError:
+        pass
+    return False
+
+
+# Characters that cannot be anywhere in a name of a reference: ASCII control
+# characters, space, and ~ ^ : ? * [ \ (see git-check-ref-format(1)).
+_INVALID_REF_NAME_CHARS_RE = re.compile(r'[\x00-\x20\x7f~^:?*\[\\]')
+
+# The contents of a loose reference file: either a hash, or 'ref: target' for
+# symbolic references.
+_HASH_RE = re.compile(r'[0-9a-f]{40}')
+_SYMREF_RE = re.compile(r'ref: (refs/\S+)')
+
+
+def is_valid_ref_name(name):
+    """Checks if the given full name of a reference (e.g.
+    ``'refs/remotes/origin/master'``) is valid.
+
+    The rules are those of ``git check-ref-format``. Among others, a valid
+    name cannot contain ``..``, so it cannot point outside of the directory
+    with references.
+    """
+    if (not name.startswith('refs/') or name.endswith(('/', '.')) or
+            '..' in name or '@{' in name or
+            _INVALID_REF_NAME_CHARS_RE.search(name) is not None):
+        return False
+    for component in name.split('/'):
+        if (not component or component.startswith('.') or
+                component.endswith('.lock')):
+            return False
+    return True
+
+
+class RefReader:
+    """A reader of references (branches, tags, etc.) from the files in a Git
+    directory.
+
+    References are either loose (one file per reference under ``refs/``) or
+    packed (all of them in the ``packed-refs`` file). When a reference is both
+    loose and packed, the loose one takes precedence. The parsed
+    ``packed-refs`` file is cached until its modification time or size
+    changes.
+
+    References in the reftable format (see :func:`uses_reftable`) are not
+    stored in such files, so they are listed by a given function instead
+    (e.g. by ``git for-each-ref``).
+
+    Instances can be shared between threads.
+    """
+
+    #: The maximal number of symbolic references that are followed when
+    #: resolving a reference (the same limit as in Git).
+    MAX_SYMREF_DEPTH = 5
+
+    def __init__(self, git_dir, list_refs=None):
+        """Creates a reader of references in the given Git directory.
+
+        :param str git_dir: Path to the directory with Git data (usually
+                            `.git`).
+        :param callable list_refs: A function that returns references
+                                   starting with the given prefix in the
+                                   same form as :meth:`read_refs`. It is
+                                   used when the references are in the
+                                   reftable format. If `None`, no references
+                                   are read in such a case.
+        """
+        self._git_dir = git_dir
+        self._common_dir = get_common_dir(git_dir)
+        self._list_refs = None
+        if uses_reftable(git_dir):
+            self._list_refs = list_refs or (lambda prefix: {})
+        self._packed_refs = {}
+        self._packed_refs_stat = None
+        self._lock = threading.Lock()
+
+    @property
+    def git_dir(self):
+        """Path to the directory with Git data."""
+        return self._git_dir
+
+    def read_refs(self, prefix):
+        """Returns a dictionary mapping full names of references starting with
+        the given prefix (e.g. ``'refs/remotes/origin/'``) to their values.
+
+        The value of a symbolic reference is ``'ref: target'``. The value of
+        any other reference is the hash of the object it points to.
+        """
+        if self._list_refs is not None:
+            return self._list_refs(prefix)
+        refs = {
+            name: hash for name, hash in self.read_packed_refs().items()
+            if name.startswith(prefix)
+        }
+        refs.update(self._read_loose_refs(prefix))
+        return refs
+
+    def read_packed_refs(self):
+        """Returns a dictionary mapping full names of packed references to
+        hashes of the objects they point to.
+        """
+        path = os.path.join(self._common_dir, 'packed-refs')
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return {}
+
+        stat_key = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        with self._lock:
+            if stat_key != self._packed_refs_stat:
+                self._packed_refs = self._parse_packed_refs(path)
+                self._packed_refs_stat = stat_key
+            return self._packed_refs
+
+    def resolve(self, name):
+        """Returns the hash of the object to which the reference with the
+        given full name (e.g. ``'refs/remotes/origin/master'``) points.
+
+        Symbolic references are followed. When there is no such reference,
+        `None` is returned.
+        """
+        for _ in range(self.MAX_SYMREF_DEPTH + 1):
+            value = self._read_ref(name)
+            if value is None or not value.startswith('ref:'):
+                return value
+            name = value[len('ref:'):].strip()
+        return None
+
+    def get_remote_branch_tips(self, remote):
+        """Returns a dictionary mapping names of branches on the given remote
+        to hashes of the commits they point to.
+
+        Symbolic references (e.g. ``refs/remotes/origin/HEAD``) are skipped.
+        """
+        prefix = 'refs/remotes/{}/'.format(remote)
+        return {
+            name[len(prefix):]: value
+            for name, value in self.read_refs(prefix).items()
+            if not value.startswith('ref:')
+        }
+
+    def fingerprint(self, prefix='refs/'):
+        """Returns a fingerprint (`str`) of references starting with the given
+        prefix.
+
+        The fingerprint changes whenever a reference is added, removed, or
+        changed.
+        """
+        refs = self.read_refs(prefix)
+        fingerprint = hashlib.sha1()
+        for name in sorted(refs):
+            fingerprint.update('{} {}\n'.format(name, refs[name]).encode())
+        return fingerprint.hexdigest()
+
+    def _parse_packed_refs(self, path):
+        # The packed-refs file is of the form
+        #
+        #   # pack-refs with: peeled fully-peeled sorted
+        #   hash refs/remotes/origin/master
+        #   hash refs/tags/v1.0
+        #   ^hash
+        #   ...
+        #
+        # where lines starting with '^' contain peeled values of the preceding
+        # annotated tags (we do not need them).
+        refs = {}
+        with open(path, encoding='utf-8', errors='replace') as f:
+            for line in f:
+                if line.startswith(('#', '^')):
+                    continue
+                parts = line.split()
+                if len(parts) == 2:
+                    hash, name = parts
+                    refs[name] = hash
+        return refs
+
+    def _read_loose_refs(self, prefix):
+        refs = {}
+        top_dir = os.path.join(self._common_dir, *prefix.rstrip('/').split('/'))
+        for dir, _, files in os.walk(top_dir):
+            for file in files:
+                # Lock files belong to references that are being written.
+                if file.endswith('.lock'):
+                    continue
+                path = os.path.join(dir, file)
+                name = '/'.join(
+                    os.path.relpath(path, self._common_dir).split(os.sep)
+                )
+                if not name.startswith(prefix):
+                    continue
+                value = self._read_loose_ref_file(path)
+                if value is not None:
+                    refs[name] = value
+        return refs
+
+    def _read_ref(self, name):
+        if not is_valid_ref_name(name):
+            return None
+        if self._list_refs is not None:
+            return self._list_refs(name).get(name)
+        for dir in (self._git_dir, self._common_dir):
+            value = self._read_loose_ref_file(
+                os.path.join(dir, *name.split('/'))
+            )
+            if value is not None:
+                return value
+        return self.read_packed_refs().get(name)
+
+    def _read_loose_ref_file(self, path):
+        # Files with other contents are not references (e.g. files in the Git
+        # directory that are not under refs/), so they are skipped.
+        try:
+            with open(path, encoding='utf-8', errors='replace') as f:
+                value = f.read().strip()
+        except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+            return None
+        if _HASH_RE.fullmatch(value) is not None:
+            return value
+        match = _SYMREF_RE.fullmatch(value)
+        if match is not None and is_valid_ref_name(match.group(1)):
+            return value
+        return None
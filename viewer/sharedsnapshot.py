@@ -0,0 +1,472 @@
+"""
+    viewer.sharedsnapshot
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Snapshots of repositories (see :mod:`viewer.snapshot`) shared by all
+    processes of a web server through files.
+
+    :copyright: © 2014 by Petr Zemek <s3rvac@gmail.com> and contributors
+    :license: BSD, see LICENSE for more details
+"""
+
+import datetime
+import hashlib
+import json
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import zlib
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    # The module is available only on POSIX systems.
+    fcntl = None
+
+from viewer.git import Commit
+from viewer.git import CommitCounts
+from viewer.snapshot import BranchSnapshot
+from viewer.snapshot import Snapshot
+
+
+class SharedSnapshotError(Exception):
+    """An exception that is raised when a shared snapshot cannot be loaded
+    or published.
+    """
+    pass
+
+
+def is_supported():
+    """Can snapshots be shared on the current platform?
+
+    The leader is elected by a POSIX record lock, so snapshots cannot be
+    shared on systems without :mod:`fcntl` (e.g. Windows).
+    """
+    return fcntl is not None
+
+
+#: Signature at the beginning of files with snapshots.
+SNAPSHOT_SIGNATURE = b'BVSS'
+
+#: Signature at the beginning of files with generation counters.
+GENERATION_SIGNATURE = b'BVSG'
+
+#: Version of the format of the files.
+VERSION = 1
+
+
+def dump_snapshot(snapshot, generation):
+    """Returns the given snapshot (:class:`viewer.snapshot.Snapshot`) of the
+    given generation (`int`) serialized into `bytes`.
+    """
+    # The file is of the following form (all numbers are big-endian):
+    #
+    #   signature (4 bytes), version (4 bytes)
+    #   generation (8 bytes)
+    #   length of the payload N (4 bytes)
+    #   payload (N bytes, zlib-compressed JSON)
+    #   SHA-1 checksum of all the preceding data (20 bytes)
+    #
+    # Every commit is in the payload only once, even when it is in more
+    # branches; branches refer to commits by their indexes.
+    commits = []
+    commit_indexes = {}
+
+    def get_commit_index(commit):
+        if commit is None:
+            return None
+        if commit.hash not in commit_indexes:
+            commit_indexes[commit.hash] = len(commits)
+            commits.append([
+                commit.hash,
+                commit.author,
+                commit.email,
+                int(commit.date.timestamp()),
+                commit.subject
+            ])
+        return commit_indexes[commit.hash]
+
+    payload = {
+        'repo_name': snapshot.repo_name,
+        'remote': snapshot.remote,
+        'last_update_date': _dump_date(snapshot.last_update_date),
+        'master_branch': snapshot.master_branch.name,
+        'shown_branches': [
+            [
+                branch.name,
+                get_commit_index(branch.commit),
+                [get_commit_index(commit)
+                 for commit in branch.unmerged_commits()]
+            ]
+            for branch in snapshot.shown_branches
+        ],
+        'ignored_branches': [
+            branch.name for branch in snapshot.ignored_branches
+        ],
+        'unmerged_commit_counts': {
+            name: list(counts)
+            for name, counts in snapshot.unmerged_commit_counts.items()
+        },
+        'fingerprint': snapshot.fingerprint,
+        'date': _dump_date(snapshot.date),
+        'num_of_shown_branches': snapshot.num_of_shown_branches,
+        'commits': commits
+    }
+    payload = zlib.compress(
+        json.dumps(payload, separators=(',', ':')).encode()
+    )
+    data = b''.join([
+        SNAPSHOT_SIGNATURE,
+        struct.pack('>IQI', VERSION, generation, len(payload)),
+        payload
+    ])
+    return data + hashlib.sha1(data).digest()
+
+
+def load_snapshot(data):
+    """Returns a tuple ``(generation, snapshot)`` with the snapshot
+    serialized in the given data (see :func:`dump_snapshot`).
+
+    :raises SharedSnapshotError: If the data are not a valid snapshot.
+    """
+    if len(data) < 40 or data[:4] != SNAPSHOT_SIGNATURE:
+        raise SharedSnapshotError('invalid shared snapshot')
+    version, generation, payload_length = struct.unpack('>IQI', data[4:20])
+    if version != VERSION:
+        raise SharedSnapshotError(
+            'unsupported shared snapshot version {}'.format(version)
+        )
+    if (len(data) != 20 + payload_length + 20 or
+            hashlib.sha1(data[:-20]).digest() != data[-20:]):
+        raise SharedSnapshotError('corrupted shared snapshot')
+    payload = json.loads(zlib.decompress(data[20:-20]).decode())
+
+    commits = [
+        Commit(hash, author, email, datetime.datetime.fromtimestamp(date_ts),
+               subject)
+        for hash, author, email, date_ts, subject in payload['commits']
+    ]
+    remote = payload['remote']
+    return generation, Snapshot(
+        repo_name=payload['repo_name'],
+        remote=remote,
+        last_update_date=_load_date(payload['last_update_date']),
+        master_branch=BranchSnapshot(remote, payload['master_branch']),
+        shown_branches=[
+            BranchSnapshot(
+                remote,
+                name,
+                commits[commit_index] if commit_index is not None else None,
+                [commits[index] for index in unmerged_commit_indexes]
+            )
+            for name, commit_index, unmerged_commit_indexes
+            in payload['shown_branches']
+        ],
+        ignored_branches=[
+            BranchSnapshot(remote, name)
+            for name in payload['ignored_branches']
+        ],
+        unmerged_commit_counts={
+            name: CommitCounts(*counts)
+            for name, counts in payload['unmerged_commit_counts'].items()
+        },
+        fingerprint=payload['fingerprint'],
+        date=_load_date(payload['date']),
+        num_of_shown_branches=payload['num_of_shown_branches']
+    )
+
+
+class SharedSnapshot:
+    """The latest snapshot of a repository shared by all processes that use
+    the same directory and name.
+
+    A single process (the leader, elected by a lock on a file) takes
+    snapshots and publishes them. Every published snapshot is written into a
+    new file, and then a generation counter in another file is increased.
+    The other processes map the file with the counter into memory, so
+    checking whether there is a new snapshot is cheap, and they load a
+    published snapshot only once. When the leader ends, another process
+    becomes the leader.
+
+    The following files are used (``<name>`` is the name of the snapshot):
+
+    * ``<name>.lock`` - locked by the leader,
+    * ``<name>.gen`` - the generation counter of the latest snapshot,
+    * ``<name>-<generation>.bin`` - published snapshots (the two latest
+      ones are kept).
+
+    Instances can be shared between threads.
+    """
+
+    def __init__(self, dir, name='snapshot'):
+        """Creates a shared snapshot.
+
+        :param str dir: A path to the directory with the files. It is created
+                        when a snapshot is first published.
+        :param str name: Name of the snapshot.
+        """
+        self._dir = dir
+        self._name = name
+        self._lock = threading.Lock()
+        self._lock_file = None
+        self._leader_pid = None
+        self._generation_file = None
+        self._generation_map = None
+        self._snapshot = None
+        self._generation = None
+        self._num_of_loads = 0
+        self._num_of_publications = 0
+
+    @property
+    def dir(self):
+        """A path to the directory with the files."""
+        return self._dir
+
+    @property
+    def name(self):
+        """Name of the snapshot."""
+        return self._name
+
+    @property
+    def is_leader(self):
+        """Is the current process the leader?"""
+        return self._leader_pid == os.getpid()
+
+    def try_to_become_leader(self):
+        """Makes the current process the leader if there is no other leader.
+
+        :returns: `True` if the current process is the leader, `False`
+                  otherwise.
+        """
+        with self._lock:
+            return self._try_to_become_leader()
+
+    def get_snapshot(self):
+        """Returns the latest published snapshot, or `None` when no snapshot
+        has been published.
+
+        A snapshot is loaded only when the generation counter changes. When
+        it cannot be loaded, the previously loaded one is returned.
+        """
+        with self._lock:
+            return self._get_snapshot()
+
+    def publish(self, snapshot):
+        """Publishes the given snapshot
+        (:class:`viewer.snapshot.Snapshot`).
+
+        :raises SharedSnapshotError: If the current process is not the leader
+                                     or if the snapshot cannot be written.
+        """
+        with self._lock:
+            self._publish(snapshot)
+
+    def get_or_take_snapshot(self, take_snapshot, get_fingerprint):
+        """Returns the latest snapshot for the current fingerprint of the
+        repository.
+
+        :param callable take_snapshot: A function without parameters that
+                                       returns a new snapshot.
+        :param callable get_fingerprint: A function without parameters that
+                                         returns the current fingerprint of
+                                         the repository.
+
+        When the published snapshot has a different fingerprint (or it is not
+        complete) and the current process is (or becomes) the leader, a new
+        snapshot is taken
+        and published. Other processes return the published snapshot until
+        the leader publishes a new one. A snapshot is taken without being
+        published only when no snapshot has been published yet and another
+        process is the leader.
+        """
+        with self._lock:
+            snapshot = self._get_snapshot()
+            if (snapshot is not None and snapshot.is_complete and
+                    snapshot.fingerprint == get_fingerprint()):
+                return snapshot
+            if not self._try_to_become_leader():
+                return snapshot if snapshot is not None else take_snapshot()
+            snapshot = take_snapshot()
+            self._publish(snapshot)
+            return snapshot
+
+    def stats(self):
+        """Returns a dictionary with statistics of the shared snapshot in the
+        current process.
+        """
+        return {
+            'leader': self.is_leader,
+            'generation': self._generation,
+            'loads': self._num_of_loads,
+            'publications': self._num_of_publications
+        }
+
+    def close(self):
+        """Closes all files. When the current process is the leader, it stops
+        being the leader.
+        """
+        with self._lock:
+            if self._generation_map is not None:
+                self._generation_map.close()
+                self._generation_map = None
+            if self._generation_file is not None:
+                self._generation_file.close()
+                self._generation_file = None
+            if self._lock_file is not None:
+                self._lock_file.close()
+                self._lock_file = None
+            self._leader_pid = None
+
+    def __repr__(self):
+        return '{}({!r}, {!r})'.format(
+            self.__class__.__name__,
+            self._dir,
+            self._name
+        )
+
+    def _try_to_become_leader(self):
+        if self.is_leader:
+            return True
+        # POSIX record locks (unlike flock() locks) are not inherited by
+        # child processes, so processes forked from the leader do not become
+        # leaders as well. Closing the file inherited from the leader does
+        # not release its lock.
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+        try:
+            os.makedirs(self._dir, exist_ok=True)
+            lock_file = open(self._get_path('.lock'), 'a+b')
+        except OSError:
+            return False
+        try:
+            fcntl.lockf(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        self._leader_pid = os.getpid()
+        return True
+
+    def _get_snapshot(self):
+        generation = self._read_generation()
+        if generation is not None and generation != self._generation:
+            try:
+                self._generation, self._snapshot = self._load(generation)
+                self._num_of_loads += 1
+            except (OSError, SharedSnapshotError):
+                # The snapshot is being replaced by a newer one (or the file
+                # is damaged), so keep the previous one.
+                pass
+        return self._snapshot
+
+    def _read_generation(self):
+        if self._generation_map is None:
+            try:
+                with open(self._get_path('.gen'), 'rb') as f:
+                    generation_map = mmap.mmap(
+                        f.fileno(), 16, access=mmap.ACCESS_READ
+                    )
+            except (OSError, ValueError):
+                return None
+            if generation_map[:4] != GENERATION_SIGNATURE:
+                generation_map.close()
+                return None
+            self._generation_map = generation_map
+        generation, = struct.unpack_from('>Q', self._generation_map, 8)
+        return generation
+
+    def _load(self, generation):
+        with open(self._get_snapshot_path(generation), 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                loaded_generation, snapshot = load_snapshot(data)
+        if loaded_generation != generation:
+            raise SharedSnapshotError(
+                'unexpected generation {}'.format(loaded_generation)
+            )
+        return generation, snapshot
+
+    def _publish(self, snapshot):
+        if not self.is_leader:
+            raise SharedSnapshotError(
+                'only the leader can publish snapshots'
+            )
+        try:
+            generation = (self._read_generation() or 0) + 1
+            self._write_file(
+                self._get_snapshot_path(generation),
+                dump_snapshot(snapshot, generation)
+            )
+            self._write_generation(generation)
+            self._remove_old_snapshots(generation)
+        except OSError as ex:
+            raise SharedSnapshotError(
+                'cannot publish snapshot: {}'.format(ex)
+            ) from ex
+        self._generation = generation
+        self._snapshot = snapshot
+        self._num_of_publications += 1
+
+    def _write_generation(self, generation):
+        path = self._get_path('.gen')
+        if not os.path.exists(path):
+            # The file is created atomically, so readers never map a file
+            # without the whole header.
+            self._write_file(path, b''.join([
+                GENERATION_SIGNATURE,
+                struct.pack('>IQ', VERSION, generation)
+            ]))
+            return
+        # The counter is updated in place, so processes that have already
+        # mapped the file see the new value. Readers check that the loaded
+        # snapshot has the expected generation.
+        fd = os.open(path, os.O_WRONLY)
+        try:
+            os.pwrite(fd, struct.pack('>Q', generation), 8)
+        finally:
+            os.close(fd)
+
+    def _remove_old_snapshots(self, generation):
+        # The previous snapshot is kept because other processes may be just
+        # loading it.
+        prefix = self._name + '-'
+        for file_name in os.listdir(self._dir):
+            if not (file_name.startswith(prefix) and
+                    file_name.endswith('.bin')):
+                continue
+            try:
+                file_generation = int(file_name[len(prefix):-len('.bin')])
+            except ValueError:
+                continue
+            if file_generation < generation - 1:
+                try:
+                    os.unlink(os.path.join(self._dir, file_name))
+                except FileNotFoundError:
+                    pass
+
+    def _write_file(self, path, data):
+        fd, tmp_path = tempfile.mkstemp(dir=self._dir, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def _get_path(self, suffix):
+        return os.path.join(self._dir, self._name + suffix)
+
+    def _get_snapshot_path(self, generation):
+        return self._get_path('-{}.bin'.format(generation))
+
+
+def _dump_date(date):
+    return date.timestamp() if date is not None else None
+
+
+def _load_date(timestamp):
+    return (datetime.datetime.fromtimestamp(timestamp)
+            if timestamp is not None else None)
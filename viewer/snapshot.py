@@ -0,0 +1,706 @@
+"""
+    viewer.snapshot
+    ~~~~~~~~~~~~~~~
+
+    Immutable snapshots of data about branches in a repository.
+
+    A snapshot contains everything that is shown about the branches, so once it
+    is taken, it can be shown without running any Git command.
+
+    :copyright: © 2014 by Petr Zemek <s3rvac@gmail.com> and contributors
+    :license: BSD, see LICENSE for more details
+"""
+
+import asyncio
+import datetime
+
+from viewer.git import Branch
+from viewer.git import GitDeadlineExceededError
+from viewer.git import RequestCache
+from viewer.git import get_deadline
+from viewer.git import sort_branches
+
+
+class BranchSnapshot:
+    """Data about a branch captured in a snapshot.
+
+    It provides the same interface for obtaining the data as
+    :class:`viewer.git.Branch`, but all the data are already present.
+    """
+
+    def __init__(self, remote, name, commit=None, unmerged_commits=()):
+        """Creates a snapshot of a branch.
+
+        :param str remote: Name of the remote on which the branch is.
+        :param str name: Name of the branch.
+        :param Commit commit: Commit representing the branch (may be `None`
+                              for branches whose details are not needed,
+                              e.g. ignored branches).
+        :param list unmerged_commits: Commits that are not in the master
+                                      branch (possibly limited).
+        """
+        self._remote = remote
+        self._name = name
+        self._commit = commit
+        self._unmerged_commits = tuple(unmerged_commits)
+
+    @property
+    def remote(self):
+        """Name of the remote on which the branch is."""
+        return self._remote
+
+    @property
+    def name(self):
+        """Name of the branch."""
+        return self._name
+
+    @property
+    def full_name(self):
+        """Full name of the branch (`'remote/name'`)."""
+        return '{}/{}'.format(self.remote, self.name)
+
+    @property
+    def commit(self):
+        """Commit representing the branch."""
+        return self._commit
+
+    @property
+    def age(self):
+        """Age of the branch.
+
+        It is the age of the commit representing the branch.
+        """
+        return self.commit.age
+
+    def unmerged_commits(self, master_branch=None, limit=None):
+        """Returns a list of commits that are not in the master branch.
+
+        :param int limit: If not `None`, returns at most `limit` commits.
+
+        `master_branch` is accepted only for compatibility with
+        :meth:`viewer.git.Branch.unmerged_commits`; the commits are always
+        those that were not in the master branch of the snapshot.
+        """
+        return list(self._unmerged_commits[:limit])
+
+    def __eq__(self, other):
+        return (self.remote == other.remote and
+                self.name == other.name and
+                self.commit == other.commit and
+                self._unmerged_commits == other._unmerged_commits)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '{}({!r}, {!r}, {!r})'.format(
+            self.__class__.__name__,
+            self.remote,
+            self.name,
+            self.commit
+        )
+
+
+class Snapshot:
+    """An immutable snapshot of data about branches in a repository."""
+
+    def __init__(self, repo_name, remote, last_update_date, master_branch,
+                 shown_branches, ignored_branches, unmerged_commit_counts,
+                 fingerprint=None, date=None, num_of_shown_branches=None):
+        """Creates a snapshot.
+
+        :param str repo_name: Name of the repository.
+        :param str remote: Name of the remote on which the branches are.
+        :param datetime last_update_date: When the repository was last
+                                          updated.
+        :param BranchSnapshot master_branch: The master branch (without
+                                             details).
+        :param list shown_branches: Shown branches (:class:`BranchSnapshot`).
+        :param list ignored_branches: Ignored branches
+                                      (:class:`BranchSnapshot`).
+        :param dict unmerged_commit_counts: A dictionary mapping full names of
+                                            the shown branches to
+                                            :class:`viewer.git.CommitCounts`.
+                                            Branches whose data could not be
+                                            obtained are not in it.
+        :param str fingerprint: Fingerprint of the repository from which the
+                                snapshot was taken (see
+                                :meth:`viewer.git.Repo.get_fingerprint`).
+        :param datetime date: When the snapshot was taken. If `None`, the
+                              current date is used.
+        :param int num_of_shown_branches: Number of all shown branches when
+                                          `shown_branches` contains only some
+                                          of them (e.g. a single page). If
+                                          `None`, it is the number of
+                                          `shown_branches`.
+        """
+        self._repo_name = repo_name
+        self._remote = remote
+        self._last_update_date = last_update_date
+        self._master_branch = master_branch
+        self._shown_branches = tuple(shown_branches)
+        self._ignored_branches = tuple(ignored_branches)
+        self._unmerged_commit_counts = dict(unmerged_commit_counts)
+        self._fingerprint = fingerprint
+        self._date = date if date is not None else datetime.datetime.now()
+        self._num_of_shown_branches = (
+            num_of_shown_branches if num_of_shown_branches is not None
+            else len(self._shown_branches)
+        )
+
+    @property
+    def repo_name(self):
+        """Name of the repository."""
+        return self._repo_name
+
+    @property
+    def remote(self):
+        """Name of the remote on which the branches are."""
+        return self._remote
+
+    @property
+    def last_update_date(self):
+        """When the repository was last updated."""
+        return self._last_update_date
+
+    @property
+    def master_branch(self):
+        """The master branch."""
+        return self._master_branch
+
+    @property
+    def shown_branches(self):
+        """Shown branches (a list of :class:`BranchSnapshot`)."""
+        return list(self._shown_branches)
+
+    @property
+    def num_of_shown_branches(self):
+        """Number of all shown branches, including those that are not in the
+        snapshot.
+        """
+        return self._num_of_shown_branches
+
+    @property
+    def ignored_branches(self):
+        """Ignored branches (a list of :class:`BranchSnapshot`)."""
+        return list(self._ignored_branches)
+
+    @property
+    def unmerged_commit_counts(self):
+        """A dictionary mapping full names of the shown branches to
+        :class:`viewer.git.CommitCounts`.
+        """
+        return dict(self._unmerged_commit_counts)
+
+    @property
+    def is_complete(self):
+        """Are data about all the shown branches in the snapshot?
+
+        Data about branches are missing when they could not be obtained
+        before the deadline (see :func:`viewer.git.set_deadline`).
+        """
+        return all(branch.full_name in self._unmerged_commit_counts
+                   for branch in self._shown_branches)
+
+    @property
+    def fingerprint(self):
+        """Fingerprint of the repository from which the snapshot was taken."""
+        return self._fingerprint
+
+    @property
+    def date(self):
+        """When the snapshot was taken."""
+        return self._date
+
+    @property
+    def age(self):
+        """Age of the snapshot (:class:`datetime.timedelta`)."""
+        return datetime.datetime.now() - self.date
+
+    def slice_shown_branches(self, branches_slice):
+        """Returns a snapshot that contains only the shown branches in the
+        given slice (:class:`slice`).
+
+        The returned snapshot has the same date and number of all shown
+        branches as this snapshot.
+        """
+        shown_branches = self._shown_branches[branches_slice]
+        return Snapshot(
+            repo_name=self.repo_name,
+            remote=self.remote,
+            last_update_date=self.last_update_date,
+            master_branch=self.master_branch,
+            shown_branches=shown_branches,
+            ignored_branches=self._ignored_branches,
+            unmerged_commit_counts={
+                branch.full_name: self._unmerged_commit_counts[branch.full_name]
+                for branch in shown_branches
+                if branch.full_name in self._unmerged_commit_counts
+            },
+            fingerprint=self.fingerprint,
+            date=self.date,
+            num_of_shown_branches=self.num_of_shown_branches
+        )
+
+    def __repr__(self):
+        return '{}({!r}, {!r}, date={!r})'.format(
+            self.__class__.__name__,
+            self.repo_name,
+            self.remote,
+            self.date
+        )
+
+
+class StreamedSnapshot:
+    """Data about branches in a repository that are obtained while they are
+    being shown.
+
+    It provides the same interface for obtaining the data as
+    :class:`Snapshot`. Branches are listed when they are first needed, and
+    the data about every shown branch are obtained just before the branch is
+    yielded when iterating over :attr:`shown_branches`, so the first branches
+    can be shown before the data about the other ones are obtained.
+    :attr:`unmerged_commit_counts` contains the counts for the branches that
+    have already been yielded.
+
+    Instances are meant to be used only once, by a single thread.
+    """
+
+    def __init__(self, repo, remote, master_branch_name, is_ignored,
+                 sort_branches_by, unmerged_commits_limit, cache=None,
+                 branches_slice=None):
+        """Creates a streamed snapshot.
+
+        The parameters have the same meaning as in :func:`take_snapshot`. No
+        Git command is run.
+        """
+        self._repo = repo
+        self._remote = remote
+        self._master_branch_name = master_branch_name
+        self._is_ignored = is_ignored
+        self._sort_branches_by = sort_branches_by
+        self._unmerged_commits_limit = unmerged_commits_limit
+        self._cache = cache if cache is not None else RequestCache()
+        self._branches_slice = branches_slice
+        self._branches = None
+        self._fingerprint = None
+        self._num_of_shown_branches = None
+        self._unmerged_commit_counts = {}
+        self._is_complete = True
+
+    @property
+    def repo_name(self):
+        """Name of the repository."""
+        return self._repo.name
+
+    @property
+    def remote(self):
+        """Name of the remote on which the branches are."""
+        return self._remote
+
+    @property
+    def last_update_date(self):
+        """When the repository was last updated."""
+        return self._repo.get_date_of_last_update()
+
+    @property
+    def master_branch(self):
+        """The master branch."""
+        return BranchSnapshot(self._remote, self._master_branch_name)
+
+    @property
+    def shown_branches(self):
+        """Shown branches.
+
+        It is an iterable that yields :class:`BranchSnapshot` for every shown
+        branch once the data about the branch have been obtained.
+        """
+        return _StreamedBranches(self)
+
+    @property
+    def num_of_shown_branches(self):
+        """Number of all shown branches, including those that are not in the
+        snapshot.
+        """
+        self._get_branches()
+        return self._num_of_shown_branches
+
+    @property
+    def fingerprint(self):
+        """Fingerprint of the repository from which the branches were listed
+        (see :meth:`viewer.git.Repo.get_fingerprint`).
+        """
+        self._get_branches()
+        return self._fingerprint
+
+    @property
+    def ignored_branches(self):
+        """Ignored branches (a list of :class:`BranchSnapshot`)."""
+        _, ignored_branches, _ = self._get_branches()
+        return [
+            BranchSnapshot(branch.remote, branch.name)
+            for branch in ignored_branches
+        ]
+
+    @property
+    def unmerged_commit_counts(self):
+        """A dictionary mapping full names of the already yielded shown
+        branches to :class:`viewer.git.CommitCounts`.
+
+        Branches whose data could not be obtained before the deadline are not
+        in it.
+        """
+        return self._unmerged_commit_counts
+
+    @property
+    def is_complete(self):
+        """Are data about all the already yielded shown branches in the
+        snapshot?
+        """
+        return self._is_complete
+
+    def iter_shown_branches(self):
+        """Yields :class:`BranchSnapshot` for every shown branch once the data
+        about the branch have been obtained (or once the deadline has passed,
+        see :func:`viewer.git.set_deadline`).
+
+        Data for the shown branches are obtained concurrently when the
+        repository has a thread pool.
+        """
+        shown_branches, _, master_branch = self._get_branches()
+
+        def snapshot_branch(branch):
+            return _snapshot_branch_before_deadline(
+                self._repo,
+                branch,
+                master_branch,
+                self._unmerged_commits_limit
+            )
+
+        for counts, branch in self._repo.imap_branches(snapshot_branch,
+                                                       shown_branches):
+            if counts is not None:
+                self._unmerged_commit_counts[branch.full_name] = counts
+            else:
+                self._is_complete = False
+            yield branch
+
+    def _get_branches(self):
+        if self._branches is None:
+            # See take_snapshot() for why the fingerprint is obtained first.
+            self._fingerprint = self._repo.get_fingerprint(self._remote)
+            shown_branches, ignored_branches, master_branch = list_branches(
+                self._repo,
+                self._remote,
+                self._master_branch_name,
+                self._is_ignored,
+                self._sort_branches_by,
+                self._cache
+            )
+            self._num_of_shown_branches = len(shown_branches)
+            if self._branches_slice is not None:
+                shown_branches = shown_branches[self._branches_slice]
+            self._branches = shown_branches, ignored_branches, master_branch
+        return self._branches
+
+
+class _StreamedBranches:
+    """Shown branches of a :class:`StreamedSnapshot`.
+
+    Checking whether there are any branches does not obtain data about them.
+    """
+
+    def __init__(self, snapshot):
+        self._snapshot = snapshot
+
+    def __bool__(self):
+        return len(self) > 0
+
+    def __len__(self):
+        shown_branches, _, _ = self._snapshot._get_branches()
+        return len(shown_branches)
+
+    def __iter__(self):
+        return self._snapshot.iter_shown_branches()
+
+
+def take_snapshot(repo, remote, master_branch_name, is_ignored,
+                  sort_branches_by, unmerged_commits_limit, cache=None,
+                  branches_slice=None):
+    """Takes a snapshot of branches on the given remote in the given
+    repository.
+
+    :param Repo repo: The repository.
+    :param str remote: Name of the remote.
+    :param str master_branch_name: Name of the master branch.
+    :param callable is_ignored: A function that takes a name of a branch and
+                                returns `True` if the branch is ignored.
+    :param str sort_branches_by: By which attribute the shown branches are
+                                 sorted.
+    :param int unmerged_commits_limit: How many unmerged commits are kept for
+                                       every branch (`None` means all).
+    :param RequestCache cache: Cache in which values obtained from the
+                               repository are memoized while the snapshot is
+                               being taken. If `None`, a new one is used.
+    :param slice branches_slice: If not `None`, only the shown branches in
+                                 this slice of all (sorted) shown branches are
+                                 in the snapshot, so data are obtained only
+                                 for them.
+
+    Data for the shown branches are obtained concurrently when the
+    repository has a thread pool. When there is a deadline (see
+    :func:`viewer.git.set_deadline`), data about every branch are obtained
+    separately and branches whose data cannot be obtained before the deadline
+    are in the snapshot without them (see :attr:`Snapshot.is_complete`).
+    """
+    if cache is None:
+        cache = RequestCache()
+
+    # The name of the repository may need a Git command, so it is obtained
+    # before data about branches, which may run out of the deadline.
+    repo_name = repo.name
+    # The fingerprint is obtained before any data, so a change that happens
+    # while the snapshot is being taken results in a different fingerprint.
+    fingerprint = repo.get_fingerprint(remote)
+    shown_branches, ignored_branches, master_branch = list_branches(
+        repo, remote, master_branch_name, is_ignored, sort_branches_by, cache
+    )
+    num_of_shown_branches = len(shown_branches)
+    if branches_slice is not None:
+        shown_branches = shown_branches[branches_slice]
+    if get_deadline() is None:
+        # The numbers of unmerged commits of all branches are obtained
+        # together, which is faster.
+        unmerged_commit_counts = repo.get_unmerged_commit_counts(
+            master_branch,
+            shown_branches
+        )
+        shown_branch_snapshots = repo.map_branches(
+            lambda branch: _snapshot_branch(
+                branch,
+                master_branch,
+                unmerged_commit_counts[branch.full_name],
+                unmerged_commits_limit
+            ),
+            shown_branches
+        )
+    else:
+        # A single branch with a lot of unmerged commits cannot cause that
+        # data about the other branches are not obtained before the deadline.
+        results = repo.map_branches(
+            lambda branch: _snapshot_branch_before_deadline(
+                repo, branch, master_branch, unmerged_commits_limit
+            ),
+            shown_branches
+        )
+        unmerged_commit_counts = {
+            branch.full_name: counts
+            for counts, branch in results if counts is not None
+        }
+        shown_branch_snapshots = [branch for _, branch in results]
+    return Snapshot(
+        repo_name=repo_name,
+        remote=remote,
+        last_update_date=repo.get_date_of_last_update(),
+        master_branch=BranchSnapshot(master_branch.remote, master_branch.name),
+        shown_branches=shown_branch_snapshots,
+        ignored_branches=[
+            BranchSnapshot(branch.remote, branch.name)
+            for branch in ignored_branches
+        ],
+        unmerged_commit_counts=unmerged_commit_counts,
+        fingerprint=fingerprint,
+        num_of_shown_branches=num_of_shown_branches
+    )
+
+
+async def take_snapshot_async(async_repo, remote, master_branch_name,
+                              is_ignored, sort_branches_by,
+                              unmerged_commits_limit, cache=None,
+                              branches_slice=None,
+                              max_concurrent_branches=None):
+    """Takes a snapshot of branches on the given remote in the given
+    repository without blocking the event loop.
+
+    :param AsyncRepo async_repo: The repository
+                                 (:class:`viewer.git.AsyncRepo`).
+    :param int max_concurrent_branches: For how many branches at most are
+                                        data obtained at the same time. If
+                                        `None`, the number is not limited.
+                                        Values lower than 1 are treated as 1.
+
+    The other parameters have the same meaning as in :func:`take_snapshot`.
+    Data for the shown branches are obtained concurrently. By limiting the
+    number of branches obtained at once (e.g. to the limit of Git commands,
+    see :data:`viewer.git.git_processes`), a page with many branches does not
+    exceed the limits of Git commands by itself. When data about a branch
+    cannot be obtained, data about the other branches stop being obtained.
+    Like in :func:`take_snapshot` with a deadline, data about every branch are
+    obtained separately and branches whose data cannot be obtained before the
+    deadline are in the snapshot without them.
+    """
+    if cache is None:
+        cache = RequestCache()
+
+    repo = async_repo.repo
+    # See take_snapshot() for the reasons of this order. The fingerprint may
+    # need a Git command (see viewer.git.Repo.refs) and both it and the date
+    # of the last update are read from files, so they are obtained in a
+    # thread.
+    repo_name = repo.name
+    fingerprint = await asyncio.to_thread(repo.get_fingerprint, remote)
+    shown_branches, ignored_branches, master_branch = _split_branches(
+        repo,
+        remote,
+        master_branch_name,
+        is_ignored,
+        sort_branches_by,
+        await async_repo.load_branches(remote, cache),
+        cache
+    )
+    num_of_shown_branches = len(shown_branches)
+    if branches_slice is not None:
+        shown_branches = shown_branches[branches_slice]
+
+    if max_concurrent_branches is None:
+        max_concurrent_branches = len(shown_branches)
+    semaphore = asyncio.Semaphore(max(1, max_concurrent_branches))
+
+    async def snapshot_branch(branch):
+        async with semaphore:
+            try:
+                counts = (await async_repo.get_unmerged_commit_counts(
+                    master_branch,
+                    [branch]
+                ))[branch.full_name]
+                unmerged_commits = ()
+                if counts.ahead:
+                    unmerged_commits = await async_repo.get_unmerged_commits(
+                        master_branch,
+                        branch,
+                        unmerged_commits_limit
+                    )
+                return counts, BranchSnapshot(
+                    branch.remote,
+                    branch.name,
+                    branch.commit,
+                    unmerged_commits
+                )
+            except GitDeadlineExceededError:
+                return None, BranchSnapshot(branch.remote, branch.name,
+                                            branch.commit)
+
+    results = await _gather_or_cancel(
+        snapshot_branch(branch) for branch in shown_branches
+    )
+    last_update_date = await asyncio.to_thread(repo.get_date_of_last_update)
+    return Snapshot(
+        repo_name=repo_name,
+        remote=remote,
+        last_update_date=last_update_date,
+        master_branch=BranchSnapshot(master_branch.remote, master_branch.name),
+        shown_branches=[branch for _, branch in results],
+        ignored_branches=[
+            BranchSnapshot(branch.remote, branch.name)
+            for branch in ignored_branches
+        ],
+        unmerged_commit_counts={
+            branch.full_name: counts
+            for counts, branch in results if counts is not None
+        },
+        fingerprint=fingerprint,
+        num_of_shown_branches=num_of_shown_branches
+    )
+
+
+def list_branches(repo, remote, master_branch_name, is_ignored,
+                  sort_branches_by, cache=None):
+    """Lists branches on the given remote in the given repository.
+
+    :returns: A tuple ``(shown_branches, ignored_branches, master_branch)``,
+              where the shown branches are sorted.
+
+    The parameters have the same meaning as in :func:`take_snapshot`. The
+    branches are loaded together with their commits by a single Git command
+    (see :meth:`viewer.git.Repo.load_branches`), but nothing else about them
+    is obtained.
+    """
+    return _split_branches(
+        repo,
+        remote,
+        master_branch_name,
+        is_ignored,
+        sort_branches_by,
+        repo.load_branches(remote, cache),
+        cache
+    )
+
+
+def _split_branches(repo, remote, master_branch_name, is_ignored,
+                    sort_branches_by, all_branches, cache):
+    ignored_branches = [branch for branch in all_branches
+                        if is_ignored(branch.name)]
+    shown_branches = [branch for branch in all_branches
+                      if branch not in ignored_branches]
+    sort_branches(shown_branches, sort_branches_by)
+    master_branch = _get_master_branch(
+        repo, remote, master_branch_name, all_branches, cache
+    )
+    return shown_branches, ignored_branches, master_branch
+
+
+def _snapshot_branch(branch, master_branch, counts, unmerged_commits_limit):
+    unmerged_commits = ()
+    if counts.ahead:
+        unmerged_commits = branch.unmerged_commits(
+            master_branch,
+            unmerged_commits_limit
+        )
+    return BranchSnapshot(
+        branch.remote,
+        branch.name,
+        branch.commit,
+        unmerged_commits
+    )
+
+
+def _snapshot_branch_before_deadline(repo, branch, master_branch,
+                                     unmerged_commits_limit):
+    # Returns a tuple (counts, branch snapshot). When the data about the
+    # branch cannot be obtained before the deadline, the counts are None and
+    # the snapshot contains only the data from the listing of branches.
+    try:
+        counts = repo.get_unmerged_commit_counts(
+            master_branch,
+            [branch]
+        )[branch.full_name]
+        return counts, _snapshot_branch(
+            branch,
+            master_branch,
+            counts,
+            unmerged_commits_limit
+        )
+    except GitDeadlineExceededError:
+        return None, BranchSnapshot(branch.remote, branch.name, branch.commit)
+
+
+def _get_master_branch(repo, remote, master_branch_name, branches, cache):
+    # Prefer the already loaded branch (its commit is already known).
+    for branch in branches:
+        if branch.name == master_branch_name:
+            return branch
+    return Branch(repo, remote, master_branch_name, cache=cache)
+
+
+async def _gather_or_cancel(coros):
+    # Like asyncio.gather(), but when a coroutine fails, the other ones are
+    # cancelled (and waited for), so they do not run Git commands after the
+    # failure is reported.
+    tasks = [asyncio.ensure_future(coro) for coro in coros]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
@@ -8,8 +8,11 @@
     :license: BSD, see LICENSE for more details
 """
 
+import collections
 import contextlib
 import os
+import threading
+import time
 
 
 @contextlib.contextmanager
@@ -39,3 +42,380 @@ def chdir(dir):
 def nonempty_lines(text):
     """Returns non-empty lines in the given text."""
     return [line for line in text.split('\n') if line]
+
+
+def iter_nonempty_lines(chunks):
+    """Yields non-empty lines from the given iterable of text chunks.
+
+    Lines may be split between chunks.
+    """
+    buffer = ''
+    for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split('\n')
+        for line in lines:
+            if line:
+                yield line
+    if buffer:
+        yield buffer
+
+
+class LRUCache:
+    """A thread-safe cache of a bounded size.
+
+    When the cache is full, the least recently used item is evicted. The
+    numbers of cache hits and misses are counted to ease sizing of the cache.
+    """
+
+    def __init__(self, maxsize):
+        """Creates an empty cache.
+
+        :param int maxsize: Maximal number of items in the cache. When it is
+                            zero, nothing is cached.
+        """
+        self._maxsize = maxsize
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    @property
+    def maxsize(self):
+        """Maximal number of items in the cache."""
+        return self._maxsize
+
+    @maxsize.setter
+    def maxsize(self, maxsize):
+        with self._lock:
+            self._maxsize = maxsize
+            self._evict()
+
+    @property
+    def hits(self):
+        """Number of lookups that found an item in the cache."""
+        return self._hits
+
+    @property
+    def misses(self):
+        """Number of lookups that did not find an item in the cache."""
+        return self._misses
+
+    def get(self, key, default=None):
+        """Returns the item for the given key, or `default` if there is no
+        such item.
+        """
+        with self._lock:
+            if key not in self._items:
+                self._misses += 1
+                return default
+            self._hits += 1
+            self._items.move_to_end(key)
+            return self._items[key]
+
+    def put(self, key, value):
+        """Stores the given item into the cache."""
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            self._evict()
+
+    def get_or_compute(self, key, compute):
+        """Returns the item for the given key, computing and storing it by
+        calling `compute()` when it is not in the cache.
+        """
+        missing = object()
+        value = self.get(key, missing)
+        if value is missing:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        """Removes all items from the cache and resets the counters."""
+        with self._lock:
+            self._items.clear()
+            self._hits = 0
+            self._misses = 0
+
+    def stats(self):
+        """Returns a dictionary with the size, maximal size, hits, and misses
+        of the cache.
+        """
+        with self._lock:
+            return {
+                'size': len(self._items),
+                'maxsize': self._maxsize,
+                'hits': self._hits,
+                'misses': self._misses
+            }
+
+    def __len__(self):
+        with self._lock:
+            return len(self._items)
+
+    def _evict(self):
+        while len(self._items) > self._maxsize:
+            self._items.popitem(last=False)
+
+
+class SingleFlight:
+    """Coalesces concurrent computations of the same value.
+
+    While a value for a key is being computed, other callers asking for the
+    same key wait for the computation and get its result (or its exception)
+    instead of computing the value again. Nothing is kept after the
+    computation ends, so callers that come later compute the value anew.
+
+    Instances can be shared between threads.
+    """
+
+    def __init__(self):
+        """Creates a single-flight group without any computations."""
+        self._flights = {}
+        self._lock = threading.Lock()
+        self._computations = 0
+        self._coalesced = 0
+
+    @property
+    def computations(self):
+        """Number of values that have been computed."""
+        return self._computations
+
+    @property
+    def coalesced(self):
+        """Number of calls that waited for a computation started by another
+        call.
+        """
+        return self._coalesced
+
+    def do(self, key, compute, deadline=None, is_shareable=None,
+           unshared_exceptions=()):
+        """Returns the value for the given key, computed by calling
+        `compute()` unless it is already being computed by another call.
+
+        :param float deadline: A time (:func:`time.monotonic`) until which the
+                               call waits for a computation started by another
+                               call. When it passes, the value is computed by
+                               this call. If `None`, the call waits as long as
+                               needed.
+        :param callable is_shareable: A function returning whether a value
+                                      computed by another call can be
+                                      returned. If `None`, all values can.
+        :param tuple unshared_exceptions: Types of exceptions raised by a
+                                          computation of another call that are
+                                          not re-raised.
+
+        When a value computed by another call cannot be returned (or when it
+        raised an exception that is not re-raised), the call tries again, so it
+        either waits for another computation or computes the value itself.
+        """
+        while True:
+            with self._lock:
+                flight = self._flights.get(key)
+                if flight is None:
+                    flight = self._flights[key] = _Flight()
+                    self._computations += 1
+                    is_leader = True
+                else:
+                    self._coalesced += 1
+                    is_leader = False
+
+            if is_leader:
+                break
+
+            timeout = None
+            if deadline is not None:
+                timeout = max(deadline - time.monotonic(), 0)
+            if not flight.done.wait(timeout):
+                with self._lock:
+                    self._computations += 1
+                return compute()
+            if flight.exception is not None:
+                if not isinstance(flight.exception, unshared_exceptions):
+                    raise flight.exception
+            elif is_shareable is None or is_shareable(flight.value):
+                return flight.value
+
+        try:
+            flight.value = compute()
+        except BaseException as ex:
+            flight.exception = ex
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.value
+
+    def stats(self):
+        """Returns a dictionary with the numbers of computations, coalesced
+        calls, and computations in progress.
+        """
+        with self._lock:
+            return {
+                'computations': self._computations,
+                'coalesced': self._coalesced,
+                'in_progress': len(self._flights)
+            }
+
+
+class _Flight:
+    """A computation of a value by :class:`SingleFlight`."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.exception = None
+
+
+class ConcurrencyLimitExceededError(Exception):
+    """An error raised when there are too many waiting callers in
+    :class:`ConcurrencyLimiter`.
+    """
+
+
+class ConcurrencyLimiter:
+    """Limits how many callers can do something at the same time.
+
+    Callers that exceed the limit wait until another caller finishes. When
+    too many callers are already waiting, :class:`ConcurrencyLimitExceededError`
+    is raised right away instead of waiting. The numbers of waiting and
+    rejected callers and the time spent waiting are measured to ease sizing of
+    the limits.
+
+    Instances can be shared between threads.
+    """
+
+    def __init__(self, limit=None, max_waiting=None):
+        """Creates a limiter.
+
+        :param int limit: Maximal number of callers at the same time. If
+                          `None`, the number is not limited.
+        :param int max_waiting: Maximal number of waiting callers. If `None`,
+                                the number is not limited.
+        """
+        self._limit = limit
+        self._max_waiting = max_waiting
+        self._condition = threading.Condition()
+        self._running = 0
+        self._waiting = 0
+        self._rejected = 0
+        self._waits = 0
+        self._total_wait_time = 0.0
+        self._max_wait_time = 0.0
+
+    @property
+    def limit(self):
+        """Maximal number of callers at the same time."""
+        return self._limit
+
+    @limit.setter
+    def limit(self, limit):
+        with self._condition:
+            self._limit = limit
+            self._condition.notify_all()
+
+    @property
+    def max_waiting(self):
+        """Maximal number of waiting callers."""
+        return self._max_waiting
+
+    @max_waiting.setter
+    def max_waiting(self, max_waiting):
+        with self._condition:
+            self._max_waiting = max_waiting
+
+    @contextlib.contextmanager
+    def slot(self):
+        """A context manager that holds a place (see :meth:`acquire`) until the
+        end of the block.
+        """
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self):
+        """Returns a dictionary with the limits, the numbers of running,
+        waiting, and rejected callers, and the time callers spent waiting (in
+        seconds).
+        """
+        with self._condition:
+            return {
+                'limit': self._limit,
+                'max_waiting': self._max_waiting,
+                'running': self._running,
+                'waiting': self._waiting,
+                'rejected': self._rejected,
+                'waits': self._waits,
+                'total_wait_time': self._total_wait_time,
+                'max_wait_time': self._max_wait_time
+            }
+
+    def acquire(self, timeout=None):
+        """Waits until the limit allows another caller and takes a place.
+
+        :param float timeout: If not `None`, waits at most `timeout` seconds.
+
+        :returns: `True` if the place has been taken, `False` if the timeout
+                  expired.
+
+        :raises ConcurrencyLimitExceededError: When the limit is reached and
+                                               `max_waiting` callers are
+                                               already waiting.
+
+        The place has to be released by :meth:`release`.
+        """
+        with self._condition:
+            if self._has_free_place():
+                self._running += 1
+                return True
+            if (self._max_waiting is not None and
+                    self._waiting >= self._max_waiting):
+                self._rejected += 1
+                raise ConcurrencyLimitExceededError(
+                    'limit of {} reached with {} waiting'.format(
+                        self._limit, self._waiting
+                    )
+                )
+            start = time.monotonic()
+            self._waiting += 1
+            try:
+                has_free_place = self._condition.wait_for(
+                    self._has_free_place,
+                    timeout
+                )
+            finally:
+                self._waiting -= 1
+            wait_time = time.monotonic() - start
+            self._waits += 1
+            self._total_wait_time += wait_time
+            self._max_wait_time = max(self._max_wait_time, wait_time)
+            if has_free_place:
+                self._running += 1
+            return has_free_place
+
+    def try_acquire(self):
+        """Takes a place if the limit allows another caller right away.
+
+        :returns: `True` if the place has been taken, `False` otherwise.
+
+        Unlike :meth:`acquire`, it neither waits nor raises
+        :class:`ConcurrencyLimitExceededError`. The place has to be released
+        by :meth:`release`.
+        """
+        with self._condition:
+            if not self._has_free_place():
+                return False
+            self._running += 1
+            return True
+
+    def release(self):
+        """Releases a place taken by :meth:`acquire` or :meth:`try_acquire`."""
+        with self._condition:
+            self._running -= 1
+            self._condition.notify()
+
+    def _has_free_place(self):
+        return self._limit is None or self._running < self._limit
@@ -0,0 +1,267 @@
+"""
+    viewer.web.asgi
+    ~~~~~~~~~~~~~~~
+
+    ASGI interface to the web.
+
+    The index page is served by coroutines. Data about the shown branches are
+    obtained by Git commands that are run concurrently by :mod:`asyncio` (see
+    :class:`viewer.git.AsyncRepo`), so a single process with an event loop
+    can serve many index pages at once without a thread per request. Other
+    pages are served by the WSGI application (:data:`viewer.web.app`) in a
+    thread.
+
+    :copyright: © 2014 by Petr Zemek <s3rvac@gmail.com> and contributors
+    :license: BSD, see LICENSE for more details
+"""
+
+import asyncio
+import io
+import sys
+import weakref
+
+from flask import Response
+from flask import g
+from flask import make_response
+
+from viewer import git
+from viewer import snapshot
+from viewer.web import app
+from viewer.web import views
+
+# Asyncio interfaces to repositories for every event loop (an interface can
+# be used only from a single loop), keyed by the repository.
+_async_repos = weakref.WeakKeyDictionary()
+
+
+def get_async_repo():
+    """Returns an :mod:`asyncio` interface to the repository of the current
+    request.
+
+    Git commands run by the interface are limited by ``GIT_MAX_PROCESSES``
+    and ``GIT_MAX_WAITING_PROCESSES`` together with the commands run in
+    threads.
+    """
+    loop_repos = _async_repos.setdefault(asyncio.get_running_loop(), {})
+    key = g.repo.path
+    if key not in loop_repos:
+        loop_repos[key] = git.AsyncRepo(g.repo)
+    return loop_repos[key]
+
+
+async def take_snapshot(branches_slice=None):
+    """Takes a snapshot of branches in the repository of the current request
+    according to the configuration.
+
+    Data are obtained for at most ``ASGI_MAX_CONCURRENT_BRANCHES`` branches
+    at once (by default, for as many branches as there can be running Git
+    commands, see ``GIT_MAX_PROCESSES``). See
+    :func:`viewer.snapshot.take_snapshot_async` for more details.
+    """
+    max_concurrent_branches = app.config['ASGI_MAX_CONCURRENT_BRANCHES']
+    if max_concurrent_branches is None:
+        max_concurrent_branches = git.git_processes.limit
+    return await snapshot.take_snapshot_async(
+        get_async_repo(),
+        remote=app.config['GIT_REMOTE'],
+        master_branch_name=app.config['GIT_MASTER_BRANCH'],
+        is_ignored=views.is_ignored,
+        sort_branches_by=app.config['SORT_BRANCHES_BY'],
+        unmerged_commits_limit=app.config['UNMERGED_COMMITS_LIMIT'],
+        cache=g.git_cache,
+        branches_slice=branches_slice,
+        max_concurrent_branches=max_concurrent_branches
+    )
+
+
+async def get_snapshot(branches_slice=None):
+    """Returns a snapshot of branches to be shown on the index page.
+
+    When the background indexer is enabled or when details of branches are
+    loaded lazily, the snapshot is obtained in the same way as by the WSGI
+    application, in a thread. Otherwise, it is taken by :func:`take_snapshot`.
+    """
+    if app.config['BACKGROUND_INDEXER']:
+        return await asyncio.to_thread(views.get_snapshot, branches_slice)
+    if app.config['LAZY_BRANCH_DETAILS']:
+        return await asyncio.to_thread(views.take_lazy_snapshot, branches_slice)
+    return await take_snapshot(branches_slice)
+
+
+async def index():
+    """Serves the index page.
+
+    It behaves like :func:`viewer.web.views.index`, except that the page is
+    never streamed (``STREAM_INDEX_PAGE`` is ignored).
+    """
+    page_num, per_page = views.get_requested_page()
+    # The version and the date may need a snapshot of the background indexer
+    # (taking it when the indexer is cold) or a Git command, so they are
+    # obtained in a thread.
+    version = await asyncio.to_thread(
+        views.get_page_version,
+        page_num,
+        per_page
+    )
+    etag = views.get_page_etag(version)
+    last_modified_date = await asyncio.to_thread(views.get_last_modified_date)
+    is_complete = True
+    if views.is_not_modified(etag, last_modified_date):
+        response = Response(status=304)
+    else:
+        page = views.get_cached_page(version)
+        if page is None:
+            snapshot = await get_snapshot(
+                views.get_branches_slice(page_num, per_page)
+            )
+            version, etag, last_modified_date = views.get_page_validators(
+                page_num, per_page, snapshot
+            )
+            page, is_complete = views.render_index_page(
+                page_num,
+                per_page,
+                snapshot
+            )
+            if is_complete:
+                views.cache_page(version, page)
+        response = make_response(page)
+    views.set_page_validators(response, etag, last_modified_date, is_complete)
+    return response
+
+
+async def application(scope, receive, send):
+    """The ASGI application."""
+    if scope['type'] == 'lifespan':
+        await serve_lifespan(receive, send)
+    elif scope['type'] != 'http':
+        raise ValueError('unsupported scope type: {}'.format(scope['type']))
+    elif scope['path'] == '/' and scope['method'] in ('GET', 'HEAD'):
+        await serve_index(scope, receive, send)
+    else:
+        await serve_by_wsgi_app(scope, receive, send)
+
+
+async def serve_lifespan(receive, send):
+    """Answers the startup and shutdown events of the server."""
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def serve_index(scope, receive, send):
+    """Serves the index page in the context of a request of the WSGI
+    application, so its request hooks and error handlers are used.
+    """
+    environ = get_environ(scope, await read_body(receive))
+    with app.request_context(environ):
+        try:
+            try:
+                rv = app.preprocess_request()
+                if rv is None:
+                    rv = await index()
+            except Exception as ex:
+                rv = app.handle_user_exception(ex)
+            response = app.finalize_request(rv)
+        except Exception as ex:
+            response = app.handle_exception(ex)
+        body, status, headers = response.get_wsgi_response(environ)
+        await send_response(send, status, headers, body)
+
+
+async def serve_by_wsgi_app(scope, receive, send):
+    """Serves the request by the WSGI application in a thread.
+
+    The whole response is read before it is sent.
+    """
+    environ = get_environ(scope, await read_body(receive))
+    status_and_headers = []
+
+    def start_response(status, headers, exc_info=None):
+        status_and_headers[:] = [status, headers]
+
+    def run_wsgi_app():
+        body = app(environ, start_response)
+        try:
+            return b''.join(body)
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+
+    body = await asyncio.to_thread(run_wsgi_app)
+    status, headers = status_and_headers
+    await send_response(send, status, headers, [body])
+
+
+async def read_body(receive):
+    """Reads the whole body of the request."""
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body', False):
+            return body
+
+
+async def send_response(send, status, headers, body):
+    """Sends a response with the given WSGI status (e.g. ``'200 OK'``),
+    headers, and body (an iterable of byte strings).
+    """
+    await send({
+        'type': 'http.response.start',
+        'status': int(status.split()[0]),
+        'headers': [
+            (name.lower().encode('latin-1'), value.encode('latin-1'))
+            for name, value in headers
+        ]
+    })
+    for chunk in body:
+        if chunk:
+            await send({
+                'type': 'http.response.body',
+                'body': chunk,
+                'more_body': True
+            })
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+def get_environ(scope, body):
+    """Returns a WSGI environment for the request with the given ASGI scope
+    and body.
+    """
+    root_path = scope.get('root_path', '')
+    path = scope['path']
+    if root_path and path.startswith(root_path):
+        path = path[len(root_path):]
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        # WSGI strings are decoded as Latin-1.
+        'SCRIPT_NAME': root_path.encode().decode('latin-1'),
+        'PATH_INFO': path.encode().decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port or 80),
+        'SERVER_PROTOCOL': 'HTTP/{}'.format(scope.get('http_version', '1.1')),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        if name in environ:
+            value = environ[name] + ',' + value
+        environ[name] = value
+    return environ
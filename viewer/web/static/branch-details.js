@@ -0,0 +1,39 @@
+/*! Copyright (c) 2014 by Petr Zemek <s3rvac@gmail.com> and contributors */
+
+// Loads details about branches (their unmerged commits) when the branches are
+// scrolled into view. Browsers that cannot tell which branches are in view
+// load the details about all branches right away.
+(function () {
+	'use strict';
+
+	function loadDetails(element) {
+		fetch(element.dataset.url).then(function (response) {
+			if (!response.ok) {
+				throw new Error(response.statusText);
+			}
+			return response.text();
+		}).then(function (html) {
+			element.innerHTML = html;
+		}).catch(function () {
+			element.textContent = 'Failed to load unmerged commits.';
+		});
+	}
+
+	var elements = document.querySelectorAll('.branch-details[data-url]');
+	if (!('IntersectionObserver' in window)) {
+		Array.prototype.forEach.call(elements, loadDetails);
+		return;
+	}
+
+	var observer = new IntersectionObserver(function (entries) {
+		entries.forEach(function (entry) {
+			if (entry.isIntersecting) {
+				observer.unobserve(entry.target);
+				loadDetails(entry.target);
+			}
+		});
+	}, {rootMargin: '200px'});
+	Array.prototype.forEach.call(elements, function (element) {
+		observer.observe(element);
+	});
+})();
@@ -8,14 +8,37 @@
     :license: BSD, see LICENSE for more details
 """
 
+import base64
+import bisect
+import calendar
+import datetime
+import hashlib
+import json
+import os
 import re
+import threading
+import time
 
-from flask import render_template
+from flask import Response
+from flask import abort
 from flask import g
+from flask import jsonify
+from flask import make_response
+from flask import render_template
+from flask import request
+from flask import stream_with_context
 
 from viewer import git
+from viewer import sharedsnapshot
+from viewer import snapshot
 from viewer.format import format_age
 from viewer.format import format_date
+from viewer.indexer import Indexer
+from viewer.refs import is_valid_ref_name
+from viewer.sharedsnapshot import SharedSnapshot
+from viewer.snapshot import StreamedSnapshot
+from viewer.utils import LRUCache
+from viewer.utils import SingleFlight
 from viewer.web import app
 
 
@@ -25,9 +48,88 @@ def setup_filters():
     app.jinja_env.filters['age'] = format_age
 
 
+# Repositories that have already been created, keyed by the configuration
+# they were created from. The existence of a repository is verified only when
+# it is created, so it is not done on every request.
+_repos = {}
+_repos_lock = threading.Lock()
+
+
+def get_repo():
+    """Returns the Git repository from the configuration.
+
+    The repository is created (and verified) only once and then reused for all
+    requests. Settings of :mod:`viewer.git` that are shared by all
+    repositories in the process are set from the configuration at the same
+    time, not on every request. The name of the repository is obtained at
+    the same time as well, so it never needs a Git command that could run
+    out of the deadline of a request (see ``REQUEST_DEADLINE``).
+    """
+    key = (
+        app.config['GIT_REPO_PATH'],
+        app.config['GIT_THREAD_POOL_SIZE'],
+        app.config['GIT_READ_OBJECTS_IN_PROCESS'],
+        app.config['GIT_MASTER_ANCESTRY_INDEX'],
+        app.config['GIT_COMMIT_STORE_SIZE']
+    )
+    with _repos_lock:
+        if key not in _repos:
+            git.results_cache.maxsize = app.config['GIT_RESULTS_CACHE_SIZE']
+            git.git_processes.limit = app.config['GIT_MAX_PROCESSES']
+            git.git_processes.max_waiting = \
+                app.config['GIT_MAX_WAITING_PROCESSES']
+            _repos[key] = git.Repo(
+                app.config['GIT_REPO_PATH'],
+                pool_size=app.config['GIT_THREAD_POOL_SIZE'],
+                read_objects_in_process=app.config['GIT_READ_OBJECTS_IN_PROCESS'],
+                master_ancestry_index=app.config['GIT_MASTER_ANCESTRY_INDEX'],
+                commit_store_size=app.config['GIT_COMMIT_STORE_SIZE']
+            )
+            _repos[key].name
+        return _repos[key]
+
+
 @app.before_request
 def setup_git_repo():
-    g.repo = git.Repo(app.config['GIT_REPO_PATH'])
+    g.repo = get_repo()
+    g.git_cache = git.RequestCache()
+
+
+@app.teardown_request
+def drop_git_cache(exception):
+    g.pop('git_cache', None)
+
+
+@app.before_request
+def setup_deadline():
+    g.deadline = None
+    if app.config['REQUEST_DEADLINE'] is not None:
+        g.deadline = time.monotonic() + app.config['REQUEST_DEADLINE']
+    git.set_deadline(g.deadline)
+
+
+@app.teardown_request
+def drop_deadline(exception):
+    git.set_deadline(None)
+
+
+@app.errorhandler(git.GitProcessLimitExceededError)
+def handle_git_process_limit_exceeded(ex):
+    # The server is overloaded, so ask the client to try again later instead
+    # of making it wait.
+    response = make_response('Too many requests, try again later.', 503)
+    response.retry_after = app.config['GIT_BUSY_RETRY_AFTER']
+    return response
+
+
+@app.errorhandler(git.GitDeadlineExceededError)
+def handle_git_deadline_exceeded(ex):
+    # Only the index page can be shown without data that could not be
+    # obtained before the deadline (see REQUEST_DEADLINE).
+    response = make_response('The request took too long, try again later.',
+                             503)
+    response.retry_after = app.config['GIT_BUSY_RETRY_AFTER']
+    return response
 
 
 def is_ignored(branch_name):
@@ -47,27 +149,853 @@ def is_ignored(branch_name):
     return False
 
 
+def take_snapshot(repo, cache=None, branches_slice=None):
+    """Takes a snapshot of branches in the given repository according to the
+    configuration.
+
+    See :func:`viewer.snapshot.take_snapshot` for the meaning of
+    `branches_slice`.
+    """
+    return snapshot.take_snapshot(
+        repo,
+        remote=app.config['GIT_REMOTE'],
+        master_branch_name=app.config['GIT_MASTER_BRANCH'],
+        is_ignored=is_ignored,
+        sort_branches_by=app.config['SORT_BRANCHES_BY'],
+        unmerged_commits_limit=app.config['UNMERGED_COMMITS_LIMIT'],
+        cache=cache,
+        branches_slice=branches_slice
+    )
+
+
+# Names of configuration values that affect snapshots.
+_SNAPSHOT_CONFIG_NAMES = [
+    'GIT_REPO_PATH',
+    'GIT_REMOTE',
+    'GIT_MASTER_BRANCH',
+    'GIT_BRANCHES_TO_IGNORE',
+    'SORT_BRANCHES_BY',
+    'UNMERGED_COMMITS_LIMIT'
+]
+
+
+# Indexers that have already been created, keyed by the configuration they
+# were created from. Only the indexer for the current configuration is
+# running.
+_indexers = {}
+_indexers_lock = threading.Lock()
+# The process in which the indexers have been created.
+_indexers_pid = None
+
+
+def get_indexer():
+    """Returns the background indexer for the configuration.
+
+    The indexer is created and started only once (in each process) and then
+    reused for all requests.
+    """
+    global _indexers_pid
+    repo = get_repo()
+    key = (
+        id(repo),
+        app.config['GIT_REMOTE'],
+        app.config['GIT_MASTER_BRANCH'],
+        tuple(app.config['GIT_BRANCHES_TO_IGNORE']),
+        app.config['SORT_BRANCHES_BY'],
+        app.config['UNMERGED_COMMITS_LIMIT'],
+        app.config['BACKGROUND_INDEXER_INTERVAL'],
+        is_snapshot_shared()
+    )
+    with _indexers_lock:
+        # Threads do not survive a fork, so indexers created before it (e.g.
+        # when a web server forks its workers after loading the application)
+        # do not run in the child process, which thus creates its own ones.
+        if _indexers_pid != os.getpid():
+            _indexers.clear()
+            _indexers_pid = os.getpid()
+        if key not in _indexers:
+            for old_indexer in _indexers.values():
+                old_indexer.stop()
+            _indexers.clear()
+            remote = app.config['GIT_REMOTE']
+            shared_snapshot = None
+            if is_snapshot_shared():
+                shared_snapshot = get_shared_snapshot()
+
+            def get_fingerprint():
+                return repo.get_fingerprint(remote)
+
+            def take_indexer_snapshot():
+                # The first snapshot is taken in the thread of a request, but
+                # snapshots of the indexer are kept (and possibly shared by
+                # all processes), so they are never limited by the deadline
+                # of a request.
+                with git.deadline(None):
+                    if shared_snapshot is None:
+                        return take_snapshot(repo)
+                    return shared_snapshot.get_or_take_snapshot(
+                        lambda: take_snapshot(repo),
+                        get_fingerprint
+                    )
+            _indexers[key] = Indexer(
+                take_snapshot=take_indexer_snapshot,
+                get_fingerprint=get_fingerprint,
+                interval=app.config['BACKGROUND_INDEXER_INTERVAL']
+            )
+            _indexers[key].start()
+        return _indexers[key]
+
+
+# Shared snapshots that have already been created, keyed by the directory
+# and name of their files.
+_shared_snapshots = {}
+_shared_snapshots_lock = threading.Lock()
+
+
+def is_snapshot_shared():
+    """Is the snapshot of the background indexer shared by all processes of
+    the web server?
+
+    Sharing is enabled by ``SHARED_SNAPSHOT``, but it is turned off on
+    platforms where it is not supported (see
+    :func:`viewer.sharedsnapshot.is_supported`).
+    """
+    return app.config['SHARED_SNAPSHOT'] and sharedsnapshot.is_supported()
+
+
+def get_shared_snapshot():
+    """Returns the snapshot shared by all processes of the web server for the
+    configuration (see ``SHARED_SNAPSHOT``).
+
+    The files of the snapshot are in the data directory of the repository
+    (see :attr:`viewer.git.Repo.data_dir`). Their name is derived from the
+    configuration, so processes with different configurations do not share
+    the snapshot.
+    """
+    repo = get_repo()
+    name = 'snapshot-' + hashlib.sha1(repr(tuple(
+        app.config[config_name] for config_name in _SNAPSHOT_CONFIG_NAMES
+        if config_name != 'GIT_REPO_PATH'
+    )).encode()).hexdigest()[:16]
+    key = (repo.data_dir, name)
+    with _shared_snapshots_lock:
+        if key not in _shared_snapshots:
+            _shared_snapshots[key] = SharedSnapshot(repo.data_dir, name)
+        return _shared_snapshots[key]
+
+
+#: Snapshots that are being taken, so concurrent requests for the same data
+#: share a single snapshot instead of running the same Git commands.
+snapshot_flights = SingleFlight()
+
+
+def get_snapshot(branches_slice=None):
+    """Returns a snapshot of branches to be shown.
+
+    When the background indexer is enabled, the latest snapshot from the
+    indexer is returned. Otherwise, a new snapshot is taken, unless the same
+    snapshot (for the same fingerprint of the repository and the same
+    configuration) is already being taken for another request, in which case
+    that snapshot is returned once it is taken.
+
+    :param slice branches_slice: If not `None`, only the shown branches in
+                                 this slice are in the snapshot.
+    """
+    if app.config['BACKGROUND_INDEXER']:
+        snapshot = get_indexer().get_snapshot()
+        if branches_slice is not None:
+            snapshot = snapshot.slice_shown_branches(branches_slice)
+        return snapshot
+    key = (
+        g.repo.get_fingerprint(app.config['GIT_REMOTE']),
+        tuple(repr(app.config[name]) for name in _SNAPSHOT_CONFIG_NAMES),
+        (branches_slice.start, branches_slice.stop)
+        if branches_slice is not None else None
+    )
+    # A request waits for a snapshot taken for another request only until its
+    # own deadline. An incomplete snapshot (or running out of time) of
+    # another request says nothing about this request, which may have more
+    # time, so such a snapshot is taken again.
+    return snapshot_flights.do(
+        key,
+        lambda: take_snapshot(g.repo, g.git_cache, branches_slice),
+        deadline=g.deadline,
+        is_shareable=lambda snapshot: snapshot.is_complete,
+        unshared_exceptions=(git.GitDeadlineExceededError,)
+    )
+
+
+def list_branches():
+    """Lists branches according to the configuration.
+
+    :returns: A tuple ``(shown_branches, ignored_branches, master_branch)``
+              (see :func:`viewer.snapshot.list_branches`).
+    """
+    return snapshot.list_branches(
+        g.repo,
+        remote=app.config['GIT_REMOTE'],
+        master_branch_name=app.config['GIT_MASTER_BRANCH'],
+        is_ignored=is_ignored,
+        sort_branches_by=app.config['SORT_BRANCHES_BY'],
+        cache=g.git_cache
+    )
+
+
+# Names of configuration values that affect the rendered index page.
+_PAGE_CONFIG_NAMES = [
+    'GIT_REPO_PATH',
+    'GIT_REMOTE',
+    'GIT_MASTER_BRANCH',
+    'GIT_BRANCHES_TO_IGNORE',
+    'SORT_BRANCHES_BY',
+    'COMMIT_DETAILS_URL_FMT',
+    'UNMERGED_COMMITS_LIMIT',
+    'COMMIT_SUBJECT_LIMIT',
+    'BACKGROUND_INDEXER',
+    'LAZY_BRANCH_DETAILS'
+]
+
+#: Rendered index pages, keyed by their versions (see get_page_cache_key()).
+page_cache = LRUCache(maxsize=16)
+
+
+def get_int_arg(name, default=None):
+    """Returns the value of the given non-negative integer parameter of the
+    current request, or `default` when the parameter is not given.
+
+    :raises ValueError: If the value is not a non-negative integer.
+    """
+    if name not in request.args:
+        return default
+    value = request.args[name]
+    if re.fullmatch('[0-9]+', value) is None:
+        raise ValueError('{} has to be an integer'.format(name))
+    return int(value)
+
+
+def get_requested_page():
+    """Returns a tuple ``(page, per_page)`` with the page of branches
+    requested by the ``page`` and ``per_page`` parameters of the current
+    request.
+
+    `per_page` is ``BRANCHES_PER_PAGE`` by default. When it is `None`, all
+    branches are on the first page. A requested `per_page` is at most
+    ``MAX_BRANCHES_PER_PAGE``, so a single request cannot make the viewer
+    obtain data about all branches. Invalid values result in 400.
+    """
+    try:
+        page = get_int_arg('page', 1)
+        per_page = get_int_arg('per_page', app.config['BRANCHES_PER_PAGE'])
+    except ValueError:
+        abort(400)
+    if page < 1 or (per_page is not None and per_page < 1):
+        abort(400)
+    if 'per_page' in request.args:
+        per_page = min(per_page, app.config['MAX_BRANCHES_PER_PAGE'])
+    return page, per_page
+
+
+def get_branches_slice(page, per_page):
+    """Returns a slice of shown branches that are on the given page, or
+    `None` when branches are not paginated.
+    """
+    if per_page is None:
+        return None
+    return slice((page - 1) * per_page, page * per_page)
+
+
+def get_num_of_pages(num_of_branches, per_page):
+    """Returns the number of pages for the given number of branches."""
+    if per_page is None or num_of_branches == 0:
+        return 1
+    return (num_of_branches + per_page - 1) // per_page
+
+
+def is_page_from_indexer_snapshot():
+    """Is the index page rendered from a snapshot of the background
+    indexer?
+    """
+    return (app.config['BACKGROUND_INDEXER'] and
+            not app.config['LAZY_BRANCH_DETAILS'])
+
+
+def get_page_version(page=1, per_page=None, snapshot=None):
+    """Returns a tuple identifying the version of the given page of the index
+    page.
+
+    :param Snapshot snapshot: A snapshot from which the page is rendered. If
+                              `None`, the page is identified by the current
+                              state of the repository.
+
+    The version consists of the fingerprint of the repository, the
+    configuration, and the page. No Git command is run.
+
+    When the page is rendered from a snapshot (the given one or a snapshot of
+    the background indexer), the fingerprint is the one from which the
+    snapshot was taken, so a page with data from a different state of the
+    repository is never identified by the current fingerprint.
+    """
+    if snapshot is None and is_page_from_indexer_snapshot():
+        snapshot = get_indexer().get_snapshot()
+    if snapshot is not None:
+        fingerprint = snapshot.fingerprint
+    else:
+        fingerprint = g.repo.get_fingerprint(app.config['GIT_REMOTE'])
+    return (
+        fingerprint,
+        tuple(repr(app.config[name]) for name in _PAGE_CONFIG_NAMES),
+        (page, per_page)
+    )
+
+
+def get_config_files_mtime():
+    """Returns the time (a timestamp) when the files with the configuration
+    were last modified, or 0 when there are no such files.
+    """
+    mtimes = [0]
+    for name in ('default.cfg', 'local.cfg'):
+        try:
+            mtimes.append(os.path.getmtime(
+                os.path.join(app.root_path, 'settings', name)
+            ))
+        except FileNotFoundError:
+            pass
+    return max(mtimes)
+
+
+# The configuration is loaded when the application starts, so a change of the
+# configuration that affects pages is never newer than its files.
+_config_files_mtime = get_config_files_mtime()
+
+
+def get_last_modified_date(snapshot=None):
+    """Returns the date when the index page was last modified (in UTC), or
+    `None` when it is not known.
+
+    It is the later of the dates when the repository was last updated and
+    when the configuration was last changed. When the page is rendered from a
+    snapshot, the date of the snapshot is used, as in
+    :func:`get_page_version`.
+    """
+    if snapshot is None and is_page_from_indexer_snapshot():
+        snapshot = get_indexer().get_snapshot()
+    try:
+        if snapshot is not None:
+            date = snapshot.last_update_date
+        else:
+            date = g.repo.get_date_of_last_update()
+    except FileNotFoundError:
+        return None
+    return datetime.datetime.fromtimestamp(
+        int(max(date.timestamp(), _config_files_mtime)),
+        datetime.timezone.utc
+    )
+
+
+def is_not_modified(etag, last_modified_date):
+    """Checks if the client already has the current version of the page
+    according to the conditional headers in the request.
+    """
+    # When both headers are present, If-None-Match takes precedence (RFC
+    # 7232, section 6).
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since and last_modified_date is not None:
+        if_modified_since = calendar.timegm(
+            request.if_modified_since.utctimetuple()
+        )
+        return last_modified_date.timestamp() <= if_modified_since
+    return False
+
+
 @app.route('/')
 def index():
-    all_branches = g.repo.get_branches_on_remote(app.config['GIT_REMOTE'])
-    ignored_branches = [branch for branch in all_branches
-                        if is_ignored(branch.name)]
-    shown_branches = [branch for branch in all_branches
-                      if branch not in ignored_branches]
-    git.sort_branches(shown_branches, app.config['SORT_BRANCHES_BY'])
-    context = {
-        'repo_name': g.repo.name,
-        'repo_last_update_date': g.repo.get_date_of_last_update(),
-        'remote': app.config['GIT_REMOTE'],
-        'master_branch': git.Branch(
-            g.repo,
-            app.config['GIT_REMOTE'],
-            app.config['GIT_MASTER_BRANCH']
+    # Whether the client has the current version of the page is decided
+    # before any branch is loaded, so answering with 304 runs no Git command.
+    page_num, per_page = get_requested_page()
+    version = get_page_version(page_num, per_page)
+    etag = get_page_etag(version)
+    last_modified_date = get_last_modified_date()
+    is_complete = True
+    if is_not_modified(etag, last_modified_date):
+        response = Response(status=304)
+    else:
+        page = get_cached_page(version)
+        if page is not None:
+            response = make_response(page)
+        elif (app.config['STREAM_INDEX_PAGE'] and
+                not app.config['LAZY_BRANCH_DETAILS']):
+            snapshot = get_streamed_snapshot(
+                get_branches_slice(page_num, per_page)
+            )
+            # The branches are listed here, so the snapshot already has its
+            # fingerprint.
+            abort_if_page_does_not_exist(snapshot, page_num, per_page)
+            version, etag, last_modified_date = get_page_validators(
+                page_num, per_page, snapshot
+            )
+            response = Response(
+                stream_with_context(
+                    stream_index_page(snapshot, version, page_num, per_page)
+                )
+            )
+            # It is not known whether the page will be complete until it has
+            # been sent.
+            is_complete = g.deadline is None
+        else:
+            snapshot = get_index_page_snapshot(page_num, per_page)
+            version, etag, last_modified_date = get_page_validators(
+                page_num, per_page, snapshot
+            )
+            page, is_complete = render_index_page(page_num, per_page, snapshot)
+            if is_complete:
+                cache_page(version, page)
+            response = make_response(page)
+    set_page_validators(response, etag, last_modified_date, is_complete)
+    return response
+
+
+def get_page_validators(page, per_page, snapshot):
+    """Returns a tuple ``(version, etag, last_modified_date)`` of the given
+    page of the index page rendered from the given snapshot.
+
+    The repository may have changed since the validators of the current state
+    of the repository were checked, so a rendered page is cached and
+    identified by the state from which its snapshot was taken.
+    """
+    version = get_page_version(page, per_page, snapshot)
+    return version, get_page_etag(version), get_last_modified_date(snapshot)
+
+
+def get_page_etag(version):
+    """Returns an ETag of a page with the given version (see
+    :func:`get_page_version`).
+    """
+    return hashlib.sha1(repr(version).encode()).hexdigest()
+
+
+def get_page_cache_key(version):
+    """Returns a key of a page with the given version in the page cache.
+
+    Apart from the version, the key contains the number of the current period
+    of ``PAGE_CACHE_TTL`` seconds, so ages of branches on a cached page are
+    outdated by at most that many seconds. The ETag of the page (see
+    :func:`get_page_etag`) does not depend on time.
+    """
+    return version + (int(time.time() // app.config['PAGE_CACHE_TTL']),)
+
+
+def get_cached_page(version):
+    """Returns the rendered page with the given version from the page cache,
+    or `None` when it is not there (or when the cache is disabled).
+    """
+    if not app.config['PAGE_CACHE_TTL']:
+        return None
+    return page_cache.get(get_page_cache_key(version))
+
+
+def cache_page(version, page):
+    """Puts the given rendered page with the given version into the page
+    cache (when it is enabled).
+    """
+    if app.config['PAGE_CACHE_TTL']:
+        page_cache.put(get_page_cache_key(version), page)
+
+
+def set_page_validators(response, etag, last_modified_date, is_complete):
+    """Sets headers that allow clients to revalidate the given response with
+    a page, or forbids reusing it when the page is not complete.
+    """
+    if is_complete:
+        # Ages of branches on the page change over time, so the page is not
+        # byte-for-byte the same for the same ETag.
+        response.set_etag(etag, weak=True)
+        if last_modified_date is not None:
+            response.last_modified = last_modified_date
+        response.cache_control.no_cache = True
+    else:
+        # A page without data that could not be obtained before the deadline
+        # must not be reused.
+        response.cache_control.no_store = True
+
+
+def abort_if_page_does_not_exist(snapshot, page, per_page):
+    """Aborts the current request with 404 when the given page is after the
+    last page of shown branches in the given snapshot.
+    """
+    if page > get_num_of_pages(snapshot.num_of_shown_branches, per_page):
+        abort(404)
+
+
+def get_index_page_context(snapshot, page=1, per_page=None):
+    """Returns a context for rendering the given page of the index page from
+    the given snapshot (:class:`viewer.snapshot.Snapshot` or
+    :class:`viewer.snapshot.StreamedSnapshot`).
+    """
+    return {
+        'repo_name': snapshot.repo_name,
+        'repo_last_update_date': snapshot.last_update_date,
+        'snapshot_age': (
+            snapshot.age
+            if app.config['BACKGROUND_INDEXER'] and
+            not app.config['LAZY_BRANCH_DETAILS'] else None
         ),
-        'shown_branches': shown_branches,
-        'ignored_branches': ignored_branches,
+        'remote': snapshot.remote,
+        'master_branch': snapshot.master_branch,
+        'shown_branches': snapshot.shown_branches,
+        'unmerged_commit_counts': snapshot.unmerged_commit_counts,
+        'ignored_branches': snapshot.ignored_branches,
         'commit_details_url_fmt': app.config['COMMIT_DETAILS_URL_FMT'],
         'unmerged_commits_limit': app.config['UNMERGED_COMMITS_LIMIT'],
-        'commit_subject_limit': app.config['COMMIT_SUBJECT_LIMIT']
+        'commit_subject_limit': app.config['COMMIT_SUBJECT_LIMIT'],
+        'lazy_branch_details': app.config['LAZY_BRANCH_DETAILS'],
+        'page': page,
+        'per_page': per_page,
+        'num_of_pages': get_num_of_pages(
+            snapshot.num_of_shown_branches,
+            per_page
+        ),
+        'num_of_shown_branches': snapshot.num_of_shown_branches
+    }
+
+
+def take_lazy_snapshot(branches_slice=None):
+    """Takes a snapshot of branches that contains only data from the listing
+    of branches (names and commits), without numbers of unmerged commits.
+
+    :param slice branches_slice: If not `None`, only the shown branches in
+                                 this slice are in the snapshot.
+    """
+    # The fingerprint is obtained before the branches are listed (see
+    # viewer.snapshot.take_snapshot()).
+    fingerprint = g.repo.get_fingerprint(app.config['GIT_REMOTE'])
+    shown_branches, ignored_branches, master_branch = list_branches()
+    num_of_shown_branches = len(shown_branches)
+    if branches_slice is not None:
+        shown_branches = shown_branches[branches_slice]
+    return snapshot.Snapshot(
+        repo_name=g.repo.name,
+        remote=app.config['GIT_REMOTE'],
+        last_update_date=g.repo.get_date_of_last_update(),
+        master_branch=master_branch,
+        shown_branches=shown_branches,
+        ignored_branches=ignored_branches,
+        unmerged_commit_counts={},
+        fingerprint=fingerprint,
+        num_of_shown_branches=num_of_shown_branches
+    )
+
+
+def get_index_page_snapshot(page=1, per_page=None):
+    """Returns a snapshot with the branches on the given page of the index
+    page.
+
+    Only data about branches on the page are obtained (unless the background
+    indexer is enabled, in which case they are already in its snapshot). When
+    details of branches are loaded lazily (see ``LAZY_BRANCH_DETAILS``), only
+    the listing of branches is needed.
+    """
+    branches_slice = get_branches_slice(page, per_page)
+    if app.config['LAZY_BRANCH_DETAILS']:
+        return take_lazy_snapshot(branches_slice)
+    return get_snapshot(branches_slice)
+
+
+def render_index_page(page=1, per_page=None, snapshot=None):
+    """Renders the given page of the index page from a snapshot of branches.
+
+    :param Snapshot snapshot: A snapshot with the branches on the page. If
+                              `None`, it is obtained here.
+
+    :returns: A tuple ``(page, is_complete)``, where `is_complete` is `False`
+              when data about some branches could not be obtained before the
+              deadline (see ``REQUEST_DEADLINE``).
+
+    When no snapshot is given, it is obtained by
+    :func:`get_index_page_snapshot`.
+    """
+    if snapshot is None:
+        snapshot = get_index_page_snapshot(page, per_page)
+    abort_if_page_does_not_exist(snapshot, page, per_page)
+    page = render_template(
+        'index.html',
+        **get_index_page_context(snapshot, page, per_page)
+    )
+    return page, app.config['LAZY_BRANCH_DETAILS'] or snapshot.is_complete
+
+
+@app.route('/branch/<path:name>')
+def branch_details(name):
+    """Returns an HTML fragment with details about the branch with the given
+    name (its unmerged commits).
+
+    It is loaded by the index page when ``LAZY_BRANCH_DETAILS`` is enabled.
+    """
+    # The name is a part of paths to files with references, so only names of
+    # existing branches on the remote are accepted.
+    remote = app.config['GIT_REMOTE']
+    if (not is_valid_ref_name('refs/remotes/{}/{}'.format(remote, name)) or
+            name not in g.repo.refs.get_remote_branch_tips(remote)):
+        return 'No such branch.', 404
+    branch = git.Branch(g.repo, remote, name, cache=g.git_cache)
+    master_branch = git.Branch(
+        g.repo,
+        remote,
+        app.config['GIT_MASTER_BRANCH'],
+        cache=g.git_cache
+    )
+    counts = g.repo.get_unmerged_commit_counts(master_branch, [branch])
+    return render_template(
+        'branch.html',
+        branch=branch,
+        master_branch=master_branch,
+        num_of_unmerged_commits=counts[branch.full_name].ahead,
+        commit_details_url_fmt=app.config['COMMIT_DETAILS_URL_FMT'],
+        unmerged_commits_limit=app.config['UNMERGED_COMMITS_LIMIT'],
+        commit_subject_limit=app.config['COMMIT_SUBJECT_LIMIT']
+    )
+
+
+def get_streamed_snapshot(branches_slice=None):
+    """Returns a snapshot of branches for streaming the index page.
+
+    Without the background indexer, it is a
+    :class:`viewer.snapshot.StreamedSnapshot`, so no data about branches are
+    obtained until the page is being rendered.
+
+    :param slice branches_slice: If not `None`, only the shown branches in
+                                 this slice are in the snapshot.
+    """
+    if app.config['BACKGROUND_INDEXER']:
+        return get_snapshot(branches_slice)
+    return StreamedSnapshot(
+        g.repo,
+        remote=app.config['GIT_REMOTE'],
+        master_branch_name=app.config['GIT_MASTER_BRANCH'],
+        is_ignored=is_ignored,
+        sort_branches_by=app.config['SORT_BRANCHES_BY'],
+        unmerged_commits_limit=app.config['UNMERGED_COMMITS_LIMIT'],
+        cache=g.git_cache,
+        branches_slice=branches_slice
+    )
+
+
+def stream_index_page(snapshot, version, page=1, per_page=None):
+    """Yields parts of the given page of the index page for the given
+    snapshot as soon as they are rendered.
+
+    When the page cache is enabled, the whole page is stored in it under the
+    given version once it has been sent (unless data about some branches
+    could not be obtained before the deadline).
+
+    It has to be run in the request context (see
+    :func:`flask.stream_with_context`). The snapshot has to be obtained before
+    that because request teardown functions run before the first part is
+    rendered. For the same reason, the deadline of the request is set again.
+    """
+    with git.deadline(g.deadline):
+        context = get_index_page_context(snapshot, page, per_page)
+        app.update_template_context(context)
+        parts = []
+        template = app.jinja_env.get_template('index.html')
+        for part in template.generate(context):
+            if app.config['PAGE_CACHE_TTL']:
+                parts.append(part)
+            yield part
+    if snapshot.is_complete:
+        cache_page(version, ''.join(parts))
+
+
+#: Fields of branches that can be requested from the API (in the order in
+#: which they are returned by default).
+API_BRANCH_FIELDS = ['name', 'commit', 'age', 'ahead', 'unmerged_commits']
+
+
+class InvalidAPIRequestError(Exception):
+    """An error raised when an API request has invalid parameters."""
+
+
+@app.errorhandler(InvalidAPIRequestError)
+def handle_invalid_api_request(ex):
+    return jsonify(error=str(ex)), 400
+
+
+def get_api_branch_fields():
+    """Returns a list of branch fields requested by the ``fields``
+    parameter of the current API request (all fields by default).
+    """
+    if 'fields' not in request.args:
+        return list(API_BRANCH_FIELDS)
+    fields = [field for field in request.args['fields'].split(',') if field]
+    for field in fields:
+        if field not in API_BRANCH_FIELDS:
+            raise InvalidAPIRequestError('unknown field: {}'.format(field))
+    return fields
+
+
+def get_api_limit():
+    """Returns the number of branches requested by the ``limit`` parameter of
+    the current API request (``API_PAGE_SIZE`` by default).
+
+    The number is at most ``API_MAX_PAGE_SIZE``, so a single request cannot
+    make the viewer obtain data about all branches.
+    """
+    try:
+        limit = get_int_arg('limit', app.config['API_PAGE_SIZE'])
+    except ValueError:
+        limit = None
+    if limit is None or limit < 1:
+        raise InvalidAPIRequestError('limit has to be a positive integer')
+    return min(limit, app.config['API_MAX_PAGE_SIZE'])
+
+
+def get_branch_position(branch):
+    """Returns a tuple ``(value, name)`` giving the position of the given
+    branch among the shown branches in the API, where `value` is the value of
+    the attribute from ``SORT_BRANCHES_BY``.
+
+    Ages of branches change over time, so when branches are sorted by their
+    age, `value` is the negated timestamp of the commit of the branch (the
+    lower the age, the later the commit).
+    """
+    attr = app.config['SORT_BRANCHES_BY']
+    if attr == 'age':
+        value = -int(branch.commit.date.timestamp())
+    else:
+        value = getattr(branch, attr)
+    return value, branch.name
+
+
+def encode_cursor(branch):
+    """Returns a cursor pointing after the given branch.
+
+    The cursor contains the position of the branch (see
+    :func:`get_branch_position`), so it stays valid even when the branch is
+    removed or moved.
+    """
+    return base64.urlsafe_b64encode(
+        json.dumps(get_branch_position(branch)).encode()
+    ).decode()
+
+
+def decode_cursor(cursor, branches):
+    """Returns the index of the first of the given branches (sorted by their
+    positions) after the position to which the given cursor points.
+    """
+    try:
+        value, name = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if not isinstance(name, str):
+            raise ValueError('invalid name')
+        return bisect.bisect_right(
+            [get_branch_position(branch) for branch in branches],
+            (value, name)
+        )
+    except (ValueError, TypeError):
+        raise InvalidAPIRequestError('invalid cursor')
+
+
+def get_commit_data(commit):
+    """Returns a dictionary with data about the given commit (for JSON)."""
+    return {
+        'hash': commit.hash,
+        'author': commit.author,
+        'email': commit.email,
+        'date': commit.date.isoformat(),
+        'subject': commit.subject
+    }
+
+
+def get_branch_data(branch, fields, master_branch, counts):
+    """Returns a dictionary with the given fields of the given branch (for
+    JSON).
+
+    :param dict counts: Numbers of unmerged commits of the branch
+                        (:class:`viewer.git.CommitCounts`), or `None` when
+                        neither ``ahead`` nor ``unmerged_commits`` is
+                        requested.
+    """
+    data = {}
+    for field in fields:
+        if field == 'name':
+            data['name'] = branch.name
+        elif field == 'commit':
+            data['commit'] = get_commit_data(branch.commit)
+        elif field == 'age':
+            data['age'] = int(branch.age.total_seconds())
+        elif field == 'ahead':
+            data['ahead'] = counts.ahead
+        elif field == 'unmerged_commits':
+            unmerged_commits = []
+            if counts.ahead:
+                unmerged_commits = branch.unmerged_commits(
+                    master_branch,
+                    app.config['UNMERGED_COMMITS_LIMIT']
+                )
+            data['unmerged_commits'] = [
+                get_commit_data(commit) for commit in unmerged_commits
+            ]
+    return data
+
+
+@app.route('/api/branches')
+def api_branches():
+    """Returns data about the shown branches in JSON.
+
+    Parameters:
+
+    * ``fields``: A comma-separated list of fields of branches to be returned
+      (see :data:`API_BRANCH_FIELDS`).
+    * ``limit``: How many branches should be returned at most.
+    * ``cursor``: Return branches after the one to which the cursor points
+      (``next_cursor`` from the previous response).
+
+    Branches are listed by a single Git command, and the other data are
+    obtained only for the returned branches.
+    """
+    fields = get_api_branch_fields()
+    limit = get_api_limit()
+    shown_branches, _, master_branch = list_branches()
+    # Cursors point to positions of branches, so the order of branches has to
+    # be given only by their positions (branches with the same value of the
+    # sorting attribute are sorted by their names).
+    shown_branches.sort(key=get_branch_position)
+    start = 0
+    if 'cursor' in request.args:
+        start = decode_cursor(request.args['cursor'], shown_branches)
+    branches = shown_branches[start:start + limit]
+
+    counts = dict.fromkeys(branch.full_name for branch in branches)
+    if 'ahead' in fields or 'unmerged_commits' in fields:
+        counts = g.repo.get_unmerged_commit_counts(master_branch, branches)
+    return jsonify({
+        'remote': app.config['GIT_REMOTE'],
+        'master_branch': master_branch.name,
+        'total': len(shown_branches),
+        'branches': g.repo.map_branches(
+            lambda branch: get_branch_data(
+                branch, fields, master_branch, counts[branch.full_name]
+            ),
+            branches
+        ),
+        'next_cursor': (
+            encode_cursor(branches[-1])
+            if start + limit < len(shown_branches) else None
+        )
+    })
+
+
+@app.route('/metrics')
+def metrics():
+    metrics = {
+        'results_cache': git.results_cache.stats(),
+        'page_cache': page_cache.stats(),
+        'snapshot_flights': snapshot_flights.stats(),
+        'git_processes': git.git_processes.stats()
     }
-    return render_template('index.html', **context)
+    if g.repo.commit_store is not None:
+        metrics['commit_store'] = g.repo.commit_store.stats()
+    if app.config['BACKGROUND_INDEXER']:
+        metrics['indexer'] = get_indexer().stats()
+        if is_snapshot_shared():
+            metrics['shared_snapshot'] = get_shared_snapshot().stats()
+    return jsonify(metrics)